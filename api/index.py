@@ -11,4 +11,11 @@ backend_path = os.path.join(path, 'backend')
 if backend_path not in sys.path:
     sys.path.append(backend_path)
 
-from backend.server import app
+from backend.server import app, warm_up
+
+# Vercel does not run the ASGI lifespan hook: load the TLS context and open the
+# local stores during the cold start instead of on the first request. The HTTP
+# pool is built on the first request's event loop.
+# Set SERVERLESS_WARMUP=0 to skip (e.g. to measure the bare import).
+if os.environ.get('SERVERLESS_WARMUP', '1') != '0':
+    warm_up()
@@ -0,0 +1,266 @@
+"""
+Precomputed turnstile access decisions: PIN -> (member, allowed_until, reason).
+
+The BFF's validateAccess (bff/src/routes/access-adms.ts) resolves, on every
+swipe, the zk_user_mappings row, staff membership, the active enrollment and
+the latest payment: four or five queries per person. Here the same rules are
+evaluated once per school into a dict keyed by PIN, so a swipe is one dict
+lookup plus an expiry check against the swipe's date:
+
+  - no mapping                                -> unknown_user
+  - schools.owner_id or active staff member   -> granted, no end date
+  - no active enrollment                      -> no_enrollment
+  - enrollment expires_at before the swipe    -> enrollment_expired
+  - latest payment overdue                    -> payment_overdue
+  - otherwise                                 -> granted until expires_at
+
+Readers belong to a school and PINs are assigned per school, so every reader
+of a school shares its school's map.
+
+A school's map is built on first use (single-flight) and refreshed per member
+afterwards: when an enrollment or payment of some members changes, only
+their rows are read again and only their PINs are replaced. Payment changes
+come from the webhook batches; enrollments and PIN mappings are found by
+polling: at most every `poll_interval` seconds, the next lookup of a school
+asks `changes_fn` for the members whose mapping or enrollment rows were
+created or updated since the previous poll. A full rebuild after `ttl`
+bounds whatever neither reports (an enrollment whose status changes without
+touching updated_at, a deleted mapping).
+"""
+
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from ttl_cache import AsyncTTLCache
+
+logger = logging.getLogger(__name__)
+
+# snapshot_fn(school_id, user_ids, athlete_ids): the rows the rules need, for the
+# whole school (both None) or only for those members
+SnapshotFn = Callable[[str, Optional[List[str]], Optional[List[str]]], Awaitable[dict]]
+# members_fn(payment_ids) -> [{school_id, user_id, unregistered_athlete_id}]
+PaymentMembersFn = Callable[[List[str]], Awaitable[List[dict]]]
+# changes_fn(school_id, since) -> [{user_id, unregistered_athlete_id}] whose
+# mapping or enrollment rows were created or updated after `since`
+ChangesFn = Callable[[str, datetime], Awaitable[List[dict]]]
+
+STAFF_ROLES = ("owner", "admin", "school_admin", "coach", "staff")
+
+# (user_id, unregistered_athlete_id): one of the two is set
+Member = Tuple[Optional[str], Optional[str]]
+
+
+@dataclass(frozen=True)
+class AccessEntry:
+    user_id: Optional[str]
+    unregistered_athlete_id: Optional[str]
+    granted: bool
+    reason: Optional[str] = None
+    allowed_until: Optional[date] = None
+
+    @property
+    def member(self) -> Member:
+        return (self.user_id, self.unregistered_athlete_id)
+
+    def as_dict(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "unregistered_athlete_id": self.unregistered_athlete_id,
+            "granted": self.granted,
+            "reason": self.reason,
+            "allowed_until": self.allowed_until.isoformat() if self.allowed_until else None,
+        }
+
+
+UNKNOWN = AccessEntry(None, None, False, "unknown_user")
+
+
+def _member(row: dict) -> Member:
+    return (row.get("user_id"), None) if row.get("user_id") else (None, row.get("unregistered_athlete_id"))
+
+
+def _date(value) -> Optional[date]:
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def build_entries(snapshot: dict) -> Dict[int, AccessEntry]:
+    """PIN -> entry for every mapping in `snapshot`, by the rules in the module docstring."""
+    staff: Set[str] = set(snapshot.get("staff") or ())
+    if snapshot.get("owner_id"):
+        staff.add(snapshot["owner_id"])
+
+    # One active enrollment per member in practice; if there are several, the longest lasting counts
+    enrollments: Dict[Member, Optional[date]] = {}
+    for row in snapshot.get("enrollments") or ():
+        member, expires = _member(row), _date(row.get("expires_at"))
+        if member not in enrollments or (enrollments[member] is not None
+                                         and (expires is None or expires > enrollments[member])):
+            enrollments[member] = expires
+    overdue = {_member(row) for row in snapshot.get("payments") or () if row.get("status") == "overdue"}
+
+    entries: Dict[int, AccessEntry] = {}
+    for mapping in snapshot.get("mappings") or ():
+        if not (mapping.get("user_id") or mapping.get("unregistered_athlete_id")):
+            continue
+        user_id, athlete_id = member = _member(mapping)
+        if user_id and user_id in staff:
+            entry = AccessEntry(user_id, None, True)
+        elif member not in enrollments:
+            entry = AccessEntry(user_id, athlete_id, False, "no_enrollment")
+        elif member in overdue:
+            entry = AccessEntry(user_id, athlete_id, False, "payment_overdue", enrollments[member])
+        else:
+            entry = AccessEntry(user_id, athlete_id, True, None, enrollments[member])
+        entries[int(mapping["zk_pin"])] = entry
+    return entries
+
+
+class SchoolAccessIndex:
+    def __init__(self, school_id: str, entries: Dict[int, AccessEntry]):
+        self.school_id = school_id
+        self.entries = entries
+        self._pins: Dict[Member, Set[int]] = defaultdict(set)
+        for pin, entry in entries.items():
+            self._pins[entry.member].add(pin)
+        self.built_at = time.time()
+        # Last time changes_fn was asked about this school
+        self.checked_at = self.built_at
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def decide(self, pin: Optional[int], today: date) -> AccessEntry:
+        entry = self.entries.get(pin) if pin is not None else None
+        if entry is None:
+            return UNKNOWN
+        # Checked at swipe time, so the map does not need rebuilding at midnight; like the
+        # BFF, an expired enrollment is reported before an overdue payment
+        if entry.reason in (None, "payment_overdue") and entry.allowed_until is not None \
+                and entry.allowed_until < today:
+            return AccessEntry(entry.user_id, entry.unregistered_athlete_id, False, "enrollment_expired",
+                               entry.allowed_until)
+        return entry
+
+    def replace(self, members: Iterable[Member], entries: Dict[int, AccessEntry]) -> None:
+        """Swap the PINs of `members` for `entries` (their freshly built rows)."""
+        for member in members:
+            for pin in self._pins.pop(member, ()):
+                if self.entries.get(pin, UNKNOWN).member == member:
+                    del self.entries[pin]
+        for pin, entry in entries.items():
+            previous = self.entries.get(pin)
+            if previous is not None:
+                self._pins[previous.member].discard(pin)
+            self.entries[pin] = entry
+            self._pins[entry.member].add(pin)
+
+
+class AccessIndex:
+    """School indexes behind an AsyncTTLCache, plus the per-member refresh."""
+
+    # Rows are stamped by the database clock when their transaction starts, so
+    # each poll looks back this much further than the previous one
+    POLL_OVERLAP = 60.0
+
+    def __init__(self, snapshot_fn: SnapshotFn, payment_members_fn: Optional[PaymentMembersFn] = None,
+                 maxsize: int = 256, ttl: float = 300.0, changes_fn: Optional[ChangesFn] = None,
+                 poll_interval: float = 30.0):
+        self._snapshot = snapshot_fn
+        self._payment_members = payment_members_fn
+        self._changes = changes_fn
+        self.poll_interval = poll_interval
+        self.cache = AsyncTTLCache(maxsize=maxsize, ttl=ttl, negative_ttl=ttl)
+        self.builds = 0
+        self.polls = 0
+        self.poll_errors = 0
+        self.member_refreshes = 0
+        self.decisions = 0
+        self.denied = 0
+
+    async def _build(self, school_id: str) -> SchoolAccessIndex:
+        index = SchoolAccessIndex(school_id, build_entries(await self._snapshot(school_id, None, None)))
+        self.builds += 1
+        logger.info(f"Access index for school {school_id} built with {len(index)} PIN(s)")
+        return index
+
+    async def school(self, school_id: str) -> SchoolAccessIndex:
+        index = await self.cache.get_or_load(school_id, lambda: self._build(school_id))
+        if self._changes is not None and time.time() - index.checked_at >= self.poll_interval:
+            await self._poll(index)
+        return index
+
+    async def _poll(self, index: SchoolAccessIndex) -> None:
+        # Claimed before the query so concurrent lookups do not poll too
+        since, index.checked_at = index.checked_at - self.POLL_OVERLAP, time.time()
+        try:
+            rows = await self._changes(index.school_id, datetime.fromtimestamp(since, timezone.utc))
+            users = sorted({row["user_id"] for row in rows if row.get("user_id")})
+            athletes = sorted({row["unregistered_athlete_id"] for row in rows
+                               if not row.get("user_id") and row.get("unregistered_athlete_id")})
+            await self.members_changed(index.school_id, users, athletes)
+        except Exception as e:
+            # The swipe goes on with the map it has; the TTL rebuild still bounds it
+            self.poll_errors += 1
+            logger.warning(f"Access changes poll for school {index.school_id} failed: {e}")
+            return
+        self.polls += 1
+
+    def decide(self, index: SchoolAccessIndex, pin: Optional[int], today: date) -> AccessEntry:
+        entry = index.decide(pin, today)
+        self.decisions += 1
+        if not entry.granted:
+            self.denied += 1
+        return entry
+
+    async def members_changed(self, school_id: str, user_ids: Sequence[str] = (),
+                              athlete_ids: Sequence[str] = ()) -> bool:
+        """
+        Re-read and replace the given members' PINs. Returns False when the
+        school has no index in memory (nothing to update; it is built fresh
+        on its next swipe).
+        """
+        if not (user_ids or athlete_ids):
+            return False
+        index = self.cache.peek(school_id, None)
+        if index is None:
+            # A build in flight may have read the old rows: do not let it be cached
+            self.cache.invalidate(school_id)
+            return False
+        snapshot = await self._snapshot(school_id, list(user_ids), list(athlete_ids))
+        members = [(u, None) for u in user_ids] + [(None, a) for a in athlete_ids]
+        index.replace(members, build_entries(snapshot))
+        self.member_refreshes += 1
+        return True
+
+    async def payments_changed(self, payment_ids: List[str]) -> int:
+        """Refresh the members behind these payments, in the schools that have an index."""
+        if self._payment_members is None or not payment_ids or len(self.cache) == 0:
+            return 0
+        by_school: Dict[str, Tuple[Set[str], Set[str]]] = defaultdict(lambda: (set(), set()))
+        for row in await self._payment_members(payment_ids):
+            if self.cache.peek(row.get("school_id"), None) is None:
+                continue
+            users, athletes = by_school[row["school_id"]]
+            if row.get("user_id"):
+                users.add(row["user_id"])
+            elif row.get("unregistered_athlete_id"):
+                athletes.add(row["unregistered_athlete_id"])
+        refreshed = 0
+        for school_id, (users, athletes) in by_school.items():
+            refreshed += await self.members_changed(school_id, sorted(users), sorted(athletes))
+        return refreshed
+
+    def invalidate(self, school_id: str) -> bool:
+        return self.cache.invalidate(school_id)
+
+    def stats(self) -> dict:
+        stats = self.cache.stats()
+        stats.update(builds=self.builds, polls=self.polls, poll_errors=self.poll_errors,
+                     member_refreshes=self.member_refreshes, decisions=self.decisions, denied=self.denied)
+        return stats
@@ -0,0 +1,363 @@
+"""
+ATTLOG ingestion for the ZKTeco turnstile readers (ADMS push protocol).
+
+A reader POSTs /iclock/cdata?SN=<serial>&table=ATTLOG with one record per
+line, tab separated:
+
+    <pin>\\t<YYYY-MM-DD HH:MM:SS>\\t<state>\\t<verify>\\t...
+
+and only advances its upload pointer when the reply acknowledges the
+records, so a slow reply is what turns into the bursts of 128 repeated
+events described in docs/ACCESS_CONTROL_ZKTECO_HANDOFF.md. Here the body is
+parsed line by line as it streams in, each record is checked against a
+sliding window of recently seen (device_id, zk_user_id, occurred_at) keys,
+and the survivors are queued for AccessEventWriter, which inserts them in
+the background as one multi-row INSERT ... ON CONFLICT DO NOTHING per batch
+(access_events_dedup_idx catches what the window missed). The reply goes out
+as soon as the body is read; no request waits for the database.
+
+Acknowledged records are never dropped by the process: a failed insert stays
+buffered and is retried with backoff. When the writer's buffer is full (a
+long database outage) the route answers 503 instead of the ACK, so the
+reader keeps its pointer and sends the records again after ErrorDelay.
+
+A buffer only lives as long as its process, and a serverless instance can be
+frozen or recycled right after replying. With `inline` (on by default under
+Vercel) the route awaits the insert before acknowledging, and answers 503
+when it fails or the writer is backing off; the reader then resends, and the
+unique index absorbs whatever the buffer writes as well.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime, tzinfo
+from typing import AsyncIterator, Awaitable, Callable, Deque, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# insert_fn(rows) inserts them all in one statement and returns how many were new
+InsertFn = Callable[[List[dict]], Awaitable[int]]
+
+# access_events.zk_user_id is an int4; a longer PIN would fail the whole batch
+_MAX_ZK_USER_ID = 2 ** 31 - 1
+
+# ZKTeco verify codes -> access_events.check_in_method (same map as the BFF)
+VERIFY_METHOD = {1: "fingerprint", 2: "card", 3: "pin", 4: "fingerprint", 15: "fingerprint"}
+
+
+@dataclass(frozen=True)
+class AttlogRecord:
+    pin: str
+    occurred_at: datetime
+    state: int
+    verify: int
+    line: str
+
+    @property
+    def zk_user_id(self) -> Optional[int]:
+        # access_events.zk_user_id is an integer; the BFF stores non-numeric (and 0) PINs as NULL
+        try:
+            pin = int(self.pin)
+        except ValueError:
+            return None
+        return pin if 0 < pin <= _MAX_ZK_USER_ID else None
+
+    @property
+    def check_in_method(self) -> str:
+        return VERIFY_METHOD.get(self.verify, "fingerprint")
+
+
+def _int(value: str, default: int) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def parse_attlog_line(line: str, zone: tzinfo) -> Optional[AttlogRecord]:
+    """One ATTLOG line -> record, or None when it has no PIN or no valid time."""
+    parts = line.strip().split("\t")
+    if len(parts) < 2 or not parts[0].strip():
+        return None
+    try:
+        occurred_at = datetime.strptime(parts[1].strip(), "%Y-%m-%d %H:%M:%S").replace(tzinfo=zone)
+    except ValueError:
+        return None
+    state = _int(parts[2].strip(), 0) if len(parts) > 2 else 0
+    verify = _int(parts[3].strip(), 1) if len(parts) > 3 else 1
+    return AttlogRecord(parts[0].strip(), occurred_at, state, verify or 1, line.strip())
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], max_line: int = 1024) -> AsyncIterator[str]:
+    """
+    Non-empty lines of a streamed body, without buffering more than one
+    partial line. A line longer than `max_line` bytes is cut there and the rest
+    of it skipped, so a body without newlines cannot grow the buffer.
+    """
+    pending = b""
+    # True while skipping the rest of a line that was already cut
+    overflow = False
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if overflow:
+                overflow = False
+                continue
+            line = line[:max_line].strip()
+            if line:
+                yield line.decode("utf-8", "replace")
+        if overflow:
+            pending = b""
+        elif len(pending) > max_line:
+            line, pending, overflow = pending[:max_line].strip(), b"", True
+            if line:
+                yield line.decode("utf-8", "replace")
+    pending = pending.strip()
+    if pending and not overflow:
+        yield pending.decode("utf-8", "replace")
+
+
+class SlidingWindowDedup:
+    """
+    Keys seen in the last `window` seconds (at most `max_keys`). A repeat
+    refreshes its key, so a reader that keeps resending the same backlog
+    keeps being filtered for as long as it does.
+    """
+
+    def __init__(self, window: float = 900.0, max_keys: int = 200_000, clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self.max_keys = max_keys
+        self._clock = clock
+        self._seen: "OrderedDict[Hashable, float]" = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def seen(self, key: Hashable) -> bool:
+        """True if `key` was seen within the window; records it either way."""
+        now = self._clock()
+        cutoff = now - self.window
+        while self._seen:
+            if next(iter(self._seen.values())) > cutoff:
+                break
+            self._seen.popitem(last=False)
+        hit = key in self._seen
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_keys:
+            self._seen.popitem(last=False)
+            self.evictions += 1
+        return hit
+
+    def forget(self, keys: List[Hashable]) -> None:
+        """Drop keys whose records were not accepted after all, so their resend gets through."""
+        for key in keys:
+            self._seen.pop(key, None)
+
+
+class AccessEventWriter:
+    """
+    Buffered access_events writer: the route queues rows, a background task
+    (started by the lifespan hook, or by the first upload) inserts them every
+    `interval` seconds or as soon as `max_batch` are waiting. A failed batch
+    goes back to the front and the task waits `interval * 2^n` (capped at
+    `max_delay`) before trying again; the rows are already acknowledged to
+    the reader, so they stay until they are written or the process stops.
+    With `inline` the route writes through (write_through) before it
+    acknowledges.
+    """
+
+    def __init__(self, insert_fn: InsertFn, interval: float = 0.5, max_batch: int = 500,
+                 max_buffer: int = 50_000, max_delay: float = 30.0, clock: Callable[[], float] = time.monotonic,
+                 inline: bool = False):
+        self.insert_fn = insert_fn
+        self.inline = inline
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_buffer = max_buffer
+        self.max_delay = max_delay
+        self._clock = clock
+        self._buffer: Deque[dict] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Serializes flushes, so a write-through never acknowledges rows another flush still holds
+        self._lock: Optional[asyncio.Lock] = None
+        # Consecutive failed flushes, and when the next one may run
+        self._failures = 0
+        self._retry_at = 0.0
+        self.queued = 0
+        self.inserted = 0
+        self.conflicts = 0
+        self.round_trips = 0
+        self.failed_flushes = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def room(self) -> int:
+        return self.max_buffer - len(self._buffer)
+
+    def submit(self, rows: List[dict]) -> bool:
+        """Queue all of `rows`, or none of them when they do not fit."""
+        if len(rows) > self.room():
+            return False
+        self._buffer.extend(rows)
+        self.queued += len(rows)
+        if len(self._buffer) >= self.max_batch and self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    async def flush(self) -> bool:
+        """
+        Insert everything buffered, one statement per `max_batch` rows. Stops at
+        the first failure, keeping the batch, and returns False.
+        """
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(self.max_batch, len(self._buffer)))]
+            self.round_trips += 1
+            try:
+                inserted = await self.insert_fn(batch)
+            except asyncio.CancelledError:
+                self._buffer.extendleft(reversed(batch))
+                raise
+            except Exception as e:
+                self._buffer.extendleft(reversed(batch))
+                self.failed_flushes += 1
+                self._failures += 1
+                delay = min(self.max_delay, self.interval * 2 ** self._failures)
+                self._retry_at = self._clock() + delay
+                logger.warning(f"access_events insert of {len(batch)} row(s) failed, "
+                               f"{len(self._buffer)} buffered, retrying in {delay:.1f}s: {e}")
+                return False
+            self._failures = 0
+            self.inserted += inserted
+            self.conflicts += len(batch) - inserted
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            # Not wait_for: before 3.12 it swallows a cancel that lands as the event
+            # fires, and stop() would then wait on this loop forever
+            waiter = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait({waiter}, timeout=max(self.interval, self._retry_at - self._clock()))
+            finally:
+                waiter.cancel()
+            self._wakeup.clear()
+            # A full batch does not cut a backoff short
+            if self._clock() >= self._retry_at:
+                async with self._lock:
+                    await self.flush()
+
+    async def write_through(self) -> bool:
+        """
+        Insert what is buffered now (the inline path); False when it is not
+        all written: the insert failed, or an earlier failure's backoff is
+        still running. Call after start().
+        """
+        async with self._lock:
+            if self._buffer and self._clock() < self._retry_at:
+                return False
+            return await self.flush()
+
+    async def start(self) -> None:
+        # A task left on a loop that has since gone away (one loop per invocation) never finishes
+        if self.running and self._task.get_loop() is asyncio.get_running_loop():
+            return
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flush task and write what is left (used on shutdown)."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._wakeup = None
+        if not await self.flush():
+            logger.error(f"Shutting down with {len(self._buffer)} acknowledged access event(s) not written")
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "buffered": len(self._buffer),
+            "queued": self.queued,
+            "inserted": self.inserted,
+            "conflicts": self.conflicts,
+            "round_trips": self.round_trips,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+class AttlogIngestor:
+    """Streams an ATTLOG body into the writer; `row_fn` turns a record into an access_events row."""
+
+    def __init__(self, writer: AccessEventWriter, dedup: SlidingWindowDedup, zone: tzinfo, chunk: int = 500):
+        self.writer = writer
+        self.dedup = dedup
+        self.zone = zone
+        self.chunk = chunk
+        self.requests = 0
+        self.records = 0
+        self.duplicates = 0
+        self.malformed = 0
+        self.rejected = 0
+
+    async def ingest(self, device: dict, lines: AsyncIterator[str],
+                     row_fn: Callable[[dict, AttlogRecord], dict]) -> Optional[int]:
+        """
+        Lines received, or None when the writer had no room (the reader must
+        resend). Rows are handed over in chunks while the body is still arriving.
+        """
+        self.requests += 1
+        received = 0
+        rows: List[dict] = []
+        keys: List[tuple] = []
+        async for line in lines:
+            received += 1
+            record = parse_attlog_line(line, self.zone)
+            if record is None:
+                self.malformed += 1
+                logger.warning(f"Malformed ATTLOG line from device {device['id']}: {line[:120]!r}")
+                continue
+            key = (device["id"], record.zk_user_id or record.pin, record.occurred_at)
+            if self.dedup.seen(key):
+                self.duplicates += 1
+                continue
+            rows.append(row_fn(device, record))
+            keys.append(key)
+            if len(rows) >= self.chunk:
+                if not self._submit(rows, keys):
+                    return None
+                rows, keys = [], []
+        if rows and not self._submit(rows, keys):
+            return None
+        self.records += received
+        return received
+
+    def _submit(self, rows: List[dict], keys: List[tuple]) -> bool:
+        if self.writer.submit(rows):
+            return True
+        self.dedup.forget(keys)
+        self.rejected += 1
+        return False
+
+    def stats(self) -> dict:
+        stats = {
+            "requests": self.requests,
+            "records": self.records,
+            "duplicates": self.duplicates,
+            "malformed": self.malformed,
+            "rejected": self.rejected,
+            "window_keys": len(self.dedup),
+            "window_evictions": self.dedup.evictions,
+        }
+        stats.update({f"writer_{key}": value for key, value in self.writer.stats().items()})
+        return stats
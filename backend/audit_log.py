@@ -0,0 +1,164 @@
+"""
+Buffered writer for the audit_log table
+(supabase/migrations/20261017213359_backend_audit_log.sql).
+
+Payment security events (blocked signature requests, webhook checksum
+mismatches) are recorded from the request path with a plain in-memory append;
+a background task flushes them every `interval`
+seconds, or as soon as `max_batch` rows are waiting, as one multi-row INSERT.
+No request ever waits for the database. The lifespan hook starts the task,
+and so do the routes that record (start() is idempotent), because serverless
+runtimes never run the lifespan; there the buffer is flushed by the task the
+first recording request started, and rows still buffered when the instance is
+frozen or recycled are lost.
+
+Memory is bounded by `max_buffer`: when the database is unreachable long
+enough for the buffer to fill, new rows are dropped (and counted) so a flood
+of bad requests cannot grow the process or push out the earliest evidence.
+A failed flush is put back at the front and retried on the next tick, up to
+`max_attempts` times per row. stop() flushes whatever is left.
+"""
+
+import asyncio
+import ipaddress
+import logging
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Deque, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# flush_fn(rows) inserts them all in one statement
+FlushFn = Callable[[List[dict]], Awaitable[None]]
+
+SIGNATURE_BLOCKED = "wompi_signature_blocked"
+CHECKSUM_MISMATCH = "wompi_checksum_mismatch"
+
+
+def _uuid_or_none(value: Optional[str]) -> Optional[str]:
+    # audit_log.school_id is a uuid column: a malformed id would fail the whole batch
+    try:
+        return str(uuid.UUID(str(value))) if value else None
+    except ValueError:
+        return None
+
+
+def _ip_or_none(value: Optional[str]) -> Optional[str]:
+    try:
+        return str(ipaddress.ip_address(value)) if value else None
+    except ValueError:
+        return None
+
+
+class AuditLogWriter:
+    def __init__(self, flush_fn: FlushFn, interval: float = 2.0, max_batch: int = 200, max_buffer: int = 10000,
+                 max_attempts: int = 3):
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_buffer = max_buffer
+        self.max_attempts = max_attempts
+        # (attempts so far, row)
+        self._buffer: Deque[Tuple[int, dict]] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.round_trips = 0
+        self.failed_flushes = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def record(self, action: str, entity_type: str = "payment", school_id: Optional[str] = None,
+               metadata: Optional[dict] = None, ip_address: Optional[str] = None,
+               user_agent: Optional[str] = None) -> None:
+        """Buffer one audit row; never blocks and never raises."""
+        metadata = dict(metadata or {})
+        if school_id and _uuid_or_none(school_id) is None:
+            metadata["school_id"] = school_id
+        row = {
+            "action": action,
+            "entity_type": entity_type,
+            "school_id": _uuid_or_none(school_id),
+            "metadata": metadata,
+            "ip_address": _ip_or_none(ip_address),
+            "user_agent": user_agent,
+            "created_at": datetime.now(timezone.utc),
+        }
+        self.recorded += 1
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.error(f"Audit log buffer full ({self.max_buffer}); {self.dropped} row(s) dropped so far")
+            return
+        self._buffer.append((0, row))
+        if len(self._buffer) >= self.max_batch and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        """Write everything buffered, one INSERT per `max_batch` rows; stops at the first failure."""
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(self.max_batch, len(self._buffer)))]
+            self.round_trips += 1
+            try:
+                await self.flush_fn([row for _, row in batch])
+            except asyncio.CancelledError:
+                # Shutdown interrupted the insert: stop() writes these again
+                self._buffer.extendleft(reversed(batch))
+                raise
+            except Exception as e:
+                self.failed_flushes += 1
+                retry = [(attempts + 1, row) for attempts, row in batch if attempts + 1 < self.max_attempts]
+                given_up = len(batch) - len(retry)
+                room = self.max_buffer - len(self._buffer)
+                if len(retry) > room:
+                    given_up += len(retry) - room
+                    retry = retry[:room]
+                self._buffer.extendleft(reversed(retry))
+                self.dropped += given_up
+                logger.warning(f"Audit log flush of {len(batch)} row(s) failed, {given_up} dropped: {e}")
+                return
+            self.written += len(batch)
+
+    async def _run(self) -> None:
+        while True:
+            # Not wait_for: before 3.12 it swallows a cancel that lands as the event
+            # fires, and stop() would then wait on this loop forever
+            waiter = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait({waiter}, timeout=self.interval)
+            finally:
+                waiter.cancel()
+            self._wakeup.clear()
+            await self.flush()
+
+    async def start(self) -> None:
+        # A task left on a loop that has since gone away (one loop per invocation) never finishes
+        if self.running and self._task.get_loop() is asyncio.get_running_loop():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flush task and write what is left (used on shutdown)."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._wakeup = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "buffered": len(self._buffer),
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped,
+            "round_trips": self.round_trips,
+            "failed_flushes": self.failed_flushes,
+        }
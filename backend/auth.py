@@ -0,0 +1,62 @@
+"""
+Bearer-token checks for the few backend endpoints called by signed-in users.
+
+Mirrors the BFF's requireAuth (bff/src/middlewares/authMiddleware.ts): the
+token is validated against Supabase Auth, platform admins pass via
+profiles.role, everyone else needs an active school_members row with a
+management role for the target school.
+"""
+
+import logging
+from typing import Optional
+
+from supabase_client import SupabaseHTTP
+
+logger = logging.getLogger(__name__)
+
+PLATFORM_ROLES = {"super_admin", "admin"}
+SCHOOL_MANAGER_ROLES = {"owner", "admin", "school_admin", "school"}
+
+
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+    return authorization.split(" ", 1)[1].strip() or None
+
+
+async def resolve_user(supabase: SupabaseHTTP, token: str) -> Optional[dict]:
+    """Validate a user access token with Supabase Auth; None if invalid/expired."""
+    resp = await supabase.client.get(
+        "/auth/v1/user",
+        headers={"Authorization": f"Bearer {token}"},
+        extensions=SupabaseHTTP.call_site("auth_user"),
+    )
+    if resp.status_code != 200:
+        return None
+    user = resp.json()
+    return user if user.get("id") else None
+
+
+async def can_manage_school(supabase: SupabaseHTTP, user_id: str, school_id: str) -> bool:
+    resp = await supabase.client.get(
+        "/rest/v1/profiles",
+        params={"id": f"eq.{user_id}", "select": "role"},
+        extensions=SupabaseHTTP.call_site("auth_profile"),
+    )
+    resp.raise_for_status()
+    rows = resp.json()
+    if rows and rows[0].get("role") in PLATFORM_ROLES:
+        return True
+
+    resp = await supabase.client.get(
+        "/rest/v1/school_members",
+        params={
+            "profile_id": f"eq.{user_id}",
+            "school_id": f"eq.{school_id}",
+            "status": "eq.active",
+            "select": "role",
+        },
+        extensions=SupabaseHTTP.call_site("auth_membership"),
+    )
+    resp.raise_for_status()
+    return any(row.get("role") in SCHOOL_MANAGER_ROLES for row in resp.json())
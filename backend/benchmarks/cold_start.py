@@ -0,0 +1,120 @@
+"""
+Cold-start profile of the Vercel entrypoint (api/index.py).
+
+Each run is a fresh interpreter doing `import api.index` (which also runs
+server.warm_up() unless --no-warmup). Reports the wall time of the import and,
+from `python -X importtime`, the modules with the largest cumulative import
+time.
+
+    python benchmarks/cold_start.py
+    python benchmarks/cold_start.py --runs 5 --top 15 --budget 1.5
+    python benchmarks/cold_start.py --no-warmup --json
+
+With --budget the script exits 1 when the median cold import exceeds it.
+test_cold_start.py runs the same measurement in the test suite.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(BENCH_DIR))
+
+# Enough for server.py to import; nothing is contacted during a cold start
+COLD_START_ENV = {
+    "SUPABASE_URL": "https://cold-start.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "cold-start-key",
+    "WOMPI_INTEGRITY_SECRET": "cold_start_integrity",
+    "WOMPI_EVENTS_KEY": "cold_start_events",
+    "LOG_LEVEL": "WARNING",
+}
+
+_PROBE = (
+    "import time; t = time.perf_counter(); import api.index; "
+    "print(time.perf_counter() - t)"
+)
+
+
+def _env(warmup: bool, var_dir: Optional[str]) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update(COLD_START_ENV)
+    env["SERVERLESS_WARMUP"] = "1" if warmup else "0"
+    env.pop("PYTHONPROFILEIMPORTTIME", None)
+    if var_dir:
+        env["BACKEND_VAR_DIR"] = var_dir
+    return env
+
+
+def measure_cold_import(warmup: bool = True, var_dir: Optional[str] = None,
+                        importtime: bool = False) -> dict:
+    """One fresh-interpreter import of api.index: wall seconds (+ -X importtime rows)."""
+    cmd = [sys.executable, "-X", "importtime", "-c", _PROBE] if importtime else [sys.executable, "-c", _PROBE]
+    proc = subprocess.run(cmd, cwd=REPO_ROOT, env=_env(warmup, var_dir), capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0:
+        raise RuntimeError(f"cold import of api.index failed:\n{proc.stderr[-2000:]}")
+    result = {"seconds": float(proc.stdout.strip().splitlines()[-1])}
+    if importtime:
+        result["modules"] = parse_importtime(proc.stderr)
+    return result
+
+
+def parse_importtime(stderr: str) -> List[dict]:
+    """Rows of `-X importtime` as {module, self_us, cumulative_us}."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+    return rows
+
+
+def summarize(modules: List[dict], top: int) -> List[dict]:
+    """Top-level packages (e.g. fastapi, httpx, server) by cumulative import time."""
+    packages: Dict[str, int] = {}
+    for row in modules:
+        package = row["module"].split(".")[0]
+        # A package's cumulative time already includes its submodules
+        if row["module"] == package or package not in packages:
+            packages[package] = max(packages.get(package, 0), row["cumulative_us"])
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{"package": name, "cumulative_ms": round(us / 1000, 2)} for name, us in ranked]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start profile of api/index.py")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=12)
+    parser.add_argument("--no-warmup", action="store_true", help="skip server.warm_up() (bare import)")
+    parser.add_argument("--budget", type=float, help="fail when the median cold import exceeds this (seconds)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    timings = [measure_cold_import(not args.no_warmup)["seconds"] for _ in range(args.runs)]
+    profile = measure_cold_import(not args.no_warmup, importtime=True)
+    report = {
+        "warmup": not args.no_warmup,
+        "runs": [round(t, 4) for t in timings],
+        "median_seconds": round(statistics.median(timings), 4),
+        "top_imports": summarize(profile["modules"], args.top),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"cold import of api.index (warm-up {'on' if report['warmup'] else 'off'}): "
+              f"median {report['median_seconds'] * 1000:.1f}ms over {args.runs} run(s)")
+        for row in report["top_imports"]:
+            print(f"  {row['cumulative_ms']:>9.2f}ms  {row['package']}")
+    if args.budget is not None and report["median_seconds"] > args.budget:
+        print(f"cold start {report['median_seconds']:.3f}s exceeds the {args.budget}s budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
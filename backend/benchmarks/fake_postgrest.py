@@ -0,0 +1,107 @@
+"""
+Local stand-in for Supabase PostgREST, for benchmarks and offline tests.
+
+Implements just the calls server.py makes:
+    GET   /rest/v1/schools?id=eq.<id>&select=payment_settings
+    GET   /rest/v1/payments?receipt_number=eq.<ref>&select=...
+    PATCH /rest/v1/payments?receipt_number=in.(...)  (Prefer: return=representation)
+
+Every request sleeps `latency` seconds (+/- `jitter`) before answering, to model
+the round trip to a real project.
+"""
+
+import asyncio
+import json
+import random
+from typing import Dict, List
+from urllib.parse import parse_qs
+
+
+def _parse_in(value: str) -> List[str]:
+    inner = value[len("in.("):-1]
+    refs, current, quoted, escaped = [], "", False, False
+    for ch in inner:
+        if escaped:
+            current += ch
+            escaped = False
+        elif ch == "\\":
+            escaped = True
+        elif ch == '"':
+            quoted = not quoted
+        elif ch == "," and not quoted:
+            refs.append(current)
+            current = ""
+        else:
+            current += ch
+    if inner:
+        refs.append(current)
+    return refs
+
+
+class FakePostgREST:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, allow_online: bool = True):
+        self.latency = latency
+        self.jitter = jitter
+        self.allow_online = allow_online
+        self.payments: Dict[str, dict] = {}
+        self.requests = 0
+
+    def add_payment(self, reference: str, amount: int = 150000, status: str = "pending") -> None:
+        self.payments[reference] = {
+            "id": f"pay-{reference}",
+            "status": status,
+            "amount": amount,
+            "payment_date": None,
+            "receipt_number": reference,
+        }
+
+    async def _respond(self, send, status: int, body) -> None:
+        payload = json.dumps(body).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        body = b""
+        more = True
+        while more:
+            message = await receive()
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+
+        self.requests += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        params = {k: v[0] for k, v in parse_qs(scope["query_string"].decode()).items()}
+        path, method = scope["path"], scope["method"]
+
+        if path == "/rest/v1/schools" and method == "GET":
+            return await self._respond(send, 200, [{"payment_settings": {"allow_online": self.allow_online}}])
+
+        if path == "/rest/v1/payments" and method == "GET":
+            row = self.payments.get(params.get("receipt_number", "")[3:])
+            return await self._respond(send, 200, [row] if row else [])
+
+        if path == "/rest/v1/payments" and method == "PATCH":
+            changes = json.loads(body or b"{}")
+            rows = []
+            for ref in _parse_in(params.get("receipt_number", "in.()")):
+                if ref in self.payments:
+                    self.payments[ref].update({k: v for k, v in changes.items() if k in self.payments[ref]})
+                    rows.append(self.payments[ref])
+            return await self._respond(send, 200, rows)
+
+        return await self._respond(send, 404, {"message": f"no fake for {method} {path}"})
@@ -0,0 +1,229 @@
+"""
+Load / latency benchmark for the payments API, fully offline.
+
+Starts a fake PostgREST (benchmarks/fake_postgrest.py) and the real ASGI app on
+loopback sockets, then drives create-signature, webhook and
+transaction/{reference} at a fixed concurrency and reports p50/p95/p99 latency
+and throughput per scenario.
+
+    python benchmarks/payments_load.py --requests 2000 --concurrency 50 --latency-ms 20 \\
+        --output bench.json
+    python benchmarks/payments_load.py --baseline benchmarks/baseline.json --max-regression 0.5
+
+With --baseline the run fails (exit 1) when a scenario has errors, or when its
+p95 or its number of upstream (PostgREST) calls grows more than
+--max-regression (fraction) over the baseline. p95 depends on the machine, so
+CI uses a generous fraction; the upstream call count does not, and catches a
+lost cache or batching regression outright.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+
+from fake_postgrest import FakePostgREST  # noqa: E402
+
+EVENTS_KEY = "bench_events_key"
+
+
+def _socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Inherited by accepted connections; without it Nagle + delayed ACK adds ~40ms
+    # to every response uvicorn writes in two chunks (start + body).
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+async def _serve(app, sock: socket.socket) -> Tuple[uvicorn.Server, "asyncio.Task"]:
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="on", access_log=False))
+    task = asyncio.get_running_loop().create_task(server.serve(sockets=[sock]))
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def signed_webhook(i: int) -> dict:
+    tx = {"id": f"bench-tx-{i}", "status": "APPROVED", "reference": f"BENCH-{i % 500:05d}", "amount_in_cents": 15000000}
+    timestamp = 1700000000 + i
+    raw = f"{tx['id']}{tx['status']}{tx['amount_in_cents']}{timestamp}{EVENTS_KEY}"
+    return {
+        "event": "transaction.updated",
+        "data": {"transaction": tx},
+        "timestamp": timestamp,
+        "signature": {
+            "properties": ["transaction.id", "transaction.status", "transaction.amount_in_cents"],
+            "checksum": hashlib.sha256(raw.encode()).hexdigest(),
+        },
+    }
+
+
+async def run_scenario(client: httpx.AsyncClient, total: int, concurrency: int,
+                       make_request: Callable[[int], "asyncio.Future"]) -> dict:
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    counter = iter(range(total))
+
+    async def worker():
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                response = await make_request(i)
+                statuses[str(response.status_code)] += 1
+            except httpx.HTTPError as exc:
+                statuses[type(exc).__name__] += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": sum(n for status, n in statuses.items() if not status.startswith(("2", "3"))),
+        "statuses": dict(statuses),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(latencies[-1], 3) if latencies else 0.0,
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+async def main_async(args) -> dict:
+    fake = FakePostgREST(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000)
+    for i in range(500):
+        fake.add_payment(f"BENCH-{i:05d}")
+    fake_sock = _socket()
+    fake_server, fake_task = await _serve(fake, fake_sock)
+
+    workdir = tempfile.mkdtemp(prefix="sportmaps-bench-")
+    os.environ.update({
+        "SUPABASE_URL": f"http://127.0.0.1:{fake_sock.getsockname()[1]}",
+        "SUPABASE_SERVICE_ROLE_KEY": "bench-service-key",
+        "WOMPI_INTEGRITY_SECRET": "bench_integrity_secret",
+        "WOMPI_EVENTS_KEY": EVENTS_KEY,
+        "WEBHOOK_SPOOL_PATH": os.path.join(workdir, "spool.db"),
+        "WEBHOOK_IDEMPOTENCY_PATH": os.path.join(workdir, "idempotency.db"),
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+        "SUPABASE_HTTP2": "0",  # the fake speaks HTTP/1.1 only
+        # Every simulated client is 127.0.0.1: the per-IP buckets would turn the run into 429s
+        "RATE_LIMITS": "off",
+    })
+    import server as backend  # noqa: E402 - must see the env above
+
+    app_sock = _socket()
+    app_server, app_task = await _serve(backend.app, app_sock)
+    base_url = f"http://127.0.0.1:{app_sock.getsockname()[1]}"
+
+    schools = [f"school-{i}" for i in range(args.schools)]
+    scenarios: Dict[str, Callable[[httpx.AsyncClient], Callable[[int], "asyncio.Future"]]] = {
+        "create_signature": lambda c: lambda i: c.post("/api/payments/wompi/create-signature", json={
+            "reference": f"SIG-{i}", "amount_in_cents": 15000000, "school_id": random.choice(schools)}),
+        "webhook": lambda c: lambda i: c.post("/api/payments/wompi/webhook", json=signed_webhook(i)),
+        "transaction": lambda c: lambda i: c.get(f"/api/payments/wompi/transaction/BENCH-{i % 500:05d}"),
+    }
+
+    results = {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        for name in args.scenarios:
+            upstream_before = fake.requests
+            results[name] = await run_scenario(client, args.requests, args.concurrency, scenarios[name](client))
+            results[name]["upstream_requests"] = fake.requests - upstream_before
+
+    # App first: its shutdown drains the webhook queue and payment batcher
+    # against the still-running fake.
+    app_server.should_exit = True
+    await app_task
+    fake_server.should_exit = True
+    await fake_task
+    return {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "schools": args.schools,
+            "python": platform.python_version(),
+        },
+        "scenarios": results,
+    }
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> List[str]:
+    failures = []
+    for name, result in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if result["errors"]:
+            failures.append(f"{name}: {result['errors']} error(s)")
+        if not base:
+            continue
+        limit = base["p95_ms"] * (1 + max_regression)
+        if result["p95_ms"] > limit:
+            failures.append(f"{name}: p95 {result['p95_ms']}ms > {limit:.2f}ms (baseline {base['p95_ms']}ms)")
+        # Machine-independent: a lost cache or batch shows up as extra upstream calls
+        upstream_limit = base.get("upstream_requests", 0) * (1 + max_regression) + 10
+        if result.get("upstream_requests", 0) > upstream_limit:
+            failures.append(f"{name}: {result['upstream_requests']} upstream requests > {upstream_limit:.0f} "
+                            f"(baseline {base.get('upstream_requests')})")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load benchmark for the payments API")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="fake PostgREST latency")
+    parser.add_argument("--jitter-ms", type=float, default=2.0)
+    parser.add_argument("--schools", type=int, default=20, help="distinct school_ids for create-signature")
+    parser.add_argument("--scenarios", nargs="+", default=["create_signature", "webhook", "transaction"],
+                        choices=["create_signature", "webhook", "transaction"])
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="compare against this JSON report")
+    parser.add_argument("--max-regression", type=float, default=0.5, help="allowed p95 growth vs baseline")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+            fh.write("\n")
+    if args.baseline:
+        with open(args.baseline) as fh:
+            failures = compare(report, json.load(fh), args.max_regression)
+        for failure in failures:
+            print(f"REGRESSION {failure}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Micro-benchmark: CPU cost per Wompi webhook event, parse + checksum.
+
+    python benchmarks/webhook_parsing.py [--events 50000]
+
+"legacy" is the code the webhook ran before the orjson fast path: stdlib
+json.loads, dotted paths split on every event, plain `!=` compare.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson  # noqa: E402
+
+from wompi_checksum import checksum_matches  # noqa: E402
+
+EVENTS_KEY = "bench_events_key"
+
+
+def make_event(i: int) -> bytes:
+    tx = {
+        "id": f"12345-{i}",
+        "status": "APPROVED",
+        "reference": f"SM-{i:06d}",
+        "amount_in_cents": 15000000,
+        "currency": "COP",
+        "payment_method_type": "CARD",
+        "customer_email": "parent@example.com",
+        "payment_method": {"type": "CARD", "extra": {"brand": "VISA", "last_four": "4242"}},
+    }
+    properties = ["transaction.id", "transaction.status", "transaction.amount_in_cents"]
+    timestamp = 1700000000 + i
+    raw = f"{tx['id']}{tx['status']}{tx['amount_in_cents']}{timestamp}{EVENTS_KEY}"
+    return json.dumps({
+        "event": "transaction.updated",
+        "data": {"transaction": tx},
+        "environment": "prod",
+        "signature": {"properties": properties, "checksum": hashlib.sha256(raw.encode()).hexdigest()},
+        "timestamp": timestamp,
+        "sent_at": "2026-10-01T05:00:00.000Z",
+    }).encode()
+
+
+def legacy(raw: bytes) -> bool:
+    body = json.loads(raw)
+    data = body.get('data', {})
+    signature_info = body.get('signature', {})
+    values = []
+    for prop in signature_info.get('properties', []):
+        value = data
+        for key in prop.split('.'):
+            if isinstance(value, dict):
+                value = value.get(key, '')
+            else:
+                value = ''
+                break
+        values.append(str(value))
+    values.append(str(body.get('timestamp', '')))
+    values.append(EVENTS_KEY)
+    return signature_info['checksum'] == hashlib.sha256(''.join(values).encode()).hexdigest()
+
+
+def fast(raw: bytes) -> bool:
+    return checksum_matches(orjson.loads(raw), EVENTS_KEY)
+
+
+def measure(fn, events) -> float:
+    start = time.process_time()
+    for raw in events:
+        if not fn(raw):
+            raise AssertionError("checksum mismatch in benchmark fixture")
+    return (time.process_time() - start) / len(events) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=50000)
+    args = parser.parse_args()
+
+    events = [make_event(i) for i in range(args.events)]
+    measure(fast, events[:1000])  # warm caches
+    before = measure(legacy, events)
+    after = measure(fast, events)
+    print(f"events: {args.events}")
+    print(f"legacy  json + split paths + !=      : {before:6.2f} us/event")
+    print(f"fast    orjson + compiled + hmac     : {after:6.2f} us/event")
+    print(f"speedup                              : {before / after:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
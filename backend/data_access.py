@@ -0,0 +1,703 @@
+"""
+Data access for the payment hot paths, with two interchangeable backends.
+
+    DATA_BACKEND=postgrest   (default) PostgREST over the shared SupabaseHTTP pool
+    DATA_BACKEND=asyncpg     straight to Postgres through an asyncpg pool
+                             (DATABASE_URL); no HTTP hop and no JSON on either
+                             side. asyncpg prepares each statement once per
+                             connection and reuses it from its statement cache.
+
+Both return the same JSON-shaped dicts (what PostgREST would have sent), so
+the caches, the SSE stream and the batcher do not care which one is active.
+
+asyncpg settings:
+    DATABASE_URL             postgres://... Use the direct connection (5432) or
+                             the session pooler: the transaction pooler (6543)
+                             cannot keep prepared statements.
+    DATABASE_POOL_MIN_SIZE   (default 1)
+    DATABASE_POOL_MAX_SIZE   (default 10)
+    DATABASE_STATEMENT_CACHE (default 100 statements per connection)
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Callable, List, Optional
+from zoneinfo import ZoneInfo
+
+import orjson
+
+from payment_batcher import postgrest_in
+from resilience import CircuitOpenError, DeadlineExceeded, Resilience, remaining_time
+from access_index import STAFF_ROLES
+from revenue_rollup import fold_revenue_rows
+from supabase_client import SupabaseHTTP
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_COLUMNS = "id,status,amount,payment_date,receipt_number"
+DEVICE_COLUMNS = "id,school_id,direction"
+ACCESS_EVENT_COLUMNS = ("school_id", "device_id", "user_id", "unregistered_athlete_id", "direction", "access_granted",
+                        "denial_reason", "check_in_method", "zk_user_id", "raw_event", "occurred_at")
+REVENUE_PAYMENT_COLUMNS = "id,amount,status,payment_method,payment_type,payment_date,created_at"
+FANOUT_COLUMNS = ("announcement_id", "status", "recipients", "delivered", "chunks", "started_at", "updated_at",
+                  "finished_at")
+
+
+class SettingsLookupError(Exception):
+    """The settings lookup failed upstream (non-200 / bad id); never cached."""
+
+
+class TransactionLookupError(Exception):
+    """The transaction lookup failed upstream (non-200); never cached."""
+
+
+class PaymentsLookupError(Exception):
+    """The bulk payments lookup failed upstream (non-200)."""
+
+
+class PaymentsUpdateError(Exception):
+    """The batched payments update was rejected; the webhook queue retries it."""
+
+
+class AuditInsertError(Exception):
+    """The audit_log insert was rejected; the audit writer retries the batch."""
+
+
+class DeviceLookupError(Exception):
+    """The turnstile_devices lookup failed upstream (non-200); never cached."""
+
+
+class AccessEventsInsertError(Exception):
+    """The access_events insert was rejected; the access event writer retries the batch."""
+
+
+class AccessSnapshotError(Exception):
+    """Reading the rows behind a school's access index failed upstream."""
+
+
+class AnnouncementFanoutError(Exception):
+    """A fan-out chunk or progress read failed upstream; the fan-out worker retries chunks."""
+
+
+class RevenueLookupError(Exception):
+    """Reading a school's payments for its revenue rollup failed upstream."""
+
+
+class PostgRESTStore:
+    """
+    PostgREST backend. Takes a getter for the shared client rather than the
+    client itself, so swapping server.supabase_http (tests) is picked up.
+    """
+
+    backend = "postgrest"
+
+    def __init__(self, http: Callable[[], SupabaseHTTP]):
+        self._http = http
+
+    @property
+    def configured(self) -> bool:
+        return self._http().configured
+
+    async def start(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+    async def payment_settings(self, school_id: str) -> Optional[dict]:
+        """payment_settings for a school; None when the school does not exist."""
+        resp = await self._http().client.get(
+            "/rest/v1/schools",
+            params={"id": f"eq.{school_id}", "select": "payment_settings"},
+            extensions=SupabaseHTTP.call_site("settings_lookup"),
+        )
+        if resp.status_code != 200:
+            raise SettingsLookupError(f"schools lookup returned {resp.status_code}")
+        data = orjson.loads(resp.content)
+        if not data:
+            return None
+        return data[0].get('payment_settings') or {}
+
+    async def transaction(self, reference: str) -> Optional[dict]:
+        response = await self._http().client.get(
+            "/rest/v1/payments",
+            params={
+                "receipt_number": f"eq.{reference}",
+                "select": TRANSACTION_COLUMNS,
+            },
+            extensions=SupabaseHTTP.call_site("transaction_lookup"),
+        )
+        if response.status_code != 200:
+            raise TransactionLookupError(f"payments lookup returned {response.status_code}")
+        data = orjson.loads(response.content)
+        return data[0] if data else None
+
+    async def payments_by_references(self, references: List[str], chunk_size: int = 200) -> List[dict]:
+        """Every payments row whose receipt_number is in `references`; one GET per chunk (URL length)."""
+
+        async def lookup(chunk: List[str]) -> List[dict]:
+            response = await self._http().client.get(
+                "/rest/v1/payments",
+                params={"receipt_number": postgrest_in(chunk), "select": TRANSACTION_COLUMNS},
+                extensions=SupabaseHTTP.call_site("payments_lookup"),
+            )
+            if response.status_code != 200:
+                raise PaymentsLookupError(f"payments lookup returned {response.status_code}")
+            return orjson.loads(response.content)
+
+        chunks = [references[i:i + chunk_size] for i in range(0, len(references), chunk_size)]
+        rows: List[dict] = []
+        for result in await asyncio.gather(*(lookup(chunk) for chunk in chunks)):
+            rows.extend(result)
+        return rows
+
+    async def update_payment_statuses(self, payment_status: str, references: List[str], now: datetime) -> List[dict]:
+        """One PATCH for every reference; the rows that matched, as updated."""
+        stamp = now.isoformat()
+        response = await self._http().client.patch(
+            "/rest/v1/payments",
+            params={"receipt_number": postgrest_in(references), "select": TRANSACTION_COLUMNS},
+            content=orjson.dumps({
+                "status": payment_status,
+                "payment_date": stamp,
+                "updated_at": stamp,
+            }),
+            headers={
+                "Content-Type": "application/json",
+                "Prefer": "return=representation",
+            },
+            extensions=SupabaseHTTP.call_site("payments_patch"),
+        )
+        logger.info(f"Supabase batch update to {payment_status} ({len(references)} refs): {response.status_code}")
+        if response.status_code >= 300:
+            raise PaymentsUpdateError(f"payments PATCH returned {response.status_code}")
+        return orjson.loads(response.content)
+
+    async def insert_audit_events(self, rows: List[dict]) -> None:
+        """One POST with a JSON array: PostgREST turns it into a single multi-row INSERT."""
+        response = await self._http().client.post(
+            "/rest/v1/audit_log",
+            content=orjson.dumps(rows),
+            headers={
+                "Content-Type": "application/json",
+                "Prefer": "return=minimal",
+            },
+            extensions=SupabaseHTTP.call_site("audit_insert"),
+        )
+        if response.status_code >= 300:
+            raise AuditInsertError(f"audit_log insert returned {response.status_code}")
+
+    async def turnstile_device(self, serial: str) -> Optional[dict]:
+        """The active reader with this serial number; None when unknown."""
+        response = await self._http().client.get(
+            "/rest/v1/turnstile_devices",
+            params={"serial_number": f"eq.{serial}", "is_active": "eq.true", "select": DEVICE_COLUMNS, "limit": 1},
+            extensions=SupabaseHTTP.call_site("device_lookup"),
+        )
+        if response.status_code != 200:
+            raise DeviceLookupError(f"turnstile_devices lookup returned {response.status_code}")
+        data = orjson.loads(response.content)
+        return data[0] if data else None
+
+    async def insert_access_events(self, rows: List[dict]) -> int:
+        """
+        One POST for the batch; PostgREST turns it into a single
+        INSERT ... ON CONFLICT (device_id, zk_user_id, occurred_at) DO NOTHING.
+        Returns how many rows were new.
+        """
+        response = await self._http().client.post(
+            "/rest/v1/access_events",
+            params={"on_conflict": "device_id,zk_user_id,occurred_at", "select": "id"},
+            content=orjson.dumps(rows),
+            headers={
+                "Content-Type": "application/json",
+                "Prefer": "resolution=ignore-duplicates,return=representation",
+            },
+            extensions=SupabaseHTTP.call_site("access_events_insert"),
+        )
+        if response.status_code >= 300:
+            raise AccessEventsInsertError(f"access_events insert returned {response.status_code}")
+        return len(orjson.loads(response.content))
+
+    async def _school_rows(self, table: str, school_id: str, columns: str, page_size: int, call_site: str,
+                           error: type, order: str = "id", **filters: str) -> List[dict]:
+        """Every row of a school (narrowed by `filters`), paged in `page_size` at a time."""
+        rows: List[dict] = []
+        while True:
+            response = await self._http().client.get(
+                f"/rest/v1/{table}",
+                params={"school_id": f"eq.{school_id}", **filters, "select": columns, "order": order,
+                        "limit": page_size, "offset": len(rows)},
+                extensions=SupabaseHTTP.call_site(call_site),
+            )
+            if response.status_code != 200:
+                raise error(f"{table} lookup returned {response.status_code}")
+            page = orjson.loads(response.content)
+            rows.extend(page)
+            if len(page) < page_size:
+                return rows
+
+    async def revenue_cells(self, school_id: str, zone: str, page_size: int = 1000) -> List[dict]:
+        """
+        Revenue cube cells of a school. PostgREST cannot GROUP BY, so the rows
+        are paged in and folded here; this runs once per cube build.
+
+        Cost: every payments row the school has ever had, ceil(rows /
+        page_size) requests, on each build: once per REVENUE_ROLLUP_TTL (300 s)
+        while the school's dashboards are open, and after every invalidate.
+        Fine for a few thousand payments per school; past that, run with
+        DATA_BACKEND=asyncpg, where Postgres does the GROUP BY and only the
+        cells cross the wire. Not limited to recent months on purpose: an old
+        unpaid payment moves to the month it is paid in, so a partial re-read
+        would leave stale cells behind.
+        """
+        payments = await self._school_rows("payments", school_id, REVENUE_PAYMENT_COLUMNS, page_size,
+                                           "revenue_rows", RevenueLookupError)
+        return fold_revenue_rows(payments, ZoneInfo(zone))
+
+    async def access_snapshot(self, school_id: str, user_ids: Optional[List[str]] = None,
+                              athlete_ids: Optional[List[str]] = None, page_size: int = 1000) -> dict:
+        """
+        What access_index.build_entries needs for a school: everyone when
+        `user_ids` and `athlete_ids` are None, otherwise only those members.
+        """
+        partial = user_ids is not None or athlete_ids is not None
+        members = {}
+        if partial:
+            clauses = [f"user_id.{postgrest_in(user_ids)}"] if user_ids else []
+            if athlete_ids:
+                clauses.append(f"unregistered_athlete_id.{postgrest_in(athlete_ids)}")
+            if not clauses:
+                return {"owner_id": None, "mappings": [], "staff": [], "enrollments": [], "payments": []}
+            members = {"or": f"({','.join(clauses)})"}
+
+        async def owner() -> Optional[str]:
+            response = await self._http().client.get(
+                "/rest/v1/schools", params={"id": f"eq.{school_id}", "select": "owner_id"},
+                extensions=SupabaseHTTP.call_site("access_snapshot"),
+            )
+            if response.status_code != 200:
+                raise AccessSnapshotError(f"schools lookup returned {response.status_code}")
+            data = orjson.loads(response.content)
+            return data[0].get("owner_id") if data else None
+
+        async def staff() -> List[dict]:
+            if partial and not user_ids:
+                return []
+            filters = {"status": "eq.active", "role": f"in.({','.join(STAFF_ROLES)})"}
+            if partial:
+                filters["profile_id"] = postgrest_in(user_ids)
+            return await self._school_rows("school_members", school_id, "profile_id", page_size,
+                                           "access_snapshot", AccessSnapshotError, **filters)
+
+        def rows(table: str, columns: str, order: str = "id", **filters: str):
+            return self._school_rows(table, school_id, columns, page_size, "access_snapshot", AccessSnapshotError,
+                                     order=order, **filters, **members)
+
+        owner_id, staff_rows, mappings, enrollments, payments = await asyncio.gather(
+            owner(),
+            staff(),
+            rows("zk_user_mappings", "zk_pin,user_id,unregistered_athlete_id"),
+            rows("enrollments", "user_id,unregistered_athlete_id,expires_at", status="eq.active"),
+            rows("payments", "user_id,unregistered_athlete_id,status", order="created_at.desc,id"),
+        )
+        latest: dict = {}
+        for payment in payments:
+            latest.setdefault((payment.get("user_id"), payment.get("unregistered_athlete_id")), payment)
+        return {
+            "owner_id": owner_id,
+            "mappings": mappings,
+            "staff": [row["profile_id"] for row in staff_rows],
+            "enrollments": enrollments,
+            "payments": list(latest.values()),
+        }
+
+    async def access_changes(self, school_id: str, since: datetime, page_size: int = 1000) -> List[dict]:
+        """Members whose zk_user_mappings or enrollments rows were created or updated after `since`."""
+        after = since.isoformat()
+        mappings, enrollments = await asyncio.gather(
+            self._school_rows("zk_user_mappings", school_id, "user_id,unregistered_athlete_id", page_size,
+                              "access_changes", AccessSnapshotError, created_at=f"gt.{after}"),
+            self._school_rows("enrollments", school_id, "user_id,unregistered_athlete_id", page_size,
+                              "access_changes", AccessSnapshotError,
+                              **{"or": f'(created_at.gt."{after}",updated_at.gt."{after}")'}),
+        )
+        return mappings + enrollments
+
+    async def payment_members(self, payment_ids: List[str], chunk_size: int = 200) -> List[dict]:
+        """(school_id, user_id, unregistered_athlete_id) of each payment."""
+
+        async def lookup(chunk: List[str]) -> List[dict]:
+            response = await self._http().client.get(
+                "/rest/v1/payments",
+                params={"id": postgrest_in(chunk), "select": "school_id,user_id,unregistered_athlete_id"},
+                extensions=SupabaseHTTP.call_site("payment_members"),
+            )
+            if response.status_code != 200:
+                raise AccessSnapshotError(f"payments lookup returned {response.status_code}")
+            return orjson.loads(response.content)
+
+        chunks = [payment_ids[i:i + chunk_size] for i in range(0, len(payment_ids), chunk_size)]
+        rows: List[dict] = []
+        for result in await asyncio.gather(*(lookup(chunk) for chunk in chunks)):
+            rows.extend(result)
+        return rows
+
+    async def fan_out_announcement_chunk(self, school_id: str, announcement_id: str, limit: int) -> Optional[dict]:
+        """
+        The next chunk of an announcement's notifications, written by Postgres
+        (rpc fan_out_announcement_chunk) in one INSERT ... SELECT. Returns the
+        announcement_fanouts progress row, or None when the announcement is not
+        this school's or its sent_at is still in the future.
+        """
+        response = await self._http().client.post(
+            "/rest/v1/rpc/fan_out_announcement_chunk",
+            params={"select": ",".join(FANOUT_COLUMNS)},
+            content=orjson.dumps({"p_school_id": school_id, "p_announcement_id": announcement_id,
+                                  "p_limit": limit}),
+            headers={"Content-Type": "application/json"},
+            extensions=SupabaseHTTP.call_site("announcement_fanout"),
+        )
+        if response.status_code != 200:
+            raise AnnouncementFanoutError(f"fan_out_announcement_chunk returned {response.status_code}")
+        data = orjson.loads(response.content)
+        return data[0] if data else None
+
+    async def announcement_fanout(self, school_id: str, announcement_id: str) -> Optional[dict]:
+        """Progress of an announcement's fan-out; None if it never started (or is not this school's)."""
+        response = await self._http().client.get(
+            "/rest/v1/announcement_fanouts",
+            params={"announcement_id": f"eq.{announcement_id}", "announcements.school_id": f"eq.{school_id}",
+                    "select": ",".join(FANOUT_COLUMNS) + ",announcements!inner(school_id)"},
+            extensions=SupabaseHTTP.call_site("announcement_fanout_progress"),
+        )
+        if response.status_code != 200:
+            raise AnnouncementFanoutError(f"announcement_fanouts lookup returned {response.status_code}")
+        data = orjson.loads(response.content)
+        if not data:
+            return None
+        data[0].pop("announcements", None)
+        return data[0]
+
+    async def running_fanouts(self, limit: int = 100) -> List[dict]:
+        """[{announcement_id, school_id, delivered}] of fan-outs left unfinished (e.g. by a redeploy)."""
+        response = await self._http().client.get(
+            "/rest/v1/announcement_fanouts",
+            params={"status": "eq.running", "select": "announcement_id,delivered,announcements!inner(school_id)",
+                    "order": "updated_at", "limit": limit},
+            extensions=SupabaseHTTP.call_site("announcement_fanout_progress"),
+        )
+        if response.status_code != 200:
+            raise AnnouncementFanoutError(f"announcement_fanouts lookup returned {response.status_code}")
+        return [{"announcement_id": row["announcement_id"], "school_id": row["announcements"]["school_id"],
+                 "delivered": row["delivered"]} for row in orjson.loads(response.content)]
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "configured": self.configured}
+
+
+def _json_value(value: Any) -> Any:
+    """Postgres value -> what PostgREST would have put in the JSON."""
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _row(record) -> dict:
+    return {key: _json_value(value) for key, value in record.items()}
+
+
+class AsyncpgStore:
+    """Direct Postgres backend over an asyncpg pool (created on start or first use)."""
+
+    backend = "asyncpg"
+
+    SETTINGS_SQL = "SELECT payment_settings FROM schools WHERE id = $1"
+    TRANSACTION_SQL = (
+        "SELECT id, status, amount, payment_date, receipt_number FROM payments "
+        "WHERE receipt_number = $1 LIMIT 1"
+    )
+    PAYMENTS_SQL = (
+        "SELECT id, status, amount, payment_date, receipt_number FROM payments "
+        "WHERE receipt_number = ANY($1::text[])"
+    )
+    UPDATE_SQL = (
+        "UPDATE payments SET status = $1, payment_date = $2::timestamptz, updated_at = $2::timestamptz "
+        "WHERE receipt_number = ANY($3::text[]) "
+        "RETURNING id, status, amount, payment_date, receipt_number"
+    )
+    AUDIT_SQL = (
+        "INSERT INTO audit_log (action, entity_type, school_id, metadata, ip_address, user_agent, created_at) "
+        "SELECT * FROM unnest($1::text[], $2::text[], $3::uuid[], $4::jsonb[], $5::inet[], $6::text[], "
+        "$7::timestamptz[])"
+    )
+    DEVICE_SQL = (
+        "SELECT id, school_id, direction FROM turnstile_devices "
+        "WHERE serial_number = $1 AND is_active LIMIT 1"
+    )
+    ACCESS_EVENTS_SQL = (
+        "INSERT INTO access_events (" + ", ".join(ACCESS_EVENT_COLUMNS) + ") "
+        "SELECT * FROM unnest($1::uuid[], $2::uuid[], $3::uuid[], $4::uuid[], $5::text[], $6::boolean[], "
+        "$7::text[], $8::text[], $9::integer[], $10::jsonb[], $11::timestamptz[]) "
+        "ON CONFLICT (device_id, zk_user_id, occurred_at) DO NOTHING"
+    )
+    # Access index rows; $2/$3 NULL means the whole school, arrays narrow it to those members
+    _MEMBER_FILTER = "($2::uuid[] IS NULL OR user_id = ANY($2::uuid[]) OR unregistered_athlete_id = ANY($3::uuid[]))"
+    ACCESS_OWNER_SQL = "SELECT owner_id FROM schools WHERE id = $1"
+    ACCESS_STAFF_SQL = (
+        "SELECT profile_id FROM school_members WHERE school_id = $1 AND status::text = 'active' "
+        "AND role::text = ANY($3::text[]) AND ($2::uuid[] IS NULL OR profile_id = ANY($2::uuid[]))"
+    )
+    ACCESS_MAPPINGS_SQL = (
+        "SELECT zk_pin, user_id, unregistered_athlete_id FROM zk_user_mappings "
+        "WHERE school_id = $1 AND " + _MEMBER_FILTER
+    )
+    ACCESS_ENROLLMENTS_SQL = (
+        "SELECT user_id, unregistered_athlete_id, expires_at FROM enrollments "
+        "WHERE school_id = $1 AND status::text = 'active' AND " + _MEMBER_FILTER
+    )
+    ACCESS_PAYMENTS_SQL = (
+        "SELECT DISTINCT ON (user_id, unregistered_athlete_id) user_id, unregistered_athlete_id, status::text "
+        "FROM payments WHERE school_id = $1 AND (user_id IS NOT NULL OR unregistered_athlete_id IS NOT NULL) "
+        "AND " + _MEMBER_FILTER + " ORDER BY user_id, unregistered_athlete_id, created_at DESC"
+    )
+    ACCESS_CHANGES_SQL = (
+        "SELECT user_id, unregistered_athlete_id FROM zk_user_mappings WHERE school_id = $1 AND created_at > $2 "
+        "UNION SELECT user_id, unregistered_athlete_id FROM enrollments "
+        "WHERE school_id = $1 AND (created_at > $2 OR updated_at > $2)"
+    )
+    PAYMENT_MEMBERS_SQL = "SELECT school_id, user_id, unregistered_athlete_id FROM payments WHERE id = ANY($1::uuid[])"
+    FANOUT_CHUNK_SQL = "SELECT " + ", ".join(FANOUT_COLUMNS) + " FROM fan_out_announcement_chunk($1, $2, $3)"
+    FANOUT_PROGRESS_SQL = (
+        "SELECT " + ", ".join("f." + column for column in FANOUT_COLUMNS) + " FROM announcement_fanouts f "
+        "JOIN announcements a ON a.id = f.announcement_id WHERE f.announcement_id = $2 AND a.school_id = $1"
+    )
+    RUNNING_FANOUTS_SQL = (
+        "SELECT f.announcement_id, a.school_id, f.delivered FROM announcement_fanouts f "
+        "JOIN announcements a ON a.id = f.announcement_id WHERE f.status = 'running' ORDER BY f.updated_at LIMIT $1"
+    )
+    # Same folding rules as revenue_rollup.fold_revenue_rows, done by Postgres
+    REVENUE_SQL = (
+        "SELECT COALESCE(to_char(p.payment_date, 'YYYY-MM'), "
+        "to_char(p.created_at AT TIME ZONE $2, 'YYYY-MM')) AS month, "
+        "COALESCE(p.status::text, 'pending') AS status, p.payment_method::text AS method, "
+        "p.payment_type::text AS type, count(*) AS count, sum(p.amount) AS amount "
+        "FROM payments p WHERE p.school_id = $1 GROUP BY 1, 2, 3, 4"
+    )
+
+    def __init__(self, dsn: Optional[str], min_size: int = 1, max_size: int = 10, statement_cache_size: int = 100,
+                 resilience: Optional[Resilience] = None):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.resilience = resilience
+        self._pool = None
+        self._pool_lock: Optional[asyncio.Lock] = None
+        self.queries = 0
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.dsn)
+
+    async def _json_codecs(self, conn) -> None:
+        # jsonb/json arrive as Python objects, like PostgREST would send them
+        for typename in ("jsonb", "json"):
+            await conn.set_type_codec(typename, encoder=lambda v: orjson.dumps(v).decode(),
+                                      decoder=orjson.loads, schema="pg_catalog")
+
+    async def pool(self):
+        if self._pool is None:
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self._pool is None:
+                    import asyncpg  # optional dependency, only needed in this mode
+
+                    self._pool = await asyncpg.create_pool(
+                        self.dsn,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        statement_cache_size=self.statement_cache_size,
+                        init=self._json_codecs,
+                    )
+                    logger.info(f"Postgres pool ready (min={self.min_size}, max={self.max_size})")
+        return self._pool
+
+    async def start(self) -> None:
+        if self.configured:
+            await self.pool()
+
+    async def aclose(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+        self._pool = None
+
+    async def _run(self, call_site: str, method: str, sql: str, *args):
+        """
+        One pooled query under the same breaker and request deadline as the
+        PostgREST calls (keyed by call site).
+        """
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"deadline passed before calling {call_site}")
+        breaker = self.resilience.breaker(call_site) if self.resilience else None
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(call_site, breaker.retry_after())
+
+        pool = await self.pool()
+        self.queries += 1
+        start = time.monotonic()
+        try:
+            result = await getattr(pool, method)(sql, *args, timeout=remaining)
+        except asyncio.TimeoutError:
+            if breaker is not None:
+                breaker.record_neutral()
+            raise DeadlineExceeded(f"request deadline passed waiting for {call_site}")
+        except Exception:
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        if breaker is not None:
+            if time.monotonic() - start >= self.resilience.config.slow_call_seconds:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        return result
+
+    async def payment_settings(self, school_id: str) -> Optional[dict]:
+        try:
+            school_uuid = uuid.UUID(school_id)
+        except ValueError:
+            # PostgREST answers 400 for a malformed uuid
+            raise SettingsLookupError(f"invalid school id {school_id!r}")
+        record = await self._run("settings_lookup", "fetchrow", self.SETTINGS_SQL, school_uuid)
+        if record is None:
+            return None
+        return record["payment_settings"] or {}
+
+    async def transaction(self, reference: str) -> Optional[dict]:
+        record = await self._run("transaction_lookup", "fetchrow", self.TRANSACTION_SQL, reference)
+        return _row(record) if record is not None else None
+
+    async def payments_by_references(self, references: List[str]) -> List[dict]:
+        records = await self._run("payments_lookup", "fetch", self.PAYMENTS_SQL, references)
+        return [_row(record) for record in records]
+
+    async def update_payment_statuses(self, payment_status: str, references: List[str], now: datetime) -> List[dict]:
+        records = await self._run("payments_patch", "fetch", self.UPDATE_SQL, payment_status, now, references)
+        logger.info(f"Postgres batch update to {payment_status} ({len(references)} refs): {len(records)} row(s)")
+        return [_row(record) for record in records]
+
+    async def insert_audit_events(self, rows: List[dict]) -> None:
+        # One column array per field, so the whole batch is a single statement
+        columns = ("action", "entity_type", "school_id", "metadata", "ip_address", "user_agent", "created_at")
+        await self._run("audit_insert", "execute", self.AUDIT_SQL,
+                        *([row[column] for row in rows] for column in columns))
+
+    async def turnstile_device(self, serial: str) -> Optional[dict]:
+        record = await self._run("device_lookup", "fetchrow", self.DEVICE_SQL, serial)
+        return _row(record) if record is not None else None
+
+    async def insert_access_events(self, rows: List[dict]) -> int:
+        status = await self._run("access_events_insert", "execute", self.ACCESS_EVENTS_SQL,
+                                 *([row[column] for row in rows] for column in ACCESS_EVENT_COLUMNS))
+        # "INSERT 0 <n>": rows skipped by ON CONFLICT are not counted
+        return int(status.rsplit(" ", 1)[-1])
+
+    async def access_snapshot(self, school_id: str, user_ids: Optional[List[str]] = None,
+                              athlete_ids: Optional[List[str]] = None) -> dict:
+        try:
+            school_uuid = uuid.UUID(school_id)
+        except ValueError:
+            raise AccessSnapshotError(f"invalid school id {school_id!r}")
+        partial = user_ids is not None or athlete_ids is not None
+        users = list(user_ids or []) if partial else None
+        athletes = list(athlete_ids or []) if partial else None
+        owner, staff, mappings, enrollments, payments = await asyncio.gather(
+            self._run("access_snapshot", "fetchval", self.ACCESS_OWNER_SQL, school_uuid),
+            self._run("access_snapshot", "fetch", self.ACCESS_STAFF_SQL, school_uuid, users, list(STAFF_ROLES)),
+            self._run("access_snapshot", "fetch", self.ACCESS_MAPPINGS_SQL, school_uuid, users, athletes),
+            self._run("access_snapshot", "fetch", self.ACCESS_ENROLLMENTS_SQL, school_uuid, users, athletes),
+            self._run("access_snapshot", "fetch", self.ACCESS_PAYMENTS_SQL, school_uuid, users, athletes),
+        )
+        return {
+            "owner_id": _json_value(owner),
+            "mappings": [_row(record) for record in mappings],
+            "staff": [_json_value(record["profile_id"]) for record in staff],
+            "enrollments": [_row(record) for record in enrollments],
+            "payments": [_row(record) for record in payments],
+        }
+
+    async def access_changes(self, school_id: str, since: datetime) -> List[dict]:
+        try:
+            school_uuid = uuid.UUID(school_id)
+        except ValueError:
+            raise AccessSnapshotError(f"invalid school id {school_id!r}")
+        records = await self._run("access_changes", "fetch", self.ACCESS_CHANGES_SQL, school_uuid, since)
+        return [_row(record) for record in records]
+
+    async def payment_members(self, payment_ids: List[str]) -> List[dict]:
+        records = await self._run("payment_members", "fetch", self.PAYMENT_MEMBERS_SQL, payment_ids)
+        return [_row(record) for record in records]
+
+    async def fan_out_announcement_chunk(self, school_id: str, announcement_id: str, limit: int) -> Optional[dict]:
+        try:
+            ids = uuid.UUID(school_id), uuid.UUID(announcement_id)
+        except ValueError:
+            raise AnnouncementFanoutError(f"invalid id {school_id!r}/{announcement_id!r}")
+        record = await self._run("announcement_fanout", "fetchrow", self.FANOUT_CHUNK_SQL, *ids, limit)
+        return _row(record) if record is not None else None
+
+    async def announcement_fanout(self, school_id: str, announcement_id: str) -> Optional[dict]:
+        try:
+            ids = uuid.UUID(school_id), uuid.UUID(announcement_id)
+        except ValueError:
+            raise AnnouncementFanoutError(f"invalid id {school_id!r}/{announcement_id!r}")
+        record = await self._run("announcement_fanout_progress", "fetchrow", self.FANOUT_PROGRESS_SQL, *ids)
+        return _row(record) if record is not None else None
+
+    async def running_fanouts(self, limit: int = 100) -> List[dict]:
+        records = await self._run("announcement_fanout_progress", "fetch", self.RUNNING_FANOUTS_SQL, limit)
+        return [_row(record) for record in records]
+
+    async def revenue_cells(self, school_id: str, zone: str) -> List[dict]:
+        try:
+            school_uuid = uuid.UUID(school_id)
+        except ValueError:
+            raise RevenueLookupError(f"invalid school id {school_id!r}")
+        records = await self._run("revenue_rows", "fetch", self.REVENUE_SQL, school_uuid, zone)
+        return [dict(_row(record), month=record["month"] or "unknown", method=record["method"] or "unknown",
+                     type=record["type"] or "unknown") for record in records]
+
+    def stats(self) -> dict:
+        stats = {"backend": self.backend, "configured": self.configured, "open": self._pool is not None,
+                 "queries": self.queries}
+        if self._pool is not None:
+            stats["size"] = self._pool.get_size()
+            stats["idle"] = self._pool.get_idle_size()
+        return stats
+
+
+def store_from_env(http: Callable[[], SupabaseHTTP], resilience: Optional[Resilience] = None):
+    backend = os.environ.get("DATA_BACKEND", "postgrest").lower()
+    if backend == "asyncpg":
+        return AsyncpgStore(
+            os.environ.get("DATABASE_URL"),
+            min_size=int(os.environ.get("DATABASE_POOL_MIN_SIZE", 1)),
+            max_size=int(os.environ.get("DATABASE_POOL_MAX_SIZE", 10)),
+            statement_cache_size=int(os.environ.get("DATABASE_STATEMENT_CACHE", 100)),
+            resilience=resilience,
+        )
+    if backend != "postgrest":
+        logger.warning(f"Unknown DATA_BACKEND={backend!r}, using postgrest")
+    return PostgRESTStore(http)
@@ -0,0 +1,106 @@
+"""
+Idempotency store for webhook deliveries.
+
+Wompi redelivers the same event several times. Each delivery key is checked
+against a bounded in-memory LRU first and a local SQLite table second; keys are
+recorded only after the event was durably queued, so a duplicate is answered
+without touching the checksum, the spool or Supabase.
+
+Keys older than the retention window are pruned from SQLite every
+`prune_every` inserts.
+"""
+
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+
+class IdempotencyStore:
+    def __init__(self, path: Union[str, Path], lru_size: int = 10000, retention: float = 7 * 86400,
+                 prune_every: int = 1000):
+        self.path = str(path)
+        self.lru_size = lru_size
+        self.retention = retention
+        self.prune_every = prune_every
+        self._lru: "OrderedDict[str, None]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._inserts = 0
+        self.checks = 0
+        self.duplicates = 0
+        self.lru_hits = 0
+
+    def open(self) -> sqlite3.Connection:
+        """Open (creating it if needed) the store now; otherwise it opens on first use."""
+        if self._conn is None:
+            if self.path != ":memory:":
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS webhook_deliveries (key TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_seen ON webhook_deliveries (seen_at)")
+            self._conn = conn
+        return self._conn
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return self.open()
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _remember(self, key: str) -> None:
+        self._lru[key] = None
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def seen(self, key: str) -> bool:
+        """True if this delivery key was already recorded; counts toward the duplicate ratio."""
+        self.checks += 1
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.lru_hits += 1
+            self.duplicates += 1
+            return True
+        row = self._db.execute("SELECT 1 FROM webhook_deliveries WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._remember(key)
+            self.duplicates += 1
+            return True
+        return False
+
+    def record(self, key: str) -> bool:
+        """Record a key; False if it was already there (a concurrent duplicate won)."""
+        inserted = self._db.execute(
+            "INSERT OR IGNORE INTO webhook_deliveries (key, seen_at) VALUES (?, ?)", (key, time.time())
+        ).rowcount == 1
+        self._remember(key)
+        if inserted:
+            self._inserts += 1
+            if self._inserts % self.prune_every == 0:
+                self.prune()
+        return inserted
+
+    def forget(self, key: str) -> None:
+        """Undo a record() whose event could not be queued, so the redelivery is processed."""
+        self._lru.pop(key, None)
+        self._db.execute("DELETE FROM webhook_deliveries WHERE key = ?", (key,))
+
+    def prune(self) -> int:
+        return self._db.execute(
+            "DELETE FROM webhook_deliveries WHERE seen_at < ?", (time.time() - self.retention,)
+        ).rowcount
+
+    def stats(self) -> dict:
+        return {
+            "checks": self.checks,
+            "duplicates": self.duplicates,
+            "duplicate_ratio": round(self.duplicates / self.checks, 4) if self.checks else 0.0,
+            "lru_hits": self.lru_hits,
+            "lru_size": len(self._lru),
+        }
@@ -0,0 +1,181 @@
+"""
+Non-blocking structured logging for the backend.
+
+Request handlers only put records on an in-memory queue (QueueHandler); a
+QueueListener thread formats them as JSON lines and writes them out, so a slow
+stdout never stalls the event loop.
+
+Done in the calling thread (needs the request context):
+    - request-id correlation (X-Request-ID, or a generated id)
+    - sampling of INFO-and-below records per request (LOG_SUCCESS_SAMPLE_RATE);
+      warnings and errors are always kept, with their full traceback
+Done in the listener thread:
+    - JSON formatting
+    - redaction of known secrets, bearer tokens and payment references
+
+Environment:
+    LOG_LEVEL                 (default INFO)
+    LOG_FORMAT                json | text (default json)
+    LOG_SUCCESS_SAMPLE_RATE   0.0-1.0 (default 1.0, keep everything)
+"""
+
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+import orjson
+
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+_SECRET_ENV_VARS = (
+    "WOMPI_INTEGRITY_SECRET",
+    "WOMPI_EVENTS_KEY",
+    "WOMPI_PRIVATE_KEY",
+    "SUPABASE_SERVICE_ROLE_KEY",
+    "METRICS_TOKEN",
+)
+_BEARER_RE = re.compile(r"(Bearer\s+)[A-Za-z0-9._~+/=-]+")
+_REFERENCE_RE = re.compile(r"\b(ref|reference|receipt_number)=([^\s,)]+)")
+
+
+def mask_reference(value: str) -> str:
+    """Keep only the last 4 characters of a payment reference."""
+    return "***" + value[-4:] if len(value) > 4 else "***"
+
+
+class Redactor:
+    def __init__(self, secrets: Iterable[str]):
+        # Longest first so a secret containing another is fully masked
+        self.secrets = sorted({s for s in secrets if s and len(s) >= 6}, key=len, reverse=True)
+
+    def __call__(self, text: str) -> str:
+        for secret in self.secrets:
+            if secret in text:
+                text = text.replace(secret, "[REDACTED]")
+        text = _BEARER_RE.sub(r"\1[REDACTED]", text)
+        return _REFERENCE_RE.sub(lambda m: f"{m.group(1)}={mask_reference(m.group(2))}", text)
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps the request id and drops unsampled low-level records."""
+
+    def __init__(self, sample_rate: float = 1.0):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        request_id = request_id_var.get()
+        record.request_id = request_id
+        if record.levelno >= logging.WARNING or self.sample_rate >= 1.0:
+            return True
+        # Deterministic per request: a sampled request keeps all of its lines
+        bucket = zlib.crc32(request_id.encode()) % 10000 if request_id != "-" else 0
+        return bucket < self.sample_rate * 10000
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, redact: Optional[Redactor] = None):
+        super().__init__()
+        self.redact = redact or (lambda text: text)
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": self.redact(record.getMessage()),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = self.redact(record.exc_text)
+        return orjson.dumps(entry).decode()
+
+
+class RedactingTextFormatter(logging.Formatter):
+    def __init__(self, redact: Redactor):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s")
+        self.redact = redact
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, "request_id"):
+            record.request_id = "-"
+        return self.redact(super().format(record))
+
+
+class _PreparedQueueHandler(logging.handlers.QueueHandler):
+    """Resolves the message and traceback now, leaves JSON formatting to the listener."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging(stream=None) -> logging.handlers.QueueListener:
+    """Install the queue-based pipeline on the root logger (idempotent)."""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    redact = Redactor(os.environ.get(name, "") for name in _SECRET_ENV_VARS)
+    output = logging.StreamHandler(stream)
+    if os.environ.get("LOG_FORMAT", "json").lower() == "text":
+        output.setFormatter(RedactingTextFormatter(redact))
+    else:
+        output.setFormatter(JsonFormatter(redact))
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = _PreparedQueueHandler(log_queue)
+    handler.addFilter(RequestContextFilter(float(os.environ.get("LOG_SUCCESS_SAMPLE_RATE", 1.0))))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+class RequestIdMiddleware:
+    """Pure ASGI middleware: binds X-Request-ID (or a new id) to the logging context and echoes it back."""
+
+    def __init__(self, app, header: str = "x-request-id"):
+        self.app = app
+        self.header = header.encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = next((v for k, v in scope.get("headers", []) if k == self.header), b"")
+        request_id = incoming.decode("latin-1")[:64] or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(self.header, request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
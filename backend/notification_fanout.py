@@ -0,0 +1,195 @@
+"""
+Announcement fan-out: one notifications row per recipient, written by Postgres.
+
+Clients used to publish an announcement by inserting one notification per
+recipient. Here the audience (parents, players or both, of the whole school
+or of one team; see announcement_recipients() in
+supabase/migrations/20261017212343_announcement_fanout.sql) is expanded
+and written by fan_out_announcement_chunk(): a single
+INSERT ... SELECT of up to `chunk_size` rows that starts after the cursor
+kept in announcement_fanouts and moves it forward in the same transaction.
+
+  - recipients are distinct by construction (UNION), and the unique index on
+    notifications(announcement_id, user_id) turns a repeated chunk into a
+    no-op, so a retry or a second publish never notifies anyone twice;
+  - progress (recipients, delivered, chunks, status) is committed with each
+    chunk: a crash or redeploy resumes where it stopped (running_fanouts on
+    start);
+  - a 1,000-member school takes two chunk statements at the default size.
+
+publish() runs the first chunk inline, so most announcements are done when
+the request returns; the rest of a large audience is left to the worker
+tasks, one announcement at a time per task.
+"""
+
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# chunk_fn(school_id, announcement_id, limit) -> progress row, None if not a sent announcement of the school
+ChunkFn = Callable[[str, str, int], Awaitable[Optional[dict]]]
+# pending_fn() -> [{announcement_id, school_id, delivered}] left running by a previous process
+PendingFn = Callable[[], Awaitable[List[dict]]]
+
+
+class FanoutWorker:
+    def __init__(self, chunk_fn: ChunkFn, pending_fn: Optional[PendingFn] = None, chunk_size: int = 500,
+                 workers: int = 2, max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                 resume_after: float = 10.0):
+        self.chunk_fn = chunk_fn
+        self.pending_fn = pending_fn
+        self.resume_after = resume_after
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # (school_id, announcement_id, notifications delivered so far)
+        self._queue: Optional["asyncio.Queue[Tuple[str, str, int]]"] = None
+        self._tasks: List[asyncio.Task] = []
+        # Announcements queued or being fanned out: a second publish does not queue them again
+        self._active: Set[str] = set()
+        self.published = 0
+        self.completed = 0
+        self.chunks = 0
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.pending_fn is not None:
+            self._tasks.append(asyncio.create_task(self._resume_later()))
+
+    async def _resume_later(self) -> None:
+        # Off the startup path, and late enough that a rolling deploy's old
+        # process has stopped touching the fan-outs it was running
+        await asyncio.sleep(self.resume_after)
+        await self.resume()
+
+    async def resume(self) -> int:
+        """Queue the fan-outs a previous process left running; returns how many."""
+        try:
+            pending = await self.pending_fn()
+        except Exception as e:
+            logger.warning(f"Could not look up unfinished announcement fan-outs: {e}")
+            return 0
+        for row in pending:
+            self._enqueue(row["school_id"], row["announcement_id"], row.get("delivered") or 0)
+        if pending:
+            logger.warning(f"Resuming {len(pending)} unfinished announcement fan-out(s)")
+        return len(pending)
+
+    async def stop(self) -> None:
+        """Stop the tasks; unfinished fan-outs keep their cursor and resume on the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._active.clear()
+
+    async def join(self) -> None:
+        """Wait until every queued announcement has been fanned out (or given up)."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def run_chunk(self, school_id: str, announcement_id: str, delivered_before: int = 0) -> Optional[dict]:
+        progress = await self.chunk_fn(school_id, announcement_id, self.chunk_size)
+        if progress is not None:
+            self.chunks += 1
+            # The row carries running totals for the announcement
+            self.delivered += max(0, (progress.get("delivered") or 0) - delivered_before)
+            if progress.get("status") == "done":
+                self.completed += 1
+        return progress
+
+    async def publish(self, school_id: str, announcement_id: str) -> Optional[dict]:
+        """
+        Fan out the first chunk now and queue the rest. Returns the progress
+        row, or None when the announcement is not a sent announcement of
+        the school. Publishing again is safe: it resumes, or reports done.
+        """
+        if announcement_id in self._active:
+            return {"announcement_id": announcement_id, "status": "running"}
+        progress = await self.run_chunk(school_id, announcement_id)
+        if progress is None:
+            return None
+        self.published += 1
+        if progress.get("status") != "done":
+            # Serverless runtimes skip the lifespan hook; the tasks start with the first large audience
+            await self.start()
+            self._enqueue(school_id, announcement_id, progress.get("delivered") or 0)
+        return progress
+
+    def _enqueue(self, school_id: str, announcement_id: str, delivered: int) -> None:
+        if announcement_id in self._active or self._queue is None:
+            return
+        self._active.add(announcement_id)
+        self._queue.put_nowait((school_id, announcement_id, delivered))
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _drain(self, school_id: str, announcement_id: str, delivered: int) -> None:
+        attempts = 0
+        while True:
+            try:
+                progress = await self.run_chunk(school_id, announcement_id, delivered)
+            except Exception as e:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    self.failed += 1
+                    logger.error(f"Fan-out of announcement {announcement_id} stopped after {attempts} failed "
+                                 f"chunk(s), resumes on the next publish or start: {e}")
+                    return
+                self.retried += 1
+                delay = self.backoff(attempts)
+                logger.warning(f"Fan-out chunk of announcement {announcement_id} failed, retrying in "
+                               f"{delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            attempts = 0
+            if progress is None:
+                logger.warning(f"Announcement {announcement_id} is gone or was rescheduled; fan-out dropped")
+                return
+            delivered = progress.get("delivered") or 0
+            if progress.get("status") == "done":
+                logger.info(f"Announcement {announcement_id} fanned out: {delivered} notification(s) to "
+                            f"{progress.get('recipients')} recipient(s) in {progress.get('chunks')} chunk(s)")
+                return
+
+    async def _worker(self) -> None:
+        while True:
+            school_id, announcement_id, delivered = await self._queue.get()
+            try:
+                await self._drain(school_id, announcement_id, delivered)
+            except Exception as e:
+                logger.exception(f"Fan-out of announcement {announcement_id} crashed: {e}")
+            finally:
+                self._active.discard(announcement_id)
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "workers": self.workers if self.running else 0,
+            "in_progress": len(self._active),
+            "published": self.published,
+            "completed": self.completed,
+            "chunks": self.chunks,
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
@@ -0,0 +1,165 @@
+"""
+Micro-batching for payment status updates coming from Wompi.
+
+During month-open charge runs Wompi sends hundreds of transaction.updated
+events within seconds. Instead of one PATCH per event, updates are held for a
+short window, grouped by target status and flushed as one
+`PATCH /rest/v1/payments?receipt_number=in.(...)` per status.
+
+Each caller awaits the outcome for its own reference:
+    "updated"   - a payments row matched and was updated
+    "not_found" - no payments row has that receipt_number (yet)
+A failed flush raises in every caller of that batch, so the webhook queue
+retries those events individually.
+
+If the same reference is submitted twice in one window, the more final status
+wins whatever the arrival order (a late PENDING never replaces an APPROVED;
+see moves_forward) and both callers get its result. Flushes are serialized
+so a later window can never be overwritten by an earlier one.
+"""
+
+import asyncio
+import contextvars
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# flush_fn(status, references) -> references that matched a row
+FlushFn = Callable[[str, List[str]], Awaitable[Set[str]]]
+
+UPDATED = "updated"
+NOT_FOUND = "not_found"
+
+# payments.status values an update may move away from, and where to
+OPEN_STATUSES = {'pending', 'pending_approval', 'overdue', 'failed', 'rejected'}
+ALLOWED_FROM_PAID = {'refunded'}
+
+
+def moves_forward(current: str, target: str) -> bool:
+    """
+    Whether `target` may replace `current`: an open payment takes any final
+    status and a paid one may only become refunded. Pending is where a
+    payment starts, never a move.
+    """
+    if target == current or target == 'pending':
+        return False
+    return current in OPEN_STATUSES or (current == 'paid' and target in ALLOWED_FROM_PAID)
+
+
+def postgrest_in(values: List[str]) -> str:
+    """Build a PostgREST `in.(...)` filter, quoting every value."""
+    quoted = []
+    for value in values:
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+        quoted.append(f'"{escaped}"')
+    return f"in.({','.join(quoted)})"
+
+
+class PaymentStatusBatcher:
+    def __init__(self, flush_fn: FlushFn, window: float = 0.05, max_batch: int = 100):
+        self.flush_fn = flush_fn
+        self.window = window
+        self.max_batch = max_batch
+        # reference -> (status, waiters); insertion order is arrival order
+        self._pending: "OrderedDict[str, Tuple[str, List[asyncio.Future]]]" = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flushes: Set[asyncio.Task] = set()
+        self.submitted = 0
+        self.coalesced = 0
+        self.round_trips = 0
+        self.updated = 0
+        self.not_found = 0
+        self.failed = 0
+
+    async def submit(self, reference: str, status: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.submitted += 1
+
+        previous = self._pending.pop(reference, None)
+        waiters = [future]
+        if previous is not None:
+            self.coalesced += 1
+            waiters = previous[1] + waiters
+            if not moves_forward(previous[0], status):
+                status = previous[0]
+        self._pending[reference] = (status, waiters)
+
+        if len(self._pending) >= self.max_batch:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._schedule_flush)
+        return await future
+
+    def _schedule_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, OrderedDict()
+        # A flush serves every caller in the batch: run it outside the context
+        # (request id, request deadline) of whichever caller happened to trigger it
+        task = contextvars.Context().run(asyncio.get_running_loop().create_task, self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: "OrderedDict[str, Tuple[str, List[asyncio.Future]]]") -> None:
+        groups: Dict[str, List[str]] = {}
+        for reference, (status, _) in batch.items():
+            groups.setdefault(status, []).append(reference)
+
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            calls = [
+                (status, refs[i:i + self.max_batch])
+                for status, refs in groups.items()
+                for i in range(0, len(refs), self.max_batch)
+            ]
+            results = await asyncio.gather(
+                *(self.flush_fn(status, refs) for status, refs in calls),
+                return_exceptions=True,
+            )
+            self.round_trips += len(calls)
+
+        for (status, refs), result in zip(calls, results):
+            if isinstance(result, BaseException):
+                self.failed += len(refs)
+                logger.warning(f"Batch update to {status} failed for {len(refs)} reference(s): {result}")
+            for reference in refs:
+                if isinstance(result, BaseException):
+                    outcome: object = result
+                elif reference in result:
+                    outcome = UPDATED
+                    self.updated += 1
+                else:
+                    outcome = NOT_FOUND
+                    self.not_found += 1
+                for waiter in batch[reference][1]:
+                    if waiter.done():
+                        continue
+                    if isinstance(outcome, BaseException):
+                        waiter.set_exception(outcome)
+                    else:
+                        waiter.set_result(outcome)
+
+    async def drain(self) -> None:
+        """Flush anything pending and wait for in-flight batches (used on shutdown)."""
+        self._schedule_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "round_trips": self.round_trips,
+            "updated": self.updated,
+            "not_found": self.not_found,
+            "failed": self.failed,
+        }
@@ -0,0 +1,56 @@
+"""
+In-process pub/sub for payment status changes.
+
+The webhook pipeline publishes each updated payments row under its
+receipt_number; SSE connections for that checkout subscribe with a small
+bounded queue. A slow subscriber drops its oldest message rather than growing
+without bound (the latest status is what matters).
+
+Only reaches subscribers connected to this process; clients always get a fresh
+snapshot from Supabase on connect, so a missed message is never fatal.
+"""
+
+import asyncio
+from typing import Any, Dict, Hashable, Set
+
+
+class EventBus:
+    def __init__(self, queue_size: int = 16):
+        self.queue_size = queue_size
+        self._subscribers: Dict[Hashable, Set[asyncio.Queue]] = {}
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, key: Hashable) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(key, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, key: Hashable, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(key)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[key]
+
+    def publish(self, key: Hashable, message: Any) -> int:
+        self.published += 1
+        queues = self._subscribers.get(key, ())
+        for queue in queues:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(message)
+            self.delivered += 1
+        return len(queues)
+
+    def stats(self) -> dict:
+        return {
+            "topics": len(self._subscribers),
+            "subscribers": sum(len(q) for q in self._subscribers.values()),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,250 @@
+"""
+In-memory token-bucket admission control for the payment routes.
+
+Every request under a limited path takes one token from its client-IP bucket
+and, when the rule has a per-school limit and the request names a school
+(X-School-Id header, ?school_id= or "school_id" in the JSON body), one from
+that school's bucket. An empty bucket answers 429 with Retry-After before the
+request reaches the route, so a client looping on create-signature cannot
+crowd out Supabase lookups for everyone else.
+
+Rules are matched by longest path prefix. The defaults can be overridden with
+RATE_LIMITS, a JSON object of path prefix -> {"per_ip": [rate, burst],
+"per_school": [rate, burst]} (rate in tokens per second), or null to exempt a
+path, or "off" to turn admission control off (load benchmarks, local runs):
+
+    RATE_LIMITS='{"/api/payments/wompi/create-signature": {"per_ip": [1, 10]}}'
+
+The client IP is the socket peer unless `trusted_proxies` > 0, in which case
+it is read from X-Forwarded-For; only enable that behind a proxy that sets
+the header (Vercel, Render), or any client can pick its own bucket.
+
+Buckets are plain [tokens, updated_at] lists in an LRU dict capped at
+`max_keys`; an evicted bucket was idle long enough to be full again anyway.
+"""
+
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+Limit = Tuple[float, float]  # (tokens per second, burst)
+
+DEFAULT_RULES: Dict[str, Optional[dict]] = {
+    "/api/payments": {"per_ip": (10, 40)},
+    # Opening a month signs one reference per child from a single admin, and
+    # parents behind a school's NAT share an IP: the burst covers both
+    "/api/payments/wompi/create-signature": {"per_ip": (10, 300), "per_school": (20, 300)},
+    "/api/payments/wompi/create-signatures": {"per_ip": (0.2, 5), "per_school": (0.5, 10)},
+    "/api/payments/wompi/transaction": {"per_ip": (5, 30)},
+    # Wompi retries on its own schedule and redeliveries are deduplicated
+    "/api/payments/wompi/webhook": None,
+}
+
+# JSON bodies above this are not inspected for a school_id
+MAX_INSPECTED_BODY = 64 * 1024
+
+
+class TokenBucketLimiter:
+    def __init__(self, max_keys: int = 50000, clock: Callable[[], float] = time.monotonic):
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets: "OrderedDict[tuple, List[float]]" = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def acquire(self, key: tuple, rate: float, burst: float) -> float:
+        """Take a token: 0.0 if admitted, else seconds until one is available."""
+        now = self._clock()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [burst, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / rate if rate > 0 else 60.0
+
+
+def _parse_rules(rules: Dict[str, Optional[dict]]) -> List[Tuple[str, Optional[Dict[str, Limit]]]]:
+    parsed = []
+    for prefix, rule in rules.items():
+        limits = None
+        if rule is not None:
+            limits = {dim: (float(rule[dim][0]), float(rule[dim][1]))
+                      for dim in ("per_ip", "per_school") if rule.get(dim)}
+        parsed.append((prefix.rstrip("/"), limits))
+    # Longest prefix first
+    return sorted(parsed, key=lambda item: len(item[0]), reverse=True)
+
+
+def rules_from_env(raw: Optional[str]) -> Dict[str, Optional[dict]]:
+    if raw and raw.strip().lower() == "off":
+        return {}
+    rules = dict(DEFAULT_RULES)
+    if raw:
+        try:
+            rules.update(orjson.loads(raw))
+        except (orjson.JSONDecodeError, TypeError) as e:
+            logger.error(f"Ignoring invalid RATE_LIMITS: {e}")
+    return rules
+
+
+def _school_from_body(body: bytes) -> Optional[str]:
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    if data.get("school_id"):
+        return str(data["school_id"])
+    items = data.get("items")
+    if isinstance(items, list):
+        # A batch counts against its school when it has exactly one
+        schools = {item.get("school_id") for item in items if isinstance(item, dict)}
+        if len(schools) == 1 and None not in schools:
+            return str(schools.pop())
+    return None
+
+
+class AdmissionControl:
+    """Rules, buckets and counters; shared by the middleware and /api/health."""
+
+    def __init__(self, rules: Optional[Dict[str, Optional[dict]]] = None, trusted_proxies: int = 0,
+                 limiter: Optional[TokenBucketLimiter] = None):
+        self.rules = _parse_rules(rules if rules is not None else DEFAULT_RULES)
+        self.trusted_proxies = trusted_proxies
+        self.limiter = limiter or TokenBucketLimiter()
+        self.admitted: Dict[str, int] = {}
+        self.limited: Dict[Tuple[str, str], int] = {}
+
+    def match(self, path: str) -> Tuple[Optional[str], Optional[Dict[str, Limit]]]:
+        for prefix, limits in self.rules:
+            if path == prefix or path.startswith(prefix + "/"):
+                return prefix, limits
+        return None, None
+
+    def client_ip(self, scope) -> str:
+        if self.trusted_proxies > 0:
+            for name, value in scope.get("headers", []):
+                if name == b"x-forwarded-for":
+                    hops = [hop.strip() for hop in value.decode("latin-1").split(",") if hop.strip()]
+                    if hops:
+                        # The entry appended by the outermost trusted proxy; earlier ones are client-supplied
+                        return hops[-min(self.trusted_proxies, len(hops))]
+        client = scope.get("client")
+        return client[0] if client else "-"
+
+    def stats(self) -> dict:
+        return {
+            "admitted": sum(self.admitted.values()),
+            "limited": sum(self.limited.values()),
+            "buckets": len(self.limiter),
+            "evictions": self.limiter.evictions,
+            "limited_by_rule": {f"{prefix}:{dim}": n for (prefix, dim), n in sorted(self.limited.items())},
+        }
+
+
+class AdmissionControlMiddleware:
+    """Pure ASGI middleware applying an AdmissionControl to matching paths."""
+
+    def __init__(self, app, control: AdmissionControl):
+        self.app = app
+        self.control = control
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        control = self.control
+        prefix, limits = control.match(scope["path"])
+        if not limits:
+            await self.app(scope, receive, send)
+            return
+
+        retry_after, dimension = 0.0, ""
+        if "per_ip" in limits:
+            rate, burst = limits["per_ip"]
+            retry_after = control.limiter.acquire((prefix, "ip", control.client_ip(scope)), rate, burst)
+            dimension = "ip"
+
+        if not retry_after and "per_school" in limits:
+            school_id, receive = await self._school_id(scope, receive)
+            if school_id:
+                rate, burst = limits["per_school"]
+                retry_after = control.limiter.acquire((prefix, "school", school_id), rate, burst)
+                dimension = "school"
+
+        if retry_after:
+            control.limited[(prefix, dimension)] = control.limited.get((prefix, dimension), 0) + 1
+            await self._reject(send, retry_after, dimension)
+            return
+        control.admitted[prefix] = control.admitted.get(prefix, 0) + 1
+        await self.app(scope, receive, send)
+
+    async def _school_id(self, scope, receive):
+        """School named by the request; reads (and replays) a small JSON body if needed."""
+        for name, value in scope.get("headers", []):
+            if name == b"x-school-id":
+                return value.decode("latin-1"), receive
+        query = scope.get("query_string", b"")
+        if b"school_id=" in query:
+            from urllib.parse import parse_qs
+
+            values = parse_qs(query.decode("latin-1")).get("school_id")
+            if values:
+                return values[0], receive
+        if scope.get("method") != "POST":
+            return None, receive
+
+        # Stop at the cap: a large upload goes to the per-IP bucket unread
+        chunks, size, more, other = [], 0, True, None
+        while more and size <= MAX_INSPECTED_BODY:
+            message = await receive()
+            if message["type"] != "http.request":
+                other = message
+                break
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            more = message.get("more_body", False)
+        body = b"".join(chunks)
+        # What was read goes back to the app first, then the rest straight from the client
+        buffered = [{"type": "http.request", "body": body, "more_body": more}]
+        if other is not None:
+            buffered.append(other)
+
+        async def replay():
+            if buffered:
+                return buffered.pop(0)
+            return await receive()
+
+        school_id = _school_from_body(body) if 0 < size <= MAX_INSPECTED_BODY and not more else None
+        return school_id, replay
+
+    async def _reject(self, send, retry_after: float, dimension: str) -> None:
+        body = orjson.dumps({"detail": "Too many requests, retry later.", "scope": dimension})
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,172 @@
+"""
+Replay archived Wompi webhooks through the normal processing path.
+
+    python replay_webhooks.py [--archive DIR] [--reference REF ...] [--transaction-id ID ...]
+                              [--since 2026-03-01T00:00] [--until 2026-03-02] [--status APPROVED ...]
+                              [--limit N] [--concurrency 32] [--skip-checksum] [--dry-run]
+
+The target database is whatever the environment points the backend at
+(SUPABASE_URL + SUPABASE_SERVICE_ROLE_KEY, or DATA_BACKEND=asyncpg with
+DATABASE_URL), and WOMPI_EVENTS_KEY is used to verify the checksums again.
+
+Every selected event goes through server.apply_wompi_event, so updates are
+coalesced by the payment batcher into one UPDATE per status per window, as
+with live traffic. Events of the same reference are applied one after the
+other in arrival order; different references run concurrently. Redeliveries
+of the same (transaction, status, timestamp) are applied once. A JSON summary
+is printed at the end; --dry-run only prints what would be replayed.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import orjson
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from webhook_archive import ArchivedEvent, WebhookArchive  # noqa: E402
+from wompi_checksum import checksum_matches  # noqa: E402
+
+ApplyFn = Callable[[dict, float], Awaitable[None]]
+KeyFn = Callable[[dict], Optional[str]]
+
+
+async def replay(archive: WebhookArchive, entries: List[ArchivedEvent], apply: ApplyFn,
+                 events_key: Optional[str] = None, delivery_key: Optional[KeyFn] = None,
+                 concurrency: int = 32) -> dict:
+    """
+    Apply `entries` with `apply(body, received_at)`. Checksums are verified
+    when `events_key` is given; `delivery_key` drops redeliveries.
+    """
+    started = time.monotonic()
+    summary = {"selected": len(entries), "applied": 0, "failed": 0, "duplicates": 0, "bad_checksum": 0,
+               "unparsable": 0, "without_reference": 0}
+
+    # Read in file order (one sequential pass per segment), then restore arrival order
+    by_position = sorted(entries, key=lambda e: (e.segment, e.offset))
+    bodies: Dict[int, bytes] = dict(zip((e.id for e in by_position), archive.read(by_position)))
+
+    chains: "OrderedDict[str, List[tuple]]" = OrderedDict()
+    seen = set()
+    for entry in entries:
+        try:
+            body = orjson.loads(bodies[entry.id])
+        except orjson.JSONDecodeError:
+            summary["unparsable"] += 1
+            continue
+        if not isinstance(body, dict):
+            summary["unparsable"] += 1
+            continue
+        signature = body.get('signature')
+        if events_key is not None and isinstance(signature, dict) and signature.get('checksum') \
+                and not checksum_matches(body, events_key):
+            summary["bad_checksum"] += 1
+            continue
+        key = delivery_key(body) if delivery_key else None
+        if key is not None:
+            if key in seen:
+                summary["duplicates"] += 1
+                continue
+            seen.add(key)
+        if not entry.reference:
+            summary["without_reference"] += 1
+            continue
+        chains.setdefault(entry.reference, []).append((body, entry.received_at))
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_chain(reference: str, events: List[tuple]) -> None:
+        async with semaphore:
+            for body, received_at in events:
+                try:
+                    await apply(body, received_at)
+                    summary["applied"] += 1
+                except Exception as e:
+                    summary["failed"] += 1
+                    print(f"ref={reference}: {e}", file=sys.stderr)
+
+    await asyncio.gather(*(run_chain(ref, events) for ref, events in chains.items()))
+    summary["references"] = len(chains)
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    return summary
+
+
+def parse_time(value: str) -> float:
+    """ISO date/datetime (UTC when no offset is given) or epoch seconds."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+async def run(args: argparse.Namespace) -> dict:
+    import server  # needs the target database and Wompi keys in the environment
+
+    archive = WebhookArchive(args.archive or server.webhook_archive.directory)
+    if archive.directory is None or not (archive.directory / "index.db").exists():
+        raise SystemExit(f"No webhook archive at {archive.directory}")
+    entries = archive.query(
+        references=args.reference, transaction_ids=args.transaction_id, statuses=args.status,
+        since=parse_time(args.since) if args.since else None,
+        until=parse_time(args.until) if args.until else None,
+        event=args.event, limit=args.limit,
+    )
+    if args.dry_run:
+        return {
+            "selected": len(entries),
+            "references": len({e.reference for e in entries if e.reference}),
+            "first": entries[0].received_at if entries else None,
+            "last": entries[-1].received_at if entries else None,
+        }
+    if not server.data_store.configured:
+        raise SystemExit("No target database configured (SUPABASE_URL or DATA_BACKEND=asyncpg + DATABASE_URL)")
+
+    await server.supabase_http.start()
+    await server.data_store.start()
+    try:
+        summary = await replay(
+            archive, entries, server.apply_wompi_event,
+            events_key=None if args.skip_checksum else server.WOMPI_EVENTS_KEY,
+            delivery_key=server.webhook_delivery_key,
+            concurrency=args.concurrency,
+        )
+        await server.payment_batcher.drain()
+        batcher = server.payment_batcher.stats()
+        summary.update(updated=batcher["updated"], not_found=batcher["not_found"],
+                       round_trips=batcher["round_trips"])
+        return summary
+    finally:
+        archive.close()
+        await server.data_store.aclose()
+        await server.supabase_http.aclose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--archive", help="archive directory (default: WEBHOOK_ARCHIVE_DIR)")
+    parser.add_argument("--reference", action="append", default=[])
+    parser.add_argument("--transaction-id", action="append", default=[])
+    parser.add_argument("--status", action="append", default=[], help="Wompi status, e.g. APPROVED")
+    parser.add_argument("--event", default="transaction.updated")
+    parser.add_argument("--since", help="received at or after (ISO, UTC by default, or epoch)")
+    parser.add_argument("--until", help="received before")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--skip-checksum", action="store_true", help="replay events whose checksum fails")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    print(orjson.dumps(asyncio.run(run(args)), option=orjson.OPT_INDENT_2).decode())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Fail-fast layer for the Supabase/PostgREST client.
+
+Sits between the shared AsyncClient and the (counting) transport, so every
+call made through supabase_http gets it, keyed by the `call_site` extension:
+
+    - circuit breaker per call site: after `failure_threshold` consecutive
+      failures (5xx/429, transport errors, timeouts, calls slower than
+      `slow_call_seconds`) the site is open and calls fail immediately with
+      CircuitOpenError; after `reset_timeout` one probe is let through
+      (half-open) and its outcome closes or re-opens the circuit
+    - request deadline: DeadlineMiddleware stores the incoming request's
+      deadline in a contextvar; upstream calls made on its behalf are cut off
+      (DeadlineExceeded) when it passes, instead of running to the httpx timeout
+    - hedged GETs for the call sites listed in `hedge_call_sites`: if the
+      first attempt has not answered after `hedge_delay`, an identical second
+      one is sent and the first good response wins. Hedges are capped at
+      `hedge_max_ratio` of the requests so they cannot double load during an
+      outage.
+
+Tunable via environment:
+    SUPABASE_BREAKER_FAILURES        consecutive failures to open (default 5)
+    SUPABASE_BREAKER_RESET_SECONDS   open -> half-open after (default 10)
+    SUPABASE_SLOW_CALL_SECONDS       slower calls count as failures (default 3)
+    SUPABASE_HEDGE_DELAY_MS          0 disables hedging (default 150)
+    SUPABASE_HEDGE_CALL_SITES        comma list (default settings_lookup,transaction_lookup)
+    SUPABASE_HEDGE_MAX_RATIO         (default 0.1)
+    REQUEST_DEADLINE_SECONDS         per incoming request (default 8); a client
+                                     may ask for less with X-Request-Timeout
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, FrozenSet, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Absolute deadline (time.monotonic()) of the request being served, if any
+deadline_var: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(httpx.TransportError):
+    """The call site's breaker is open; the request was not sent."""
+
+    def __init__(self, call_site: str, retry_after: float, request: Optional[httpx.Request] = None):
+        super().__init__(f"circuit open for {call_site}", request=request)
+        self.call_site = call_site
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    """The incoming request's deadline passed before the upstream call finished."""
+
+
+def remaining_time(clock: Callable[[], float] = time.monotonic) -> Optional[float]:
+    """Seconds left for the current request; None outside a request."""
+    deadline = deadline_var.get()
+    return None if deadline is None else deadline - clock()
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+@dataclass(frozen=True)
+class ResilienceConfig:
+    failure_threshold: int = 5
+    reset_timeout: float = 10.0
+    slow_call_seconds: float = 3.0
+    hedge_delay: float = 0.15
+    hedge_call_sites: FrozenSet[str] = field(default_factory=lambda: frozenset({"settings_lookup", "transaction_lookup"}))
+    hedge_max_ratio: float = 0.1
+
+    @classmethod
+    def from_env(cls) -> "ResilienceConfig":
+        sites = os.environ.get("SUPABASE_HEDGE_CALL_SITES")
+        return cls(
+            failure_threshold=int(_env_float("SUPABASE_BREAKER_FAILURES", cls.failure_threshold)),
+            reset_timeout=_env_float("SUPABASE_BREAKER_RESET_SECONDS", cls.reset_timeout),
+            slow_call_seconds=_env_float("SUPABASE_SLOW_CALL_SECONDS", cls.slow_call_seconds),
+            hedge_delay=_env_float("SUPABASE_HEDGE_DELAY_MS", cls.hedge_delay * 1000) / 1000,
+            hedge_call_sites=(frozenset(s.strip() for s in sites.split(",") if s.strip())
+                              if sites is not None else cls().hedge_call_sites),
+            hedge_max_ratio=_env_float("SUPABASE_HEDGE_MAX_RATIO", cls.hedge_max_ratio),
+        )
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 10.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self.opened_total = 0
+        self.rejected_total = 0
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - self._clock())
+
+    def allow(self) -> bool:
+        """Whether a call may go out now; in half-open only one probe at a time."""
+        if self.state == OPEN and self.retry_after() <= 0:
+            self.state = HALF_OPEN
+            logger.info(f"Circuit {self.name} half-open, probing")
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        self.rejected_total += 1
+        return False
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            logger.info(f"Circuit {self.name} closed")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opened_total += 1
+                logger.warning(f"Circuit {self.name} open after {self.consecutive_failures} failure(s)")
+            self.state = OPEN
+            self.opened_at = self._clock()
+
+    def record_neutral(self) -> None:
+        """The call ended without a verdict (e.g. cut by the caller's deadline)."""
+        self._probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "state_code": _STATE_CODES[self.state],
+            "consecutive_failures": self.consecutive_failures,
+            "opened_total": self.opened_total,
+            "rejected_total": self.rejected_total,
+            "retry_after": round(self.retry_after(), 3) if self.state == OPEN else 0.0,
+        }
+
+
+class Resilience:
+    """Breakers (one per call site) and hedging counters; outlives client rebuilds."""
+
+    def __init__(self, config: Optional[ResilienceConfig] = None, clock: Callable[[], float] = time.monotonic):
+        self.config = config or ResilienceConfig.from_env()
+        self._clock = clock
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_exceeded = 0
+
+    def breaker(self, call_site: str) -> CircuitBreaker:
+        breaker = self.breakers.get(call_site)
+        if breaker is None:
+            breaker = self.breakers[call_site] = CircuitBreaker(
+                call_site, self.config.failure_threshold, self.config.reset_timeout, self._clock)
+        return breaker
+
+    def may_hedge(self, request: httpx.Request, call_site: str) -> bool:
+        cfg = self.config
+        return (
+            cfg.hedge_delay > 0
+            and request.method == "GET"
+            and call_site in cfg.hedge_call_sites
+            and self.hedges < cfg.hedge_max_ratio * self.requests
+        )
+
+    def stats(self) -> dict:
+        return {
+            "breakers": {name: breaker.stats() for name, breaker in sorted(self.breakers.items())},
+            "open_circuits": sum(1 for b in self.breakers.values() if b.state != CLOSED),
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "deadline_exceeded": self.deadline_exceeded,
+        }
+
+
+def _failed(response: httpx.Response) -> bool:
+    return response.status_code >= 500 or response.status_code == 429
+
+
+async def _discard(task: "asyncio.Future") -> None:
+    """Cancel a losing attempt and release its connection if it already answered."""
+    task.cancel()
+    try:
+        response = await task
+    except BaseException:
+        return
+    await response.aclose()
+
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    def __init__(self, inner: httpx.AsyncBaseTransport, resilience: Resilience):
+        self.inner = inner
+        self.resilience = resilience
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        res = self.resilience
+        call_site = request.extensions.get("call_site", "other")
+        remaining = remaining_time(res._clock)
+        if remaining is not None and remaining <= 0:
+            res.deadline_exceeded += 1
+            raise DeadlineExceeded(f"deadline passed before calling {call_site}", request=request)
+
+        breaker = res.breaker(call_site)
+        if not breaker.allow():
+            raise CircuitOpenError(call_site, breaker.retry_after(), request=request)
+
+        res.requests += 1
+        start = res._clock()
+        try:
+            if res.may_hedge(request, call_site):
+                call = self._hedged(request)
+            else:
+                call = self.inner.handle_async_request(request)
+            response = await asyncio.wait_for(call, remaining) if remaining is not None else await call
+        except asyncio.TimeoutError:
+            res.deadline_exceeded += 1
+            if res._clock() - start >= res.config.slow_call_seconds:
+                breaker.record_failure()
+            else:
+                breaker.record_neutral()
+            raise DeadlineExceeded(f"request deadline passed waiting for {call_site}", request=request)
+        except asyncio.CancelledError:
+            breaker.record_neutral()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+
+        if _failed(response) or res._clock() - start >= res.config.slow_call_seconds:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    async def _hedged(self, request: httpx.Request) -> httpx.Response:
+        res = self.resilience
+        first = asyncio.ensure_future(self.inner.handle_async_request(request))
+        try:
+            done, _ = await asyncio.wait({first}, timeout=res.config.hedge_delay)
+            if done:
+                return first.result()
+            res.hedges += 1
+            second = asyncio.ensure_future(self.inner.handle_async_request(request))
+        except BaseException:
+            await _discard(first)
+            raise
+
+        attempts = [first, second]
+        pending = set(attempts)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in attempts:
+                    if task in done and task.exception() is None and not _failed(task.result()):
+                        if task is second:
+                            res.hedge_wins += 1
+                        for other in attempts:
+                            if other is not task:
+                                await _discard(other)
+                        return task.result()
+        except BaseException:
+            for task in attempts:
+                await _discard(task)
+            raise
+
+        # Both attempts failed: answer like the original request would have
+        await _discard(second)
+        return first.result()
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
+
+
+class DeadlineMiddleware:
+    """
+    Pure ASGI middleware: every request gets a deadline of `budget` seconds
+    (less if the client sends X-Request-Timeout: <seconds>), visible to
+    upstream calls through `deadline_var`.
+    """
+
+    def __init__(self, app, budget: float = 8.0, header: str = "x-request-timeout"):
+        self.app = app
+        self.budget = budget
+        self.header = header.encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.budget <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        budget = self.budget
+        requested = next((v for k, v in scope.get("headers", []) if k == self.header), None)
+        if requested:
+            try:
+                budget = min(budget, max(0.0, float(requested)))
+            except ValueError:
+                pass
+        token = deadline_var.set(time.monotonic() + budget)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            deadline_var.reset(token)
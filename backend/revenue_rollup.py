@@ -0,0 +1,183 @@
+"""
+Per-school revenue rollups for the finance dashboards.
+
+A school's `payments` rows are folded once into a cube of cells
+
+    (month, status, method, type) -> (count, amount in cents)
+
+and every dashboard query is answered from the cube: filtering by month range
+and summing over the dimensions left out of `group_by` touches only the
+cells, never the payments. A school has a few hundred cells at most however
+many years of payments it has.
+
+Folding rules (the asyncpg store does the same in SQL):
+  - month is that of payment_date (a local date already), or of created_at
+    in ROLLUP_TIMEZONE while there is none;
+  - status is payments.status as is (the receipt review moves it through
+    awaiting_approval / rejected / paid on the same row);
+  - method is payment_method, "unknown" when not set;
+  - type is payment_type (one_time / subscription).
+
+Cubes are cached per school and rebuilt, single-flight, after a change or
+when their TTL runs out. Changes arrive from the webhook batches
+(payments_changed, with the payment ids each PATCH matched) and from the
+screens that record or review payments (invalidate).
+"""
+
+import re
+import time
+from collections import defaultdict
+from datetime import datetime, timezone, tzinfo
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from ttl_cache import AsyncTTLCache
+
+DIMENSIONS = ("month", "status", "method", "type")
+
+_MONTH = re.compile(r"^(\d{4})-(\d{2})(?:-\d{2})?$")
+
+CellKey = Tuple[str, str, str, str]
+LoadFn = Callable[[str], Awaitable[List[dict]]]
+# payment_members_fn(payment_ids) -> [{school_id, ...}], as for the access index
+PaymentMembersFn = Callable[[List[str]], Awaitable[List[dict]]]
+
+
+class RollupQueryError(ValueError):
+    """Bad from/to/group_by; the route answers 400."""
+
+
+def _cents(amount) -> int:
+    return int(round(float(amount or 0) * 100))
+
+
+def _amount(cents: int):
+    """Cents -> what PostgREST would have sent for a DECIMAL(10,2)."""
+    return cents // 100 if cents % 100 == 0 else cents / 100
+
+
+def _month(row: dict, zone: tzinfo) -> str:
+    if row.get("payment_date"):
+        return str(row["payment_date"])[:7]
+    stamp = row.get("created_at")
+    if not stamp:
+        return "unknown"
+    moment = datetime.fromisoformat(stamp.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(zone).strftime("%Y-%m")
+
+
+def fold_revenue_rows(payments: Iterable[dict], zone: tzinfo) -> List[dict]:
+    """
+    Raw payments rows of one school -> cube cells, in the same shape the
+    asyncpg store returns straight from its GROUP BY.
+    """
+    cells: Dict[CellKey, List[int]] = defaultdict(lambda: [0, 0])
+    for row in payments:
+        key = (_month(row, zone), row.get("status") or "pending", row.get("payment_method") or "unknown",
+               row.get("payment_type") or "unknown")
+        cell = cells[key]
+        cell[0] += 1
+        cell[1] += _cents(row.get("amount"))
+    return [{"month": key[0], "status": key[1], "method": key[2], "type": key[3],
+             "count": count, "amount": _amount(cents)} for key, (count, cents) in cells.items()]
+
+
+def parse_month(value: Optional[str], name: str) -> Optional[str]:
+    """'2026-03' or '2026-03-15' -> '2026-03'; None passes through."""
+    if value is None or value == "":
+        return None
+    match = _MONTH.match(value)
+    if not match or not 1 <= int(match.group(2)) <= 12:
+        raise RollupQueryError(f"{name} must be YYYY-MM or YYYY-MM-DD")
+    return f"{match.group(1)}-{match.group(2)}"
+
+
+def parse_group_by(value: Optional[str]) -> Tuple[str, ...]:
+    """Comma-separated dimensions, kept in canonical order; default by month."""
+    if value is None:
+        return ("month",)
+    requested = {part.strip() for part in value.split(",") if part.strip()}
+    unknown = requested - set(DIMENSIONS)
+    if unknown:
+        raise RollupQueryError(f"group_by accepts {', '.join(DIMENSIONS)}; got {', '.join(sorted(unknown))}")
+    return tuple(d for d in DIMENSIONS if d in requested)
+
+
+class RevenueCube:
+    """The cells of one school, queried without going back to the payments."""
+
+    def __init__(self, cells: Sequence[dict], built_at: Optional[float] = None):
+        self.cells: Dict[CellKey, Tuple[int, int]] = {}
+        for cell in cells:
+            key = tuple(str(cell[d]) for d in DIMENSIONS)
+            count, cents = self.cells.get(key, (0, 0))
+            self.cells[key] = (count + int(cell["count"]), cents + _cents(cell["amount"]))
+        self.built_at = built_at or time.time()
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    def query(self, start: Optional[str] = None, end: Optional[str] = None,
+              group_by: Sequence[str] = ("month",)) -> dict:
+        """Buckets for months in [start, end] (inclusive), summed over the other dimensions."""
+        positions = [DIMENSIONS.index(d) for d in group_by]
+        buckets: Dict[tuple, List[int]] = defaultdict(lambda: [0, 0])
+        total = [0, 0]
+        for key, (count, cents) in self.cells.items():
+            month = key[0]
+            if (start and month < start) or (end and month > end):
+                continue
+            bucket = buckets[tuple(key[p] for p in positions)]
+            bucket[0] += count
+            bucket[1] += cents
+            total[0] += count
+            total[1] += cents
+        rows = []
+        for values in sorted(buckets):
+            row = dict(zip(group_by, values))
+            count, cents = buckets[values]
+            row.update(count=count, amount=_amount(cents))
+            rows.append(row)
+        return {"buckets": rows, "totals": {"count": total[0], "amount": _amount(total[1])}}
+
+
+class RevenueRollups:
+    """Cube per school behind an AsyncTTLCache: concurrent loads of a cold school share one build."""
+
+    def __init__(self, load: LoadFn, maxsize: int = 512, ttl: float = 300.0,
+                 payment_members_fn: Optional[PaymentMembersFn] = None):
+        self._load = load
+        self._payment_members = payment_members_fn
+        self.cache = AsyncTTLCache(maxsize=maxsize, ttl=ttl, negative_ttl=ttl)
+        self.builds = 0
+        self.cells_built = 0
+        self.build_seconds = 0.0
+
+    async def _build(self, school_id: str) -> RevenueCube:
+        started = time.monotonic()
+        cube = RevenueCube(await self._load(school_id))
+        self.builds += 1
+        self.cells_built += len(cube)
+        self.build_seconds += time.monotonic() - started
+        return cube
+
+    async def cube(self, school_id: str) -> RevenueCube:
+        return await self.cache.get_or_load(school_id, lambda: self._build(school_id))
+
+    def invalidate(self, school_id: str) -> bool:
+        """The school's payments changed: its next query rebuilds the cube."""
+        return self.cache.invalidate(school_id)
+
+    async def payments_changed(self, payment_ids: List[str]) -> int:
+        """Drop the cubes of the schools behind these payments; the number dropped."""
+        if self._payment_members is None or not payment_ids or len(self.cache) == 0:
+            return 0
+        schools = {row.get("school_id") for row in await self._payment_members(payment_ids)}
+        return sum(1 for school_id in schools if school_id and self.invalidate(school_id))
+
+    def stats(self) -> dict:
+        stats = self.cache.stats()
+        stats.update(builds=self.builds, cells_built=self.cells_built,
+                     build_seconds=round(self.build_seconds, 3))
+        return stats
@@ -10,39 +10,146 @@ Student, class, and enrollment CRUD is handled directly by the frontend
 via Supabase client. See NAMING_DICTIONARY.md for table mappings.
 """
 
-from fastapi import FastAPI, APIRouter, Request, HTTPException, Header
+from fastapi import FastAPI, APIRouter, Request, HTTPException, Header, Query
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 import os
 import sys
 import logging
+import asyncio
 import hashlib
 import uuid
 import random
+import sqlite3
+import time
 from pathlib import Path
+from zoneinfo import ZoneInfo
 from pydantic import BaseModel, Field
-from typing import List, Optional
-from datetime import datetime, timedelta
+import orjson
+from typing import List, Optional, Set
+from datetime import datetime, timedelta, timezone
+
+import audit_log
+from access_index import UNKNOWN, AccessIndex, SchoolAccessIndex
+from access_ingest import AccessEventWriter, AttlogIngestor, AttlogRecord, SlidingWindowDedup, iter_lines
+from audit_log import AuditLogWriter
+from auth import bearer_token, can_manage_school, resolve_user
+from data_access import SettingsLookupError, store_from_env
+from idempotency import IdempotencyStore
+from logging_setup import RequestIdMiddleware, configure_logging, request_id_var
+from metrics import Registry, RequestMetricsMiddleware, render_stats
+from notification_fanout import FanoutWorker
+from payment_batcher import PaymentStatusBatcher
+from pubsub import EventBus
+from rate_limit import AdmissionControl, AdmissionControlMiddleware, rules_from_env
+from resilience import CircuitOpenError, DeadlineExceeded, DeadlineMiddleware, Resilience
+from revenue_rollup import RevenueRollups, RollupQueryError, parse_group_by, parse_month
+from supabase_client import SupabaseHTTP
+from ttl_cache import AsyncTTLCache
+from webhook_archive import WebhookArchive
+from webhook_queue import WebhookQueue, WebhookSpool
+from wompi_checksum import checksum_matches
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
+# Local state (webhook spool, idempotency keys). Serverless bundles are read-only
+# except /tmp, so default there on Vercel; /tmp is per instance and lost when it
+# is recycled (see webhook_queue for what that means for queued events).
+VAR_DIR = Path(os.environ.get('BACKEND_VAR_DIR') or ('/tmp/sportmaps' if os.environ.get('VERCEL') else ROOT_DIR / 'var'))
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging: JSON lines written by a background listener thread
+configure_logging()
 logger = logging.getLogger(__name__)
 
+# Prometheus metrics, scraped from /api/metrics
+metrics = Registry()
+REQUEST_LATENCY = metrics.histogram(
+    "sportmaps_http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+REQUESTS_TOTAL = metrics.counter(
+    "sportmaps_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+REQUESTS_IN_FLIGHT = metrics.gauge("sportmaps_http_requests_in_flight", "HTTP requests currently being served")
+SUPABASE_LATENCY = metrics.histogram(
+    "sportmaps_supabase_request_duration_seconds", "Supabase upstream latency by call site", ("call_site",))
+SUPABASE_RESPONSES = metrics.counter(
+    "sportmaps_supabase_responses_total", "Supabase upstream responses by call site and status",
+    ("call_site", "status"))
+SUPABASE_TIMEOUTS = metrics.counter(
+    "sportmaps_supabase_timeouts_total", "Supabase upstream timeouts by call site", ("call_site",))
+WEBHOOK_EVENTS = metrics.counter(
+    "sportmaps_wompi_webhook_events_total", "Wompi webhook events received by event and status",
+    ("event", "status"))
+WEBHOOK_CHECKSUM_FAILURES = metrics.counter(
+    "sportmaps_wompi_webhook_checksum_failures_total", "Wompi webhooks rejected for a bad checksum")
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+
+def observe_supabase(call_site: str, seconds: float, outcome) -> None:
+    SUPABASE_LATENCY.observe(seconds, call_site)
+    SUPABASE_RESPONSES.inc(call_site, str(outcome))
+    if outcome == "timeout":
+        SUPABASE_TIMEOUTS.inc(call_site)
+
+
+# Optional: Supabase service role key for server-side DB updates
+SUPABASE_URL = os.environ.get('SUPABASE_URL')
+SUPABASE_SERVICE_KEY = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
+
+# Shared PostgREST client (keep-alive + HTTP/2), opened/closed by the lifespan hook.
+# Calls fail fast through per-call-site circuit breakers and the request deadline.
+supabase_http = SupabaseHTTP(SUPABASE_URL, SUPABASE_SERVICE_KEY, resilience=Resilience())
+supabase_http.observer = observe_supabase
+
+# Payment hot-path queries: PostgREST (default) or asyncpg straight to Postgres,
+# chosen by DATA_BACKEND. Auth checks always go through Supabase.
+data_store = store_from_env(lambda: supabase_http, resilience=supabase_http.resilience)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await supabase_http.start()
+    await data_store.start()
+    if data_store.configured:
+        await webhook_queue.start()
+        await audit_writer.start()
+        await access_writer.start()
+        await notification_fanout.start()
+    try:
+        yield
+    finally:
+        await webhook_queue.stop()
+        await payment_batcher.drain()
+        await audit_writer.stop()
+        await access_writer.stop()
+        await notification_fanout.stop()
+        webhook_queue.spool.close()
+        webhook_idempotency.close()
+        webhook_archive.close()
+        await data_store.aclose()
+        await supabase_http.aclose()
+
+
 # Create the main app
 app = FastAPI(
     title="SportMaps API",
     description="Lightweight backend for payment webhooks and server-side operations",
     version="2.0.0",
+    lifespan=lifespan,
 )
 
 # Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+# orjson serializes route return values several times faster than the stdlib encoder
+api_router = APIRouter(prefix="/api", default_response_class=ORJSONResponse)
+
+# Token buckets per client IP and per school in front of /api/payments/*; innermost,
+# so 429s still carry CORS headers and show up in the request metrics
+admission_control = AdmissionControl(
+    rules_from_env(os.environ.get('RATE_LIMITS')),
+    # Vercel's edge appends the client to X-Forwarded-For; elsewhere set it per deploy
+    trusted_proxies=int(os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', '1' if os.environ.get('VERCEL') else '0')),
+)
+app.add_middleware(AdmissionControlMiddleware, control=admission_control)
 
 # CORS
 app.add_middleware(
@@ -52,6 +159,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestIdMiddleware)
+app.add_middleware(DeadlineMiddleware, budget=float(os.environ.get('REQUEST_DEADLINE_SECONDS', 8)))
+app.add_middleware(
+    RequestMetricsMiddleware,
+    latency=REQUEST_LATENCY,
+    in_flight=REQUESTS_IN_FLIGHT,
+    requests=REQUESTS_TOTAL,
+)
 
 # ============================================================================
 # Health Check
@@ -69,7 +184,65 @@ async def root():
 
 @api_router.get("/health")
 async def health_check():
-    return {"status": "ok", "timestamp": datetime.utcnow().isoformat()}
+    return {
+        "status": "ok",
+        "timestamp": datetime.utcnow().isoformat(),
+        "supabase_pool": supabase_http.stats(),
+        "data_store": data_store.stats(),
+        "supabase_breakers": supabase_http.resilience.stats() if supabase_http.resilience else None,
+        "payment_settings_cache": payment_settings_cache.stats(),
+        "webhook_queue": webhook_queue.stats(),
+        "payment_batcher": payment_batcher.stats(),
+        "webhook_idempotency": webhook_idempotency.stats(),
+        "transaction_cache": transaction_cache.stats(),
+        "payment_events": payment_events.stats(),
+        "webhook_archive": webhook_archive.stats(),
+        "admission_control": admission_control.stats(),
+        "audit_log": audit_writer.stats(),
+        "revenue_rollups": revenue_rollups.stats(),
+        "device_cache": device_cache.stats(),
+        "attlog_ingest": attlog_ingestor.stats(),
+        "access_index": access_index.stats(),
+        "notification_fanout": notification_fanout.stats(),
+    }
+
+
+@metrics.collector
+def component_metrics():
+    yield from render_stats("sportmaps_supabase_pool", supabase_http.stats())
+    yield from render_stats("sportmaps_data_store", data_store.stats(), {"backend": data_store.backend})
+    if supabase_http.resilience is not None:
+        resilience = supabase_http.resilience.stats()
+        yield from render_stats("sportmaps_supabase_resilience", resilience)
+        for call_site, breaker in resilience["breakers"].items():
+            yield from render_stats("sportmaps_supabase_breaker", breaker, {"call_site": call_site})
+    yield from render_stats("sportmaps_payment_settings_cache", payment_settings_cache.stats())
+    yield from render_stats("sportmaps_transaction_cache", transaction_cache.stats())
+    yield from render_stats("sportmaps_webhook_queue", webhook_queue.stats())
+    yield from render_stats("sportmaps_payment_batcher", payment_batcher.stats())
+    yield from render_stats("sportmaps_webhook_idempotency", webhook_idempotency.stats())
+    yield from render_stats("sportmaps_payment_events", payment_events.stats())
+    yield from render_stats("sportmaps_webhook_archive", webhook_archive.stats())
+    yield from render_stats("sportmaps_audit_log", audit_writer.stats())
+    yield from render_stats("sportmaps_revenue_rollups", revenue_rollups.stats())
+    yield from render_stats("sportmaps_device_cache", device_cache.stats())
+    yield from render_stats("sportmaps_attlog_ingest", attlog_ingestor.stats())
+    yield from render_stats("sportmaps_access_index", access_index.stats())
+    yield from render_stats("sportmaps_notification_fanout", notification_fanout.stats())
+    admission = admission_control.stats()
+    yield from render_stats("sportmaps_admission_control", admission)
+    for rule, limited in admission["limited_by_rule"].items():
+        prefix, dimension = rule.rsplit(":", 1)
+        yield from render_stats("sportmaps_admission_rule", {"limited": limited},
+                                {"prefix": prefix, "dimension": dimension})
+
+
+@api_router.get("/metrics")
+async def prometheus_metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus text exposition. Requires `Bearer $METRICS_TOKEN` when that is set."""
+    if METRICS_TOKEN and bearer_token(authorization) != METRICS_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid metrics token.")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 # ============================================================================
 # Wompi Payment Integration (server-side only — needs secrets)
@@ -87,9 +260,63 @@ if not WOMPI_INTEGRITY_SECRET or not WOMPI_EVENTS_KEY:
     # FAIL FAST: Stop deployment/container immediately to prevent insecure operation.
     sys.exit(1)
 
-# Optional: Supabase service role key for server-side DB updates
-SUPABASE_URL = os.environ.get('SUPABASE_URL')
-SUPABASE_SERVICE_KEY = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
+
+# schools.payment_settings changes about once a month; cache it per school so a
+# signature on a warm school costs only the SHA-256. The school-settings screen
+# calls the invalidation endpoint below after saving.
+payment_settings_cache = AsyncTTLCache(
+    maxsize=int(os.environ.get('PAYMENT_SETTINGS_CACHE_SIZE', 2048)),
+    ttl=float(os.environ.get('PAYMENT_SETTINGS_CACHE_TTL', 300)),
+    negative_ttl=float(os.environ.get('PAYMENT_SETTINGS_CACHE_NEGATIVE_TTL', 60)),
+)
+
+
+async def fetch_payment_settings(school_id: str) -> Optional[dict]:
+    """payment_settings for a school; None when the school does not exist."""
+    return await data_store.payment_settings(school_id)
+
+
+async def get_payment_settings(school_id: str) -> Optional[dict]:
+    return await payment_settings_cache.get_or_load(school_id, lambda: fetch_payment_settings(school_id))
+
+
+async def write_audit_rows(rows: List[dict]) -> None:
+    await data_store.insert_audit_events(rows)
+
+
+# Security events go to audit_log in the background, one multi-row INSERT per flush
+audit_writer = AuditLogWriter(
+    write_audit_rows,
+    interval=float(os.environ.get('AUDIT_LOG_FLUSH_SECONDS', 2)),
+    max_batch=int(os.environ.get('AUDIT_LOG_BATCH_SIZE', 200)),
+    max_buffer=int(os.environ.get('AUDIT_LOG_MAX_BUFFER', 10000)),
+)
+
+
+def request_origin(request: Optional[Request]) -> dict:
+    """Client IP and user agent for an audit row."""
+    if request is None:
+        return {}
+    return {
+        "ip_address": admission_control.client_ip(request.scope),
+        "user_agent": request.headers.get("user-agent"),
+    }
+
+
+async def audit_blocked_signature(item: "WompiSignatureRequest", request: Optional[Request]) -> None:
+    # Serverless runtimes skip the lifespan hook; the writer starts with the first row
+    await audit_writer.start()
+    audit_writer.record(
+        audit_log.SIGNATURE_BLOCKED,
+        school_id=item.school_id,
+        metadata={
+            "reference": item.reference,
+            "amount_in_cents": item.amount_in_cents,
+            "currency": item.currency,
+            "request_id": request_id_var.get(),
+        },
+        **request_origin(request),
+    )
 
 
 class WompiSignatureRequest(BaseModel):
@@ -99,8 +326,43 @@ class WompiSignatureRequest(BaseModel):
     school_id: Optional[str] = None
 
 
+def wompi_signature(reference: str, amount_in_cents: int, currency: str) -> str:
+    raw_signature = f"{reference}{amount_in_cents}{currency}{WOMPI_INTEGRITY_SECRET}"
+    return hashlib.sha256(raw_signature.encode()).hexdigest()
+
+
+async def online_payments_error(school_id: Optional[str]) -> Optional[HTTPException]:
+    """
+    Security: Feature Flag Check. None when the school may sign online payments,
+    otherwise the error to answer with (raised by the single route, reported
+    per item by the batch route).
+    """
+    if not school_id or not data_store.configured:
+        return None
+    try:
+        settings = await get_payment_settings(school_id)
+    except SettingsLookupError as e:
+        logger.warning(f"School settings lookup skipped for {school_id}: {e}")
+        return None
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        # Supabase is down or too slow for this request: answer now instead of queueing
+        logger.warning(f"School settings unavailable for {school_id}: {e}")
+        retry_after = getattr(e, 'retry_after', 1.0)
+        return HTTPException(status_code=503, detail="Payment configuration temporarily unavailable.",
+                             headers={"Retry-After": str(max(1, round(retry_after)))})
+    except Exception as e:
+        logger.error(f"Error checking school settings: {e}")
+        # Fail open or closed? Fail closed for security.
+        return HTTPException(status_code=500, detail="Error validating payment configuration.")
+    # Default to False if not explicitly allowed
+    if settings is not None and not settings.get('allow_online', False):
+        logger.warning(f"Blocked Wompi signature request for school {school_id} (Online payments disabled)")
+        return HTTPException(status_code=403, detail="Online payments are currently disabled for this school.")
+    return None
+
+
 @api_router.post("/payments/wompi/create-signature")
-async def create_wompi_signature(req: WompiSignatureRequest):
+async def create_wompi_signature(req: WompiSignatureRequest, request: Request = None):
     """
     Generate SHA-256 integrity signature for Wompi Widget Checkout.
     Concatenation order: reference + amountInCents + currency + INTEGRITY_SECRET
@@ -108,36 +370,13 @@ async def create_wompi_signature(req: WompiSignatureRequest):
     Includes Security Check: Verifies if the school allows online payments.
     """
     try:
-        # Security: Feature Flag Check
-        if req.school_id and SUPABASE_URL and SUPABASE_SERVICE_KEY:
-            try:
-                import httpx
-                async with httpx.AsyncClient() as client:
-                    resp = await client.get(
-                        f"{SUPABASE_URL}/rest/v1/schools",
-                        params={"id": f"eq.{req.school_id}", "select": "payment_settings"},
-                        headers={
-                            "apikey": SUPABASE_SERVICE_KEY,
-                            "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-                        }
-                    )
-                    if resp.status_code == 200:
-                        data = resp.json()
-                        if data:
-                            settings = data[0].get('payment_settings', {})
-                            # Default to False if not explicitly allowed
-                            if not settings.get('allow_online', False):
-                                logger.warning(f"Blocked Wompi signature request for school {req.school_id} (Online payments disabled)")
-                                raise HTTPException(status_code=403, detail="Online payments are currently disabled for this school.")
-            except HTTPException:
-                raise
-            except Exception as e:
-                logger.error(f"Error checking school settings: {e}")
-                # Fail open or closed? Fail closed for security.
-                raise HTTPException(status_code=500, detail="Error validating payment configuration.")
+        error = await online_payments_error(req.school_id)
+        if error is not None:
+            if error.status_code == 403:
+                await audit_blocked_signature(req, request)
+            raise error
 
-        raw_signature = f"{req.reference}{req.amount_in_cents}{req.currency}{WOMPI_INTEGRITY_SECRET}"
-        signature_hash = hashlib.sha256(raw_signature.encode()).hexdigest()
+        signature_hash = wompi_signature(req.reference, req.amount_in_cents, req.currency)
         logger.info(f"Wompi signature generated for ref={req.reference}, amount={req.amount_in_cents}, school={req.school_id}")
         return {
             "signature": signature_hash,
@@ -153,97 +392,318 @@ async def create_wompi_signature(req: WompiSignatureRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+WOMPI_SIGNATURE_BATCH_MAX = int(os.environ.get('WOMPI_SIGNATURE_BATCH_MAX', 500))
+
+
+class WompiSignatureBatchRequest(BaseModel):
+    items: List[WompiSignatureRequest] = Field(..., min_length=1, max_length=WOMPI_SIGNATURE_BATCH_MAX)
+
+
+@api_router.post("/payments/wompi/create-signatures")
+async def create_wompi_signatures(req: WompiSignatureBatchRequest, request: Request = None):
+    """
+    Batch version of create-signature for month-open charge runs.
+    payment_settings are checked once per distinct school_id, then every item
+    is signed in one pass. Always 200: each result carries either the
+    signature or the status/error that item would have gotten on its own
+    (403 school blocked, 500 settings error, 409 reference repeated in the batch).
+    """
+    school_ids = list({item.school_id for item in req.items if item.school_id})
+    errors = dict(zip(school_ids, await asyncio.gather(*(online_payments_error(s) for s in school_ids))))
+
+    results = []
+    seen_references: Set[str] = set()
+    for index, item in enumerate(req.items):
+        error = errors.get(item.school_id) if item.school_id else None
+        if error is None and item.reference in seen_references:
+            error = HTTPException(status_code=409, detail="Duplicate reference in batch.")
+        seen_references.add(item.reference)
+        if error is not None:
+            if error.status_code == 403:
+                await audit_blocked_signature(item, request)
+            results.append({
+                "index": index,
+                "reference": item.reference,
+                "ok": False,
+                "status": error.status_code,
+                "error": error.detail,
+            })
+            continue
+        results.append({
+            "index": index,
+            "reference": item.reference,
+            "ok": True,
+            "signature": wompi_signature(item.reference, item.amount_in_cents, item.currency),
+            "amount_in_cents": item.amount_in_cents,
+            "currency": item.currency,
+        })
+
+    signed = sum(1 for result in results if result["ok"])
+    logger.info(f"Wompi signatures generated: {signed}/{len(results)} item(s), {len(school_ids)} school(s)")
+    return {"results": results, "signed": signed, "failed": len(results) - signed}
+
+
+async def authorize_school_manager(authorization: Optional[str], school_id: str) -> None:
+    """401/403 unless the bearer token belongs to a platform admin or a manager of the school."""
+    token = bearer_token(authorization)
+    if not token:
+        raise HTTPException(status_code=401, detail="Authorization token required.")
+    if not supabase_http.configured:
+        raise HTTPException(status_code=503, detail="Supabase is not configured.")
+
+    try:
+        user = await resolve_user(supabase_http, token)
+        if not user:
+            raise HTTPException(status_code=401, detail="Invalid or expired token.")
+        if not await can_manage_school(supabase_http, user["id"], school_id):
+            raise HTTPException(status_code=403, detail="Not allowed to manage this school.")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error authorizing school manager for {school_id}: {e}")
+        raise HTTPException(status_code=500, detail="Error validating permissions.")
+
+
+@api_router.post("/schools/{school_id}/payment-settings/invalidate")
+async def invalidate_payment_settings(school_id: str, authorization: Optional[str] = Header(None)):
+    """
+    Drop the cached payment_settings for a school.
+    Called by the school-settings screen right after saving, with the user's
+    Supabase access token; only platform admins and school managers may call it.
+    """
+    await authorize_school_manager(authorization, school_id)
+    invalidated = payment_settings_cache.invalidate(school_id)
+    logger.info(f"Payment settings cache invalidated for school {school_id} (was_cached={invalidated})")
+    return {"status": "ok", "school_id": school_id, "invalidated": invalidated}
+
+
+# Map Wompi status to our payment status
+WOMPI_STATUS_MAP = {
+    'APPROVED': 'paid',
+    'DECLINED': 'rejected',
+    'VOIDED': 'refunded',
+    'ERROR': 'failed',
+    'PENDING': 'pending',
+}
+
+
+# Checkout polls GET /payments/wompi/transaction/{reference} until the payment
+# flips to paid. Rows are cached briefly (read-through) and refreshed from the
+# webhook's batched PATCH (write-through); "not found yet" is cached shorter.
+transaction_cache = AsyncTTLCache(
+    maxsize=int(os.environ.get('TRANSACTION_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('TRANSACTION_CACHE_TTL', 5)),
+    negative_ttl=float(os.environ.get('TRANSACTION_CACHE_NEGATIVE_TTL', 2)),
+)
+
+
+# Checkout SSE streams subscribe here by receipt_number
+payment_events = EventBus()
+
+
+async def fetch_transaction(reference: str) -> Optional[dict]:
+    return await data_store.transaction(reference)
+
+
+async def patch_payment_statuses(payment_status: str, references: List[str]) -> Set[str]:
+    """
+    One update for every payment moving to `payment_status`.
+    Returns the receipt numbers that matched a row.
+    Raises PaymentsUpdateError when rejected; the queue retries the events.
+    """
+    rows = await data_store.update_payment_statuses(payment_status, references, datetime.now(timezone.utc))
+    for row in rows:
+        # Write-through: the next checkout poll sees the new status from memory,
+        # and open SSE streams for that checkout get it pushed
+        transaction_cache.set(row.get('receipt_number'), row)
+        payment_events.publish(row.get('receipt_number'), row)
+    payments_changed([row['id'] for row in rows if row.get('id')])
+    return {row.get('receipt_number') for row in rows}
+
+
+# Webhook bursts are coalesced into one PATCH per target status per window
+payment_batcher = PaymentStatusBatcher(
+    patch_payment_statuses,
+    window=float(os.environ.get('PAYMENT_BATCH_WINDOW_MS', 50)) / 1000,
+    max_batch=int(os.environ.get('PAYMENT_BATCH_MAX_SIZE', 100)),
+)
+
+
+async def apply_wompi_event(body: dict, received_at: float) -> None:
+    """
+    Apply a spooled Wompi event to the payments table.
+    Runs on the webhook queue workers; raising schedules a retry.
+    """
+    if body.get('event') != 'transaction.updated':
+        return
+    transaction = body.get('data', {}).get('transaction', {})
+    tx_reference = transaction.get('reference', '')
+    payment_status = WOMPI_STATUS_MAP.get(transaction.get('status', ''), 'pending')
+
+    outcome = await payment_batcher.submit(tx_reference, payment_status)
+    if outcome != 'updated':
+        logger.warning(f"Wompi update for ref={tx_reference} matched no payment ({outcome})")
+
+
+# Events are spooled to local SQLite and applied by background workers, so the
+# webhook acknowledges right after checksum validation.
+webhook_queue = WebhookQueue(
+    WebhookSpool(os.environ.get('WEBHOOK_SPOOL_PATH', str(VAR_DIR / 'webhook_spool.db'))),
+    apply_wompi_event,
+    # Workers mostly wait on the batcher, so enough of them to fill a batch
+    workers=int(os.environ.get('WEBHOOK_WORKERS', 64)),
+    max_attempts=int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 8)),
+    base_delay=float(os.environ.get('WEBHOOK_RETRY_BASE_DELAY', 1.0)),
+    max_delay=float(os.environ.get('WEBHOOK_RETRY_MAX_DELAY', 300.0)),
+    # Serverless: apply before acknowledging, since /tmp and the workers go away with the instance
+    inline=os.environ.get('WEBHOOK_PROCESS_INLINE', '1' if os.environ.get('VERCEL') else '0') == '1',
+)
+
+
+# Redeliveries of the same (transaction, status, timestamp) are answered from here
+webhook_idempotency = IdempotencyStore(
+    os.environ.get('WEBHOOK_IDEMPOTENCY_PATH', str(VAR_DIR / 'webhook_idempotency.db')),
+    lru_size=int(os.environ.get('WEBHOOK_IDEMPOTENCY_LRU_SIZE', 10000)),
+    retention=float(os.environ.get('WEBHOOK_IDEMPOTENCY_RETENTION_DAYS', 7)) * 86400,
+)
+
+
+# Every raw body Wompi sends, gzip segments + index by reference / transaction id
+# (replay_webhooks.py reads it). WEBHOOK_ARCHIVE_DIR= (empty) turns it off.
+webhook_archive = WebhookArchive(
+    os.environ.get('WEBHOOK_ARCHIVE_DIR', str(VAR_DIR / 'webhook_archive')),
+    segment_bytes=int(float(os.environ.get('WEBHOOK_ARCHIVE_SEGMENT_MB', 32)) * 1024 * 1024),
+    segment_seconds=float(os.environ.get('WEBHOOK_ARCHIVE_SEGMENT_HOURS', 24)) * 3600,
+    retention=float(os.environ.get('WEBHOOK_ARCHIVE_RETENTION_DAYS', 180)) * 86400,
+    max_bytes=int(float(os.environ.get('WEBHOOK_ARCHIVE_MAX_MB', 2048)) * 1024 * 1024),
+)
+# A Wompi event is a couple of KB; the route is unauthenticated and not rate limited
+WOMPI_WEBHOOK_MAX_BYTES = int(os.environ.get('WOMPI_WEBHOOK_MAX_BYTES', 64 * 1024))
+
+
+async def read_capped_body(request: Request, limit: int) -> bytes:
+    """The request body, or 413 as soon as it is known to exceed `limit` bytes."""
+    declared = request.headers.get('content-length', '')
+    if declared.isdigit() and int(declared) > limit:
+        raise HTTPException(status_code=413, detail="Request body too large")
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise HTTPException(status_code=413, detail="Request body too large")
+    return bytes(body)
+
+
+def webhook_delivery_key(body: dict) -> Optional[str]:
+    transaction = (body.get('data') or {}).get('transaction') or {}
+    tx_id = transaction.get('id')
+    if not tx_id:
+        return None
+    return f"{tx_id}:{transaction.get('status', '')}:{body.get('timestamp', '')}"
+
+
+def is_duplicate_delivery(delivery_key: Optional[str]) -> bool:
+    if not delivery_key:
+        return False
+    try:
+        return webhook_idempotency.seen(delivery_key)
+    except Exception as e:
+        # The store is an optimization; never drop an event because it failed
+        logger.warning(f"Idempotency lookup failed, processing delivery anyway: {e}")
+        return False
+
+
+def record_delivery(delivery_key: Optional[str]) -> bool:
+    """False only when a concurrent delivery of the same event already recorded it."""
+    if not delivery_key:
+        return True
+    try:
+        return webhook_idempotency.record(delivery_key)
+    except Exception as e:
+        logger.warning(f"Idempotency record failed, processing delivery anyway: {e}")
+        return True
+
+
 @api_router.post("/payments/wompi/webhook")
 async def wompi_webhook(request: Request):
     """
     Wompi webhook endpoint.
     Receives transaction events from Wompi and validates the checksum.
-    On success, updates the payments table in Supabase via service role.
+    Valid transaction events are queued durably and applied to the payments
+    table by the webhook workers; the response does not wait for Supabase.
     """
     try:
-        body = await request.json()
+        raw_body = await read_capped_body(request, WOMPI_WEBHOOK_MAX_BYTES)
+        # Archived before anything else can reject it: this is what Wompi actually sent
+        await webhook_archive.append_async(raw_body)
+        body = orjson.loads(raw_body)
         event = body.get('event', '')
         data = body.get('data', {})
         signature_info = body.get('signature', {})
 
         logger.info(f"Wompi webhook received: event={event}")
 
+        # 0. Redelivery of an event we already queued: answer without touching anything
+        delivery_key = webhook_delivery_key(body)
+        if is_duplicate_delivery(delivery_key):
+            logger.info(f"Wompi webhook duplicate delivery ignored: {delivery_key}")
+            return {"status": "ok", "event": event, "processed": False, "duplicate": True}
+
         # 1. Validate checksum
         if signature_info and signature_info.get('checksum'):
-            checksum = signature_info['checksum']
-            properties = signature_info.get('properties', [])
-
-            values = []
-            for prop in properties:
-                keys = prop.split('.')
-                value = data
-                for key in keys:
-                    if isinstance(value, dict):
-                        value = value.get(key, '')
-                    else:
-                        value = ''
-                        break
-                values.append(str(value))
-
-            values.append(str(body.get('timestamp', '')))
-            values.append(WOMPI_EVENTS_KEY)
-
-            raw_checksum = ''.join(values)
-            expected_checksum = hashlib.sha256(raw_checksum.encode()).hexdigest()
-
-            if checksum != expected_checksum:
+            if not checksum_matches(body, WOMPI_EVENTS_KEY):
+                WEBHOOK_CHECKSUM_FAILURES.inc()
                 logger.warning(f"Wompi webhook checksum mismatch!")
+                transaction = data.get('transaction', {}) if isinstance(data, dict) else {}
+                await audit_writer.start()
+                audit_writer.record(
+                    audit_log.CHECKSUM_MISMATCH,
+                    metadata={
+                        "event": event,
+                        "reference": transaction.get('reference'),
+                        "transaction_id": transaction.get('id'),
+                        "status": transaction.get('status'),
+                        "checksum": signature_info.get('checksum'),
+                        "request_id": request_id_var.get(),
+                    },
+                    **request_origin(request),
+                )
                 raise HTTPException(status_code=401, detail="Invalid checksum")
 
             logger.info("Wompi webhook checksum validated successfully")
 
-        # 2. Process the event
+        # 2. Queue the event
         if event == 'transaction.updated':
             transaction = data.get('transaction', {})
             tx_id = transaction.get('id', '')
             tx_status = transaction.get('status', '')
+            WEBHOOK_EVENTS.inc(event, tx_status if tx_status in WOMPI_STATUS_MAP else 'OTHER')
             tx_reference = transaction.get('reference', '')
             tx_amount = transaction.get('amount_in_cents', 0)
-            tx_method = transaction.get('payment_method_type', 'UNKNOWN')
 
             logger.info(
                 f"Wompi TX update: id={tx_id}, status={tx_status}, "
                 f"ref={tx_reference}, amount={tx_amount}"
             )
 
-            # Update Supabase payments table if service key is available
-            if SUPABASE_URL and SUPABASE_SERVICE_KEY:
+            # Update the payments table if a data backend is configured
+            if data_store.configured:
+                if not record_delivery(delivery_key):
+                    # A concurrent delivery of the same event got here first
+                    return {"status": "ok", "event": event, "processed": False, "duplicate": True}
                 try:
-                    import httpx
-                    async with httpx.AsyncClient() as client:
-                        # Map Wompi status to our payment status
-                        status_map = {
-                            'APPROVED': 'paid',
-                            'DECLINED': 'rejected',
-                            'VOIDED': 'refunded',
-                            'ERROR': 'failed',
-                            'PENDING': 'pending',
-                        }
-                        payment_status = status_map.get(tx_status, 'pending')
-
-                        response = await client.patch(
-                            f"{SUPABASE_URL}/rest/v1/payments",
-                            params={"receipt_number": f"eq.{tx_reference}"},
-                            json={
-                                "status": payment_status,
-                                "payment_date": datetime.utcnow().isoformat(),
-                                "updated_at": datetime.utcnow().isoformat(),
-                            },
-                            headers={
-                                "apikey": SUPABASE_SERVICE_KEY,
-                                "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-                                "Content-Type": "application/json",
-                                "Prefer": "return=minimal",
-                            },
-                        )
-                        logger.info(f"Supabase update response: {response.status_code}")
-                except Exception as db_err:
-                    logger.warning(f"Supabase update failed: {db_err}")
+                    # Spool the bytes Wompi sent; no re-serialization on the hot path
+                    event_id = await webhook_queue.submit(raw_body)
+                except Exception as spool_err:
+                    # Not durably stored: make Wompi redeliver instead of dropping it
+                    logger.error(f"Could not spool Wompi event: {spool_err}")
+                    if delivery_key:
+                        try:
+                            webhook_idempotency.forget(delivery_key)
+                        except Exception as e:
+                            logger.error(f"Could not forget delivery {delivery_key}: {e}")
+                    raise HTTPException(status_code=503, detail="Event could not be queued")
+                return {"status": "ok", "event": event, "processed": True, "queued": True, "event_id": event_id}
 
         return {"status": "ok", "event": event, "processed": True}
 
@@ -254,35 +714,97 @@ async def wompi_webhook(request: Request):
         return {"status": "error", "message": str(e)}
 
 
+def conditional_json(request: Request, body: dict) -> Response:
+    """JSON response with an ETag; answers 304 when the client already has it."""
+    payload = orjson.dumps(body, option=orjson.OPT_SORT_KEYS, default=str)
+    etag = f'"{hashlib.sha1(payload).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in (request.headers.get("if-none-match") or ""):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(body, headers=headers)
+
+
 @api_router.get("/payments/wompi/transaction/{reference}")
-async def get_wompi_transaction(reference: str):
+async def get_wompi_transaction(reference: str, request: Request):
     """
     Check a Wompi transaction status by reference.
-    In production, this queries Supabase; for now returns basic info.
+    Served from the transaction cache when warm, otherwise from Supabase.
+    Responses carry an ETag so polling clients can revalidate with If-None-Match.
     """
-    if SUPABASE_URL and SUPABASE_SERVICE_KEY:
+    if data_store.configured:
         try:
-            import httpx
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{SUPABASE_URL}/rest/v1/payments",
-                    params={
-                        "receipt_number": f"eq.{reference}",
-                        "select": "id,status,amount,payment_date,receipt_number",
-                    },
-                    headers={
-                        "apikey": SUPABASE_SERVICE_KEY,
-                        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-                    },
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    if data:
-                        return {"success": True, "transaction": data[0]}
+            transaction = await transaction_cache.get_or_load(reference, lambda: fetch_transaction(reference))
+            if transaction:
+                return conditional_json(request, {"success": True, "transaction": transaction})
         except Exception as e:
             logger.warning(f"Error checking transaction: {e}")
+            return ORJSONResponse(
+                {"success": False, "message": "Transaction not found"},
+                headers={"Cache-Control": "no-store"},
+            )
+
+    return conditional_json(request, {"success": False, "message": "Transaction not found"})
 
-    return {"success": False, "message": "Transaction not found"}
+
+# Statuses after which a checkout will not change again
+FINAL_PAYMENT_STATUSES = {'paid', 'rejected', 'refunded', 'failed'}
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+SSE_TIMEOUT_SECONDS = float(os.environ.get('SSE_TIMEOUT_SECONDS', 600))
+
+
+def sse_message(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {orjson.dumps(data, default=str).decode()}\n\n"
+
+
+async def transaction_event_stream(reference: str, request: Request):
+    # Subscribe before taking the snapshot so no update can fall in between
+    queue = payment_events.subscribe(reference)
+    try:
+        yield "retry: 3000\n\n"
+        transaction = None
+        if data_store.configured:
+            try:
+                transaction = await fetch_transaction(reference)
+                transaction_cache.set(reference, transaction)
+            except Exception as e:
+                logger.warning(f"Error loading SSE snapshot for {reference}: {e}")
+        yield sse_message("snapshot", {"success": transaction is not None, "transaction": transaction})
+        if transaction and transaction.get('status') in FINAL_PAYMENT_STATUSES:
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SSE_TIMEOUT_SECONDS
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                yield sse_message("timeout", {"reference": reference})
+                return
+            try:
+                transaction = await asyncio.wait_for(queue.get(), min(SSE_HEARTBEAT_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    return
+                yield ": heartbeat\n\n"
+                continue
+            yield sse_message("status", {"success": True, "transaction": transaction})
+            if transaction.get('status') in FINAL_PAYMENT_STATUSES:
+                return
+    finally:
+        payment_events.unsubscribe(reference, queue)
+
+
+@api_router.get("/payments/wompi/transaction/{reference}/events")
+async def wompi_transaction_events(reference: str, request: Request):
+    """
+    Server-Sent Events stream of a checkout's payment status.
+    Sends a Supabase snapshot on connect, then every update applied by the
+    webhook, with periodic heartbeats. Closes on a final status or timeout.
+    """
+    return StreamingResponse(
+        transaction_event_stream(reference, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @api_router.post("/payments/webhook")
@@ -296,6 +818,366 @@ async def payment_webhook(request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# ============================================================================
+# Finance dashboards
+# ============================================================================
+
+# Revenue is served from a per-school cube (month x status x method x type), so
+# a dashboard load costs O(buckets) instead of re-reading every payment. Webhook
+# batches drop the cubes of the schools they touched (payments_changed); the
+# screens that record or review payments call the invalidation endpoint; the
+# TTL bounds staleness for writes that skip both.
+REVENUE_TIMEZONE = os.environ.get('REVENUE_TIMEZONE', 'America/Bogota')
+# Each build reads every payments row of the school over PostgREST (see
+# PostgRESTStore.revenue_cells); the TTL bounds how often an active school pays that.
+revenue_rollups = RevenueRollups(
+    lambda school_id: data_store.revenue_cells(school_id, REVENUE_TIMEZONE),
+    maxsize=int(os.environ.get('REVENUE_ROLLUP_CACHE_SIZE', 512)),
+    ttl=float(os.environ.get('REVENUE_ROLLUP_TTL', 300)),
+    payment_members_fn=lambda payment_ids: data_store.payment_members(payment_ids),
+)
+
+
+@api_router.get("/schools/{school_id}/revenue")
+async def school_revenue(
+    school_id: str,
+    request: Request,
+    from_month: Optional[str] = Query(None, alias="from"),
+    to_month: Optional[str] = Query(None, alias="to"),
+    group_by: Optional[str] = Query(None),
+    authorization: Optional[str] = Header(None),
+):
+    """
+    Revenue of a school for months in [from, to] (YYYY-MM, both optional),
+    bucketed by any of month, status, method and type (default: month).
+    Carries an ETag; dashboards revalidate with If-None-Match.
+    """
+    # Authorize before validating: anonymous callers learn nothing about the parameters
+    await authorize_school_manager(authorization, school_id)
+    try:
+        start = parse_month(from_month, "from")
+        end = parse_month(to_month, "to")
+        dimensions = parse_group_by(group_by)
+    except RollupQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not data_store.configured:
+        raise HTTPException(status_code=503, detail="Database is not configured.")
+
+    try:
+        cube = await revenue_rollups.cube(school_id)
+    except Exception as e:
+        logger.error(f"Error building revenue rollup for school {school_id}: {e}")
+        raise HTTPException(status_code=503, detail="Revenue temporarily unavailable.")
+    body = cube.query(start, end, dimensions)
+    body.update(school_id=school_id, timezone=REVENUE_TIMEZONE, group_by=list(dimensions),
+                **{"from": start, "to": end})
+    return conditional_json(request, body)
+
+
+@api_router.post("/schools/{school_id}/revenue/invalidate")
+async def invalidate_school_revenue(school_id: str, authorization: Optional[str] = Header(None)):
+    """Rebuild the school's revenue cube on its next load (after a payment is recorded or reviewed)."""
+    await authorize_school_manager(authorization, school_id)
+    invalidated = revenue_rollups.invalidate(school_id)
+    logger.info(f"Revenue rollup invalidated for school {school_id} (was_cached={invalidated})")
+    return {"status": "ok", "school_id": school_id, "invalidated": invalidated}
+
+
+# ============================================================================
+# Announcements
+# ============================================================================
+
+# Publishing an announcement writes its notifications in Postgres, a chunk per
+# statement (INSERT ... SELECT over the audience), instead of one client insert
+# per recipient. The first chunk runs in the request; larger audiences finish
+# in the worker, which also resumes fan-outs a previous process left running.
+notification_fanout = FanoutWorker(
+    lambda school_id, announcement_id, limit: data_store.fan_out_announcement_chunk(school_id, announcement_id, limit),
+    lambda: data_store.running_fanouts(),
+    chunk_size=int(os.environ.get('NOTIFICATION_FANOUT_CHUNK', 500)),
+    workers=int(os.environ.get('NOTIFICATION_FANOUT_WORKERS', 2)),
+)
+
+
+def _announcement_ids(school_id: str, announcement_id: str) -> None:
+    try:
+        uuid.UUID(school_id)
+        uuid.UUID(announcement_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Announcement not found.")
+
+
+@api_router.post("/schools/{school_id}/announcements/{announcement_id}/publish")
+async def publish_announcement(school_id: str, announcement_id: str, authorization: Optional[str] = Header(None)):
+    """
+    Notify the audience of a sent announcement. Answers 200 when every
+    notification is written, 202 while a large audience is still being
+    fanned out. Calling it again is safe: recipients are never notified twice.
+    """
+    await authorize_school_manager(authorization, school_id)
+    _announcement_ids(school_id, announcement_id)
+    if not data_store.configured:
+        raise HTTPException(status_code=503, detail="Database is not configured.")
+    try:
+        progress = await notification_fanout.publish(school_id, announcement_id)
+    except Exception as e:
+        logger.error(f"Error fanning out announcement {announcement_id}: {e}")
+        raise HTTPException(status_code=503, detail="Could not publish the announcement, try again.")
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Announcement not found or not sent yet.")
+    return ORJSONResponse(progress, status_code=200 if progress.get("status") == "done" else 202)
+
+
+@api_router.get("/schools/{school_id}/announcements/{announcement_id}/fanout")
+async def announcement_fanout_progress(school_id: str, announcement_id: str,
+                                       authorization: Optional[str] = Header(None)):
+    """Progress of an announcement's fan-out (recipients, delivered, chunks, status)."""
+    await authorize_school_manager(authorization, school_id)
+    _announcement_ids(school_id, announcement_id)
+    if not data_store.configured:
+        raise HTTPException(status_code=503, detail="Database is not configured.")
+    try:
+        progress = await data_store.announcement_fanout(school_id, announcement_id)
+    except Exception as e:
+        logger.error(f"Error reading fan-out progress of announcement {announcement_id}: {e}")
+        raise HTTPException(status_code=503, detail="Progress temporarily unavailable.")
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Announcement has not been published.")
+    return progress
+
+
+# ============================================================================
+# Turnstile readers (ZKTeco ADMS push)
+# ============================================================================
+
+# Only the ATTLOG upload is served here (route POST /iclock/cdata?table=ATTLOG to
+# it); the handshake and the command queue stay in the BFF (access-adms.ts).
+ACCESS_DEVICE_TIMEZONE = ZoneInfo(os.environ.get('ACCESS_DEVICE_TIMEZONE', 'America/Bogota'))
+# Same opt-in allowlist as the BFF: the protocol has no auth, the reader's IP is the barrier
+ACCESS_DEVICE_IP_ALLOWLIST = {ip.strip() for ip in os.environ.get('ACCESS_DEVICE_IP_ALLOWLIST', '').split(',')
+                              if ip.strip()}
+# "count" answers "OK: <n>" so the reader advances its pointer; "plain" answers "OK"
+# for firmwares that only take that (see the ACK note in access-adms.ts)
+ATTLOG_ACK = os.environ.get('ATTLOG_ACK', 'count').lower()
+
+device_cache = AsyncTTLCache(
+    maxsize=int(os.environ.get('DEVICE_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('DEVICE_CACHE_TTL', 300)),
+    negative_ttl=float(os.environ.get('DEVICE_CACHE_NEGATIVE_TTL', 60)),
+)
+
+
+async def write_access_events(rows: List[dict]) -> int:
+    return await data_store.insert_access_events(rows)
+
+
+access_writer = AccessEventWriter(
+    write_access_events,
+    interval=float(os.environ.get('ACCESS_EVENTS_FLUSH_SECONDS', 0.5)),
+    max_batch=int(os.environ.get('ACCESS_EVENTS_BATCH_SIZE', 500)),
+    max_buffer=int(os.environ.get('ACCESS_EVENTS_MAX_BUFFER', 50000)),
+    max_delay=float(os.environ.get('ACCESS_EVENTS_RETRY_MAX_DELAY', 30)),
+    # A frozen serverless instance loses its buffer: there, write before acknowledging
+    inline=os.environ.get('ACCESS_EVENTS_INLINE', '1' if os.environ.get('VERCEL') else '0') == '1',
+)
+attlog_ingestor = AttlogIngestor(
+    access_writer,
+    SlidingWindowDedup(
+        window=float(os.environ.get('ATTLOG_DEDUP_WINDOW_SECONDS', 900)),
+        max_keys=int(os.environ.get('ATTLOG_DEDUP_MAX_KEYS', 200000)),
+    ),
+    ACCESS_DEVICE_TIMEZONE,
+)
+
+
+# PIN -> (member, allowed_until, reason) per school, so swipes never query Postgres
+# per person. Members are refreshed when their payments move (webhook batches
+# below), when a poll finds new or updated enrollments/PIN mappings, or when a
+# caller reports a change to /api/access/changes; the TTL is a full-rebuild
+# backstop, as short as the BFF's own PIN mapping cache.
+access_index = AccessIndex(
+    lambda school_id, user_ids, athlete_ids: data_store.access_snapshot(school_id, user_ids, athlete_ids),
+    lambda payment_ids: data_store.payment_members(payment_ids),
+    maxsize=int(os.environ.get('ACCESS_INDEX_MAX_SCHOOLS', 256)),
+    ttl=float(os.environ.get('ACCESS_INDEX_TTL', 300)),
+    changes_fn=lambda school_id, since: data_store.access_changes(school_id, since),
+    poll_interval=float(os.environ.get('ACCESS_INDEX_POLL_SECONDS', 30)),
+)
+ACCESS_API_TOKEN = os.environ.get('ACCESS_API_TOKEN')
+_payment_refreshes: Set[asyncio.Task] = set()
+
+
+def payments_changed(payment_ids: List[str]) -> None:
+    """
+    In the background, after a webhook batch updated these payments: refresh
+    the access entries of their members and drop their schools' revenue cubes.
+    """
+    if not payment_ids or (len(access_index.cache) == 0 and len(revenue_rollups.cache) == 0):
+        return
+
+    async def refresh() -> None:
+        try:
+            await access_index.payments_changed(payment_ids)
+        except Exception as e:
+            logger.warning(f"Access index refresh for {len(payment_ids)} payment(s) failed: {e}")
+        try:
+            await revenue_rollups.payments_changed(payment_ids)
+        except Exception as e:
+            logger.warning(f"Revenue rollup invalidation for {len(payment_ids)} payment(s) failed: {e}")
+
+    task = asyncio.create_task(refresh())
+    _payment_refreshes.add(task)
+    task.add_done_callback(_payment_refreshes.discard)
+
+
+def attlog_row(device: dict, record: AttlogRecord, serial: str, index: Optional[SchoolAccessIndex]) -> dict:
+    """access_events row for one ATTLOG record, decided from the school's access index."""
+    if index is not None:
+        decision = access_index.decide(index, record.zk_user_id, record.occurred_at.date())
+        granted, reason = decision.granted, decision.reason
+    else:
+        decision, granted, reason = UNKNOWN, False, "not_validated"
+    return {
+        "school_id": device["school_id"],
+        "device_id": device["id"],
+        "user_id": decision.user_id,
+        "unregistered_athlete_id": decision.unregistered_athlete_id,
+        "direction": device.get("direction"),
+        "access_granted": granted,
+        "denial_reason": reason,
+        "check_in_method": record.check_in_method,
+        "zk_user_id": record.zk_user_id,
+        "raw_event": {"sn": serial, "line": record.line, "table": "ATTLOG"},
+        "occurred_at": record.occurred_at,
+    }
+
+
+@api_router.post("/iclock/cdata")
+async def iclock_cdata(request: Request):
+    """
+    ATTLOG push from a reader. The body is parsed while it streams in and
+    acknowledged with "OK: <n>" as soon as it is read; the rows reach
+    access_events in the background, or before the ACK when the writer is
+    inline (serverless; see access_ingest.py).
+    """
+    client_ip = admission_control.client_ip(request.scope)
+    if ACCESS_DEVICE_IP_ALLOWLIST and client_ip not in ACCESS_DEVICE_IP_ALLOWLIST:
+        logger.warning(f"Reader push from a non-allowlisted IP: {client_ip}")
+        return PlainTextResponse("", status_code=403)
+    serial = request.query_params.get('SN') or request.query_params.get('sn')
+    table = request.query_params.get('table') or request.query_params.get('Table')
+    if table != 'ATTLOG':
+        return PlainTextResponse("OK")
+    if not data_store.configured:
+        return PlainTextResponse("", status_code=503)
+
+    try:
+        device = await device_cache.get_or_load(serial, lambda: data_store.turnstile_device(serial)) if serial else None
+    except Exception as e:
+        logger.error(f"Error looking up reader {serial}: {e}")
+        return PlainTextResponse("", status_code=503)
+    if device is None:
+        # Same as the BFF: an unknown serial is acknowledged and ignored
+        logger.warning(f"ATTLOG from unknown reader serial {serial}")
+        return PlainTextResponse("OK")
+
+    try:
+        index = await access_index.school(device["school_id"])
+    except Exception as e:
+        # Still take the records: they are written unvalidated rather than resent forever
+        logger.error(f"Access index unavailable for school {device['school_id']}: {e}")
+        index = None
+
+    # Serverless runtimes skip the lifespan hook; the writer starts with the first upload
+    await access_writer.start()
+    received = await attlog_ingestor.ingest(device, iter_lines(request.stream()),
+                                            lambda device, record: attlog_row(device, record, serial, index))
+    if received is None:
+        logger.warning(f"ATTLOG from {serial} not accepted: access event buffer full")
+        return PlainTextResponse("", status_code=503)
+    if access_writer.inline and not await access_writer.write_through():
+        # Still buffered here, but this instance may not live to write them: have the reader resend
+        logger.warning(f"ATTLOG from {serial} not acknowledged: access_events insert did not go through")
+        return PlainTextResponse("", status_code=503)
+    logger.info(f"ATTLOG {serial}: {received} record(s) acknowledged")
+    return PlainTextResponse("OK" if ATTLOG_ACK == "plain" else f"OK: {received}")
+
+
+def require_access_token(authorization: Optional[str]) -> None:
+    """The access API is service-to-service (the BFF): `Bearer $ACCESS_API_TOKEN`."""
+    if not ACCESS_API_TOKEN:
+        raise HTTPException(status_code=503, detail="Access API is not configured.")
+    if bearer_token(authorization) != ACCESS_API_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid access API token.")
+
+
+@api_router.get("/access/validate")
+async def validate_access(SN: str, pin: int, authorization: Optional[str] = Header(None)):
+    """
+    Access decision for a PIN on a reader, for the BFF's validateAccess: one
+    lookup in the school's access index (built on the school's first swipe).
+    """
+    require_access_token(authorization)
+    if not data_store.configured:
+        raise HTTPException(status_code=503, detail="Database is not configured.")
+    try:
+        device = await device_cache.get_or_load(SN, lambda: data_store.turnstile_device(SN))
+        if device is None:
+            raise HTTPException(status_code=404, detail="Unknown reader.")
+        index = await access_index.school(device["school_id"])
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error validating access on reader {SN}: {e}")
+        raise HTTPException(status_code=503, detail="Access validation temporarily unavailable.")
+    today = datetime.now(ACCESS_DEVICE_TIMEZONE).date()
+    decision = access_index.decide(index, pin or None, today)
+    return dict(decision.as_dict(), school_id=device["school_id"], device_id=device["id"], pin=pin)
+
+
+class AccessChangesRequest(BaseModel):
+    school_id: str
+    user_ids: List[str] = Field(default_factory=list, max_length=1000)
+    unregistered_athlete_ids: List[str] = Field(default_factory=list, max_length=1000)
+
+
+@api_router.post("/access/changes")
+async def access_changes(req: AccessChangesRequest, authorization: Optional[str] = Header(None)):
+    """
+    Enrollments, payments or PIN mappings of these members changed: re-read
+    only their rows into the school's access index (if it is loaded).
+    """
+    require_access_token(authorization)
+    try:
+        refreshed = await access_index.members_changed(req.school_id, req.user_ids, req.unregistered_athlete_ids)
+    except Exception as e:
+        # The next swipe must not see stale data: fall back to a full rebuild
+        logger.warning(f"Access index refresh for school {req.school_id} failed, dropping it: {e}")
+        access_index.invalidate(req.school_id)
+        refreshed = False
+    return {"status": "ok", "school_id": req.school_id, "refreshed": refreshed}
+
+
+def warm_up() -> None:
+    """
+    Build now what the first request would otherwise build lazily.
+    Serverless runtimes skip the lifespan hook, so api/index.py calls this at
+    import time. Only loop-independent parts: the PostgREST TLS context and h2
+    import (the bulk of the first-request penalty) and the local SQLite
+    stores. The HTTP pool itself is built on the first request's event loop.
+    """
+    started = time.perf_counter()
+    if supabase_http.configured:
+        supabase_http.prepare()
+    try:
+        webhook_queue.spool.open()
+        webhook_idempotency.open()
+    except (OSError, sqlite3.Error) as e:
+        # Not fatal: the stores open (and fail loudly) on the first webhook
+        logger.warning(f"Warm-up could not open the local stores under {VAR_DIR}: {e}")
+    logger.info(f"Warm-up done in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+
 # ============================================================================
 # Include routers
 # ============================================================================
@@ -0,0 +1,263 @@
+"""
+Shared HTTP client for Supabase / PostgREST.
+
+One AsyncClient per process, created in the FastAPI lifespan hook (or lazily on
+first use in serverless runtimes that skip lifespan events). Keep-alive and
+HTTP/2 let every payment route reuse warm connections instead of paying a
+TCP+TLS handshake per request.
+
+The client's connections belong to the event loop it was built on. A
+serverless runtime may run each invocation on a fresh loop, so the client is
+rebuilt (and the old one closed) when used from a different loop, like the
+background tasks' start() methods do.
+
+Tunable via environment:
+    SUPABASE_HTTP_MAX_CONNECTIONS    (default 20)
+    SUPABASE_HTTP_MAX_KEEPALIVE      (default 10)
+    SUPABASE_HTTP_KEEPALIVE_EXPIRY   seconds (default 30)
+    SUPABASE_HTTP_CONNECT_TIMEOUT    seconds (default 3)
+    SUPABASE_HTTP_TIMEOUT            seconds for read/write/pool (default 10)
+    SUPABASE_HTTP2                   "1"/"0" (default 1, needs the `h2` package)
+
+With a `Resilience` attached, calls also go through its per-call-site circuit
+breakers, request deadline and hedged GETs (see resilience.py).
+"""
+
+import asyncio
+import importlib.util
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional, Union
+
+import httpx
+
+from resilience import Resilience, ResilientTransport
+
+logger = logging.getLogger(__name__)
+
+# observer(call_site, seconds, status_code | "error" | "timeout")
+Observer = Callable[[str, float, Union[int, str]], None]
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 3.0
+    timeout: float = 10.0
+    http2: bool = True
+
+    @classmethod
+    def from_env(cls) -> "PoolConfig":
+        return cls(
+            max_connections=_env_int("SUPABASE_HTTP_MAX_CONNECTIONS", cls.max_connections),
+            max_keepalive_connections=_env_int("SUPABASE_HTTP_MAX_KEEPALIVE", cls.max_keepalive_connections),
+            keepalive_expiry=_env_float("SUPABASE_HTTP_KEEPALIVE_EXPIRY", cls.keepalive_expiry),
+            connect_timeout=_env_float("SUPABASE_HTTP_CONNECT_TIMEOUT", cls.connect_timeout),
+            timeout=_env_float("SUPABASE_HTTP_TIMEOUT", cls.timeout),
+            http2=os.environ.get("SUPABASE_HTTP2", "1").lower() not in ("0", "false", "no"),
+        )
+
+
+class _CountingTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps the real transport to track in-flight and total requests, and reports
+    each call to the observer labelled by the `call_site` request extension.
+    """
+
+    def __init__(self, inner: httpx.AsyncBaseTransport, owner: "SupabaseHTTP"):
+        self.inner = inner
+        self.owner = owner
+        self.in_flight = 0
+        self.requests_total = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.requests_total += 1
+        observer = self.owner.observer
+        start = time.perf_counter()
+        outcome: Union[int, str] = "error"
+        try:
+            response = await self.inner.handle_async_request(request)
+            outcome = response.status_code
+            return response
+        except httpx.TimeoutException:
+            outcome = "timeout"
+            raise
+        finally:
+            self.in_flight -= 1
+            if observer is not None:
+                observer(request.extensions.get("call_site", "other"), time.perf_counter() - start, outcome)
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
+
+
+class SupabaseHTTP:
+    """Process-wide pooled client with the service-role headers preset."""
+
+    def __init__(
+        self,
+        url: Optional[str],
+        service_key: Optional[str],
+        config: Optional[PoolConfig] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        resilience: Optional[Resilience] = None,
+    ):
+        self.url = url.rstrip("/") if url else url
+        self.service_key = service_key
+        self.config = config or PoolConfig.from_env()
+        self._transport_override = transport
+        self.resilience = resilience
+        self.observer: Optional[Observer] = None
+        self._transport: Optional[_CountingTransport] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ssl_context = None
+        self.rebuilds = 0
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.url and self.service_key)
+
+    def _http2_available(self) -> bool:
+        if not self.config.http2:
+            return False
+        if importlib.util.find_spec("h2") is None:
+            logger.warning("SUPABASE_HTTP2 enabled but the 'h2' package is missing; falling back to HTTP/1.1")
+            return False
+        return True
+
+    def _build(self) -> httpx.AsyncClient:
+        cfg = self.config
+        limits = httpx.Limits(
+            max_connections=cfg.max_connections,
+            max_keepalive_connections=cfg.max_keepalive_connections,
+            keepalive_expiry=cfg.keepalive_expiry,
+        )
+        inner = self._transport_override or httpx.AsyncHTTPTransport(
+            http2=self._http2_available(),
+            limits=limits,
+            verify=self.prepare(),
+        )
+        previous, self._transport = self._transport, _CountingTransport(inner, self)
+        if previous is not None:
+            self._transport.requests_total = previous.requests_total
+        transport: httpx.AsyncBaseTransport = self._transport
+        if self.resilience is not None:
+            transport = ResilientTransport(transport, self.resilience)
+        return httpx.AsyncClient(
+            base_url=self.url or "",
+            headers={
+                "apikey": self.service_key or "",
+                "Authorization": f"Bearer {self.service_key}",
+            },
+            timeout=httpx.Timeout(cfg.timeout, connect=cfg.connect_timeout),
+            transport=transport,
+        )
+
+    def prepare(self):
+        """
+        The loop-independent part of the pool, cached: the TLS context (CA
+        bundle load) and the h2 import. Safe at import time; the client itself
+        is built by open() on the first request's loop.
+        """
+        if self._ssl_context is None:
+            self._ssl_context = httpx.create_ssl_context()
+            if self._http2_available():
+                import h2.connection  # noqa: F401 - imported once here, not on the first request
+        return self._ssl_context
+
+    def open(self) -> httpx.AsyncClient:
+        """The pool for the running loop: built on first use, rebuilt if the loop changed."""
+        try:
+            loop: Optional[asyncio.AbstractEventLoop] = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        client = self._client
+        if client is not None and not client.is_closed and self._loop is not loop:
+            # Built on a previous invocation's loop: its connections are unusable here
+            self.rebuilds += 1
+            if loop is not None:
+                loop.create_task(self._discard(client))
+            client = None
+        if client is None or client.is_closed:
+            self._client = client = self._build()
+            self._loop = loop
+        return client
+
+    @staticmethod
+    async def _discard(client: httpx.AsyncClient) -> None:
+        try:
+            await client.aclose()
+        except Exception as e:  # the old loop may already be closed
+            logger.debug(f"Closing a Supabase client from a previous event loop failed: {e}")
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The shared client. Created on first access if lifespan did not run."""
+        return self.open()
+
+    async def start(self) -> None:
+        if self.configured:
+            self.open()
+            logger.info(
+                f"Supabase HTTP pool ready (max={self.config.max_connections}, "
+                f"keepalive={self.config.max_keepalive_connections}, http2={self._http2_available()})"
+            )
+
+    async def aclose(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        self._loop = None
+        self._transport = None
+
+    @staticmethod
+    def call_site(name: str) -> dict:
+        """Request extensions labelling a call for the observer (metrics per call site)."""
+        return {"call_site": name}
+
+    def stats(self) -> dict:
+        """Pool utilization snapshot for /api/health."""
+        stats = {
+            "configured": self.configured,
+            "open": self._client is not None and not self._client.is_closed,
+            "rebuilds": self.rebuilds,
+            "max_connections": self.config.max_connections,
+            "max_keepalive_connections": self.config.max_keepalive_connections,
+            "in_flight": 0,
+            "requests_total": 0,
+            "connections": 0,
+            "idle_connections": 0,
+            "utilization": 0.0,
+        }
+        if self._transport is None:
+            return stats
+        stats["in_flight"] = self._transport.in_flight
+        stats["requests_total"] = self._transport.requests_total
+        # httpcore exposes the live connection list on the pool; the httpx
+        # transport keeps the pool on a private attribute, so probe defensively.
+        pool = getattr(self._transport.inner, "_pool", None)
+        connections = getattr(pool, "connections", None) or []
+        stats["connections"] = len(connections)
+        stats["idle_connections"] = sum(1 for c in connections if c.is_idle())
+        stats["utilization"] = round(len(connections) / max(self.config.max_connections, 1), 3)
+        return stats
@@ -0,0 +1,229 @@
+import os
+import sys
+import unittest
+from datetime import date, timedelta
+from unittest.mock import patch
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from access_index import AccessIndex, SchoolAccessIndex, build_entries
+    from supabase_client import SupabaseHTTP
+    from ttl_cache import AsyncTTLCache
+
+SCHOOL = "2137182d-a695-4695-8e5a-61151fc59196"
+DEVICE = {"id": "5f0c8d43-6a9e-4c59-9d0e-0c1f2a3b4c5d", "school_id": SCHOOL, "direction": "entry"}
+
+
+def school_snapshot():
+    return {
+        "owner_id": "owner",
+        "staff": ["coach"],
+        "mappings": [
+            {"zk_pin": 1, "user_id": "owner"},
+            {"zk_pin": 2, "user_id": "coach"},
+            {"zk_pin": 3, "user_id": "ana"},
+            {"zk_pin": 4, "user_id": "luis"},
+            {"zk_pin": 5, "unregistered_athlete_id": "sofia"},
+            {"zk_pin": 6, "user_id": "marta"},
+            {"zk_pin": 7},
+        ],
+        "enrollments": [
+            {"user_id": "ana", "expires_at": "2026-06-30"},
+            {"user_id": "ana", "expires_at": "2026-12-31"},
+            {"user_id": "luis", "expires_at": "2026-12-31"},
+            {"unregistered_athlete_id": "sofia", "expires_at": None},
+        ],
+        "payments": [
+            {"user_id": "luis", "status": "overdue"},
+            {"unregistered_athlete_id": "sofia", "status": "paid"},
+        ],
+    }
+
+
+class TestRules(unittest.TestCase):
+
+    def test_entries_follow_validate_access(self):
+        index = SchoolAccessIndex(SCHOOL, build_entries(school_snapshot()))
+        today = date(2026, 7, 1)
+        decide = lambda pin: index.decide(pin, today)  # noqa: E731
+        self.assertEqual(len(index), 6)
+        self.assertTrue(decide(1).granted and decide(2).granted)
+        # Con dos matrículas activas cuenta la que dura más
+        self.assertEqual((decide(3).granted, decide(3).allowed_until), (True, date(2026, 12, 31)))
+        self.assertEqual(decide(4).reason, "payment_overdue")
+        self.assertEqual((decide(5).granted, decide(5).unregistered_athlete_id), (True, "sofia"))
+        self.assertEqual(decide(6).reason, "no_enrollment")
+        self.assertEqual(decide(7).reason, "unknown_user")
+        self.assertEqual(decide(None).reason, "unknown_user")
+
+    def test_expiry_is_checked_at_swipe_time(self):
+        index = SchoolAccessIndex(SCHOOL, build_entries(school_snapshot()))
+        self.assertTrue(index.decide(3, date(2026, 12, 31)).granted)
+        expired = index.decide(3, date(2027, 1, 1))
+        self.assertEqual((expired.granted, expired.reason, expired.user_id), (False, "enrollment_expired", "ana"))
+        # Vencida manda sobre la mora, como en el BFF
+        self.assertEqual(index.decide(4, date(2027, 1, 1)).reason, "enrollment_expired")
+        self.assertTrue(index.decide(1, date(2030, 1, 1)).granted)
+
+
+class TestIncrementalRefresh(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.snapshot = school_snapshot()
+        self.calls = []
+
+        async def snapshot_fn(school_id, user_ids, athlete_ids):
+            self.calls.append((school_id, user_ids, athlete_ids))
+            if user_ids is None and athlete_ids is None:
+                return self.snapshot
+            users, athletes = set(user_ids), set(athlete_ids)
+
+            def mine(row):
+                return row.get("user_id") in users or row.get("unregistered_athlete_id") in athletes
+
+            return {"owner_id": self.snapshot["owner_id"],
+                    "staff": [s for s in self.snapshot["staff"] if s in users],
+                    **{key: [row for row in self.snapshot[key] if mine(row)]
+                       for key in ("mappings", "enrollments", "payments")}}
+
+        async def payment_members(payment_ids):
+            return [{"school_id": SCHOOL, "user_id": "luis"}, {"school_id": "other-school", "user_id": "x"}]
+
+        self.index = AccessIndex(snapshot_fn, payment_members)
+
+    async def test_members_are_replaced_without_a_rebuild(self):
+        school = await self.index.school(SCHOOL)
+        self.assertIs(await self.index.school(SCHOOL), school)
+        # Marta se matricula y cambia de PIN; Luis paga
+        self.snapshot["mappings"][5] = {"zk_pin": 16, "user_id": "marta"}
+        self.snapshot["enrollments"].append({"user_id": "marta", "expires_at": "2026-09-30"})
+        self.snapshot["payments"][0] = {"user_id": "luis", "status": "paid"}
+        self.assertTrue(await self.index.members_changed(SCHOOL, ["marta"]))
+        self.assertEqual(await self.index.payments_changed(["pay-1", "pay-2"]), 1)
+
+        today = date(2026, 7, 1)
+        self.assertEqual(self.index.decide(school, 6, today).reason, "unknown_user")
+        self.assertTrue(self.index.decide(school, 16, today).granted)
+        self.assertTrue(self.index.decide(school, 4, today).granted)
+        self.assertTrue(self.index.decide(school, 3, today).granted)
+        self.assertEqual(self.calls, [(SCHOOL, None, None), (SCHOOL, ["marta"], []), (SCHOOL, ["luis"], [])])
+        stats = self.index.stats()
+        self.assertEqual((stats["builds"], stats["member_refreshes"], stats["decisions"], stats["denied"]),
+                         (1, 2, 4, 1))
+
+    async def test_new_enrollments_and_mappings_are_polled(self):
+        asked = []
+        # Un sondeo al construir (nada nuevo), otro con las altas, y uno que falla
+        answers = [[], [{"user_id": "marta"}, {"user_id": None, "unregistered_athlete_id": "pedro"}],
+                   RuntimeError("timeout")]
+
+        async def changes_fn(school_id, since):
+            asked.append(since)
+            answer = answers[min(len(asked), len(answers)) - 1]
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        index = AccessIndex(self.index._snapshot, changes_fn=changes_fn, poll_interval=0)
+        school = await index.school(SCHOOL)
+        # Marta se matricula y Pedro recibe PIN: los ve el sondeo, sin reconstruir el colegio
+        self.snapshot["enrollments"].append({"user_id": "marta", "expires_at": "2026-09-30"})
+        self.snapshot["mappings"].append({"zk_pin": 8, "unregistered_athlete_id": "pedro"})
+        self.snapshot["enrollments"].append({"unregistered_athlete_id": "pedro", "expires_at": None})
+        self.assertIs(await index.school(SCHOOL), school)
+        today = date(2026, 7, 1)
+        self.assertTrue(index.decide(school, 6, today).granted and index.decide(school, 8, today).granted)
+        self.assertEqual(self.calls[-1], (SCHOOL, ["marta"], ["pedro"]))
+        # Un sondeo fallido no tumba la consulta
+        self.assertIs(await index.school(SCHOOL), school)
+        stats = index.stats()
+        self.assertEqual((stats["builds"], stats["polls"], stats["poll_errors"]), (1, 2, 1))
+        self.assertLess(asked[2] - asked[1], timedelta(seconds=1))
+        self.assertLess(asked[0].timestamp(), school.built_at - AccessIndex.POLL_OVERLAP + 1)
+
+        # Con el intervalo sin cumplir no se pregunta
+        index.poll_interval = 3600
+        await index.school(SCHOOL)
+        self.assertEqual(len(asked), 3)
+
+    async def test_changes_for_schools_not_loaded_are_skipped(self):
+        self.assertFalse(await self.index.members_changed(SCHOOL, ["ana"]))
+        self.assertEqual(await self.index.payments_changed(["pay-1"]), 0)
+        self.assertEqual(self.calls, [])
+
+
+class TestAccessRoutes(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.reads = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            path = request.url.path
+            self.reads.append(path)
+            if path == "/rest/v1/turnstile_devices":
+                known = request.url.params["serial_number"] == "eq.JJA1254900898"
+                return httpx.Response(200, json=[DEVICE] if known else [])
+            if int(request.url.params.get("offset", 0)) > 0:
+                return httpx.Response(200, json=[])
+            rows = {
+                "/rest/v1/schools": [{"owner_id": "owner"}],
+                "/rest/v1/zk_user_mappings": [{"zk_pin": 3, "user_id": "ana", "unregistered_athlete_id": None}],
+                "/rest/v1/enrollments": [{"user_id": "ana", "unregistered_athlete_id": None,
+                                          "expires_at": "2099-12-31"}],
+            }
+            return httpx.Response(200, json=rows.get(path, []))
+
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        store = server.store_from_env(lambda: fake)
+        for target, value in (("supabase_http", fake), ("data_store", store), ("device_cache", AsyncTTLCache()),
+                              ("access_index", AccessIndex(store.access_snapshot)),
+                              ("ACCESS_API_TOKEN", "bff-token")):
+            patcher = patch.object(server, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bff")
+        self.addAsyncCleanup(self.client.aclose)
+        self.auth = {"Authorization": "Bearer bff-token"}
+
+    async def test_validate_reads_the_school_once(self):
+        params = {"SN": "JJA1254900898", "pin": 3}
+        first = await self.client.get("/api/access/validate", params=params, headers=self.auth)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual((first.json()["granted"], first.json()["user_id"], first.json()["allowed_until"]),
+                         (True, "ana", "2099-12-31"))
+        reads = len(self.reads)
+        for pin in (3, 9, 0):
+            resp = await self.client.get("/api/access/validate", params=dict(params, pin=pin), headers=self.auth)
+            self.assertEqual(resp.json()["granted"], pin == 3)
+        # Sin consultas por persona: todo sale del índice en memoria
+        self.assertEqual(len(self.reads), reads)
+
+        unknown = await self.client.get("/api/access/validate", params=dict(params, SN="OTHER"), headers=self.auth)
+        self.assertEqual(unknown.status_code, 404)
+        self.assertEqual((await self.client.get("/api/access/validate", params=params)).status_code, 401)
+
+    async def test_changes_refresh_only_those_members(self):
+        body = {"school_id": SCHOOL, "user_ids": ["ana"]}
+        cold = await self.client.post("/api/access/changes", json=body, headers=self.auth)
+        self.assertEqual(cold.json()["refreshed"], False)
+        await server.access_index.school(SCHOOL)
+        self.reads.clear()
+        warm = await self.client.post("/api/access/changes", json=body, headers=self.auth)
+        self.assertEqual(warm.json()["refreshed"], True)
+        self.assertNotIn("/rest/v1/turnstile_devices", self.reads)
+        with patch.object(server, "ACCESS_API_TOKEN", None):
+            resp = await self.client.post("/api/access/changes", json=body, headers=self.auth)
+        self.assertEqual(resp.status_code, 503)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+from zoneinfo import ZoneInfo
+
+import httpx
+import orjson
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from access_index import AccessIndex
+    from access_ingest import (AccessEventWriter, AttlogIngestor, SlidingWindowDedup, iter_lines,
+                               parse_attlog_line)
+    from supabase_client import SupabaseHTTP
+    from ttl_cache import AsyncTTLCache
+
+BOGOTA = ZoneInfo("America/Bogota")
+DEVICE = {"id": "5f0c8d43-6a9e-4c59-9d0e-0c1f2a3b4c5d", "school_id": "2137182d-a695-4695-8e5a-61151fc59196",
+          "direction": "entry"}
+# Lo que lee el índice de acceso: el PIN 2 es un deportista con matrícula vigente
+SCHOOL_ROWS = {
+    "/rest/v1/schools": [{"owner_id": "owner-1"}],
+    "/rest/v1/zk_user_mappings": [{"zk_pin": 2, "user_id": "athlete-2", "unregistered_athlete_id": None}],
+    "/rest/v1/enrollments": [{"user_id": "athlete-2", "unregistered_athlete_id": None, "expires_at": "2026-12-31"}],
+}
+
+
+def attlog(count, start=0, pin=2):
+    """`count` líneas ATTLOG de un mismo PIN, una por minuto."""
+    base = datetime(2026, 6, 27, 6, 0)
+    return "".join(f"{pin}\t{(base + timedelta(minutes=i)):%Y-%m-%d %H:%M:%S}\t0\t1\t0\t0\t0\n"
+                   for i in range(start, start + count))
+
+
+async def chunked(body: bytes, size: int):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+class TestParsing(unittest.IsolatedAsyncioTestCase):
+
+    async def test_lines_split_across_chunks(self):
+        body = b"2\t2026-06-27 06:00:00\t0\t3\n\n7\t2026-06-27 06:01:00\t0\t2\t0\n8\t2026-06-27 06:02:00"
+        lines = [line async for line in iter_lines(chunked(body, 5))]
+        self.assertEqual(len(lines), 3)
+        first = parse_attlog_line(lines[0], BOGOTA)
+        self.assertEqual(first.occurred_at.astimezone(timezone.utc), datetime(2026, 6, 27, 11, 0, tzinfo=timezone.utc))
+        self.assertEqual((first.zk_user_id, first.check_in_method), (2, "pin"))
+        self.assertEqual(parse_attlog_line(lines[1], BOGOTA).check_in_method, "card")
+        self.assertEqual(parse_attlog_line(lines[2], BOGOTA).check_in_method, "fingerprint")
+        self.assertIsNone(parse_attlog_line("2\tayer", BOGOTA))
+        self.assertIsNone(parse_attlog_line("\t2026-06-27 06:00:00", BOGOTA))
+        # Un PIN que no cabe en el int4 de zk_user_id tumbaría el lote entero
+        self.assertIsNone(parse_attlog_line("99999999999\t2026-06-27 06:00:00", BOGOTA).zk_user_id)
+
+    async def test_overlong_lines_are_cut(self):
+        body = b"2\t2026-06-27 06:00:00\t0\t3" + b"x" * 5000 + b"\n" + b"y" * 5000 + b"\n7\t2026-06-27 06:01:00"
+        lines = [line async for line in iter_lines(chunked(body, 300), max_line=64)]
+        # Cada línea cuenta para el ACK, pero nunca se guarda más de max_line de ella
+        self.assertEqual([len(line) for line in lines], [64, 64, 21])
+        self.assertEqual(parse_attlog_line(lines[0], BOGOTA).zk_user_id, 2)
+
+
+class TestSlidingWindow(unittest.TestCase):
+
+    def test_repeats_refresh_and_old_keys_expire(self):
+        now = [0.0]
+        dedup = SlidingWindowDedup(window=10, max_keys=3, clock=lambda: now[0])
+        self.assertFalse(dedup.seen("a"))
+        now[0] = 8
+        self.assertTrue(dedup.seen("a"))
+        now[0] = 16
+        # "a" se refrescó en t=8, sigue dentro de la ventana
+        self.assertTrue(dedup.seen("a"))
+        self.assertFalse(dedup.seen("b"))
+        now[0] = 30
+        self.assertFalse(dedup.seen("a"))
+        for key in "cde":
+            dedup.seen(key)
+        self.assertEqual((len(dedup), dedup.evictions), (3, 1))
+        dedup.forget(["e"])
+        self.assertFalse(dedup.seen("e"))
+
+
+def fake_database():
+    """PostgREST falso: un lector conocido, su colegio y access_events con el índice único de dedup."""
+    state = {"keys": set(), "inserts": [], "lookups": 0, "rows": []}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/rest/v1/turnstile_devices":
+            state["lookups"] += 1
+            known = request.url.params["serial_number"] == "eq.JJA1254900898"
+            return httpx.Response(200, json=[DEVICE] if known else [])
+        if request.method == "GET":
+            rows = SCHOOL_ROWS.get(request.url.path, [])
+            offset = int(request.url.params.get("offset", 0))
+            return httpx.Response(200, json=rows[offset:] if offset == 0 else [])
+        assert request.url.params["on_conflict"] == "device_id,zk_user_id,occurred_at"
+        assert "resolution=ignore-duplicates" in request.headers["prefer"]
+        if state.get("down"):
+            return httpx.Response(503, json={"message": "connection refused"})
+        rows = orjson.loads(request.content)
+        state["inserts"].append(len(rows))
+        state["rows"].extend(rows)
+        new = []
+        for row in rows:
+            key = (row["device_id"], row["zk_user_id"], row["occurred_at"])
+            if key not in state["keys"]:
+                state["keys"].add(key)
+                new.append({"id": str(len(state["keys"]))})
+        return httpx.Response(201, json=new)
+
+    return SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler)), state
+
+
+class TestAttlogRoute(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        fake, self.db = fake_database()
+        self.writer = AccessEventWriter(server.write_access_events, max_batch=100, max_buffer=1000)
+        ingestor = AttlogIngestor(self.writer, SlidingWindowDedup(), BOGOTA, chunk=50)
+        for target, value in (("supabase_http", fake), ("data_store", server.store_from_env(lambda: fake)),
+                              ("device_cache", AsyncTTLCache()), ("access_writer", self.writer),
+                              ("attlog_ingestor", ingestor),
+                              ("access_index", AccessIndex(lambda *args: server.data_store.access_snapshot(*args)))):
+            patcher = patch.object(server, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Mismo loop que la prueba: el writer arranca con la primera subida
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://reader")
+        self.addAsyncCleanup(self.client.aclose)
+        self.addAsyncCleanup(self.writer.stop)
+
+    async def push(self, body: str, serial="JJA1254900898", headers=None):
+        return await self.client.post("/api/iclock/cdata", params={"SN": serial, "table": "ATTLOG"},
+                                      content=chunked(body.encode(), 97), headers=headers)
+
+    async def test_bursts_are_acked_and_written_once(self):
+        # El F22 reenvía el mismo bloque de 128 y luego uno que se solapa
+        for body in (attlog(128), attlog(128), attlog(128, start=100)):
+            resp = await self.push(body)
+            self.assertEqual((resp.status_code, resp.text), (200, "OK: 128"))
+        await self.writer.stop()
+
+        self.assertEqual(len(self.db["keys"]), 228)
+        # Una sentencia por lote de hasta 100 filas, nunca una por evento
+        self.assertEqual(sum(self.db["inserts"]), 228)
+        self.assertTrue(all(n <= 100 for n in self.db["inserts"]) and len(self.db["inserts"]) <= 4)
+        self.assertEqual(self.db["lookups"], 1)
+        stats = server.attlog_ingestor.stats()
+        self.assertEqual((stats["records"], stats["duplicates"]), (384, 156))
+        self.assertEqual((stats["writer_inserted"], stats["writer_conflicts"]), (228, 0))
+        # Cada evento sale decidido del índice del colegio, construido una sola vez
+        self.assertTrue(all(row["access_granted"] and row["user_id"] == "athlete-2" for row in self.db["rows"]))
+        self.assertEqual(server.access_index.stats()["builds"], 1)
+
+    async def test_full_buffer_is_not_acked_and_the_resend_gets_through(self):
+        self.writer.max_buffer = 100
+        resp = await self.push(attlog(160))
+        self.assertEqual(resp.status_code, 503)
+        await self.writer.flush()
+        resp = await self.push(attlog(160))
+        self.assertEqual(resp.text, "OK: 160")
+        await self.writer.stop()
+        self.assertEqual(len(self.db["keys"]), 160)
+
+    async def test_failed_inserts_are_kept_and_retried_with_backoff(self):
+        # Filas ya confirmadas al lector: una caída larga no las descarta
+        calls = []
+
+        async def down_then_up(rows):
+            calls.append(len(rows))
+            if len(calls) <= 6:
+                raise RuntimeError("connection refused")
+            return len(rows)
+
+        now = [0.0]
+        writer = AccessEventWriter(down_then_up, interval=1, max_batch=10, max_buffer=30, max_delay=8,
+                                   clock=lambda: now[0])
+        self.assertTrue(writer.submit([{"n": i} for i in range(25)]))
+        for _ in range(6):
+            self.assertFalse(await writer.flush())
+        self.assertEqual((writer.stats()["buffered"], writer._retry_at), (25, 8))
+        # Lleno: la siguiente subida no entra y el lector recibe 503
+        self.assertFalse(writer.submit([{"n": i} for i in range(10)]))
+        self.assertTrue(await writer.flush())
+        self.assertEqual((writer.stats()["buffered"], writer.stats()["inserted"], calls[6:]), (0, 25, [10, 10, 5]))
+
+    async def test_inline_writer_acks_only_what_it_wrote(self):
+        # Serverless: el buffer puede morir con la instancia, así que el ACK espera al INSERT
+        now = [0.0]
+        writer = AccessEventWriter(server.write_access_events, max_batch=100, max_buffer=1000, max_delay=8,
+                                   clock=lambda: now[0], inline=True)
+        ingestor = AttlogIngestor(writer, SlidingWindowDedup(), BOGOTA, chunk=50)
+        self.addAsyncCleanup(writer.stop)
+        with patch.object(server, "access_writer", writer), patch.object(server, "attlog_ingestor", ingestor):
+            self.db["down"] = True
+            self.assertEqual((await self.push(attlog(40))).status_code, 503)
+            self.db["down"] = False
+            # Durante el backoff tampoco se confirma; el lector reenvía después de ErrorDelay
+            self.assertEqual((await self.push(attlog(40))).status_code, 503)
+            now[0] = 10
+            resp = await self.push(attlog(40))
+            self.assertEqual((resp.status_code, resp.text), (200, "OK: 40"))
+            # Ya escritas al responder, sin esperar al flush de fondo
+            self.assertEqual((len(self.db["keys"]), writer.stats()["buffered"]), (40, 0))
+
+    async def test_unknown_readers_and_other_tables(self):
+        self.assertEqual((await self.push(attlog(3), serial="OTHER")).text, "OK")
+        resp = await self.client.post("/api/iclock/cdata", params={"SN": "JJA1254900898", "table": "OPERLOG"},
+                                      content=b"OPLOG 4\t0\t2026-06-27 06:00:00")
+        self.assertEqual(resp.text, "OK")
+        with patch.object(server, "ACCESS_DEVICE_IP_ALLOWLIST", {"181.63.24.103"}), \
+                patch.object(server.admission_control, "trusted_proxies", 1):
+            blocked = await self.push(attlog(3), headers={"X-Forwarded-For": "203.0.113.9"})
+            allowed = await self.push(attlog(3), headers={"X-Forwarded-For": "181.63.24.103"})
+        self.assertEqual((blocked.status_code, allowed.text), (403, "OK: 3"))
+        await self.writer.stop()
+        self.assertEqual(len(self.db["keys"]), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+import os
+import sys
+
+import httpx
+import orjson
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from audit_log import CHECKSUM_MISMATCH, SIGNATURE_BLOCKED, AuditLogWriter
+    from idempotency import IdempotencyStore
+    from supabase_client import SupabaseHTTP
+    from ttl_cache import AsyncTTLCache
+    from webhook_archive import WebhookArchive
+    from webhook_queue import WebhookQueue, WebhookSpool
+
+SCHOOL_ID = "6f1c2a8e-4b7d-4e0a-9c1f-2d3e4f5a6b7c"
+
+
+class FakeSink:
+    """flush_fn falso: guarda cada lote; falla las primeras `failures` llamadas."""
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+
+    async def __call__(self, rows):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("db down")
+        self.batches.append(rows)
+
+
+class TestAuditLogWriter(unittest.IsolatedAsyncioTestCase):
+
+    async def test_size_threshold_wakes_the_flusher(self):
+        sink = FakeSink()
+        writer = AuditLogWriter(sink, interval=60, max_batch=3)
+        await writer.start()
+        for i in range(7):
+            writer.record(SIGNATURE_BLOCKED, school_id=SCHOOL_ID, metadata={"reference": f"R{i}"})
+        await asyncio.sleep(0.01)
+        # Al llenarse un lote sale todo el buffer, sin esperar el intervalo
+        self.assertEqual([len(b) for b in sink.batches], [3, 3, 1])
+        writer.record(SIGNATURE_BLOCKED, school_id=SCHOOL_ID)
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(sink.batches), 3)
+        # stop() escribe lo que quedó
+        await writer.stop()
+        self.assertEqual([len(b) for b in sink.batches], [3, 3, 1, 1])
+        self.assertEqual(writer.stats()["written"], 8)
+        self.assertEqual(sink.batches[0][0]["school_id"], SCHOOL_ID)
+
+    async def test_interval_flush(self):
+        sink = FakeSink()
+        writer = AuditLogWriter(sink, interval=0.02, max_batch=100)
+        await writer.start()
+        writer.record(CHECKSUM_MISMATCH, ip_address="203.0.113.9", user_agent="curl")
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(sink.batches), 1)
+        row = sink.batches[0][0]
+        self.assertEqual((row["ip_address"], row["user_agent"]), ("203.0.113.9", "curl"))
+        await writer.stop()
+
+    async def test_bounded_buffer_and_retries(self):
+        sink = FakeSink(failures=2)
+        writer = AuditLogWriter(sink, max_batch=10, max_buffer=4, max_attempts=2)
+        for i in range(6):
+            writer.record(SIGNATURE_BLOCKED, school_id="not-a-uuid", ip_address="testclient")
+        self.assertEqual(writer.stats()["dropped"], 2)
+
+        # Primer fallo: vuelven al buffer; segundo: se agotan los intentos
+        await writer.flush()
+        self.assertEqual(writer.stats()["buffered"], 4)
+        await writer.flush()
+        self.assertEqual((writer.stats()["buffered"], writer.stats()["dropped"]), (0, 6))
+
+        writer.record(SIGNATURE_BLOCKED, school_id="not-a-uuid")
+        await writer.flush()
+        row = sink.batches[0][0]
+        # Un school_id que no es uuid rompería la FK: va a metadata
+        self.assertIsNone(row["school_id"])
+        self.assertEqual(row["metadata"]["school_id"], "not-a-uuid")
+        self.assertIsNone(row["ip_address"])
+
+
+class TestSecurityEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.posts = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.method == "POST":
+                self.posts.append((request.url.path, orjson.loads(request.content)))
+                return httpx.Response(201)
+            return httpx.Response(200, json=[{"payment_settings": {"allow_online": False}}])
+
+        self.writer = AuditLogWriter(server.write_audit_rows)
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        self.patches = [
+            patch.object(server, "audit_writer", self.writer),
+            patch.object(server, "supabase_http", fake),
+            patch.object(server, "payment_settings_cache", AsyncTTLCache()),
+            patch.object(server, "webhook_queue", WebhookQueue(WebhookSpool(":memory:"), server.apply_wompi_event)),
+            patch.object(server, "webhook_idempotency", IdempotencyStore(":memory:")),
+            patch.object(server, "webhook_archive", WebhookArchive(None)),
+            patch.object(server.admission_control, "trusted_proxies", 1),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+    def test_blocked_signatures_and_bad_checksums_are_audited(self):
+        from fastapi.testclient import TestClient
+
+        client = TestClient(server.app)
+        headers = {"X-Forwarded-For": "198.51.100.4", "User-Agent": "checkout/1.0"}
+        resp = client.post("/api/payments/wompi/create-signature", headers=headers,
+                           json={"reference": "SM-1", "amount_in_cents": 150000, "school_id": SCHOOL_ID})
+        self.assertEqual(resp.status_code, 403)
+        resp = client.post("/api/payments/wompi/create-signatures", headers=headers, json={"items": [
+            {"reference": "SM-2", "amount_in_cents": 150000, "school_id": SCHOOL_ID},
+            {"reference": "SM-3", "amount_in_cents": 150000},
+        ]})
+        self.assertEqual(resp.json()["failed"], 1)
+        resp = client.post("/api/payments/wompi/webhook", json={
+            "event": "transaction.updated",
+            "data": {"transaction": {"id": "tx-9", "reference": "SM-9", "status": "APPROVED"}},
+            "signature": {"properties": ["transaction.id"], "checksum": "0" * 64},
+            "timestamp": 1700000000,
+        })
+        self.assertEqual(resp.status_code, 401)
+
+        # Nada salió a la base de datos durante las peticiones
+        self.assertEqual(self.posts, [])
+        self.assertEqual(self.writer.stats()["buffered"], 3)
+        asyncio.run(self.writer.flush())
+
+        self.assertEqual(len(self.posts), 1)
+        path, rows = self.posts[0]
+        self.assertEqual(path, "/rest/v1/audit_log")
+        self.assertEqual([r["action"] for r in rows], [SIGNATURE_BLOCKED, SIGNATURE_BLOCKED, CHECKSUM_MISMATCH])
+        self.assertEqual([r["metadata"]["reference"] for r in rows], ["SM-1", "SM-2", "SM-9"])
+        self.assertEqual((rows[0]["ip_address"], rows[0]["user_agent"]), ("198.51.100.4", "checkout/1.0"))
+        self.assertEqual(rows[0]["school_id"], SCHOOL_ID)
+        self.assertEqual(rows[2]["metadata"]["transaction_id"], "tx-9")
+
+    def test_routes_start_the_writer_without_lifespan(self):
+        # Como en Vercel: sin lifespan, y un event loop nuevo por invocación
+        self.writer.interval = 0.01
+
+        async def invocation(reference):
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                resp = await client.post("/api/payments/wompi/create-signature", json={
+                    "reference": reference, "amount_in_cents": 150000, "school_id": SCHOOL_ID})
+            self.assertEqual(resp.status_code, 403)
+            await asyncio.sleep(0.1)
+
+        asyncio.run(invocation("SM-1"))
+        asyncio.run(invocation("SM-2"))
+        self.assertEqual([rows[0]["metadata"]["reference"] for _, rows in self.posts], ["SM-1", "SM-2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
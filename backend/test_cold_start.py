@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BACKEND_DIR)
+sys.path.append(os.path.join(BACKEND_DIR, "benchmarks"))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from cold_start import measure_cold_import
+    from idempotency import IdempotencyStore
+    from supabase_client import SupabaseHTTP
+    from webhook_queue import WebhookQueue, WebhookSpool
+
+# Holgado para runners de CI compartidos; localmente la importación en frío
+# (con warm-up) ronda los 0.25s.
+COLD_START_BUDGET_SECONDS = float(os.environ.get("COLD_START_BUDGET_SECONDS", 1.5))
+
+
+class TestColdStart(unittest.TestCase):
+
+    def test_cold_import_of_vercel_entrypoint_within_budget(self):
+        """Importar api.index en un intérprete nuevo (incluido el warm-up) cabe en el presupuesto."""
+        with tempfile.TemporaryDirectory() as var_dir:
+            seconds = measure_cold_import(warmup=True, var_dir=var_dir)["seconds"]
+            self.assertTrue(os.path.exists(os.path.join(var_dir, "webhook_spool.db")))
+        self.assertLess(seconds, COLD_START_BUDGET_SECONDS,
+                        f"cold import of api.index took {seconds:.3f}s "
+                        f"(budget {COLD_START_BUDGET_SECONDS}s); see benchmarks/cold_start.py")
+
+    def test_warm_up_prepares_pool_and_stores(self):
+        """warm_up deja listos el TLS de PostgREST y los stores SQLite; el pool se arma en el loop del request."""
+        pool = SupabaseHTTP("https://fake.supabase.co", "fake-key",
+                            transport=httpx.MockTransport(lambda request: httpx.Response(200, json=[])))
+        spool = WebhookSpool(":memory:")
+        idempotency = IdempotencyStore(":memory:")
+        with patch.object(server, "supabase_http", pool), \
+                patch.object(server, "webhook_queue", WebhookQueue(spool, server.apply_wompi_event)), \
+                patch.object(server, "webhook_idempotency", idempotency):
+            self.assertFalse(pool.stats()["open"])
+            server.warm_up()
+        self.assertFalse(pool.stats()["open"])
+        self.assertIsNotNone(pool._ssl_context)
+        self.assertIsNotNone(spool._conn)
+        self.assertIsNotNone(idempotency._conn)
+
+
+if __name__ == '__main__':
+    unittest.main()
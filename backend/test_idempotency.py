@@ -0,0 +1,83 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from idempotency import IdempotencyStore
+    from supabase_client import SupabaseHTTP
+    from test_webhook_queue import signed_event
+    from webhook_archive import WebhookArchive
+    from webhook_queue import WebhookQueue, WebhookSpool
+
+
+class TestIdempotencyStore(unittest.TestCase):
+
+    def test_keys_persist_behind_a_small_lru(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "idem.db")
+            store = IdempotencyStore(path, lru_size=1)
+            self.assertFalse(store.seen("a"))
+            self.assertTrue(store.record("a"))
+            self.assertTrue(store.record("b"))  # saca "a" del LRU
+            self.assertFalse(store.record("a"))
+            store.close()
+
+            reopened = IdempotencyStore(path)
+            self.assertTrue(reopened.seen("a"))
+            self.assertTrue(reopened.seen("a"))
+            self.assertEqual(reopened.lru_hits, 1)
+            self.assertEqual(reopened.stats()["duplicate_ratio"], 1.0)
+            reopened.close()
+
+    def test_prune_and_forget(self):
+        store = IdempotencyStore(":memory:", retention=-1)
+        store.record("old")
+        self.assertEqual(store.prune(), 1)
+        store.record("k")
+        store.forget("k")
+        self.assertFalse(store.seen("k"))
+
+
+class TestDuplicateDeliveries(unittest.TestCase):
+
+    def test_redelivery_is_answered_without_queueing(self):
+        from fastapi.testclient import TestClient
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, json=[{"receipt_number": "REF-1"}])
+
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        spool = WebhookSpool(":memory:")
+        # Sin lifespan, como en Vercel: cada evento se aplica antes de responder
+        queue = WebhookQueue(spool, server.apply_wompi_event, inline=True)
+        store = IdempotencyStore(":memory:")
+        with patch.object(server, "supabase_http", fake), patch.object(server, "webhook_queue", queue), \
+                patch.object(server, "webhook_idempotency", store), \
+                patch.object(server, "webhook_archive", WebhookArchive(None)):
+            client = TestClient(server.app)
+            first = client.post("/api/payments/wompi/webhook", json=signed_event()).json()
+            again = [client.post("/api/payments/wompi/webhook", json=signed_event()).json() for _ in range(3)]
+            newer = client.post("/api/payments/wompi/webhook", json=signed_event(timestamp=1700000099)).json()
+
+        self.assertTrue(first["processed"])
+        for body in again:
+            self.assertEqual((body["processed"], body["duplicate"]), (False, True))
+        self.assertTrue(newer["processed"])
+        self.assertEqual(fake.stats()["requests_total"], 2)
+        self.assertEqual(store.stats()["duplicates"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import io
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import unittest
+from unittest.mock import patch
+
+import orjson
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from logging_setup import (JsonFormatter, Redactor, RequestContextFilter, _PreparedQueueHandler,
+                               request_id_var)
+
+
+class TestLoggingPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        output = logging.StreamHandler(self.stream)
+        output.setFormatter(JsonFormatter(Redactor(["test_secret_123"])))
+        self.queue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(self.queue, output)
+        self.listener.start()
+        self.handler = _PreparedQueueHandler(self.queue)
+        self.filter = RequestContextFilter(sample_rate=1.0)
+        self.handler.addFilter(self.filter)
+        self.logger = logging.getLogger("test.pipeline")
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+
+    def lines(self):
+        self.listener.stop()
+        self.listener.start()
+        return [orjson.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_json_with_request_id_and_redaction(self):
+        token = request_id_var.set("req-42")
+        try:
+            self.logger.info("signing ref=SM-000123 with test_secret_123 auth=Bearer eyJhbGciOi.x.y")
+        finally:
+            request_id_var.reset(token)
+        entry = self.lines()[0]
+        self.assertEqual(entry["request_id"], "req-42")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertIn("ref=***0123", entry["msg"])
+        self.assertNotIn("test_secret_123", entry["msg"])
+        self.assertNotIn("eyJhbGciOi", entry["msg"])
+
+    def test_errors_keep_traceback_and_bypass_sampling(self):
+        self.filter.sample_rate = 0.0
+        self.logger.info("dropped")
+        try:
+            raise ValueError("boom for ref=SM-000999")
+        except ValueError:
+            self.logger.exception("failed")
+        entries = self.lines()
+        self.assertEqual([e["msg"] for e in entries], ["failed"])
+        self.assertIn("ValueError", entries[0]["exc"])
+        self.assertIn("ref=***0999", entries[0]["exc"])
+
+    def test_sampling_is_per_request(self):
+        self.filter.sample_rate = 0.5
+        kept = 0
+        for i in range(200):
+            token = request_id_var.set(f"req-{i}")
+            try:
+                record = logging.LogRecord("x", logging.INFO, __file__, 1, "a", None, None)
+                first = self.filter.filter(record)
+                second = self.filter.filter(logging.LogRecord("x", logging.INFO, __file__, 1, "b", None, None))
+            finally:
+                request_id_var.reset(token)
+            self.assertEqual(first, second)
+            kept += first
+        self.assertTrue(50 < kept < 150)
+
+
+class TestRequestIdMiddleware(unittest.TestCase):
+
+    def test_echoes_or_generates_request_id(self):
+        from fastapi.testclient import TestClient
+
+        client = TestClient(server.app)
+        self.assertEqual(client.get("/api/", headers={"X-Request-ID": "abc-123"}).headers["x-request-id"], "abc-123")
+        self.assertEqual(len(client.get("/api/").headers["x-request-id"]), 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from idempotency import IdempotencyStore
+    from metrics import Registry
+    from supabase_client import SupabaseHTTP
+    from test_webhook_queue import signed_event
+    from ttl_cache import AsyncTTLCache
+    from webhook_archive import WebhookArchive
+    from webhook_queue import WebhookQueue, WebhookSpool
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_histogram_exposition(self):
+        registry = Registry()
+        hist = registry.histogram("lat_seconds", "latency", ("route",), buckets=(0.1, 1.0))
+        hist.observe(0.05, "/a")
+        hist.observe(0.5, "/a")
+        hist.observe(3, "/a")
+        text = registry.render()
+        self.assertIn('lat_seconds_bucket{route="/a",le="0.1"} 1', text)
+        self.assertIn('lat_seconds_bucket{route="/a",le="1.0"} 2', text)
+        self.assertIn('lat_seconds_bucket{route="/a",le="+Inf"} 3', text)
+        self.assertIn('lat_seconds_count{route="/a"} 3', text)
+        self.assertIn("# TYPE lat_seconds histogram", text)
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+
+    def test_routes_upstream_and_webhook_metrics(self):
+        from fastapi.testclient import TestClient
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, json=[{"payment_settings": {"allow_online": True}}])
+
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        fake.observer = server.observe_supabase
+        bad = signed_event()
+        bad["signature"]["checksum"] = "0" * 64
+        with patch.object(server, "supabase_http", fake), \
+                patch.object(server, "payment_settings_cache", AsyncTTLCache()), \
+                patch.object(server, "webhook_queue", WebhookQueue(WebhookSpool(":memory:"), server.apply_wompi_event)), \
+                patch.object(server, "webhook_idempotency", IdempotencyStore(":memory:")), \
+                patch.object(server, "webhook_archive", WebhookArchive(None)):
+            client = TestClient(server.app)
+            client.post("/api/payments/wompi/create-signature",
+                        json={"reference": "R1", "amount_in_cents": 100, "school_id": "s-metrics"})
+            client.post("/api/payments/wompi/webhook", json=bad)
+            client.get("/api/payments/wompi/transaction/R-metrics")
+            text = client.get("/api/metrics").text
+
+        self.assertIn('route="/api/payments/wompi/create-signature"', text)
+        self.assertIn('route="/api/payments/wompi/transaction/{reference}"', text)
+        self.assertNotIn('route="/api/payments/wompi/transaction/R-metrics"', text)
+        self.assertIn('sportmaps_supabase_responses_total{call_site="settings_lookup",status="200"}', text)
+        self.assertIn('sportmaps_supabase_request_duration_seconds_count{call_site="transaction_lookup"}', text)
+        self.assertIn("sportmaps_wompi_webhook_checksum_failures_total", text)
+        self.assertIn("sportmaps_http_requests_in_flight", text)
+        self.assertIn("sportmaps_webhook_idempotency_duplicate_ratio", text)
+
+    def test_metrics_token(self):
+        from fastapi.testclient import TestClient
+
+        with patch.object(server, "METRICS_TOKEN", "s3cret"), \
+                patch.object(server, "webhook_queue", WebhookQueue(WebhookSpool(":memory:"), server.apply_wompi_event)), \
+                patch.object(server, "webhook_idempotency", IdempotencyStore(":memory:")), \
+                patch.object(server, "webhook_archive", WebhookArchive(None)):
+            client = TestClient(server.app)
+            self.assertEqual(client.get("/api/metrics").status_code, 401)
+            ok = client.get("/api/metrics", headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(ok.status_code, 200)
+        self.assertTrue(ok.headers["content-type"].startswith("text/plain"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+import httpx
+import orjson
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from notification_fanout import FanoutWorker
+    from supabase_client import SupabaseHTTP
+
+SCHOOL = "2137182d-a695-4695-8e5a-61151fc59196"
+ANNOUNCEMENT = "9a1f7c2e-3b4d-4e5f-8a6b-7c8d9e0f1a2b"
+
+
+class FakeFanout:
+    """fan_out_announcement_chunk en memoria: cursor, destinatarios sin repetir y progreso acumulado."""
+
+    def __init__(self, recipients, published=(ANNOUNCEMENT,)):
+        self.recipients = sorted(set(recipients))
+        self.published = set(published)
+        self.notified = []
+        self.progress = {}
+        self.calls = 0
+        self.failures = 0
+
+    async def chunk(self, school_id, announcement_id, limit):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("statement timeout")
+        if school_id != SCHOOL or announcement_id not in self.published:
+            return None
+        row = self.progress.setdefault(announcement_id, {"announcement_id": announcement_id, "status": "running",
+                                                         "recipients": 0, "delivered": 0, "chunks": 0, "cursor": ""})
+        if row["status"] == "done":
+            return dict(row)
+        batch = [r for r in self.recipients if r > row["cursor"]][:limit]
+        new = [r for r in batch if (announcement_id, r) not in self.notified]
+        self.notified.extend((announcement_id, r) for r in new)
+        row.update(recipients=row["recipients"] + len(batch), delivered=row["delivered"] + len(new),
+                   chunks=row["chunks"] + 1, cursor=batch[-1] if batch else row["cursor"],
+                   status="done" if len(batch) < limit else "running")
+        return dict(row)
+
+
+class TestFanoutWorker(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        # 1.000 acudientes, con repetidos (hermanos) que la audiencia ya trae deduplicados
+        self.db = FakeFanout([f"parent-{i:04d}" for i in range(1000)] * 2)
+        self.worker = FanoutWorker(self.db.chunk, chunk_size=300, workers=2, base_delay=0.001)
+        self.addAsyncCleanup(self.worker.stop)
+
+    async def test_large_audience_finishes_in_the_background(self):
+        first = await self.worker.publish(SCHOOL, ANNOUNCEMENT)
+        self.assertEqual((first["status"], first["delivered"]), ("running", 300))
+        # Mientras sigue en curso, publicar de nuevo no encola otra vez
+        self.assertEqual((await self.worker.publish(SCHOOL, ANNOUNCEMENT))["status"], "running")
+        await self.worker.join()
+
+        self.assertEqual(len(self.db.notified), 1000)
+        self.assertEqual(len(set(self.db.notified)), 1000)
+        # 1.000 destinatarios en lotes de 300: cuatro sentencias
+        self.assertEqual(self.db.calls, 4)
+        stats = self.worker.stats()
+        self.assertEqual((stats["published"], stats["completed"], stats["chunks"], stats["delivered"],
+                          stats["in_progress"]), (1, 1, 4, 1000, 0))
+        again = await self.worker.publish(SCHOOL, ANNOUNCEMENT)
+        self.assertEqual((again["status"], again["delivered"]), ("done", 1000))
+        self.assertEqual(len(self.db.notified), 1000)
+
+    async def test_small_audiences_and_unknown_announcements(self):
+        small = FakeFanout(["a", "b", "c"])
+        worker = FanoutWorker(small.chunk)
+        progress = await worker.publish(SCHOOL, ANNOUNCEMENT)
+        self.assertEqual((progress["status"], progress["delivered"], progress["chunks"]), ("done", 3, 1))
+        self.assertFalse(worker.running)
+        self.assertIsNone(await worker.publish(SCHOOL, "draft-announcement"))
+        self.assertIsNone(await worker.publish("other-school", ANNOUNCEMENT))
+
+    async def test_failed_chunks_are_retried_and_unfinished_fanouts_resume(self):
+        await self.worker.run_chunk(SCHOOL, ANNOUNCEMENT)
+        self.db.failures = 2
+        # Un proceso nuevo retoma lo que el anterior dejó en 'running'
+        resumed = FanoutWorker(self.db.chunk, pending_fn=self.pending, chunk_size=300, base_delay=0.001)
+        self.addAsyncCleanup(resumed.stop)
+        await resumed.start()
+        self.assertEqual(await resumed.resume(), 1)
+        await resumed.join()
+        self.assertEqual(len(self.db.notified), 1000)
+        stats = resumed.stats()
+        self.assertEqual((stats["retried"], stats["failed"], stats["delivered"]), (2, 0, 700))
+
+    async def pending(self):
+        return [{"announcement_id": a, "school_id": SCHOOL, "delivered": row["delivered"]}
+                for a, row in self.db.progress.items() if row["status"] == "running"]
+
+
+class TestAnnouncementRoutes(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = FakeFanout([f"parent-{i}" for i in range(5)])
+        self.rpc_bodies = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            path = request.url.path
+            if path == "/auth/v1/user":
+                return httpx.Response(200, json={"id": "user-1"})
+            if path == "/rest/v1/profiles":
+                return httpx.Response(200, json=[{"role": "school"}])
+            if path == "/rest/v1/school_members":
+                return httpx.Response(200, json=[{"role": "owner"}])
+            if path == "/rest/v1/rpc/fan_out_announcement_chunk":
+                body = orjson.loads(request.content)
+                self.rpc_bodies.append(body)
+                row = await self.db.chunk(body["p_school_id"], body["p_announcement_id"], body["p_limit"])
+                return httpx.Response(200, json=[] if row is None else [row])
+            if path == "/rest/v1/announcement_fanouts":
+                row = self.db.progress.get(request.url.params["announcement_id"][3:])
+                return httpx.Response(200, json=[dict(row, announcements={"school_id": SCHOOL})] if row else [])
+            return httpx.Response(404)
+
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        self.worker = FanoutWorker(lambda s, a, n: server.data_store.fan_out_announcement_chunk(s, a, n),
+                                   chunk_size=2, base_delay=0.001)
+        for target, value in (("supabase_http", fake), ("data_store", server.store_from_env(lambda: fake)),
+                              ("notification_fanout", self.worker)):
+            patcher = patch.object(server, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addAsyncCleanup(self.worker.stop)
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://app")
+        self.addAsyncCleanup(self.client.aclose)
+        self.auth = {"Authorization": "Bearer user-token"}
+
+    async def test_publish_then_follow_progress(self):
+        url = f"/api/schools/{SCHOOL}/announcements/{ANNOUNCEMENT}"
+        self.assertEqual((await self.client.get(f"{url}/fanout", headers=self.auth)).status_code, 404)
+        resp = await self.client.post(f"{url}/publish", headers=self.auth)
+        self.assertEqual((resp.status_code, resp.json()["delivered"]), (202, 2))
+        self.assertEqual(self.rpc_bodies[0], {"p_school_id": SCHOOL, "p_announcement_id": ANNOUNCEMENT, "p_limit": 2})
+        await self.worker.join()
+
+        progress = await self.client.get(f"{url}/fanout", headers=self.auth)
+        self.assertEqual(progress.status_code, 200)
+        self.assertEqual((progress.json()["status"], progress.json()["delivered"], progress.json()["chunks"]),
+                         ("done", 5, 3))
+        self.assertNotIn("announcements", progress.json())
+        self.assertEqual((await self.client.post(f"{url}/publish", headers=self.auth)).status_code, 200)
+        self.assertEqual(len(self.db.notified), 5)
+
+    async def test_rejects_unknown_announcements_and_anonymous_callers(self):
+        url = f"/api/schools/{SCHOOL}/announcements/{ANNOUNCEMENT}/publish"
+        self.assertEqual((await self.client.post(url)).status_code, 401)
+        draft = url.replace(ANNOUNCEMENT, "5f0c8d43-6a9e-4c59-9d0e-0c1f2a3b4c5d")
+        self.assertEqual((await self.client.post(draft, headers=self.auth)).status_code, 404)
+        malformed = url.replace(ANNOUNCEMENT, "not-a-uuid")
+        self.assertEqual((await self.client.post(malformed, headers=self.auth)).status_code, 404)
+        self.assertEqual(len(self.rpc_bodies), 1)
+        self.assertEqual(self.db.notified, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
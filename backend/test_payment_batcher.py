@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from payment_batcher import NOT_FOUND, UPDATED, PaymentStatusBatcher, postgrest_in
+
+
+class FakePayments:
+    """Tabla payments en memoria; registra cada round trip."""
+
+    def __init__(self, existing):
+        self.rows = {ref: "pending" for ref in existing}
+        self.calls = []
+        self.fail = False
+
+    async def patch(self, status, references):
+        self.calls.append((status, list(references)))
+        await asyncio.sleep(0)
+        if self.fail:
+            raise RuntimeError("PostgREST 503")
+        matched = {ref for ref in references if ref in self.rows}
+        for ref in matched:
+            self.rows[ref] = status
+        return matched
+
+
+class TestPaymentStatusBatcher(unittest.IsolatedAsyncioTestCase):
+
+    async def test_burst_costs_one_round_trip_per_status(self):
+        table = FakePayments([f"REF-{i}" for i in range(300)])
+        batcher = PaymentStatusBatcher(table.patch, window=0.01, max_batch=1000)
+
+        updates = [(f"REF-{i}", "paid" if i % 3 else "rejected") for i in range(300)]
+        outcomes = await asyncio.gather(*(batcher.submit(ref, status) for ref, status in updates))
+
+        self.assertEqual(len(table.calls), 2)
+        self.assertEqual(set(outcomes), {UPDATED})
+        self.assertEqual(table.rows["REF-0"], "rejected")
+        self.assertEqual(table.rows["REF-1"], "paid")
+
+    async def test_per_reference_results_and_chunking(self):
+        table = FakePayments(["A", "B"])
+        batcher = PaymentStatusBatcher(table.patch, window=0.01, max_batch=2)
+
+        outcomes = await asyncio.gather(*(batcher.submit(ref, "paid") for ref in ["A", "B", "GHOST"]))
+
+        self.assertEqual(outcomes, [UPDATED, UPDATED, NOT_FOUND])
+        self.assertEqual(batcher.stats()["not_found"], 1)
+
+    async def test_more_final_status_wins_within_window(self):
+        table = FakePayments(["A", "B", "C"])
+        batcher = PaymentStatusBatcher(table.patch, window=0.01)
+
+        # Wompi no garantiza el orden: un PENDING tardío no pisa el APPROVED
+        submits = [("A", "pending"), ("A", "paid"), ("B", "paid"), ("B", "pending"),
+                   ("C", "paid"), ("C", "rejected"), ("C", "refunded")]
+        outcomes = await asyncio.gather(*(batcher.submit(ref, status) for ref, status in submits))
+        self.assertEqual(outcomes, [UPDATED] * 7)
+        self.assertEqual(sorted(table.calls), [("paid", ["A", "B"]), ("refunded", ["C"])])
+        self.assertEqual(batcher.coalesced, 4)
+
+    async def test_failed_flush_raises_in_every_caller(self):
+        table = FakePayments(["A", "B"])
+        table.fail = True
+        batcher = PaymentStatusBatcher(table.patch, window=0.01)
+
+        results = await asyncio.gather(batcher.submit("A", "paid"), batcher.submit("B", "paid"),
+                                       return_exceptions=True)
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+
+    def test_postgrest_in_quotes_values(self):
+        self.assertEqual(postgrest_in(["SM-1", 'a,"b)']), 'in.("SM-1","a,\\"b)")')
+
+
+if __name__ == '__main__':
+    unittest.main()
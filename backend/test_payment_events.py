@@ -0,0 +1,95 @@
+import asyncio
+import json
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from pubsub import EventBus
+    from supabase_client import SupabaseHTTP
+    from ttl_cache import AsyncTTLCache
+
+
+class FakeRequest:
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+def parse(chunk):
+    lines = dict(line.split(": ", 1) for line in chunk.strip().splitlines())
+    return lines["event"], json.loads(lines["data"])
+
+
+class TestEventBus(unittest.IsolatedAsyncioTestCase):
+
+    async def test_slow_subscriber_keeps_latest(self):
+        bus = EventBus(queue_size=2)
+        queue = bus.subscribe("REF")
+        for status in ("pending", "pending", "paid"):
+            bus.publish("REF", {"status": status})
+        self.assertEqual(bus.dropped, 1)
+        self.assertEqual([queue.get_nowait(), queue.get_nowait()], [{"status": "pending"}, {"status": "paid"}])
+        bus.unsubscribe("REF", queue)
+        self.assertEqual(bus.stats()["topics"], 0)
+
+
+class TestTransactionEventStream(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.row = {"id": "p-1", "status": "pending", "amount": 50000, "receipt_number": "REF-1"}
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, json=[self.row])
+
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        self.bus = EventBus()
+        for p in (patch.object(server, "supabase_http", fake),
+                  patch.object(server, "payment_events", self.bus),
+                  patch.object(server, "transaction_cache", AsyncTTLCache())):
+            p.start()
+            self.addCleanup(p.stop)
+
+    async def test_snapshot_then_pushed_status_then_close(self):
+        stream = server.transaction_event_stream("REF-1", FakeRequest())
+        self.assertTrue((await stream.__anext__()).startswith("retry:"))
+        event, data = parse(await stream.__anext__())
+        self.assertEqual((event, data["transaction"]["status"]), ("snapshot", "pending"))
+
+        next_chunk = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0)
+        self.bus.publish("REF-1", dict(self.row, status="paid"))
+        event, data = parse(await next_chunk)
+        self.assertEqual((event, data["transaction"]["status"]), ("status", "paid"))
+
+        with self.assertRaises(StopAsyncIteration):
+            await stream.__anext__()
+        self.assertEqual(self.bus.stats()["subscribers"], 0)
+
+    async def test_heartbeat_and_timeout(self):
+        with patch.object(server, "SSE_HEARTBEAT_SECONDS", 0.01), patch.object(server, "SSE_TIMEOUT_SECONDS", 0.035):
+            chunks = [chunk async for chunk in server.transaction_event_stream("REF-1", FakeRequest())]
+        self.assertIn(": heartbeat\n\n", chunks)
+        self.assertEqual(parse(chunks[-1])[0], "timeout")
+
+    async def test_final_snapshot_closes_immediately(self):
+        self.row["status"] = "paid"
+        chunks = [chunk async for chunk in server.transaction_event_stream("REF-1", FakeRequest())]
+        self.assertEqual(len(chunks), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
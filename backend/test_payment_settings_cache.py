@@ -0,0 +1,199 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from server import WompiSignatureRequest, create_wompi_signature
+    from supabase_client import SupabaseHTTP
+    from ttl_cache import AsyncTTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAsyncTTLCache(unittest.IsolatedAsyncioTestCase):
+
+    async def test_ttl_and_negative_ttl(self):
+        clock = FakeClock()
+        cache = AsyncTTLCache(maxsize=10, ttl=60, negative_ttl=5, clock=clock)
+        calls = []
+
+        async def load_found():
+            calls.append("found")
+            return {"allow_online": True}
+
+        async def load_missing():
+            calls.append("missing")
+            return None
+
+        self.assertEqual(await cache.get_or_load("a", load_found), {"allow_online": True})
+        self.assertIsNone(await cache.get_or_load("b", load_missing))
+        clock.now += 10
+        await cache.get_or_load("a", load_found)
+        await cache.get_or_load("b", load_missing)
+        # "a" sigue fresco, la entrada negativa "b" ya expiró
+        self.assertEqual(calls, ["found", "missing", "missing"])
+        clock.now += 60
+        await cache.get_or_load("a", load_found)
+        self.assertEqual(calls.count("found"), 2)
+
+    async def test_lru_eviction(self):
+        cache = AsyncTTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        async def never():
+            raise AssertionError("should be a hit")
+
+        await cache.get_or_load("a", never)  # "a" pasa a ser el más reciente
+        cache.set("c", 3)
+        self.assertEqual(cache.peek("a"), 1)
+        self.assertEqual(cache.peek("b", "gone"), "gone")
+        self.assertEqual(cache.evictions, 1)
+
+    async def test_single_flight(self):
+        cache = AsyncTTLCache()
+        calls = 0
+        release = asyncio.Event()
+
+        async def slow_load():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {"allow_online": True}
+
+        waiters = [asyncio.ensure_future(cache.get_or_load("school", slow_load)) for _ in range(50)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters)
+        self.assertEqual(calls, 1)
+        self.assertTrue(all(r == {"allow_online": True} for r in results))
+
+    async def test_errors_are_shared_but_not_cached(self):
+        cache = AsyncTTLCache()
+
+        async def boom():
+            raise RuntimeError("upstream down")
+
+        with self.assertRaises(RuntimeError):
+            await cache.get_or_load("x", boom)
+        self.assertEqual(len(cache), 0)
+
+    async def test_cancelled_leader_does_not_fail_the_other_waiters(self):
+        cache = AsyncTTLCache()
+        release = asyncio.Event()
+        calls = 0
+
+        async def slow_load():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {"allow_online": True}
+
+        # El primero dispara la carga y su cliente se desconecta a mitad de camino
+        leader = asyncio.ensure_future(cache.get_or_load("s", slow_load))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.get_or_load("s", slow_load))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        self.assertEqual(await follower, {"allow_online": True})
+        self.assertTrue(leader.cancelled())
+        self.assertEqual((calls, cache.peek("s")), (1, {"allow_online": True}))
+
+    async def test_invalidate_during_load_is_not_resurrected(self):
+        cache = AsyncTTLCache()
+        release = asyncio.Event()
+
+        async def slow_load():
+            await release.wait()
+            return {"allow_online": True}
+
+        task = asyncio.ensure_future(cache.get_or_load("s", slow_load))
+        await asyncio.sleep(0)
+        cache.invalidate("s")
+        release.set()
+        await task
+        self.assertEqual(cache.peek("s", "gone"), "gone")
+
+
+def fake_supabase(routes):
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.path)
+        status, body = routes[request.url.path]
+        return httpx.Response(status, json=body)
+
+    return SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler)), calls
+
+
+class TestSignatureUsesCache(unittest.IsolatedAsyncioTestCase):
+
+    async def test_settings_looked_up_once_per_school(self):
+        fake, calls = fake_supabase({"/rest/v1/schools": (200, [{"payment_settings": {"allow_online": True}}])})
+        with patch.object(server, "supabase_http", fake), \
+                patch.object(server, "payment_settings_cache", AsyncTTLCache()):
+            for i in range(5):
+                await create_wompi_signature(WompiSignatureRequest(
+                    reference=f"REF-{i}", amount_in_cents=1000, school_id="school-1"))
+        self.assertEqual(calls, ["/rest/v1/schools"])
+
+
+class TestInvalidateEndpoint(unittest.TestCase):
+
+    def call(self, routes, headers=None):
+        from fastapi.testclient import TestClient
+
+        fake, _ = fake_supabase(routes)
+        cache = AsyncTTLCache()
+        cache.set("school-1", {"allow_online": False})
+        with patch.object(server, "supabase_http", fake), patch.object(server, "payment_settings_cache", cache):
+            resp = TestClient(server.app).post("/api/schools/school-1/payment-settings/invalidate", headers=headers)
+        return resp, cache
+
+    def test_requires_token(self):
+        resp, cache = self.call({})
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(len(cache), 1)
+
+    def test_rejects_non_members(self):
+        resp, cache = self.call({
+            "/auth/v1/user": (200, {"id": "user-1"}),
+            "/rest/v1/profiles": (200, [{"role": "parent"}]),
+            "/rest/v1/school_members": (200, []),
+        }, headers={"Authorization": "Bearer user-token"})
+        self.assertEqual(resp.status_code, 403)
+        self.assertEqual(len(cache), 1)
+
+    def test_school_owner_invalidates(self):
+        resp, cache = self.call({
+            "/auth/v1/user": (200, {"id": "user-1"}),
+            "/rest/v1/profiles": (200, [{"role": "school"}]),
+            "/rest/v1/school_members": (200, [{"role": "owner"}]),
+        }, headers={"Authorization": "Bearer user-token"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.json()["invalidated"])
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
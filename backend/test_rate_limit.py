@@ -0,0 +1,190 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from idempotency import IdempotencyStore
+    from rate_limit import (MAX_INSPECTED_BODY, AdmissionControl, AdmissionControlMiddleware, TokenBucketLimiter,
+                            _parse_rules, rules_from_env)
+    from supabase_client import SupabaseHTTP
+    from ttl_cache import AsyncTTLCache
+    from webhook_archive import WebhookArchive
+    from webhook_queue import WebhookQueue, WebhookSpool
+
+SIGNATURE = "/api/payments/wompi/create-signature"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_refill(self):
+        clock = FakeClock()
+        limiter = TokenBucketLimiter(clock=clock)
+        for _ in range(3):
+            self.assertEqual(limiter.acquire(("k",), rate=2, burst=3), 0.0)
+        self.assertAlmostEqual(limiter.acquire(("k",), rate=2, burst=3), 0.5)
+        clock.now += 0.5
+        self.assertEqual(limiter.acquire(("k",), rate=2, burst=3), 0.0)
+        # Nunca acumula más que el burst
+        clock.now += 60
+        for _ in range(3):
+            self.assertEqual(limiter.acquire(("k",), rate=2, burst=3), 0.0)
+        self.assertGreater(limiter.acquire(("k",), rate=2, burst=3), 0)
+
+    def test_lru_bound(self):
+        limiter = TokenBucketLimiter(max_keys=2, clock=FakeClock())
+        for key in ("a", "b", "c"):
+            limiter.acquire((key,), rate=1, burst=1)
+        self.assertEqual((len(limiter), limiter.evictions), (2, 1))
+
+    def test_rules_match_longest_prefix_on_segment_boundary(self):
+        control = AdmissionControl(rules_from_env('{"/api/payments/wompi/transaction": null}'))
+        self.assertEqual(control.match(SIGNATURE)[0], SIGNATURE)
+        self.assertEqual(control.match(SIGNATURE + "s")[0], SIGNATURE + "s")
+        self.assertEqual(control.match("/api/payments/wompi/webhook"), ("/api/payments/wompi/webhook", None))
+        self.assertIsNone(control.match("/api/payments/wompi/transaction/R1")[1])
+        self.assertEqual(control.match("/api/payments/other")[0], "/api/payments")
+        self.assertEqual(control.match("/api/health"), (None, None))
+        # Un RATE_LIMITS inválido deja los valores por defecto
+        self.assertEqual(rules_from_env("{nope"), rules_from_env(None))
+        # "off" apaga todo (benchmarks): ninguna ruta tiene límites
+        self.assertEqual(AdmissionControl(rules_from_env("off")).match(SIGNATURE), (None, None))
+
+    def test_forwarded_for_only_behind_trusted_proxies(self):
+        scope = {"client": ("10.0.0.1", 5000), "headers": [(b"x-forwarded-for", b"6.6.6.6, 203.0.113.7")]}
+        self.assertEqual(AdmissionControl().client_ip(scope), "10.0.0.1")
+        self.assertEqual(AdmissionControl(trusted_proxies=1).client_ip(scope), "203.0.113.7")
+
+
+class TestAdmissionMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+
+        lookups = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            lookups.append(request.url.params["id"])
+            return httpx.Response(200, json=[{"payment_settings": {"allow_online": True}}])
+
+        self.lookups = lookups
+        self.clock = FakeClock()
+        control = server.admission_control
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        self.patches = [
+            patch.object(control, "limiter", TokenBucketLimiter(clock=self.clock)),
+            patch.object(control, "trusted_proxies", 1),
+            patch.object(control, "rules", _parse_rules({
+                SIGNATURE: {"per_ip": (1, 3), "per_school": (0.5, 2)},
+                "/api/payments/wompi/webhook": None,
+            })),
+            patch.object(control, "admitted", {}),
+            patch.object(control, "limited", {}),
+            patch.object(server, "supabase_http", fake),
+            patch.object(server, "payment_settings_cache", AsyncTTLCache()),
+        ]
+        for p in self.patches:
+            p.start()
+        self.client = TestClient(server.app)
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+    def sign(self, reference, school_id=None, ip="203.0.113.7"):
+        body = {"reference": reference, "amount_in_cents": 150000}
+        if school_id:
+            body["school_id"] = school_id
+        return self.client.post(SIGNATURE, json=body, headers={"X-Forwarded-For": f"10.0.0.1, {ip}"})
+
+    def test_school_bucket_answers_429_with_retry_after(self):
+        # El body leído por el middleware sigue llegando a la ruta
+        first = self.sign("R1", "s1", ip="203.0.113.1")
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()["reference"], "R1")
+        self.assertEqual(self.sign("R2", "s1", ip="203.0.113.2").status_code, 200)
+
+        limited = self.sign("R3", "s1", ip="203.0.113.3")
+        self.assertEqual(limited.status_code, 429)
+        self.assertEqual(limited.headers["retry-after"], "2")
+        self.assertEqual(limited.json()["scope"], "school")
+        self.assertEqual(self.lookups, ["eq.s1"])
+        # Otro colegio tiene su propio bucket
+        self.assertEqual(self.sign("R4", "s2", ip="203.0.113.3").status_code, 200)
+
+        self.clock.now += 2
+        self.assertEqual(self.sign("R5", "s1", ip="203.0.113.4").status_code, 200)
+
+    def test_ip_bucket_and_exempt_webhook(self):
+        for i in range(3):
+            self.assertEqual(self.sign(f"R{i}").status_code, 200)
+        limited = self.sign("R3")
+        self.assertEqual((limited.status_code, limited.json()["scope"]), (429, "ip"))
+        self.assertEqual(limited.headers["retry-after"], "1")
+        self.assertEqual(self.sign("R4", ip="198.51.100.9").status_code, 200)
+
+        with patch.object(server, "webhook_queue", WebhookQueue(WebhookSpool(":memory:"), server.apply_wompi_event)), \
+                patch.object(server, "webhook_idempotency", IdempotencyStore(":memory:")), \
+                patch.object(server, "webhook_archive", WebhookArchive(None)):
+            for _ in range(5):
+                self.assertNotEqual(self.client.post("/api/payments/wompi/webhook", json={}).status_code, 429)
+
+        stats = server.admission_control.stats()
+        self.assertEqual((stats["admitted"], stats["limited"]), (4, 1))
+        self.assertEqual(stats["limited_by_rule"], {f"{SIGNATURE}:ip": 1})
+
+    def test_large_body_is_not_buffered_and_reaches_the_app_whole(self):
+        # Pasado el tope deja de leer: bucket por IP y la ruta recibe lo ya leído más el resto
+        chunk = b"x" * 16384
+        messages = [{"type": "http.request", "body": chunk, "more_body": True} for _ in range(40)]
+        messages.append({"type": "http.request", "body": b"", "more_body": False})
+        reads, received = [], []
+
+        async def receive():
+            reads.append(1)
+            return messages[len(reads) - 1]
+
+        async def app(scope, receive, send):
+            more = True
+            while more:
+                message = await receive()
+                received.append(message["body"])
+                more = message["more_body"]
+
+        async def send(message):
+            pass
+
+        scope = {"type": "http", "method": "POST", "path": SIGNATURE, "query_string": b"",
+                 "headers": [(b"x-forwarded-for", b"10.0.0.1, 203.0.113.9")]}
+        middleware = AdmissionControlMiddleware(app, server.admission_control)
+        school_id, replay = asyncio.run(middleware._school_id(scope, receive))
+        self.assertIsNone(school_id)
+        self.assertEqual(len(reads), MAX_INSPECTED_BODY // len(chunk) + 1)
+
+        reads.clear()
+        asyncio.run(middleware(scope, receive, send))
+        self.assertEqual(b"".join(received), chunk * 40)
+        self.assertEqual(server.admission_control.stats()["admitted"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
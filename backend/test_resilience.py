@@ -0,0 +1,144 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import patch
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from idempotency import IdempotencyStore
+    from resilience import (CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, DeadlineExceeded,
+                            Resilience, ResilienceConfig, deadline_var)
+    from server import WompiSignatureRequest, create_wompi_signature
+    from supabase_client import SupabaseHTTP
+    from ttl_cache import AsyncTTLCache
+    from webhook_queue import WebhookQueue, WebhookSpool
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_then_half_open_probe_decides(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker("settings_lookup", failure_threshold=3, reset_timeout=10, clock=clock)
+        for _ in range(3):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+        clock.now += 10
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        # Solo una sonda a la vez
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+
+        clock.now += 10
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.stats()["opened_total"], 2)
+
+
+def slow_supabase(delays, status=200, config=None):
+    """PostgREST falso: el intento n tarda delays[n] segundos (el último se repite)."""
+    attempts = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        attempt = len(attempts)
+        attempts.append(request.url.path)
+        await asyncio.sleep(delays[min(attempt, len(delays) - 1)])
+        return httpx.Response(status, json=[{"payment_settings": {"allow_online": True}, "attempt": attempt}])
+
+    resilience = Resilience(config or ResilienceConfig(hedge_delay=0))
+    fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler),
+                        resilience=resilience)
+    return fake, attempts
+
+
+class TestResilientTransport(unittest.IsolatedAsyncioTestCase):
+
+    async def test_open_circuit_fails_fast(self):
+        fake, attempts = slow_supabase([0], status=503, config=ResilienceConfig(failure_threshold=2, hedge_delay=0))
+        site = SupabaseHTTP.call_site("settings_lookup")
+        for _ in range(2):
+            self.assertEqual((await fake.client.get("/rest/v1/schools", extensions=site)).status_code, 503)
+        with self.assertRaises(CircuitOpenError):
+            await fake.client.get("/rest/v1/schools", extensions=site)
+        # Otros call sites tienen su propio breaker
+        await fake.client.get("/rest/v1/payments", extensions=SupabaseHTTP.call_site("transaction_lookup"))
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(fake.resilience.stats()["breakers"]["settings_lookup"]["state"], OPEN)
+
+    async def test_request_deadline_cuts_slow_call(self):
+        fake, _ = slow_supabase([5])
+        token = deadline_var.set(time.monotonic() + 0.05)
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                await fake.client.get("/rest/v1/schools")
+        finally:
+            deadline_var.reset(token)
+        self.assertEqual(fake.resilience.deadline_exceeded, 1)
+        # Cortado antes del umbral de llamada lenta: no cuenta como fallo
+        self.assertEqual(fake.resilience.breaker("other").consecutive_failures, 0)
+
+    async def test_hedged_get_takes_first_good_answer(self):
+        config = ResilienceConfig(hedge_delay=0.02, hedge_max_ratio=1.0)
+        fake, attempts = slow_supabase([1.0, 0.0], config=config)
+        response = await fake.client.get("/rest/v1/schools", extensions=SupabaseHTTP.call_site("settings_lookup"))
+        self.assertEqual(response.json()[0]["attempt"], 1)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(fake.resilience.hedge_wins, 1)
+        # Los PATCH nunca se duplican
+        await fake.client.patch("/rest/v1/payments", json={}, extensions=SupabaseHTTP.call_site("settings_lookup"))
+        self.assertEqual(len(attempts), 3)
+
+    async def test_signature_answers_503_when_circuit_open(self):
+        fake, attempts = slow_supabase([0], status=500, config=ResilienceConfig(failure_threshold=1, hedge_delay=0))
+        with patch.object(server, "supabase_http", fake), \
+                patch.object(server, "payment_settings_cache", AsyncTTLCache()):
+            # El primer 500 es un SettingsLookupError (no bloquea) y abre el circuito
+            await create_wompi_signature(WompiSignatureRequest(reference="R1", amount_in_cents=1, school_id="s1"))
+            with self.assertRaises(server.HTTPException) as ctx:
+                await create_wompi_signature(WompiSignatureRequest(reference="R2", amount_in_cents=1, school_id="s2"))
+        self.assertEqual(ctx.exception.status_code, 503)
+        self.assertIn("Retry-After", ctx.exception.headers)
+        self.assertEqual(len(attempts), 1)
+
+
+class TestHealthEndpoint(unittest.TestCase):
+
+    def test_health_exposes_breakers(self):
+        from fastapi.testclient import TestClient
+
+        fake, _ = slow_supabase([0])
+        fake.resilience.breaker("settings_lookup").record_failure()
+        with patch.object(server, "supabase_http", fake), \
+                patch.object(server, "webhook_queue", WebhookQueue(WebhookSpool(":memory:"), server.apply_wompi_event)), \
+                patch.object(server, "webhook_idempotency", IdempotencyStore(":memory:")):
+            body = TestClient(server.app).get("/api/health").json()
+        breaker = body["supabase_breakers"]["breakers"]["settings_lookup"]
+        self.assertEqual((breaker["state"], breaker["consecutive_failures"]), ("closed", 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import asyncio
+import os
+import sys
+import unittest
+from unittest.mock import patch
+from zoneinfo import ZoneInfo
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from revenue_rollup import RevenueCube, RevenueRollups, RollupQueryError, fold_revenue_rows, parse_group_by
+    from supabase_client import SupabaseHTTP
+
+BOGOTA = ZoneInfo("America/Bogota")
+
+
+def payment(amount, status="paid", method="pse", kind="one_time", payment_date="2026-03-10",
+            created_at="2026-03-09T15:00:00Z", pid=None):
+    return {"id": pid, "amount": amount, "status": status, "payment_method": method, "payment_type": kind,
+            "payment_date": payment_date if status == "paid" else None, "created_at": created_at}
+
+
+PAYMENTS = [
+    payment(150000, pid="p1"),
+    payment(150000.5, method="card", pid="p2"),
+    # Sin payment_date: 1 de marzo 03:00 UTC todavía es febrero en Bogotá
+    payment(80000, status="partial", created_at="2026-03-01T03:00:00Z", pid="p3"),
+    payment(120000, status="pending", method=None, kind="subscription", pid="p4"),
+    payment(120000, status="awaiting_approval", method="transfer", kind="subscription", pid="p5"),
+    payment(50000, status="failed", created_at="2026-04-02T12:00:00Z", pid="p6"),
+]
+
+
+class TestCube(unittest.TestCase):
+
+    def setUp(self):
+        self.cube = RevenueCube(fold_revenue_rows(PAYMENTS, BOGOTA))
+
+    def test_folding_rules(self):
+        by_month = self.cube.query()
+        self.assertEqual(by_month["buckets"], [
+            {"month": "2026-02", "count": 1, "amount": 80000},
+            {"month": "2026-03", "count": 4, "amount": 540000.5},
+            {"month": "2026-04", "count": 1, "amount": 50000},
+        ])
+        self.assertEqual(by_month["totals"], {"count": 6, "amount": 670000.5})
+        # El estado de la revisión del comprobante viene en la misma fila
+        march = self.cube.query("2026-03", "2026-03", ("status", "method"))["buckets"]
+        self.assertEqual(march, [
+            {"status": "awaiting_approval", "method": "transfer", "count": 1, "amount": 120000},
+            {"status": "paid", "method": "card", "count": 1, "amount": 150000.5},
+            {"status": "paid", "method": "pse", "count": 1, "amount": 150000},
+            {"status": "pending", "method": "unknown", "count": 1, "amount": 120000},
+        ])
+
+    def test_query_filters_and_regroups(self):
+        self.assertEqual(self.cube.query(start="2026-03", group_by=("type",))["buckets"], [
+            {"type": "one_time", "count": 3, "amount": 350000.5},
+            {"type": "subscription", "count": 2, "amount": 240000},
+        ])
+        self.assertEqual(self.cube.query(end="2026-01")["totals"], {"count": 0, "amount": 0})
+        self.assertEqual(self.cube.query(group_by=())["buckets"], [{"count": 6, "amount": 670000.5}])
+        self.assertEqual(parse_group_by("method, month"), ("month", "method"))
+        with self.assertRaises(RollupQueryError):
+            parse_group_by("month,student")
+
+
+class TestRollups(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_loads_share_one_build(self):
+        loads = []
+
+        async def load(school_id):
+            loads.append(school_id)
+            await asyncio.sleep(0.01)
+            return fold_revenue_rows(PAYMENTS, BOGOTA)
+
+        rollups = RevenueRollups(load)
+        cubes = await asyncio.gather(*(rollups.cube("s1") for _ in range(10)))
+        self.assertEqual(len({id(cube) for cube in cubes}), 1)
+        self.assertTrue(rollups.invalidate("s1"))
+        await rollups.cube("s1")
+        self.assertEqual(loads, ["s1", "s1"])
+        self.assertEqual(rollups.stats()["builds"], 2)
+
+
+    async def test_webhook_payments_drop_their_schools_cubes(self):
+        members = {"pay-1": "s1", "pay-2": "s1", "pay-3": "s2"}
+
+        async def payment_members(payment_ids):
+            return [{"school_id": members[pid]} for pid in payment_ids if pid in members]
+
+        async def load(school_id):
+            return fold_revenue_rows(PAYMENTS, BOGOTA)
+
+        rollups = RevenueRollups(load, payment_members_fn=payment_members)
+        # Sin cubos cargados ni siquiera se consulta
+        self.assertEqual(await rollups.payments_changed(["pay-1"]), 0)
+        await rollups.cube("s1")
+        await rollups.cube("s3")
+        self.assertEqual(await rollups.payments_changed(["pay-1", "pay-2", "pay-3", "pay-404"]), 1)
+        await rollups.cube("s1")
+        await rollups.cube("s3")
+        self.assertEqual(rollups.stats()["builds"], 3)
+
+
+class TestRevenueEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+
+        self.reads = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            path, params = request.url.path, request.url.params
+            if path == "/auth/v1/user":
+                return httpx.Response(200, json={"id": "user-1"})
+            if path == "/rest/v1/profiles":
+                return httpx.Response(200, json=[{"role": "school"}])
+            if path == "/rest/v1/school_members":
+                return httpx.Response(200, json=[{"role": "owner"}])
+            self.reads.append(path)
+            rows = PAYMENTS
+            offset, limit = int(params["offset"]), int(params["limit"])
+            return httpx.Response(200, json=rows[offset:offset + limit])
+
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        store = server.store_from_env(lambda: fake)
+        rollups = RevenueRollups(lambda school_id: store.revenue_cells(school_id, "America/Bogota", page_size=4))
+        for target, value in (("supabase_http", fake), ("data_store", store), ("revenue_rollups", rollups)):
+            patcher = patch.object(server, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = TestClient(server.app)
+        self.auth = {"Authorization": "Bearer user-token"}
+
+    def test_dashboard_loads_read_the_cube(self):
+        url = "/api/schools/school-1/revenue?from=2026-03-01&to=2026-04&group_by=month,status"
+        first = self.client.get(url, headers=self.auth)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()["from"], "2026-03")
+        self.assertEqual(first.json()["totals"], {"count": 5, "amount": 590000.5})
+        self.assertEqual(len(first.json()["buckets"]), 4)
+        # Páginas de 4: dos lecturas de payments
+        self.assertEqual(self.reads, ["/rest/v1/payments"] * 2)
+
+        again = self.client.get(url, headers=dict(self.auth, **{"If-None-Match": first.headers["etag"]}))
+        self.assertEqual(again.status_code, 304)
+        other = self.client.get("/api/schools/school-1/revenue?group_by=method", headers=self.auth)
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(len(self.reads), 2)
+
+        invalidated = self.client.post("/api/schools/school-1/revenue/invalidate", headers=self.auth)
+        self.assertTrue(invalidated.json()["invalidated"])
+        self.assertEqual(self.client.get(url, headers=self.auth).status_code, 200)
+        self.assertEqual(len(self.reads), 4)
+
+    def test_rejects_bad_queries_and_anonymous_callers(self):
+        self.assertEqual(self.client.get("/api/schools/school-1/revenue").status_code, 401)
+        # Sin credenciales no se valida nada: 401 antes que el 400 de los parámetros
+        self.assertEqual(self.client.get("/api/schools/school-1/revenue?group_by=student").status_code, 401)
+        bad = self.client.get("/api/schools/school-1/revenue?group_by=student", headers=self.auth)
+        self.assertEqual(bad.status_code, 400)
+        self.assertEqual(self.client.get("/api/schools/school-1/revenue?from=2026-13",
+                                         headers=self.auth).status_code, 400)
+        self.assertEqual(self.reads, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
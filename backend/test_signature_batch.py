@@ -0,0 +1,81 @@
+import unittest
+from unittest.mock import patch
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from server import (WompiSignatureBatchRequest, WompiSignatureRequest, create_wompi_signature,
+                        create_wompi_signatures)
+    from supabase_client import SupabaseHTTP
+    from ttl_cache import AsyncTTLCache
+
+
+def fake_schools(settings_by_school):
+    """PostgREST falso: payment_settings por school_id; un valor int responde ese status."""
+    lookups = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        school_id = request.url.params["id"][len("eq."):]
+        lookups.append(school_id)
+        value = settings_by_school[school_id]
+        if isinstance(value, int):
+            return httpx.Response(value, json={"message": "boom"})
+        return httpx.Response(200, json=[{"payment_settings": value}])
+
+    return SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler)), lookups
+
+
+class TestSignatureBatch(unittest.IsolatedAsyncioTestCase):
+
+    async def test_one_lookup_per_school_and_partial_failures(self):
+        fake, lookups = fake_schools({
+            "open": {"allow_online": True},
+            "closed": {"allow_online": False},
+            "flaky": 503,
+        })
+        items = [WompiSignatureRequest(reference=f"OPEN-{i}", amount_in_cents=150000, school_id="open")
+                 for i in range(50)]
+        items += [
+            WompiSignatureRequest(reference="CLOSED-1", amount_in_cents=150000, school_id="closed"),
+            WompiSignatureRequest(reference="FLAKY-1", amount_in_cents=90000, school_id="flaky"),
+            WompiSignatureRequest(reference="OPEN-0", amount_in_cents=150000, school_id="open"),
+            WompiSignatureRequest(reference="NO-SCHOOL", amount_in_cents=1000),
+        ]
+        with patch.object(server, "supabase_http", fake), \
+                patch.object(server, "payment_settings_cache", AsyncTTLCache()):
+            body = await create_wompi_signatures(WompiSignatureBatchRequest(items=items))
+            single = await create_wompi_signature(items[0])
+
+        self.assertEqual(sorted(lookups), ["closed", "flaky", "open"])
+        self.assertEqual((body["signed"], body["failed"]), (52, 2))
+        by_ref = {r["reference"]: r for r in body["results"] if r["index"] != 52}
+        self.assertEqual(by_ref["OPEN-0"]["signature"], single["signature"])
+        self.assertEqual((by_ref["CLOSED-1"]["ok"], by_ref["CLOSED-1"]["status"]), (False, 403))
+        # Un lookup no-200 no bloquea, igual que en la ruta individual
+        self.assertTrue(by_ref["FLAKY-1"]["ok"])
+        self.assertTrue(by_ref["NO-SCHOOL"]["ok"])
+        duplicate = body["results"][52]
+        self.assertEqual((duplicate["reference"], duplicate["ok"], duplicate["status"]), ("OPEN-0", False, 409))
+
+    def test_batch_size_is_validated(self):
+        from fastapi.testclient import TestClient
+
+        client = TestClient(server.app)
+        self.assertEqual(client.post("/api/payments/wompi/create-signatures", json={"items": []}).status_code, 422)
+        too_many = [{"reference": f"R{i}", "amount_in_cents": 1}
+                    for i in range(server.WOMPI_SIGNATURE_BATCH_MAX + 1)]
+        self.assertEqual(client.post("/api/payments/wompi/create-signatures", json={"items": too_many}).status_code, 422)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from supabase_client import PoolConfig, SupabaseHTTP
+    from idempotency import IdempotencyStore
+    from webhook_queue import WebhookQueue, WebhookSpool
+
+
+class TestSupabaseHTTP(unittest.IsolatedAsyncioTestCase):
+
+    async def test_client_is_shared_and_carries_service_headers(self):
+        """Todas las llamadas reutilizan el mismo cliente con apikey/Authorization ya puestos."""
+        seen = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            seen.append(request)
+            return httpx.Response(200, json=[])
+
+        pool = SupabaseHTTP("https://fake.supabase.co/", "svc", transport=httpx.MockTransport(handler))
+        first = pool.client
+        await first.get("/rest/v1/schools")
+        await pool.client.patch("/rest/v1/payments", json={})
+
+        self.assertIs(first, pool.client)
+        self.assertEqual(str(seen[0].url), "https://fake.supabase.co/rest/v1/schools")
+        for request in seen:
+            self.assertEqual(request.headers["apikey"], "svc")
+            self.assertEqual(request.headers["authorization"], "Bearer svc")
+        self.assertEqual(pool.stats()["requests_total"], 2)
+        await pool.aclose()
+        self.assertFalse(pool.stats()["open"])
+
+    def test_client_follows_the_running_loop(self):
+        """Cada asyncio.run (una invocación serverless) usa un cliente de su propio loop."""
+        def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, json=[])
+
+        pool = SupabaseHTTP("https://fake.supabase.co", "svc", transport=httpx.MockTransport(handler))
+
+        async def call():
+            response = await pool.client.get("/rest/v1/schools")
+            return response.status_code, pool.client
+
+        results = [asyncio.run(call()) for _ in range(3)]
+        self.assertEqual([status for status, _ in results], [200, 200, 200])
+        self.assertEqual(len({id(client) for _, client in results}), 3)
+        self.assertEqual((pool.stats()["rebuilds"], pool.stats()["requests_total"]), (2, 3))
+        asyncio.run(pool.aclose())
+
+    def test_pool_config_from_env(self):
+        with patch.dict(os.environ, {
+            "SUPABASE_HTTP_MAX_CONNECTIONS": "50",
+            "SUPABASE_HTTP_TIMEOUT": "2.5",
+            "SUPABASE_HTTP2": "0",
+        }):
+            config = PoolConfig.from_env()
+        self.assertEqual(config.max_connections, 50)
+        self.assertEqual(config.timeout, 2.5)
+        self.assertFalse(config.http2)
+
+    def test_health_exposes_pool_stats(self):
+        from fastapi.testclient import TestClient
+
+        queue = WebhookQueue(WebhookSpool(":memory:"), server.apply_wompi_event)
+        with patch.object(server, "webhook_queue", queue), \
+                patch.object(server, "webhook_idempotency", IdempotencyStore(":memory:")), \
+                TestClient(server.app) as client:
+            body = client.get("/api/health").json()
+        self.assertEqual(body["status"], "ok")
+        self.assertTrue(body["supabase_pool"]["configured"])
+        self.assertIn("utilization", body["supabase_pool"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from supabase_client import SupabaseHTTP
+    from ttl_cache import AsyncTTLCache
+
+
+ROW = {"id": "p-1", "status": "pending", "amount": 50000, "payment_date": None, "receipt_number": "REF-1"}
+
+
+class TestTransactionEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        from fastapi.testclient import TestClient
+
+        self.rows = {"REF-1": dict(ROW)}
+        self.gets = 0
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            ref = request.url.params["receipt_number"]
+            if request.method == "GET":
+                self.gets += 1
+                row = self.rows.get(ref[3:])
+                return httpx.Response(200, json=[row] if row else [])
+            # PATCH ... receipt_number=in.("REF-1")
+            self.rows["REF-1"]["status"] = "paid"
+            return httpx.Response(200, json=[self.rows["REF-1"]])
+
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        for p in (patch.object(server, "supabase_http", fake),
+                  patch.object(server, "transaction_cache", AsyncTTLCache(ttl=60, negative_ttl=60))):
+            p.start()
+            self.addCleanup(p.stop)
+        self.client = TestClient(server.app)
+
+    def test_polls_are_served_from_cache(self):
+        for _ in range(10):
+            body = self.client.get("/api/payments/wompi/transaction/REF-1").json()
+        self.assertEqual(body["transaction"]["status"], "pending")
+        self.assertEqual(self.gets, 1)
+
+    def test_not_found_is_cached_negatively(self):
+        for _ in range(3):
+            body = self.client.get("/api/payments/wompi/transaction/NOPE").json()
+        self.assertFalse(body["success"])
+        self.assertEqual(self.gets, 1)
+
+    def test_etag_revalidation(self):
+        first = self.client.get("/api/payments/wompi/transaction/REF-1")
+        etag = first.headers["etag"]
+        self.assertIn("no-cache", first.headers["cache-control"])
+        again = self.client.get("/api/payments/wompi/transaction/REF-1", headers={"If-None-Match": etag})
+        self.assertEqual(again.status_code, 304)
+
+    def test_webhook_batch_writes_through(self):
+        first = self.client.get("/api/payments/wompi/transaction/REF-1")
+        asyncio.run(server.patch_payment_statuses("paid", ["REF-1"]))
+
+        polled = self.client.get("/api/payments/wompi/transaction/REF-1",
+                                 headers={"If-None-Match": first.headers["etag"]})
+        self.assertEqual(polled.status_code, 200)
+        self.assertEqual(polled.json()["transaction"]["status"], "paid")
+        self.assertEqual(self.gets, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import gzip
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import httpx
+import orjson
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from idempotency import IdempotencyStore
+    from payment_batcher import PaymentStatusBatcher
+    from replay_webhooks import parse_time, replay
+    from supabase_client import SupabaseHTTP
+    from test_webhook_queue import signed_event
+    from ttl_cache import AsyncTTLCache
+    from webhook_archive import WebhookArchive
+    from webhook_queue import WebhookQueue, WebhookSpool
+
+
+def raw(event: dict) -> bytes:
+    return orjson.dumps(event)
+
+
+class TestWebhookArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_rotated_segments_are_gzip_and_indexed(self):
+        archive = WebhookArchive(self.tmp.name, segment_bytes=600)
+        bodies = [raw(signed_event(reference=f"REF-{i % 4}", tx_id=f"tx-{i}")) for i in range(12)]
+        bodies.append(b"not json")
+        for i, body in enumerate(bodies):
+            archive.append(body, received_at=1000.0 + i)
+        self.assertGreater(archive.stats()["rotations"], 1)
+        self.assertLess(archive.stats()["compressed_bytes"], archive.stats()["raw_bytes"])
+
+        hits = archive.query(references=["REF-1"])
+        self.assertEqual([h.transaction_id for h in hits], ["tx-1", "tx-5", "tx-9"])
+        self.assertEqual(list(archive.read(hits)), [bodies[1], bodies[5], bodies[9]])
+        self.assertEqual([h.id for h in archive.query(transaction_ids=["tx-7"])], [8])
+        self.assertEqual(len(archive.query(since=1005, until=1008)), 3)
+        # Lo que no es un evento de Wompi no ocupa el archivo
+        self.assertEqual((archive.query(since=1012), archive.stats()["skipped"]), ([], 1))
+
+        archive.close()
+        # Cada segmento cerrado es un gzip normal (zcat) con un body por línea
+        segments = sorted(f for f in os.listdir(self.tmp.name) if f.endswith(".gz"))
+        joined = b"".join(gzip.decompress(open(os.path.join(self.tmp.name, f), "rb").read()) for f in segments)
+        self.assertEqual(joined, b"".join(body + b"\n" for body in bodies[:-1]))
+
+    def test_time_rotation_and_retention(self):
+        archive = WebhookArchive(self.tmp.name, segment_seconds=10, retention=25)
+        for i in range(4):
+            archive.append(raw(signed_event(tx_id=f"tx-{i}")), received_at=1000.0 + i * 10)
+        # Al rotar en t=1030 el segmento de t=1000 ya pasó la retención
+        self.assertEqual(archive.stats()["pruned_segments"], 1)
+        self.assertEqual([e.transaction_id for e in archive.query()], ["tx-1", "tx-2", "tx-3"])
+        self.assertFalse(os.path.exists(archive.segment_path(1)))
+        archive.close()
+
+    def test_closed_segments_are_bounded_by_size(self):
+        archive = WebhookArchive(self.tmp.name, segment_bytes=300, max_bytes=1000)
+        for i in range(20):
+            archive.append(raw(signed_event(tx_id=f"tx-{i}")), received_at=1000.0 + i)
+        archive.close()
+        segments = [f for f in os.listdir(self.tmp.name) if f.endswith(".gz")]
+        # Solo cuenta lo cerrado: el tope se pasa a lo sumo por el segmento que se está escribiendo
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.tmp.name, f)) for f in segments), 1000 + 300 * 2)
+        self.assertGreater(archive.stats()["pruned_segments"], 0)
+        self.assertEqual(archive.query()[-1].transaction_id, "tx-19")
+
+    def test_disabled_and_failing_archive_never_raise(self):
+        self.assertIsNone(WebhookArchive(None).append(raw(signed_event())))
+        broken = WebhookArchive(os.path.join(self.tmp.name, "file"))
+        open(os.path.join(self.tmp.name, "file"), "w").close()
+        self.assertIsNone(broken.append(raw(signed_event())))
+        self.assertEqual(broken.stats()["errors"], 1)
+
+    def test_webhook_route_archives_wompi_events(self):
+        from fastapi.testclient import TestClient
+
+        archive = WebhookArchive(self.tmp.name)
+        bad = signed_event(reference="REF-BAD")
+        bad["signature"]["checksum"] = "0" * 64
+        with patch.object(server, "webhook_queue", WebhookQueue(WebhookSpool(":memory:"), server.apply_wompi_event)), \
+                patch.object(server, "webhook_idempotency", IdempotencyStore(":memory:")), \
+                patch.object(server, "webhook_archive", archive), \
+                patch.object(server, "data_store", server.store_from_env(lambda: SupabaseHTTP(None, None))):
+            client = TestClient(server.app)
+            self.assertEqual(client.post("/api/payments/wompi/webhook", content=raw(bad)).status_code, 401)
+            self.assertEqual(client.post("/api/payments/wompi/webhook", content=raw(signed_event())).status_code, 200)
+            client.post("/api/payments/wompi/webhook", content=b'{"hello": "world"}')
+            huge = client.post("/api/payments/wompi/webhook", content=b"x" * (server.WOMPI_WEBHOOK_MAX_BYTES + 1))
+            self.assertEqual(huge.status_code, 413)
+        self.assertEqual([e.reference for e in archive.query()], ["REF-BAD", "REF-1"])
+        self.assertEqual(archive.stats()["skipped"], 1)
+        self.assertEqual(list(archive.read(archive.query(references=["REF-BAD"]))), [raw(bad)])
+        archive.close()
+
+
+class TestReplay(unittest.IsolatedAsyncioTestCase):
+
+    async def test_replay_applies_a_filtered_slice_in_bulk(self):
+        patches = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            refs = request.url.params["receipt_number"][len("in.("):-1].replace('"', "").split(",")
+            status = orjson.loads(request.content)["status"]
+            patches.append((status, sorted(refs)))
+            return httpx.Response(200, json=[{"receipt_number": r, "status": status} for r in refs])
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        archive = WebhookArchive(tmp.name)
+        events = [signed_event(reference="REF-1", status="PENDING", tx_id="tx-1", timestamp=1)]
+        events += [signed_event(reference=f"REF-{i}", tx_id=f"tx-{i}", timestamp=2) for i in range(1, 6)]
+        events.append(signed_event(reference="REF-2", tx_id="tx-2", timestamp=2))  # reenvío
+        bad = signed_event(reference="REF-6", tx_id="tx-6")
+        bad["signature"]["checksum"] = "0" * 64
+        events.append(bad)
+        for i, event in enumerate(events):
+            archive.append(raw(event), received_at=1000.0 + i)
+        archive.append(raw(signed_event(reference="REF-OLD", tx_id="tx-0")), received_at=10.0)
+
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        batcher = PaymentStatusBatcher(server.patch_payment_statuses, window=0.01)
+        with patch.object(server, "supabase_http", fake), patch.object(server, "payment_batcher", batcher), \
+                patch.object(server, "transaction_cache", AsyncTTLCache()):
+            summary = await replay(archive, archive.query(since=parse_time("1970-01-01T00:10")),
+                                   server.apply_wompi_event, events_key="test_events_key",
+                                   delivery_key=server.webhook_delivery_key, concurrency=8)
+        archive.close()
+
+        self.assertEqual((summary["selected"], summary["applied"], summary["references"]), (8, 6, 5))
+        self.assertEqual((summary["duplicates"], summary["bad_checksum"], summary["failed"]), (1, 1, 0))
+        # Un PATCH por estado y ventana; REF-1 pasa por pending antes de paid
+        self.assertEqual(patches[0], ("pending", ["REF-1"]))
+        self.assertEqual(sorted(r for status, refs in patches[1:] for r in refs),
+                         ["REF-1", "REF-2", "REF-3", "REF-4", "REF-5"])
+        self.assertLessEqual(len(patches), 3)
+        self.assertEqual(batcher.stats()["updated"], 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from audit_log import AuditLogWriter
+    from supabase_client import SupabaseHTTP
+    from idempotency import IdempotencyStore
+    from webhook_archive import WebhookArchive
+    from webhook_queue import WebhookQueue, WebhookSpool
+
+
+def signed_event(reference="REF-1", status="APPROVED", tx_id="tx-1", timestamp=1700000000):
+    data = {"transaction": {"id": tx_id, "status": status, "reference": reference, "amount_in_cents": 5000}}
+    properties = ["transaction.id", "transaction.status", "transaction.amount_in_cents"]
+    raw = f"{tx_id}{status}5000{timestamp}test_events_key"
+    return {
+        "event": "transaction.updated",
+        "data": data,
+        "timestamp": timestamp,
+        "signature": {"properties": properties, "checksum": hashlib.sha256(raw.encode()).hexdigest()},
+    }
+
+
+class TestWebhookSpool(unittest.TestCase):
+
+    def test_events_survive_reopen_and_recover_processing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "spool.db")
+            spool = WebhookSpool(path)
+            first = spool.append({"n": 1})
+            spool.append({"n": 2})
+            self.assertEqual(spool.claim()[0], first)
+            spool.close()
+
+            # Un proceso nuevo ve los dos eventos y devuelve el "processing" a pending
+            reopened = WebhookSpool(path)
+            self.assertEqual(reopened.requeue_processing(), 1)
+            self.assertEqual(reopened.counts(), {"pending": 2, "processing": 0, "dead_letters": 0})
+            reopened.close()
+
+
+class TestWebhookQueue(unittest.IsolatedAsyncioTestCase):
+
+    async def test_retries_then_succeeds(self):
+        attempts = []
+
+        async def flaky(payload, received_at):
+            attempts.append(payload["n"])
+            if len(attempts) < 3:
+                raise RuntimeError("supabase 503")
+
+        queue = WebhookQueue(WebhookSpool(":memory:"), flaky, workers=2, base_delay=0.01, max_delay=0.02)
+        await queue.start()
+        await queue.submit({"n": 7})
+        for _ in range(100):
+            if queue.processed:
+                break
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+        self.assertEqual(attempts, [7, 7, 7])
+        self.assertEqual(queue.retried, 2)
+        self.assertEqual(queue.spool.counts()["pending"], 0)
+
+    async def test_dead_letters_after_max_attempts(self):
+        async def always_fails(payload, received_at):
+            raise RuntimeError("boom")
+
+        queue = WebhookQueue(WebhookSpool(":memory:"), always_fails, max_attempts=2, base_delay=0.001, inline=True)
+        # Sin lifespan (Vercel): submit hace el primer intento en línea y arranca los workers,
+        # que se encargan del reintento y del dead-letter
+        event_id = await queue.submit({"n": 1})
+        self.assertEqual((queue.running, queue.retried), (True, 1))
+        for _ in range(100):
+            if queue.dead_lettered:
+                break
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+        dead = queue.spool.dead_letters()
+        self.assertEqual(len(dead), 1)
+        self.assertEqual(dead[0]["event_id"], event_id)
+        self.assertIn("boom", dead[0]["last_error"])
+        self.assertEqual(queue.spool.counts(), {"pending": 0, "processing": 0, "dead_letters": 1})
+
+
+class TestWebhookEndpoint(unittest.TestCase):
+
+    def test_acks_before_supabase_and_worker_applies_patch(self):
+        from fastapi.testclient import TestClient
+
+        patches = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            patches.append((request.method, request.url.params.get("receipt_number")))
+            return httpx.Response(200, json=[{"receipt_number": "REF-1"}])
+
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        queue = WebhookQueue(WebhookSpool(":memory:"), server.apply_wompi_event, workers=1)
+        # Writer propio: el global puede traer filas de auditoría de otras pruebas
+        with patch.object(server, "supabase_http", fake), patch.object(server, "webhook_queue", queue), \
+                patch.object(server, "webhook_idempotency", IdempotencyStore(":memory:")), \
+                patch.object(server, "webhook_archive", WebhookArchive(None)), \
+                patch.object(server, "audit_writer", AuditLogWriter(server.write_audit_rows)):
+            with TestClient(server.app) as client:
+                resp = client.post("/api/payments/wompi/webhook", json=signed_event())
+                self.assertEqual(resp.status_code, 200)
+                self.assertTrue(resp.json()["queued"])
+                for _ in range(100):
+                    if queue.processed:
+                        break
+                    client.portal.call(asyncio.sleep, 0.01)
+
+        self.assertEqual(patches, [("PATCH", 'in.("REF-1")')])
+
+    def test_bad_checksum_is_not_queued(self):
+        from fastapi.testclient import TestClient
+
+        queue = WebhookQueue(WebhookSpool(":memory:"), server.apply_wompi_event)
+        body = signed_event()
+        body["signature"]["checksum"] = "0" * 64
+        with patch.object(server, "webhook_queue", queue), \
+                patch.object(server, "webhook_idempotency", IdempotencyStore(":memory:")), \
+                patch.object(server, "webhook_archive", WebhookArchive(None)):
+            resp = TestClient(server.app).post("/api/payments/wompi/webhook", json=body)
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(queue.spool.counts()["pending"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import hashlib
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from wompi_checksum import checksum_matches, compile_properties, expected_checksum
+
+
+class TestWompiChecksum(unittest.TestCase):
+
+    def test_matches_wompi_concatenation(self):
+        data = {"transaction": {"id": "1234-1", "status": "APPROVED", "amount_in_cents": 4490000}}
+        raw = "1234-1APPROVED44900001530291411events_key"
+        body = {
+            "data": data,
+            "timestamp": 1530291411,
+            "signature": {
+                "properties": ["transaction.id", "transaction.status", "transaction.amount_in_cents"],
+                "checksum": hashlib.sha256(raw.encode()).hexdigest(),
+            },
+        }
+        self.assertTrue(checksum_matches(body, "events_key"))
+        body["data"]["transaction"]["status"] = "DECLINED"
+        self.assertFalse(checksum_matches(body, "events_key"))
+
+    def test_missing_and_non_dict_paths_are_empty(self):
+        extract = compile_properties(("transaction.id", "transaction.id.deep", "nope.x"))
+        self.assertEqual(extract({"transaction": {"id": 7}}), ["7", "", ""])
+
+    def test_extractor_is_compiled_once_per_properties(self):
+        props = ("transaction.id", "transaction.status")
+        self.assertIs(compile_properties(props), compile_properties(tuple(list(props))))
+        expected = hashlib.sha256(b"1PENDING9k").hexdigest()
+        self.assertEqual(expected_checksum({"transaction": {"id": 1, "status": "PENDING"}}, list(props), 9, "k"),
+                         expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest.mock import patch
+
+import httpx
+import orjson
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+with patch.dict(os.environ, {
+    "SUPABASE_URL": "https://fake.supabase.co",
+    "SUPABASE_SERVICE_ROLE_KEY": "fake-key",
+    "WOMPI_INTEGRITY_SECRET": "test_secret_123",
+    "WOMPI_EVENTS_KEY": "test_events_key"
+}):
+    import server
+    from supabase_client import SupabaseHTTP
+    from ttl_cache import AsyncTTLCache
+    from wompi_reconcile import (WompiTransactions, diff, load_checkpoint, reconcile, save_checkpoint,
+                                 window)
+
+SINCE = datetime(2026, 3, 1, tzinfo=timezone.utc)
+UNTIL = datetime(2026, 3, 2, tzinfo=timezone.utc)
+
+
+def fake_wompi(transactions, page_delay=0.01, throttle_first=False):
+    """API de Wompi falsa: pagina `transactions`; opcionalmente un 429 en la primera llamada."""
+    calls = {"requests": 0, "in_flight": 0, "max_in_flight": 0, "auth": set()}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        calls["requests"] += 1
+        calls["auth"].add(request.headers.get("authorization"))
+        if throttle_first and calls["requests"] == 1:
+            return httpx.Response(429, headers={"Retry-After": "0"})
+        calls["in_flight"] += 1
+        calls["max_in_flight"] = max(calls["max_in_flight"], calls["in_flight"])
+        await asyncio.sleep(page_delay)
+        calls["in_flight"] -= 1
+        page, size = int(request.url.params["page"]), int(request.url.params["page_size"])
+        rows = transactions[(page - 1) * size:page * size]
+        return httpx.Response(200, json={"data": rows, "meta": {"page": page, "page_size": size,
+                                                                 "total_results": len(transactions)}})
+
+    return httpx.MockTransport(handler), calls
+
+
+def tx(reference, status="APPROVED", amount_in_cents=15000000, created_at="2026-03-01T10:00:00.000Z"):
+    return {"id": f"tx-{reference}-{status}", "reference": reference, "status": status,
+            "amount_in_cents": amount_in_cents, "created_at": created_at}
+
+
+class TestDiff(unittest.TestCase):
+
+    def test_hash_join_findings(self):
+        transactions = [
+            tx("SM-1"),                                          # pending -> paid
+            tx("SM-2", "DECLINED"), tx("SM-2", "APPROVED", created_at="2026-03-01T09:00:00Z"),
+            tx("SM-3", "VOIDED"),                                # paid -> refunded
+            tx("SM-4", "DECLINED"),                              # paid aquí: conflicto
+            tx("SM-5", "PENDING"),
+            tx("SM-6", amount_in_cents=100),                     # ya cuadra el estado, no el monto
+            tx("SM-404"),
+        ]
+        payments = [
+            {"receipt_number": "SM-1", "status": "pending", "amount": 150000},
+            {"receipt_number": "SM-2", "status": "overdue", "amount": 150000},
+            {"receipt_number": "SM-3", "status": "paid", "amount": 150000},
+            {"receipt_number": "SM-4", "status": "paid", "amount": 150000},
+            {"receipt_number": "SM-5", "status": "pending", "amount": 150000},
+            {"receipt_number": "SM-6", "status": "paid", "amount": 150000},
+        ]
+        result = diff(transactions, payments, server.WOMPI_STATUS_MAP)
+        # Un APPROVED gana aunque haya un intento posterior rechazado
+        self.assertEqual(result["corrections"], {"paid": ["SM-1", "SM-2"], "refunded": ["SM-3"]})
+        self.assertEqual([c["reference"] for c in result["conflict"]], ["SM-4"])
+        self.assertEqual([m["reference"] for m in result["missing_payment"]], ["SM-404"])
+        self.assertEqual(result["amount_mismatch"], [{"reference": "SM-6", "payment_cents": 15000000,
+                                                      "wompi_cents": 100}])
+        self.assertEqual((result["matched"], result["pending_in_wompi"], result["references"]), (1, 1, 7))
+
+
+class TestScan(unittest.IsolatedAsyncioTestCase):
+
+    async def test_pages_concurrently_within_the_limit(self):
+        transactions = [tx(f"SM-{i}") for i in range(450)]
+        transport, calls = fake_wompi(transactions, throttle_first=True)
+        wompi = WompiTransactions("prv_test_key", page_size=50, concurrency=3, transport=transport)
+        scanned = await wompi.scan(SINCE, UNTIL)
+        await wompi.aclose()
+        self.assertEqual([t["reference"] for t in scanned], [t["reference"] for t in transactions])
+        self.assertEqual((wompi.requests, wompi.retries), (10, 1))
+        self.assertEqual(calls["max_in_flight"], 3)
+        self.assertEqual(calls["auth"], {"Bearer prv_test_key"})
+
+
+class TestReconcile(unittest.IsolatedAsyncioTestCase):
+
+    async def test_set_based_corrections_through_the_backend(self):
+        requests = []
+        rows = {f"SM-{i}": {"id": str(i), "receipt_number": f"SM-{i}", "status": "pending", "amount": 150000,
+                            "payment_date": None} for i in range(300)}
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            refs = request.url.params["receipt_number"][len("in.("):-1].replace('"', "").split(",")
+            requests.append((request.method, len(refs)))
+            found = [rows[r] for r in refs if r in rows]
+            if request.method == "PATCH":
+                status = orjson.loads(request.content)["status"]
+                found = [dict(row, status=status) for row in found]
+            return httpx.Response(200, json=found)
+
+        transactions = [tx(f"SM-{i}") for i in range(250)] + [tx(f"SM-{i}", "DECLINED") for i in range(250, 300)]
+        transport, _ = fake_wompi(transactions)
+        wompi = WompiTransactions("prv_test_key", page_size=100, transport=transport)
+        fake = SupabaseHTTP("https://fake.supabase.co", "fake-key", transport=httpx.MockTransport(handler))
+        with patch.object(server, "supabase_http", fake), patch.object(server, "transaction_cache", AsyncTTLCache()):
+            dry = await reconcile(wompi, SINCE, UNTIL, server.data_store.payments_by_references,
+                                  server.WOMPI_STATUS_MAP)
+            self.assertEqual([method for method, _ in requests], ["GET", "GET"])
+            report = await reconcile(wompi, SINCE, UNTIL, server.data_store.payments_by_references,
+                                     server.WOMPI_STATUS_MAP, apply=server.patch_payment_statuses)
+            cached = server.transaction_cache.peek("SM-0")
+        await wompi.aclose()
+
+        self.assertTrue(dry["dry_run"])
+        self.assertEqual(dry["corrections"], {"paid": 250, "rejected": 50})
+        self.assertEqual(report["applied"], {"paid": 250, "rejected": 50})
+        # Lookups y PATCH en lotes de hasta 200 referencias, uno por estado
+        self.assertEqual(requests[2:], [("GET", 200), ("GET", 100), ("PATCH", 200), ("PATCH", 50), ("PATCH", 50)])
+        self.assertEqual(cached["status"], "paid")
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_next_run_starts_at_checkpoint_minus_overlap(self):
+        args = argparse.Namespace(since=None, until=None, days=7, overlap_hours=24)
+        now = datetime(2026, 3, 10, 3, 0, tzinfo=timezone.utc)
+        self.assertEqual(window(args, None, now), (now - timedelta(days=7), now))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "checkpoint.json"
+            save_checkpoint(path, UNTIL, {"transactions": 3, "corrections": {"paid": 1}})
+            checkpoint = load_checkpoint(path)
+        self.assertEqual(checkpoint["scanned_until"], "2026-03-02T00:00:00Z")
+        self.assertEqual(window(args, checkpoint, now)[0], UNTIL - timedelta(hours=24))
+        self.assertIsNone(load_checkpoint(Path(tmp) / "missing.json"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Small in-process async cache: bounded LRU + TTL + single-flight loads.
+
+Used for read-mostly rows we look up on hot payment paths (e.g.
+schools.payment_settings). A loader returning None is cached as a negative
+entry with its own (shorter) TTL; a loader that raises is never cached, and
+every waiter coalesced on that load sees the same exception. The load runs
+in its own task: cancelling the caller that started it (a client that
+disconnected) leaves it running for everyone else.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple
+
+_MISSING = object()
+
+
+def _retrieve(task: "asyncio.Future") -> None:
+    # Mark a failure retrieved so a load every caller abandoned does not log "never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+class AsyncTTLCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0, negative_ttl: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, "asyncio.Future"] = {}
+        self._stale_loads: Set[Hashable] = set()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peek(self, key: Hashable, default: Any = _MISSING) -> Any:
+        """Fresh cached value (None for a negative entry) or `default`; no load, no stats."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= self._clock():
+            return default
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Write-through: also wins over a load for this key that is still in flight."""
+        if key in self._inflight:
+            self._stale_loads.add(key)
+        self._store(key, value)
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self._entries[key] = (self._clock() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> bool:
+        if key in self._inflight:
+            self._stale_loads.add(key)
+        return self._entries.pop(key, None) is not None
+
+    def clear(self) -> None:
+        self._stale_loads.update(self._inflight)
+        self._entries.clear()
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Optional[Any]]]) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+
+        self.misses += 1
+        pending = self._inflight.get(key)
+        if pending is None:
+            # The load runs in its own task, so it outlives whichever caller started it:
+            # a leader whose client disconnects does not fail the requests coalesced on it
+            pending = asyncio.ensure_future(self._load(key, loader))
+            pending.add_done_callback(_retrieve)
+            self._inflight[key] = pending
+            self.loads += 1
+        # shield: one cancelled caller must not cancel the shared load
+        return await asyncio.shield(pending)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Optional[Any]]]) -> Optional[Any]:
+        try:
+            value = await loader()
+            # An invalidate()/set() that raced with this load wins: don't resurrect stale data
+            if key not in self._stale_loads:
+                self._store(key, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+            self._stale_loads.discard(key)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,328 @@
+"""
+Append-only archive of the raw Wompi webhook bodies, for forensics and replay.
+
+Every body the webhook route receives that parses as a Wompi event (checksum
+valid or not, duplicates included) is appended, byte for byte, to the current
+gzip segment under `directory`:
+
+    webhooks-000001.gz   webhooks-000002.gz   ...   index.db
+
+Each record is compressed with a full flush after it, so it starts on a byte
+boundary with a fresh dictionary: index.db stores (segment, offset, length)
+and a record is read back by seeking to its offset and inflating `length`
+bytes, without touching the rest of the segment. A closed segment is a
+regular gzip file of newline-separated bodies (`zcat webhooks-000001.gz`);
+the one being written when the process died lacks only the gzip trailer.
+
+Segments rotate at `segment_bytes` (compressed) or `segment_seconds`, and
+segments older than `retention` are deleted with their index rows, as are the
+oldest ones while closed segments take more than `max_bytes`. Segment numbers
+are allocated in index.db, so several workers can share a directory.
+
+The route calls append_async(), which runs append() on the archive's own
+thread: compression, file writes and the index insert never block the event
+loop, and records keep their arrival order.
+
+The index is a SQLite table keyed by reference and by transaction id; see
+replay_webhooks.py for the tool that reads it.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, Union
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive_segments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    closed_at REAL
+);
+CREATE TABLE IF NOT EXISTS archive_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    received_at REAL NOT NULL,
+    event TEXT,
+    reference TEXT,
+    transaction_id TEXT,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_archive_events_reference ON archive_events (reference);
+CREATE INDEX IF NOT EXISTS idx_archive_events_transaction ON archive_events (transaction_id);
+CREATE INDEX IF NOT EXISTS idx_archive_events_received ON archive_events (received_at);
+"""
+
+_COLUMNS = "id, segment, offset, length, received_at, event, reference, transaction_id, status"
+
+
+@dataclass(frozen=True)
+class ArchivedEvent:
+    id: int
+    segment: int
+    offset: int
+    length: int
+    received_at: float
+    event: Optional[str]
+    reference: Optional[str]
+    transaction_id: Optional[str]
+    status: Optional[str]
+
+
+def _fields(raw: bytes) -> Dict[str, Optional[str]]:
+    """What the index keeps of a body; empty when it is not a Wompi event."""
+    try:
+        body = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return {}
+    if not isinstance(body, dict) or not isinstance(body.get('event'), str) or not body['event']:
+        return {}
+    data = body.get('data')
+    transaction = data.get('transaction') if isinstance(data, dict) else None
+    if not isinstance(transaction, dict):
+        transaction = {}
+
+    def text(value) -> Optional[str]:
+        return str(value) if value not in (None, "") else None
+
+    return {
+        "event": text(body.get('event')),
+        "reference": text(transaction.get('reference')),
+        "transaction_id": text(transaction.get('id')),
+        "status": text(transaction.get('status')),
+    }
+
+
+class WebhookArchive:
+    def __init__(self, directory: Optional[Union[str, Path]], segment_bytes: int = 32 * 1024 * 1024,
+                 segment_seconds: float = 86400, retention: float = 180 * 86400,
+                 max_bytes: int = 2 * 1024 * 1024 * 1024, level: int = 6):
+        # None (or "") disables archiving: append() is a no-op
+        self.directory = Path(directory) if directory else None
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self.level = level
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._file: Optional[BinaryIO] = None
+        self._compressor = None
+        self._segment: Optional[int] = None
+        self._segment_opened_at = 0.0
+        self.appended = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.rotations = 0
+        self.pruned_segments = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        # Opened on first use so importing the app never touches the filesystem
+        if self._conn is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.directory / "index.db"), isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def segment_path(self, segment: int) -> Path:
+        return self.directory / f"webhooks-{segment:06d}.gz"
+
+    def _open_segment(self, now: float) -> None:
+        segment = self._db.execute("INSERT INTO archive_segments (created_at) VALUES (?)", (now,)).lastrowid
+        self._file = open(self.segment_path(segment), "xb")
+        self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        # Gzip header now, so every record offset points at raw deflate data
+        self._file.write(self._compressor.flush(zlib.Z_FULL_FLUSH))
+        self._segment = segment
+        self._segment_opened_at = now
+
+    def _close_segment(self) -> None:
+        if self._file is None:
+            return
+        self._file.write(self._compressor.flush(zlib.Z_FINISH))
+        self._file.close()
+        self._db.execute("UPDATE archive_segments SET closed_at = ? WHERE id = ?", (time.time(), self._segment))
+        self._file = self._compressor = self._segment = None
+
+    def _rotate(self, now: float) -> None:
+        self._close_segment()
+        self.rotations += 1
+        self.prune(now)
+
+    def append(self, raw: bytes, received_at: Optional[float] = None) -> Optional[int]:
+        """Archive one body as received; returns its index id. Never raises."""
+        if self.directory is None:
+            return None
+        fields = _fields(raw)
+        if not fields:
+            # Anyone can POST to the route: only what looks like a Wompi event is kept
+            self.skipped += 1
+            return None
+        now = received_at or time.time()
+        try:
+            if self._file is not None and now - self._segment_opened_at >= self.segment_seconds:
+                self._rotate(now)
+            if self._file is None:
+                self._open_segment(now)
+            offset = self._file.tell()
+            chunk = self._compressor.compress(raw + b"\n") + self._compressor.flush(zlib.Z_FULL_FLUSH)
+            self._file.write(chunk)
+            self._file.flush()
+            event_id = self._db.execute(
+                "INSERT INTO archive_events (segment, offset, length, received_at, event, reference, transaction_id,"
+                " status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._segment, offset, len(raw), now, fields["event"], fields["reference"],
+                 fields["transaction_id"], fields["status"]),
+            ).lastrowid
+            self.appended += 1
+            self.raw_bytes += len(raw)
+            self.compressed_bytes += len(chunk)
+            if offset + len(chunk) >= self.segment_bytes:
+                self._rotate(now)
+            return event_id
+        except (OSError, sqlite3.Error, zlib.error) as e:
+            # The archive is evidence, not part of processing: never fail the webhook for it
+            self.errors += 1
+            logger.error(f"Could not archive webhook body: {e}")
+            return None
+
+    async def append_async(self, raw: bytes, received_at: Optional[float] = None) -> Optional[int]:
+        """append() on the archive's thread, off the event loop."""
+        if self.directory is None:
+            return None
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="webhook-archive")
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.append, raw, received_at or time.time())
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """
+        Delete closed segments older than the retention window, then the oldest
+        while closed segments add up to more than `max_bytes`, with their index rows.
+        """
+        cutoff = (now or time.time()) - self.retention
+        closed = [(row[0], row[1]) for row in self._db.execute(
+            "SELECT id, created_at FROM archive_segments WHERE closed_at IS NOT NULL ORDER BY id")]
+        old = [segment for segment, created_at in closed if created_at < cutoff]
+        kept = [segment for segment, created_at in closed if created_at >= cutoff]
+        sizes = {segment: self._size(segment) for segment in kept}
+        total = sum(sizes.values())
+        for segment in kept:
+            if total <= self.max_bytes:
+                break
+            old.append(segment)
+            total -= sizes[segment]
+        for segment in old:
+            try:
+                os.unlink(self.segment_path(segment))
+            except FileNotFoundError:
+                pass
+            self._db.execute("DELETE FROM archive_events WHERE segment = ?", (segment,))
+            self._db.execute("DELETE FROM archive_segments WHERE id = ?", (segment,))
+        self.pruned_segments += len(old)
+        return len(old)
+
+    def _size(self, segment: int) -> int:
+        try:
+            return self.segment_path(segment).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def query(self, references: Sequence[str] = (), transaction_ids: Sequence[str] = (),
+              since: Optional[float] = None, until: Optional[float] = None, statuses: Sequence[str] = (),
+              event: Optional[str] = None, limit: Optional[int] = None) -> List[ArchivedEvent]:
+        """Index rows matching every given filter, oldest first."""
+        where, params = [], []
+        for column, values in (("reference", references), ("transaction_id", transaction_ids),
+                               ("status", statuses)):
+            if values:
+                where.append(f"{column} IN ({','.join('?' * len(values))})")
+                params.extend(values)
+        if since is not None:
+            where.append("received_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("received_at < ?")
+            params.append(until)
+        if event:
+            where.append("event = ?")
+            params.append(event)
+        sql = f"SELECT {_COLUMNS} FROM archive_events"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY received_at, id"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return [ArchivedEvent(*row) for row in self._db.execute(sql, params)]
+
+    def read(self, entries: Iterable[ArchivedEvent]) -> Iterator[bytes]:
+        """The raw bodies of `entries`, in the order given."""
+        files: Dict[int, BinaryIO] = {}
+        try:
+            for entry in entries:
+                if entry.segment == self._segment and self._file is not None:
+                    self._file.flush()
+                fh = files.get(entry.segment)
+                if fh is None:
+                    fh = files[entry.segment] = open(self.segment_path(entry.segment), "rb")
+                fh.seek(entry.offset)
+                inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+                out = b""
+                while len(out) < entry.length:
+                    chunk = inflater.unconsumed_tail or fh.read(16 * 1024)
+                    if not chunk:
+                        raise EOFError(f"segment {entry.segment} ends inside record {entry.id}")
+                    out += inflater.decompress(chunk, entry.length - len(out))
+                yield out
+        finally:
+            for fh in files.values():
+                fh.close()
+
+    def close(self) -> None:
+        if self.directory is None:
+            return
+        if self._executor is not None:
+            # Lets queued appends finish first
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        try:
+            self._close_segment()
+        except (OSError, sqlite3.Error, zlib.error) as e:
+            logger.error(f"Could not close webhook archive segment: {e}")
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "segment": self._segment,
+            "appended": self.appended,
+            "skipped": self.skipped,
+            "raw_bytes": self.raw_bytes,
+            "compressed_bytes": self.compressed_bytes,
+            "rotations": self.rotations,
+            "pruned_segments": self.pruned_segments,
+            "errors": self.errors,
+        }
@@ -0,0 +1,286 @@
+"""
+Durable queue for Wompi webhook events.
+
+The webhook route validates the checksum, appends the raw event to a local
+SQLite spool (WAL mode) and acknowledges. A pool of asyncio workers drains the
+spool and applies the payment update; failures are retried with exponential
+backoff and, once attempts are exhausted, moved to a dead-letter table so no
+status update is ever silently dropped.
+
+The spool is a single-writer SQLite file; every statement is a short indexed
+write, so calls are made directly from the event loop.
+
+Serverless runtimes never run the lifespan hook, so submit() starts the
+workers itself, and with `inline` it also makes the first attempt before
+returning (the instance may be frozen as soon as the response is sent).
+Retries and dead-lettering then run while that instance is warm, and
+re-claim anything an earlier invocation left due. The spool there lives on the
+instance's ephemeral /tmp: an event whose first attempt failed survives only as
+long as the instance does, so the durability guarantee above holds only on
+hosts with a persistent spool path.
+"""
+
+import asyncio
+import logging
+import random
+import sqlite3
+import time
+from pathlib import Path
+
+import orjson
+from typing import Any, Awaitable, Callable, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict, float], Awaitable[Any]]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending | processing
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_webhook_events_due ON webhook_events (status, next_attempt_at);
+
+CREATE TABLE IF NOT EXISTS webhook_dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    failed_at REAL NOT NULL
+);
+"""
+
+
+class WebhookSpool:
+    """SQLite-backed append/claim/ack store for raw webhook events."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = str(path)
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def open(self) -> sqlite3.Connection:
+        """Open (creating it if needed) the spool now; otherwise it opens on first use."""
+        # Never at import time, so importing the app never touches the filesystem
+        if self._conn is None:
+            if self.path != ":memory:":
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # NORMAL + WAL survives process crashes; only an OS crash can lose the tail
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return self.open()
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def append(self, payload: Union[dict, bytes, str], received_at: Optional[float] = None) -> int:
+        """Append an event; raw request bytes are stored as received."""
+        now = received_at or time.time()
+        if isinstance(payload, dict):
+            payload = orjson.dumps(payload)
+        if isinstance(payload, bytes):
+            payload = payload.decode()
+        cur = self._db.execute(
+            "INSERT INTO webhook_events (payload, received_at, next_attempt_at) VALUES (?, ?, ?)",
+            (payload, now, now),
+        )
+        return cur.lastrowid
+
+    def claim(self, now: Optional[float] = None) -> Optional[tuple]:
+        """Mark the oldest due event as processing and return (id, payload, received_at, attempts)."""
+        now = now or time.time()
+        row = self._db.execute(
+            "SELECT id, payload, received_at, attempts FROM webhook_events "
+            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is None:
+            return None
+        self._db.execute("UPDATE webhook_events SET status = 'processing' WHERE id = ?", (row[0],))
+        return row
+
+    def claim_id(self, event_id: int) -> Optional[tuple]:
+        row = self._db.execute(
+            "SELECT id, payload, received_at, attempts FROM webhook_events WHERE id = ? AND status = 'pending'",
+            (event_id,),
+        ).fetchone()
+        if row is not None:
+            self._db.execute("UPDATE webhook_events SET status = 'processing' WHERE id = ?", (event_id,))
+        return row
+
+    def ack(self, event_id: int) -> None:
+        self._db.execute("DELETE FROM webhook_events WHERE id = ?", (event_id,))
+
+    def retry(self, event_id: int, attempts: int, next_attempt_at: float, error: str) -> None:
+        self._db.execute(
+            "UPDATE webhook_events SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? "
+            "WHERE id = ?",
+            (attempts, next_attempt_at, error, event_id),
+        )
+
+    def dead_letter(self, event_id: int, attempts: int, error: str) -> None:
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.execute(
+                "INSERT INTO webhook_dead_letters (event_id, payload, received_at, attempts, last_error, failed_at) "
+                "SELECT id, payload, received_at, ?, ?, ? FROM webhook_events WHERE id = ?",
+                (attempts, error, time.time(), event_id),
+            )
+            self._db.execute("DELETE FROM webhook_events WHERE id = ?", (event_id,))
+
+    def requeue_processing(self) -> int:
+        """Crash recovery: events claimed by a previous process go back to pending."""
+        return self._db.execute(
+            "UPDATE webhook_events SET status = 'pending' WHERE status = 'processing'"
+        ).rowcount
+
+    def next_due_at(self) -> Optional[float]:
+        row = self._db.execute(
+            "SELECT MIN(next_attempt_at) FROM webhook_events WHERE status = 'pending'"
+        ).fetchone()
+        return row[0] if row else None
+
+    def dead_letters(self, limit: int = 100) -> List[dict]:
+        rows = self._db.execute(
+            "SELECT id, event_id, payload, received_at, attempts, last_error, failed_at "
+            "FROM webhook_dead_letters ORDER BY id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+        keys = ("id", "event_id", "payload", "received_at", "attempts", "last_error", "failed_at")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def counts(self) -> dict:
+        pending, processing = self._db.execute(
+            "SELECT COALESCE(SUM(status = 'pending'), 0), COALESCE(SUM(status = 'processing'), 0) FROM webhook_events"
+        ).fetchone()
+        dead = self._db.execute("SELECT COUNT(*) FROM webhook_dead_letters").fetchone()[0]
+        return {"pending": pending, "processing": processing, "dead_letters": dead}
+
+
+class WebhookQueue:
+    """Asyncio worker pool draining a WebhookSpool through `handler(payload, received_at)`."""
+
+    def __init__(
+        self,
+        spool: WebhookSpool,
+        handler: Handler,
+        workers: int = 4,
+        max_attempts: int = 8,
+        base_delay: float = 1.0,
+        max_delay: float = 300.0,
+        idle_poll: float = 5.0,
+        inline: bool = False,
+    ):
+        self.spool = spool
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idle_poll = idle_poll
+        self.inline = inline
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self) -> None:
+        # Workers left on a loop that has since gone away (one loop per invocation) never run again
+        if self.running and self._tasks[0].get_loop() is asyncio.get_running_loop():
+            return
+        self._tasks = []
+        recovered = self.spool.requeue_processing()
+        if recovered:
+            logger.warning(f"Webhook queue recovered {recovered} in-flight event(s) from a previous run")
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Webhook queue started with {self.workers} worker(s) on {self.spool.path}")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, payload: Union[dict, bytes, str]) -> int:
+        """Durably append an event; with `inline`, also make its first attempt before returning."""
+        event_id = self.spool.append(payload)
+        # No lifespan hook on serverless: the first submit starts the workers
+        await self.start()
+        if self.inline:
+            row = self.spool.claim_id(event_id)
+            if row is not None:
+                await self._process(row)
+        self._wakeup.set()
+        return event_id
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _process(self, row) -> None:
+        event_id, payload, received_at, attempts = row
+        try:
+            await self.handler(orjson.loads(payload), received_at)
+        except Exception as e:
+            attempts += 1
+            error = f"{type(e).__name__}: {e}"
+            if attempts >= self.max_attempts:
+                self.spool.dead_letter(event_id, attempts, error)
+                self.dead_lettered += 1
+                logger.error(f"Webhook event {event_id} dead-lettered after {attempts} attempts: {error}")
+            else:
+                delay = self.backoff(attempts)
+                self.spool.retry(event_id, attempts, time.time() + delay, error)
+                self.retried += 1
+                logger.warning(f"Webhook event {event_id} failed (attempt {attempts}), retrying in {delay:.1f}s: {error}")
+        else:
+            self.spool.ack(event_id)
+            self.processed += 1
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            # Clear before claiming so a submit() landing in between is not missed
+            self._wakeup.clear()
+            row = self.spool.claim()
+            if row is not None:
+                await self._process(row)
+                continue
+            next_due = self.spool.next_due_at()
+            timeout = self.idle_poll if next_due is None else max(0.0, min(self.idle_poll, next_due - time.time()))
+            # Not wait_for: before 3.12 it swallows a cancel that lands as the event fires
+            waiter = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait({waiter}, timeout=timeout)
+            finally:
+                waiter.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "workers": len(self._tasks),
+            "processed": self.processed,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered,
+            **self.spool.counts(),
+        }
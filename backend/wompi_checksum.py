@@ -0,0 +1,54 @@
+"""
+Wompi event checksum verification.
+
+Wompi signs `signature.properties` (dotted paths into `data`, e.g.
+"transaction.status"), then the event timestamp, then our events secret.
+The property list is the same for every event of a given type, so the dotted
+paths are split once per distinct `properties` tuple and the resulting
+extractor is cached. The final comparison is constant-time.
+"""
+
+import hashlib
+import hmac
+from functools import lru_cache
+from typing import Callable, List, Sequence, Tuple
+
+
+@lru_cache(maxsize=64)
+def compile_properties(properties: Tuple[str, ...]) -> Callable[[dict], List[str]]:
+    """Extractor returning the stringified value of each property path in `data`."""
+    paths = tuple(tuple(prop.split('.')) for prop in properties)
+
+    def extract(data: dict) -> List[str]:
+        values = []
+        for keys in paths:
+            value = data
+            for key in keys:
+                if isinstance(value, dict):
+                    value = value.get(key, '')
+                else:
+                    value = ''
+                    break
+            values.append(str(value))
+        return values
+
+    return extract
+
+
+def expected_checksum(data: dict, properties: Sequence[str], timestamp, events_key: str) -> str:
+    values = compile_properties(tuple(properties))(data)
+    values.append(str(timestamp))
+    values.append(events_key)
+    return hashlib.sha256(''.join(values).encode()).hexdigest()
+
+
+def checksum_matches(body: dict, events_key: str) -> bool:
+    """Constant-time check of `body.signature.checksum` against the recomputed one."""
+    signature_info = body.get('signature') or {}
+    expected = expected_checksum(
+        body.get('data', {}),
+        signature_info.get('properties', []),
+        body.get('timestamp', ''),
+        events_key,
+    )
+    return hmac.compare_digest(str(signature_info.get('checksum', '')).encode(), expected.encode())
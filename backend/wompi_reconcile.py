@@ -0,0 +1,333 @@
+"""
+Nightly reconciliation of payments against the Wompi transactions API.
+
+    python wompi_reconcile.py [--since 2026-03-01] [--until 2026-03-02] [--dry-run]
+                              [--checkpoint PATH] [--report PATH] [--concurrency 4]
+
+Steps:
+    1. scan   pages of GET {WOMPI_API_URL}/transactions for the window, the
+              first page alone (to learn the total) and the rest concurrently,
+              at most `concurrency` requests in flight
+    2. join   payments rows for every reference seen, fetched in bulk
+              (PostgREST in.(...) chunks or one asyncpg ANY()), hashed by
+              receipt_number and probed with the Wompi transactions
+    3. fix    payments whose status is behind Wompi's final status, one
+              UPDATE per target status (server.patch_payment_statuses, so the
+              transaction cache and SSE streams see it too)
+    4. report a JSON summary (plus the rows behind every count) and a
+              checkpoint: the next run starts at the previous `until` minus
+              `overlap`, so PENDING transactions that settled late are seen again
+
+Only forward moves are applied: an open payment (pending, overdue, failed...)
+takes Wompi's final status and a paid one may become refunded when Wompi says
+VOIDED. Anything else that disagrees (paid here, DECLINED there; amounts
+that differ; Wompi transactions without a payments row) is reported, not
+touched.
+
+Environment: WOMPI_PRIVATE_KEY, WOMPI_API_URL (default
+https://production.wompi.co/v1; point it at a local stub to test) and the
+usual SUPABASE_URL / DATA_BACKEND settings for the payments side.
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import httpx
+import orjson
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Same forward-only ordering as the webhook's status batches
+from payment_batcher import moves_forward  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+WOMPI_API_URL = "https://production.wompi.co/v1"
+
+RETRYABLE = {429, 500, 502, 503, 504}
+
+LookupFn = Callable[[List[str]], Awaitable[List[dict]]]
+ApplyFn = Callable[[str, List[str]], Awaitable[Set[str]]]
+
+
+def _iso(moment: datetime) -> str:
+    return moment.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def parse_time(value: str) -> datetime:
+    """ISO date/datetime, UTC when no offset is given."""
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+class WompiTransactions:
+    """Paged reader for the merchant transactions endpoint."""
+
+    def __init__(self, private_key: Optional[str], base_url: str = WOMPI_API_URL, page_size: int = 200,
+                 concurrency: int = 4, max_attempts: int = 4, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        headers = {"Authorization": f"Bearer {private_key}"} if private_key else {}
+        self.client = httpx.AsyncClient(base_url=base_url.rstrip("/"), headers=headers, transport=transport,
+                                        timeout=httpx.Timeout(30.0, connect=5.0))
+        self.requests = 0
+        self.retries = 0
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def page(self, since: datetime, until: datetime, page: int) -> dict:
+        params = {
+            "from_date": _iso(since),
+            "until_date": _iso(until),
+            "page": page,
+            "page_size": self.page_size,
+            "order_by": "created_at",
+            "order": "ASC",
+        }
+        for attempt in range(1, self.max_attempts + 1):
+            self.requests += 1
+            backoff = 0.5 * 2 ** (attempt - 1)
+            try:
+                response = await self.client.get("/transactions", params=params)
+            except httpx.TransportError as e:
+                if attempt == self.max_attempts:
+                    raise
+                delay, reason = backoff, str(e) or type(e).__name__
+            else:
+                if response.status_code == 200:
+                    return orjson.loads(response.content)
+                if response.status_code not in RETRYABLE or attempt == self.max_attempts:
+                    response.raise_for_status()
+                # Respect Wompi's rate limiting when it says how long to wait
+                retry_after = response.headers.get("retry-after", "")
+                delay = float(retry_after) if retry_after.isdigit() else backoff
+                reason = f"HTTP {response.status_code}"
+            self.retries += 1
+            logger.warning(f"Wompi transactions page {page} failed ({reason}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def scan(self, since: datetime, until: datetime) -> List[dict]:
+        """Every transaction created in [since, until)."""
+        first = await self.page(since, until, 1)
+        transactions = list(first.get("data") or [])
+        meta = first.get("meta") or {}
+        total = meta.get("total_results")
+        if total is None:
+            # No total: walk the pages until a short one
+            page = 1
+            last = transactions
+            while len(last) >= self.page_size:
+                page += 1
+                last = (await self.page(since, until, page)).get("data") or []
+                transactions.extend(last)
+            return transactions
+
+        pages = math.ceil(total / self.page_size)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(number: int) -> List[dict]:
+            async with semaphore:
+                return (await self.page(since, until, number)).get("data") or []
+
+        for rows in await asyncio.gather(*(fetch(n) for n in range(2, pages + 1))):
+            transactions.extend(rows)
+        return transactions
+
+
+def _pick(current: Optional[dict], candidate: dict) -> dict:
+    """One Wompi transaction per reference: an APPROVED one, else the latest."""
+    if current is None:
+        return candidate
+    if (current.get("status") == "APPROVED") != (candidate.get("status") == "APPROVED"):
+        return current if current.get("status") == "APPROVED" else candidate
+    return candidate if (candidate.get("created_at") or "") >= (current.get("created_at") or "") else current
+
+
+def _cents(amount) -> Optional[int]:
+    try:
+        return round(float(amount) * 100)
+    except (TypeError, ValueError):
+        return None
+
+
+def diff(transactions: List[dict], payments: List[dict], status_map: Dict[str, str]) -> dict:
+    """
+    Hash join Wompi transactions against payments rows by reference /
+    receipt_number; `status_map` is Wompi status -> payments.status. Returns
+    the corrections ({target status: [references]}) and the findings that are
+    only reported.
+    """
+    by_reference: Dict[str, dict] = {}
+    for tx in transactions:
+        reference = tx.get("reference")
+        if reference:
+            by_reference[reference] = _pick(by_reference.get(reference), tx)
+
+    # Build side: the payments rows (the smaller set), keyed by receipt_number
+    table = {row["receipt_number"]: row for row in payments if row.get("receipt_number")}
+
+    corrections: Dict[str, List[str]] = {}
+    result = {"matched": 0, "pending_in_wompi": 0, "missing_payment": [], "amount_mismatch": [], "conflict": []}
+    for reference, tx in by_reference.items():
+        row = table.get(reference)
+        if row is None:
+            result["missing_payment"].append({"reference": reference, "transaction_id": tx.get("id"),
+                                              "status": tx.get("status"), "amount_in_cents": tx.get("amount_in_cents")})
+            continue
+        expected_cents = _cents(row.get("amount"))
+        if expected_cents is not None and tx.get("amount_in_cents") is not None \
+                and expected_cents != tx["amount_in_cents"]:
+            result["amount_mismatch"].append({"reference": reference, "payment_cents": expected_cents,
+                                              "wompi_cents": tx["amount_in_cents"]})
+        wompi_status = tx.get("status")
+        target = status_map.get(wompi_status)
+        current = row.get("status")
+        if wompi_status == "PENDING" or target is None:
+            result["pending_in_wompi"] += 1
+        elif target == current:
+            result["matched"] += 1
+        elif moves_forward(current, target):
+            corrections.setdefault(target, []).append(reference)
+        else:
+            result["conflict"].append({"reference": reference, "payment_status": current,
+                                       "wompi_status": wompi_status, "transaction_id": tx.get("id")})
+    result["corrections"] = corrections
+    result["references"] = len(by_reference)
+    return result
+
+
+async def reconcile(wompi: WompiTransactions, since: datetime, until: datetime, lookup: LookupFn,
+                    status_map: Dict[str, str], apply: Optional[ApplyFn] = None, chunk_size: int = 200) -> dict:
+    """Scan, join and (unless `apply` is None) correct; returns the report."""
+    started = time.monotonic()
+    transactions = await wompi.scan(since, until)
+    references = sorted({tx["reference"] for tx in transactions if tx.get("reference")})
+    payments = await lookup(references) if references else []
+    result = diff(transactions, payments, status_map)
+
+    applied: Dict[str, int] = {}
+    if apply is not None:
+        for status, refs in result["corrections"].items():
+            matched = 0
+            for i in range(0, len(refs), chunk_size):
+                matched += len(await apply(status, refs[i:i + chunk_size]))
+            applied[status] = matched
+
+    return {
+        "since": _iso(since),
+        "until": _iso(until),
+        "transactions": len(transactions),
+        "wompi_requests": wompi.requests,
+        "wompi_retries": wompi.retries,
+        "payments_found": len(payments),
+        "dry_run": apply is None,
+        "corrections": {status: len(refs) for status, refs in result["corrections"].items()},
+        "applied": applied,
+        "seconds": round(time.monotonic() - started, 3),
+        **{key: value for key, value in result.items() if key != "corrections"},
+        "corrected_references": result["corrections"],
+    }
+
+
+def load_checkpoint(path: Path) -> Optional[dict]:
+    try:
+        return orjson.loads(path.read_bytes())
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path: Path, until: datetime, report: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(orjson.dumps({
+        "scanned_until": _iso(until),
+        "run_at": _iso(datetime.now(timezone.utc)),
+        "transactions": report["transactions"],
+        "corrections": report["corrections"],
+    }, option=orjson.OPT_INDENT_2))
+    # Atomic: a crash never leaves a half-written checkpoint
+    os.replace(tmp, path)
+
+
+def window(args: argparse.Namespace, checkpoint: Optional[dict], now: datetime):
+    until = parse_time(args.until) if args.until else now
+    if args.since:
+        since = parse_time(args.since)
+    elif checkpoint and checkpoint.get("scanned_until"):
+        since = parse_time(checkpoint["scanned_until"]) - timedelta(hours=args.overlap_hours)
+    else:
+        since = until - timedelta(days=args.days)
+    return since, until
+
+
+async def run(args: argparse.Namespace) -> dict:
+    import server  # payments side: the backend's data store and write-through
+
+    checkpoint_path = Path(args.checkpoint or server.VAR_DIR / "wompi_reconcile_checkpoint.json")
+    since, until = window(args, load_checkpoint(checkpoint_path), datetime.now(timezone.utc))
+    if not server.data_store.configured:
+        raise SystemExit("No payments database configured (SUPABASE_URL or DATA_BACKEND=asyncpg + DATABASE_URL)")
+
+    wompi = WompiTransactions(
+        os.environ.get("WOMPI_PRIVATE_KEY"),
+        base_url=args.base_url or os.environ.get("WOMPI_API_URL", WOMPI_API_URL),
+        page_size=args.page_size,
+        concurrency=args.concurrency,
+    )
+    await server.supabase_http.start()
+    await server.data_store.start()
+    try:
+        report = await reconcile(
+            wompi, since, until,
+            lookup=server.data_store.payments_by_references,
+            status_map=server.WOMPI_STATUS_MAP,
+            apply=None if args.dry_run else server.patch_payment_statuses,
+        )
+    finally:
+        await wompi.aclose()
+        await server.data_store.aclose()
+        await server.supabase_http.aclose()
+
+    report_path = Path(args.report or server.VAR_DIR / "wompi_reconcile" /
+                       f"report-{until.strftime('%Y%m%dT%H%M%SZ')}.json")
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report_path.write_bytes(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+    # Only scheduled runs (no explicit window) move the checkpoint
+    if not args.dry_run and not args.since and not args.until:
+        save_checkpoint(checkpoint_path, until, report)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--since", help="window start (ISO, UTC by default); default: checkpoint - overlap")
+    parser.add_argument("--until", help="window end (default: now)")
+    parser.add_argument("--days", type=float, default=7, help="window when there is no checkpoint yet")
+    parser.add_argument("--overlap-hours", type=float, default=24, help="rescan before the checkpoint")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: var/wompi_reconcile_checkpoint.json)")
+    parser.add_argument("--report", help="report file (default: var/wompi_reconcile/report-<until>.json)")
+    parser.add_argument("--base-url", help="Wompi API base URL (default: WOMPI_API_URL or production)")
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4, help="Wompi pages in flight")
+    parser.add_argument("--dry-run", action="store_true", help="report only: no updates, no checkpoint")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    summary = {key: value for key, value in report.items()
+               if key not in ("missing_payment", "amount_mismatch", "conflict", "corrected_references")}
+    for key in ("missing_payment", "amount_mismatch", "conflict"):
+        summary[key] = len(report[key])
+    print(orjson.dumps(summary, option=orjson.OPT_INDENT_2).decode())
+
+
+if __name__ == "__main__":
+    main()
@@ -1074,16 +1074,16 @@ CREATE INDEX idx_transactions_date_amount ON transactions(created_at DESC, amoun
 WHERE payment_status = 'paid';
 
 -- Para dashboard de asistencia
-CREATE INDEX idx_attendance_recent ON attendance_records(school_id, attendance_date DESC)
-WHERE attendance_date >= CURRENT_DATE - INTERVAL '30 days';
+-- (sin predicado "últimos 30 días": CURRENT_DATE no es IMMUTABLE y Postgres
+-- rechaza el índice parcial; el rango se filtra en la consulta)
+CREATE INDEX idx_attendance_recent ON attendance_records(school_id, attendance_date DESC);
 
 -- Para búsqueda de estudiantes por nombre
 CREATE INDEX idx_students_full_name_trgm ON students
 USING GIN ((first_name || ' ' || last_name) gin_trgm_ops);
 
--- Para próximos pagos (facturación recurrente)
-CREATE INDEX idx_enrollments_upcoming_payments ON enrollments(next_payment_date)
-WHERE is_active = true AND next_payment_date <= CURRENT_DATE + INTERVAL '7 days';
+-- Para próximos pagos (facturación recurrente): lo cubre idx_enrollments_next_payment
+-- (next_payment_date WHERE is_active); un predicado con CURRENT_DATE no es válido en un índice.
 
 -- =====================================================
 -- COMENTARIOS EN TABLAS Y COLUMNAS
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+geocoding.py
+============
+
+Geocoding compartido de los importadores (import_idrd_schools.py,
+import_entidades_deportivas.py, scrape_deportebogota.py, scrape_idrd_clubes.py):
+un solo cache en SQLite y una sola llamada a Nominatim.
+
+Antes cada script tenia su propio load_cache()/save_cache() sobre
+scripts/.geocode_cache.json y reescribia el JSON entero (indent=2) despues de
+CADA consulta: O(n^2) de disco por corrida, y dos scripts corriendo a la vez
+se pisaban el archivo (gana el ultimo en escribir, el resto se pierde).
+
+Ahora:
+  - scripts/.geocode_cache.sqlite en modo WAL: cada resultado es un UPSERT de
+    una fila (clave = query normalizada), lectores y escritores de varios
+    procesos no se bloquean y busy_timeout absorbe los choques de escritura.
+  - Las lecturas van a la base, no a un dict cargado al arrancar: lo que
+    geocodifica un proceso lo ve el otro en la siguiente consulta.
+  - El JSON viejo se migra solo la primera vez (y de nuevo si cambia, p.ej.
+    tras un git pull): INSERT ... ON CONFLICT DO NOTHING, asi nunca pisa un
+    resultado mas nuevo de la base. El JSON queda como semilla versionada;
+    `python scripts/geocoding.py --export-json` lo regenera.
+
+Uso desde un script:
+    from geocoding import GeocodeCache, nominatim_geocode
+    cache = GeocodeCache.open()
+    coords = nominatim_geocode("Usme, Bogota, Colombia", cache,
+                               bounds=BOGOTA_BOUNDS, user_agent=USER_AGENT)
+    # Para lotes (los importadores), geocoding_engine.geocode_all(): varios
+    # proveedores en paralelo sobre este mismo cache.
+
+Variables opcionales:
+    GEOCODE_CACHE="scripts/.geocode_cache.sqlite"
+    # Si apunta a un .json (como antes), ese JSON es la semilla y la base
+    # queda al lado con extension .sqlite.
+
+NUNCA inventa coordenadas: "no encontrado" y "fuera de bounds" se cachean
+como {"lat": None, "lng": None}.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+LEGACY_JSON = SCRIPTS_DIR / ".geocode_cache.json"
+DEFAULT_DB = SCRIPTS_DIR / ".geocode_cache.sqlite"
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+RATE_LIMIT_SECS = 1.1  # politica de Nominatim: max 1 req/s
+MAX_ATTEMPTS = 3
+
+# (lat_min, lat_max, lng_min, lng_max)
+Bounds = Tuple[float, float, float, float]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS geocodes (
+    key          TEXT PRIMARY KEY,
+    lat          REAL,
+    lng          REAL,
+    display_name TEXT,
+    updated_at   REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+-- Proximo turno libre por proveedor, compartido entre procesos (reserve_slot)
+CREATE TABLE IF NOT EXISTS rate_slots (
+    key     TEXT PRIMARY KEY,
+    next_at REAL NOT NULL
+);
+"""
+
+UPSERT_SQL = """
+INSERT INTO geocodes (key, lat, lng, display_name, updated_at) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(key) DO UPDATE SET
+    lat = excluded.lat, lng = excluded.lng,
+    display_name = excluded.display_name, updated_at = excluded.updated_at
+"""
+
+# La semilla no pisa lo que ya resolvio la base
+SEED_SQL = """
+INSERT INTO geocodes (key, lat, lng, display_name, updated_at) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(key) DO NOTHING
+"""
+
+
+def cache_key(query: str) -> str:
+    """Clave de cache: la query exacta, sin espacios de borde y en minusculas."""
+    return query.strip().lower()
+
+
+def cache_paths() -> tuple[Path, Path]:
+    """(base SQLite, JSON semilla) segun GEOCODE_CACHE."""
+    configured = os.environ.get("GEOCODE_CACHE")
+    if not configured:
+        return DEFAULT_DB, LEGACY_JSON
+    path = Path(configured)
+    if path.suffix == ".json":
+        return path.with_suffix(".sqlite"), path
+    return path, LEGACY_JSON
+
+
+class GeocodeCache:
+    """
+    Cache query -> {"lat", "lng"[, "display_name"]} en SQLite.
+
+    Una conexion por proceso; en autocommit cada put() es su propia
+    transaccion de una fila. Se puede abrir desde varios procesos a la vez.
+    """
+
+    def __init__(self, path: Path, legacy_json: Optional[Path] = None, busy_timeout: float = 30.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=busy_timeout, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # En WAL, NORMAL solo arriesga la ultima transaccion ante un corte de luz, nunca la base
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        # Fallos transitorios (timeouts): no se persisten, pero no se reintentan en esta corrida
+        self._failed: set[str] = set()
+        self.migrated = 0
+        if legacy_json is not None:
+            self.migrated = self.import_json(legacy_json)
+
+    @classmethod
+    def open(cls) -> "GeocodeCache":
+        db, legacy = cache_paths()
+        return cls(db, legacy)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self) -> "GeocodeCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT count(*) FROM geocodes").fetchone()[0]
+
+    def resolved(self) -> int:
+        """Entradas con coordenadas (el resto son "no encontrado")."""
+        return self._conn.execute("SELECT count(*) FROM geocodes WHERE lat IS NOT NULL").fetchone()[0]
+
+    def __contains__(self, query: str) -> bool:
+        return self.get(query) is not None
+
+    def get(self, query: str) -> Optional[dict]:
+        """El valor cacheado, o None si la query nunca se resolvio."""
+        key = cache_key(query)
+        if key in self._failed:
+            return {"lat": None, "lng": None}
+        row = self._conn.execute(
+            "SELECT lat, lng, display_name FROM geocodes WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value = {"lat": row[0], "lng": row[1]}
+        if row[2] is not None:
+            value["display_name"] = row[2]
+        return value
+
+    def put(self, query: str, lat: Optional[float], lng: Optional[float],
+            display_name: Optional[str] = None) -> None:
+        self._conn.execute(UPSERT_SQL, (cache_key(query), lat, lng, display_name, time.time()))
+
+    def put_failed(self, query: str) -> None:
+        self._failed.add(cache_key(query))
+
+    def items(self) -> Iterator[tuple[str, dict]]:
+        rows = self._conn.execute("SELECT key, lat, lng, display_name FROM geocodes ORDER BY key")
+        for key, lat, lng, display_name in rows:
+            value = {"lat": lat, "lng": lng}
+            if display_name is not None:
+                value["display_name"] = display_name
+            yield key, value
+
+    def import_json(self, path: Path) -> int:
+        """
+        Carga el JSON viejo si no se cargo ya en esta version (ruta, mtime y
+        tamaño). Devuelve cuantas claves nuevas entraron.
+        """
+        path = Path(path)
+        if not path.exists():
+            return 0
+        stat = path.stat()
+        stamp = f"{path.resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+        # BEGIN IMMEDIATE toma el lock de escritura: si dos procesos arrancan
+        # a la vez, el segundo espera y encuentra la migracion ya hecha
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            done = self._conn.execute("SELECT value FROM meta WHERE key = 'json_seed'").fetchone()
+            if done is not None and done[0] == stamp:
+                self._conn.execute("COMMIT")
+                return 0
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+            except Exception as e:
+                print(f"  [warn] cache JSON ilegible, se ignora: {path}: {str(e)[:80]}", flush=True)
+                data = {}
+            before = self._conn.total_changes
+            now = time.time()
+            self._conn.executemany(SEED_SQL, (
+                (cache_key(k), v.get("lat"), v.get("lng"), v.get("display_name"), now)
+                for k, v in data.items() if isinstance(v, dict)
+            ))
+            added = self._conn.total_changes - before
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('json_seed', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (stamp,),
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        if added:
+            print(f"Cache geocode: {added} entradas migradas de {path.name}", flush=True)
+        return added
+
+    def reserve_slot(self, key: str, interval: float, not_before: float = 0.0) -> float:
+        """
+        Reserva el proximo turno de `key` (uno cada `interval` segundos entre
+        TODOS los procesos que comparten la base) y devuelve cuanto esperar.
+        Asi dos importadores en paralelo no le hacen 2 req/s a Nominatim.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute("SELECT next_at FROM rate_slots WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            slot = max(now, row[0] if row else 0.0, not_before)
+            self._conn.execute(
+                "INSERT INTO rate_slots (key, next_at) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET next_at = excluded.next_at",
+                (key, slot + interval),
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return slot - now
+
+    def export_json(self, path: Path) -> int:
+        """Escribe la semilla JSON (mismo formato que antes) de una sola vez."""
+        data = dict(self.items())
+        path = Path(path)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+        return len(data)
+
+
+def rate_key(url: str) -> str:
+    """Los turnos se reservan por host: la politica de uso es del servidor, no del script."""
+    return urlsplit(url).netloc
+
+
+def in_bounds(lat: float, lng: float, bounds: Bounds) -> bool:
+    lo_lat, hi_lat, lo_lng, hi_lng = bounds
+    return lo_lat <= lat <= hi_lat and lo_lng <= lng <= hi_lng
+
+
+def nominatim_params(query: str, bounds: Bounds, bounded: bool = True) -> dict:
+    params = {"q": query, "format": "json", "limit": 1, "countrycodes": "co"}
+    if bounded:
+        # viewbox = lng_min,lat_max,lng_max,lat_min
+        params["viewbox"] = f"{bounds[2]},{bounds[1]},{bounds[3]},{bounds[0]}"
+        params["bounded"] = 1
+    return params
+
+
+def nominatim_geocode(query: str, cache: GeocodeCache, *, bounds: Bounds, user_agent: str,
+                      bounded: bool = True, url: str = NOMINATIM_URL,
+                      rate_limit: float = RATE_LIMIT_SECS) -> Optional[tuple[float, float]]:
+    """
+    Devuelve (lat, lng) o None. Cachea por query exacta (cache_key).
+
+    bounds descarta resultados fuera de la caja; con bounded=True ademas se
+    la pasa a Nominatim como viewbox.
+    """
+    import requests  # type: ignore
+
+    if not cache_key(query):
+        return None
+    cached = cache.get(query)
+    if cached is not None:
+        if cached.get("lat") is not None and cached.get("lng") is not None:
+            return float(cached["lat"]), float(cached["lng"])
+        return None
+
+    # Reintentar hasta 3 veces con backoff ante timeout/transient errors.
+    last_err: Optional[str] = None
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            time.sleep(cache.reserve_slot(rate_key(url), rate_limit) if attempt == 0 else 3.0 * attempt)
+            resp = requests.get(
+                url,
+                params=nominatim_params(query, bounds, bounded),
+                headers={"User-Agent": user_agent},
+                timeout=30,
+            )
+            resp.raise_for_status()
+            data = resp.json()
+        except Exception as e:
+            last_err = str(e)[:200]
+            if attempt < MAX_ATTEMPTS - 1:
+                print(f"  [warn] geocode retry {attempt+1}/{MAX_ATTEMPTS} '{query[:50]}': {last_err[:70]}",
+                      flush=True)
+            continue
+        if not data:
+            cache.put(query, None, None)
+            return None
+        lat, lng = float(data[0]["lat"]), float(data[0]["lon"])
+        if not in_bounds(lat, lng, bounds):
+            print(f"  [warn] geocode fuera de bounds descartado: {query} -> {lat},{lng}", flush=True)
+            cache.put(query, None, None)
+            return None
+        cache.put(query, lat, lng, data[0].get("display_name"))
+        return lat, lng
+
+    # Tras 3 intentos fallidos: no re-intentar en esta corrida, pero no
+    # persistirlo — la siguiente corrida (o otro proceso) lo vuelve a intentar.
+    print(f"  [fail] geocode definitivo '{query[:50]}': {last_err}", flush=True)
+    cache.put_failed(query)
+    return None
+
+
+def main() -> None:
+    db, legacy = cache_paths()
+    with GeocodeCache(db, legacy) as cache:
+        if "--export-json" in sys.argv[1:]:
+            n = cache.export_json(legacy)
+            print(f"{n} entradas exportadas a {legacy}")
+            return
+        print(f"{db}: {len(cache)} entradas ({cache.resolved()} con coordenadas)")
+
+
+if __name__ == "__main__":
+    main()
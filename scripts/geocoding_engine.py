@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+geocoding_engine.py
+===================
+
+Geocoding concurrente (asyncio) sobre varios proveedores compatibles con la
+API /search de Nominatim, con el mismo cache que geocoding.py.
+
+El geocode() sincrono hace time.sleep(1.1) antes de cada llamada y recorre
+la cascada de candidatos de una entidad a la vez: un import de 600
+entidades pasa mas de 10 minutos solo durmiendo. Aqui:
+
+  - Cada proveedor tiene su propio limitador (token bucket: `rate` req/s,
+    rafagas de hasta `burst`) y `concurrency` conexiones. Los workers de
+    cada proveedor toman trabajos de UNA cola comun apenas tienen turno, asi
+    que el mas rapido hace mas y ninguno pasa de su limite.
+  - La cascada (escenario -> direccion -> barrio -> localidad...) de cada
+    entidad avanza por su cuenta: hasta `max_pending` entidades en vuelo, y
+    la siguiente candidata de una entidad entra a la cola en cuanto la
+    anterior vuelve sin resultado. Una misma query pedida por dos entidades
+    (p.ej. el centroide de una localidad) viaja una sola vez.
+  - Un error (red, 5xx, 429) devuelve el trabajo a la cola, donde puede
+    tomarlo otro proveedor, y frena al que fallo (Retry-After si lo manda).
+    Tras `max_attempts` se da por fallido en esta corrida (no se persiste).
+
+Politica de uso del Nominatim publico
+(https://operations.osmfoundation.org/policies/nominatim/): maximo 1 req/s
+absoluto, un solo hilo, User-Agent que identifique la aplicacion y resultados
+cacheados. Cualquier proveedor con ese host queda forzado a rate <= 1 y
+concurrency 1, y su turno se reserva en la base del cache (reserve_slot), de
+modo que varios importadores en paralelo siguen sumando 1 req/s en total.
+
+Proveedores (GEOCODE_PROVIDERS, separados por coma):
+    public                                   Nominatim publico (1 req/s)
+    <nombre>=<url>[@<req/s>[/<conexiones>]]  otro servidor compatible
+p.ej.:
+    GEOCODE_PROVIDERS="public,propio=http://nominatim.interno:8080/search@20/4,local=http://127.0.0.1:8088/search@50"
+
+Uso:
+    from geocoding_engine import geocode_all
+    results = geocode_all([["Parque X, Usme, Bogota", "Usme, Bogota"], ...], cache,
+                          bounds=BOGOTA_BOUNDS, user_agent=USER_AGENT)
+    # -> [((lat, lng), indice_de_la_candidata) | (None, None), ...]
+
+Requiere: pip install httpx
+"""
+
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Sequence, Tuple
+
+import httpx  # type: ignore
+
+from geocoding import NOMINATIM_URL, Bounds, GeocodeCache, cache_key, in_bounds, nominatim_params, rate_key
+
+PUBLIC_HOST = rate_key(NOMINATIM_URL)
+PUBLIC_MAX_RATE = 1.0
+
+# (coords, indice de la candidata que resolvio) o (None, None)
+Resolution = Tuple[Optional[Tuple[float, float]], Optional[int]]
+
+
+@dataclass
+class Provider:
+    name: str
+    url: str
+    rate: float             # req/s
+    concurrency: int = 1    # conexiones en paralelo
+    burst: float = 1.0      # tokens acumulables
+
+    @property
+    def public(self) -> bool:
+        return rate_key(self.url) == PUBLIC_HOST
+
+    def __post_init__(self) -> None:
+        if self.rate <= 0 or self.concurrency < 1:
+            raise ValueError(f"Proveedor {self.name}: rate y concurrency deben ser positivos")
+        if self.public:
+            # La politica es del servidor, no negociable por configuracion
+            self.rate = min(self.rate, PUBLIC_MAX_RATE)
+            self.concurrency = 1
+            self.burst = 1.0
+
+
+def public_nominatim() -> Provider:
+    return Provider("public", NOMINATIM_URL, PUBLIC_MAX_RATE)
+
+
+def parse_providers(spec: str) -> list[Provider]:
+    """GEOCODE_PROVIDERS -> [Provider]; ver el docstring del modulo."""
+    providers: list[Provider] = []
+    for entry in (e.strip() for e in spec.split(",")):
+        if not entry:
+            continue
+        if entry == "public":
+            providers.append(public_nominatim())
+            continue
+        name, sep, target = entry.partition("=")
+        if not sep or not name.strip() or not target.strip():
+            raise ValueError(f"GEOCODE_PROVIDERS: entrada invalida {entry!r} (nombre=url[@req/s[/conexiones]])")
+        url, _, limits = target.strip().partition("@")
+        rate, _, concurrency = limits.partition("/")
+        providers.append(Provider(name.strip(), url, float(rate or 1.0), int(concurrency or 1),
+                                  burst=max(1.0, float(rate or 1.0))))
+    if not providers:
+        raise ValueError("GEOCODE_PROVIDERS no define ningun proveedor")
+    return providers
+
+
+def providers_from_env() -> list[Provider]:
+    return parse_providers(os.environ.get("GEOCODE_PROVIDERS", "public"))
+
+
+class TokenBucket:
+    """`rate` tokens por segundo, hasta `burst` acumulados; acquire() espera turno (FIFO)."""
+
+    def __init__(self, rate: float, burst: float = 1.0, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self._clock = clock
+        self._updated = clock()
+        self._paused_until = 0.0
+        # Se crea dentro del loop (en 3.9 un Lock queda atado al loop del constructor)
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self) -> float:
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return now
+
+    def pause(self, seconds: float) -> None:
+        """Nadie sale antes de `seconds` (429 / Retry-After, backoff)."""
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = self._refill()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+
+class SharedSlots:
+    """Un turno cada 1/rate segundos entre todos los procesos, reservado en la base del cache."""
+
+    def __init__(self, cache: GeocodeCache, key: str, rate: float):
+        self.cache = cache
+        self.key = key
+        self.interval = 1.0 / rate
+        self._lock: Optional[asyncio.Lock] = None
+
+    def pause(self, seconds: float) -> None:
+        self.cache.reserve_slot(self.key, 0.0, not_before=time.time() + seconds)
+
+    async def acquire(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            await asyncio.sleep(self.cache.reserve_slot(self.key, self.interval))
+
+
+@dataclass
+class _Job:
+    query: str
+    future: "asyncio.Future"
+    attempts: int = 0
+
+
+@dataclass
+class _Slot:
+    provider: Provider
+    limiter: object
+    client: httpx.AsyncClient
+    requests: int = 0
+    found: int = 0
+    errors: int = 0
+    tasks: list = field(default_factory=list)
+
+
+def _retry_after(resp: httpx.Response, default: float) -> float:
+    value = resp.headers.get("retry-after")
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, AttributeError):
+        return default
+
+
+def _parse(data) -> Optional[tuple[float, float, Optional[str]]]:
+    """Respuesta de /search -> (lat, lng, display_name), o None si no hubo resultados."""
+    if not isinstance(data, list):
+        raise ValueError(f"respuesta inesperada: {str(data)[:60]}")
+    if not data:
+        return None
+    first = data[0]
+    if not isinstance(first, dict):
+        raise ValueError(f"resultado inesperado: {str(first)[:60]}")
+    return float(first["lat"]), float(first["lon"]), first.get("display_name")
+
+
+class GeocodeEngine:
+    """
+    async with GeocodeEngine(cache, providers, bounds=..., user_agent=...) as engine:
+        coords = await engine.geocode("Usme, Bogota, Colombia")
+        results = await engine.resolve_all([[cand1, cand2], ...])
+
+    `transport` (httpx) permite probarlo contra un servidor falso, sin red.
+    """
+
+    def __init__(self, cache: GeocodeCache, providers: Sequence[Provider], *, bounds: Bounds, user_agent: str,
+                 bounded: bool = True, max_attempts: int = 3, max_pending: int = 64,
+                 error_backoff: float = 3.0, timeout: float = 30.0,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        if not providers:
+            raise ValueError("GeocodeEngine necesita al menos un proveedor")
+        if any(p.public for p in providers) and not user_agent.strip():
+            raise ValueError("El Nominatim publico exige un User-Agent que identifique la aplicacion")
+        self.cache = cache
+        self.providers = list(providers)
+        self.bounds = bounds
+        self.user_agent = user_agent
+        self.bounded = bounded
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.error_backoff = error_backoff
+        self.timeout = timeout
+        self.transport = transport
+        self._queue: Optional["asyncio.Queue[_Job]"] = None
+        self._slots: list[_Slot] = []
+        # cache_key -> future compartido por todas las entidades que piden esa query
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.cache_hits = 0
+        self.failed = 0
+
+    async def __aenter__(self) -> "GeocodeEngine":
+        self._queue = asyncio.Queue()
+        for provider in self.providers:
+            limiter = (SharedSlots(self.cache, rate_key(provider.url), provider.rate) if provider.public
+                       else TokenBucket(provider.rate, provider.burst))
+            client = httpx.AsyncClient(
+                headers={"User-Agent": self.user_agent}, timeout=self.timeout, transport=self.transport,
+                limits=httpx.Limits(max_connections=provider.concurrency),
+            )
+            slot = _Slot(provider, limiter, client)
+            slot.tasks = [asyncio.create_task(self._worker(slot)) for _ in range(provider.concurrency)]
+            self._slots.append(slot)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        tasks = [task for slot in self._slots for task in slot.tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for slot in self._slots:
+            await slot.client.aclose()
+        for future in list(self._inflight.values()):
+            if not future.done():
+                future.cancel()
+        self._slots = []
+        self._queue = None
+
+    async def geocode(self, query: str) -> Optional[tuple[float, float]]:
+        """Devuelve (lat, lng) o None; cache primero, misma semantica que nominatim_geocode()."""
+        key = cache_key(query)
+        if not key:
+            return None
+        cached = self.cache.get(query)
+        if cached is not None:
+            self.cache_hits += 1
+            if cached.get("lat") is not None and cached.get("lng") is not None:
+                return float(cached["lat"]), float(cached["lng"])
+            return None
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self._queue.put_nowait(_Job(query, future))
+        # shield: si una entidad se cancela, las demas que esperan la misma query siguen
+        return await asyncio.shield(future)
+
+    async def resolve(self, candidates: Sequence[str]) -> Resolution:
+        """Cascada: la primera candidata con resultado gana."""
+        for index, query in enumerate(candidates):
+            coords = await self.geocode(query)
+            if coords:
+                return coords, index
+        return None, None
+
+    async def resolve_all(self, candidate_lists: Sequence[Sequence[str]],
+                          on_result: Optional[Callable[[int, Resolution], None]] = None) -> list:
+        """resolve() de cada lista, con hasta `max_pending` cascadas en vuelo; mismo orden de entrada."""
+        pending = asyncio.Semaphore(self.max_pending)
+
+        async def one(i: int, candidates: Sequence[str]):
+            async with pending:
+                result = await self.resolve(candidates)
+            if on_result is not None:
+                on_result(i, result)
+            return result
+
+        return list(await asyncio.gather(*(one(i, c) for i, c in enumerate(candidate_lists))))
+
+    async def _worker(self, slot: _Slot) -> None:
+        while True:
+            # Turno primero: un proveedor lento no acapara trabajos que otro haria ya
+            await slot.limiter.acquire()
+            job = await self._queue.get()
+            try:
+                await self._run(slot, job)
+            except Exception as e:
+                # Nunca dejar una cascada esperando un future que nadie va a resolver
+                print(f"  [fail] geocode '{job.query[:50]}' ({slot.provider.name}): {str(e)[:70]}", flush=True)
+                if not job.future.done():
+                    self.failed += 1
+                    job.future.set_result(None)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, slot: _Slot, job: _Job) -> None:
+        if job.future.done():
+            return
+        provider = slot.provider
+        try:
+            resp = await slot.client.get(provider.url, params=nominatim_params(job.query, self.bounds, self.bounded))
+            slot.requests += 1
+            if resp.status_code == 429 or resp.status_code >= 500:
+                slot.limiter.pause(_retry_after(resp, self.error_backoff * (job.attempts + 1)))
+            resp.raise_for_status()
+            # Un 200 con otra forma (p.ej. {"error": ...} de un stand-in) es un error del trabajo
+            place = _parse(resp.json())
+        except Exception as e:
+            slot.errors += 1
+            job.attempts += 1
+            err = (f"HTTP {e.response.status_code}" if isinstance(e, httpx.HTTPStatusError)
+                   else str(e)[:70] or type(e).__name__)
+            if job.attempts >= self.max_attempts:
+                print(f"  [fail] geocode definitivo '{job.query[:50]}': {err}", flush=True)
+                self.cache.put_failed(job.query)
+                self.failed += 1
+                job.future.set_result(None)
+                return
+            print(f"  [warn] geocode retry {job.attempts}/{self.max_attempts} ({provider.name}) "
+                  f"'{job.query[:50]}': {err}", flush=True)
+            # Backoff del proveedor que fallo; el trabajo vuelve a la cola para cualquiera
+            if not isinstance(e, httpx.HTTPStatusError):
+                slot.limiter.pause(self.error_backoff * job.attempts)
+            self._queue.put_nowait(job)
+            return
+        job.future.set_result(self._store(job.query, place, slot))
+
+    def _store(self, query: str, place: Optional[tuple], slot: _Slot) -> Optional[tuple[float, float]]:
+        if place is None:
+            self.cache.put(query, None, None)
+            return None
+        lat, lng, display_name = place
+        if not in_bounds(lat, lng, self.bounds):
+            print(f"  [warn] geocode fuera de bounds descartado: {query} -> {lat},{lng}", flush=True)
+            self.cache.put(query, None, None)
+            return None
+        self.cache.put(query, lat, lng, display_name)
+        slot.found += 1
+        return lat, lng
+
+    def stats(self) -> dict:
+        return {
+            "cache_hits": self.cache_hits,
+            "failed": self.failed,
+            "providers": {
+                slot.provider.name: {"requests": slot.requests, "found": slot.found, "errors": slot.errors}
+                for slot in self._slots
+            },
+        }
+
+
+def geocode_all(candidate_lists: Sequence[Sequence[str]], cache: GeocodeCache, *, bounds: Bounds,
+                user_agent: str, bounded: bool = True, providers: Optional[Sequence[Provider]] = None,
+                on_result: Optional[Callable[[int, Resolution], None]] = None) -> list:
+    """Punto de entrada sincrono para los scripts: resolve_all() con los proveedores de GEOCODE_PROVIDERS."""
+    providers = list(providers) if providers is not None else providers_from_env()
+
+    async def run() -> list:
+        async with GeocodeEngine(cache, providers, bounds=bounds, user_agent=user_agent,
+                                 bounded=bounded) as engine:
+            started = time.monotonic()
+            results = await engine.resolve_all(candidate_lists, on_result)
+            stats = engine.stats()
+        per_provider = ", ".join(f"{name}={s['requests']}" for name, s in stats["providers"].items())
+        print(f"Geocoding: {len(candidate_lists)} entidades en {time.monotonic() - started:.1f}s "
+              f"(cache={stats['cache_hits']}, requests: {per_provider}, fallidos={stats['failed']})", flush=True)
+        return results
+
+    return asyncio.run(run())
@@ -28,10 +28,8 @@ import json
 import os
 import re
 import sys
-import time
 import unicodedata
 from pathlib import Path
-from typing import Optional
 
 
 def _hash8(s: str) -> str:
@@ -46,14 +44,14 @@ except Exception:
 
 try:
     import openpyxl  # type: ignore
-    import requests  # type: ignore
+    from geocoding import GeocodeCache
+    from geocoding_engine import geocode_all
 except ImportError as e:
-    print(f"Missing dep: {e.name}. Run: pip install openpyxl requests")
+    print(f"Missing dep: {e.name}. Run: pip install openpyxl httpx")
     sys.exit(1)
 
 
 ROOT = Path(__file__).resolve().parents[1]
-CACHE_FILE = ROOT / "scripts" / ".geocode_cache.json"
 SQL_OUT = ROOT / "supabase" / "seed" / "entidades_deportivas_2025_2026.sql"
 TS_OUT = Path(
     "C:/Users/Usuario/Documents/Landing_page/sportmap-maps-landing-page/frontend/src/data/mapData.entidades.ts"
@@ -64,8 +62,6 @@ FILE_INSTITUTOS = XLSX_DIR / "Directorio-Institutos-Departamentales-y-Municipale
 FILE_FEDERACIONES = XLSX_DIR / "Directorio-Federaciones-Deportivas-2025.xlsx"
 FILE_ASOCIACIONES = XLSX_DIR / "Directorio-Asociaciones-Recreativas-2025.xlsx"
 
-NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
-RATE_LIMIT = 1.1
 USER_AGENT = "SportMaps-Importer/1.0 (brayan.lopez@osigu.com)"
 
 # Colombia bounding box
@@ -118,62 +114,9 @@ def sql_array(xs: list[str]) -> str:
 
 
 # ── Geocode cache ────────────────────────────────────────────────────────────
-def load_cache() -> dict[str, dict]:
-    if CACHE_FILE.exists():
-        try:
-            return json.loads(CACHE_FILE.read_text(encoding="utf-8"))
-        except Exception:
-            return {}
-    return {}
-
-
-def save_cache(cache: dict[str, dict]) -> None:
-    CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
-    CACHE_FILE.write_text(json.dumps(cache, ensure_ascii=False, indent=2), encoding="utf-8")
-
-
-def in_colombia(lat: float, lng: float) -> bool:
-    return COLOMBIA_BOUNDS[0] <= lat <= COLOMBIA_BOUNDS[1] and COLOMBIA_BOUNDS[2] <= lng <= COLOMBIA_BOUNDS[3]
-
-
-def geocode(query: str, cache: dict[str, dict]) -> Optional[tuple[float, float]]:
-    key = query.strip().lower()
-    if not key:
-        return None
-    if key in cache:
-        v = cache[key]
-        return (float(v["lat"]), float(v["lng"])) if v.get("lat") is not None else None
-
-    for attempt in range(3):
-        try:
-            time.sleep(RATE_LIMIT if attempt == 0 else 3.0 * attempt)
-            resp = requests.get(
-                NOMINATIM_URL,
-                params={"q": query, "format": "json", "limit": 1, "countrycodes": "co"},
-                headers={"User-Agent": USER_AGENT},
-                timeout=30,
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            if not data:
-                cache[key] = {"lat": None, "lng": None}
-                save_cache(cache)
-                return None
-            lat, lng = float(data[0]["lat"]), float(data[0]["lon"])
-            if not in_colombia(lat, lng):
-                cache[key] = {"lat": None, "lng": None}
-                save_cache(cache)
-                return None
-            cache[key] = {"lat": lat, "lng": lng}
-            save_cache(cache)
-            return lat, lng
-        except Exception as e:
-            if attempt < 2:
-                print(f"  [warn] geocode retry {attempt+1}: {str(e)[:80]}", flush=True)
-                continue
-    cache[key] = {"lat": None, "lng": None}
-    save_cache(cache)
-    return None
+def geocode_cascades(cascades: list[list[str]], cache: GeocodeCache) -> list:
+    """[(coords, indice) | (None, None)] por cascada. Cache y proveedores compartidos: ver geocoding_engine.py."""
+    return geocode_all(cascades, cache, bounds=COLOMBIA_BOUNDS, user_agent=USER_AGENT, bounded=False)
 
 
 # ── Parsers por archivo ──────────────────────────────────────────────────────
@@ -439,7 +382,7 @@ def write_ts(records: list[dict]) -> None:
 # ── Main ─────────────────────────────────────────────────────────────────────
 
 def main() -> None:
-    cache = load_cache()
+    cache = GeocodeCache.open()
     print(f"Cache geocode: {len(cache)} entries")
 
     print("\n=== Parseando archivos ===")
@@ -454,19 +397,17 @@ def main() -> None:
     print(f"\nTotal entidades: {len(all_records)}")
 
     print("\n=== Geocodificando ===")
-    for idx, rec in enumerate(all_records, 1):
+    cascades = []
+    for rec in all_records:
         candidates = []
         if rec.get("address") and rec.get("city"):
             candidates.append(f"{rec['address']}, {rec['city']}, Colombia")
         if rec.get("city"):
             candidates.append(f"{rec['city']}, Colombia")
+        cascades.append(candidates)
 
-        lat = lng = None
-        for q in candidates:
-            coords = geocode(q, cache)
-            if coords:
-                lat, lng = coords
-                break
+    for idx, (rec, (coords, _)) in enumerate(zip(all_records, geocode_cascades(cascades, cache)), 1):
+        lat, lng = coords if coords else (None, None)
         rec["lat"] = lat
         rec["lng"] = lng
         marker = f"{lat:.4f},{lng:.4f}" if lat else "NO_GEO"
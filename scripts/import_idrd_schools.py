@@ -21,10 +21,10 @@ Uso:
     python scripts/import_idrd_schools.py
     # Variables opcionales:
     #   IDRD_XLSX="C:/path/to/02-escuelas-avaladas-2026-abril.xlsx"
-    #   GEOCODE_CACHE="scripts/.geocode_cache.json"
+    #   GEOCODE_CACHE="scripts/.geocode_cache.sqlite"  (ver geocoding.py)
 
 Requiere:
-    pip install openpyxl requests
+    pip install openpyxl httpx
 
 NUNCA inventa coordenadas. Si Nominatim no encuentra una direccion, deja
 NULL en SQL y omite la escuela del mapData.ts (no se ve en el mapa pero
@@ -37,7 +37,6 @@ import json
 import os
 import re
 import sys
-import time
 import unicodedata
 from pathlib import Path
 from typing import Optional
@@ -52,9 +51,10 @@ except Exception:
 
 try:
     import openpyxl  # type: ignore
-    import requests  # type: ignore
+    from geocoding import GeocodeCache
+    from geocoding_engine import geocode_all
 except ImportError as e:
-    print(f"Falta dependencia: {e.name}. Instala con: pip install openpyxl requests")
+    print(f"Falta dependencia: {e.name}. Instala con: pip install openpyxl httpx")
     sys.exit(1)
 
 
@@ -64,15 +64,12 @@ DEFAULT_XLSX = Path(os.environ.get(
     "IDRD_XLSX",
     "C:/Users/Usuario/Documents/02-escuelas-avaladas-2026-abril.xlsx",
 ))
-CACHE_FILE = Path(os.environ.get("GEOCODE_CACHE", ROOT / "scripts" / ".geocode_cache.json"))
 SQL_OUT = ROOT / "supabase" / "seed" / "idrd_avaladas_2026.sql"
 TS_OUT = Path(
     "C:/Users/Usuario/Documents/Landing_page/sportmap-maps-landing-page/frontend/src/data/mapData.idrd.ts"
 )
 
 USER_AGENT = "SportMaps-IDRD-Import/1.0 (brayan.lopez@osigu.com)"
-NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
-RATE_LIMIT_SECS = 1.1  # politica de Nominatim: max 1 req/s
 
 # Bogota bounding box (lat_min, lat_max, lng_min, lng_max) — descartar geocodings que caigan fuera
 BOGOTA_BOUNDS = (4.45, 4.85, -74.25, -73.95)
@@ -207,92 +204,15 @@ def split_phones(raw: str) -> Optional[str]:
 
 # ── Geocoding (Nominatim) ────────────────────────────────────────────────────
 
-def load_cache() -> dict[str, dict]:
-    if CACHE_FILE.exists():
-        try:
-            return json.loads(CACHE_FILE.read_text(encoding="utf-8"))
-        except Exception:
-            return {}
-    return {}
-
-
-def save_cache(cache: dict[str, dict]) -> None:
-    CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
-    CACHE_FILE.write_text(json.dumps(cache, ensure_ascii=False, indent=2), encoding="utf-8")
-
-
-def in_bogota(lat: float, lng: float) -> bool:
-    lo_lat, hi_lat, lo_lng, hi_lng = BOGOTA_BOUNDS
-    return lo_lat <= lat <= hi_lat and lo_lng <= lng <= hi_lng
-
-
-def geocode(query: str, cache: dict[str, dict]) -> Optional[tuple[float, float]]:
-    """Devuelve (lat, lng) o None. Cachea por query exacta."""
-    key = query.strip().lower()
-    if not key:
-        return None
-    if key in cache:
-        v = cache[key]
-        if v.get("lat") is not None and v.get("lng") is not None:
-            return float(v["lat"]), float(v["lng"])
-        return None
-
-    # Reintentar hasta 3 veces con backoff ante timeout/transient errors.
-    last_err: Optional[str] = None
-    for attempt in range(3):
-        try:
-            time.sleep(RATE_LIMIT_SECS if attempt == 0 else 3.0 * attempt)
-            resp = requests.get(
-                NOMINATIM_URL,
-                params={
-                    "q": query,
-                    "format": "json",
-                    "limit": 1,
-                    "countrycodes": "co",
-                    "viewbox": f"{BOGOTA_BOUNDS[2]},{BOGOTA_BOUNDS[1]},{BOGOTA_BOUNDS[3]},{BOGOTA_BOUNDS[0]}",
-                    "bounded": 1,
-                },
-                headers={"User-Agent": USER_AGENT},
-                timeout=30,
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            if not data:
-                cache[key] = {"lat": None, "lng": None}
-                save_cache(cache)
-                return None
-            lat = float(data[0]["lat"])
-            lng = float(data[0]["lon"])
-            if not in_bogota(lat, lng):
-                print(f"  [warn] Geocode fuera de Bogota descartado: {query} -> {lat},{lng}", flush=True)
-                cache[key] = {"lat": None, "lng": None}
-                save_cache(cache)
-                return None
-            cache[key] = {"lat": lat, "lng": lng, "display_name": data[0].get("display_name")}
-            save_cache(cache)
-            return lat, lng
-        except Exception as e:
-            last_err = str(e)[:200]
-            # NO cachear el fallo si fue timeout — re-intentable en siguiente run.
-            if attempt < 2:
-                print(f"  [warn] timeout/err (intento {attempt+1}/3) en '{query[:60]}': {last_err[:80]}", flush=True)
-                continue
-    # Tras 3 intentos fallidos: cachear como NOT_FOUND para no re-intentar en este run
-    print(f"  [fail] Geocode definitivo en '{query[:60]}': {last_err}", flush=True)
-    cache[key] = {"lat": None, "lng": None}
-    save_cache(cache)
-    return None
-
-
-def geocode_with_fallbacks(escenario: str, direccion_sede: str, barrio: str, localidad: str, cache: dict[str, dict]) -> tuple[Optional[float], Optional[float], str]:
+def geocode_candidates(escenario: str, direccion_sede: str, barrio: str, localidad: str) -> list[tuple[str, str]]:
     """
-    Intenta geocodificar en orden:
+    Cascada de queries, en orden:
       1. <escenario>, <barrio>, <localidad>, Bogota, Colombia
       2. <direccion_sede>, <barrio>, <localidad>, Bogota, Colombia
       3. <escenario>, Bogota, Colombia
       4. <barrio>, <localidad>, Bogota, Colombia
       5. <localidad>, Bogota, Colombia (ultimo recurso: centro de localidad)
-    Devuelve (lat, lng, fuente_usada).
+    Devuelve [(query, fuente)]; la primera con resultado gana (geocoding_engine).
     """
     candidates: list[tuple[str, str]] = []
     if escenario:
@@ -305,12 +225,7 @@ def geocode_with_fallbacks(escenario: str, direccion_sede: str, barrio: str, loc
         candidates.append((f"{barrio}, {localidad}, Bogota, Colombia", "barrio+localidad"))
     if localidad:
         candidates.append((f"{localidad}, Bogota, Colombia", "localidad+bogota"))
-
-    for query, source in candidates:
-        coords = geocode(query, cache)
-        if coords:
-            return coords[0], coords[1], source
-    return None, None, "not_found"
+    return candidates
 
 
 # ── SQL escaping ──────────────────────────────────────────────────────────────
@@ -348,10 +263,11 @@ def main() -> None:
     print(f"Leyendo {DEFAULT_XLSX}…")
     wb = openpyxl.load_workbook(DEFAULT_XLSX, data_only=True)
     ws = wb["2026"]
-    cache = load_cache()
+    cache = GeocodeCache.open()
     print(f"Cache geocode: {len(cache)} entradas previas")
 
     schools: list[dict] = []
+    cascades: list[list[tuple[str, str]]] = []
     for row_idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
         name_raw = row[1]
         if not name_raw:
@@ -371,13 +287,7 @@ def main() -> None:
         horarios = normalize_text(row[22])
         total_alumnos = row[17]
 
-        print(f"[{row_idx-1:02d}] {name[:50]}")
-        lat, lng, geosrc = geocode_with_fallbacks(escenario, direccion_sede, barrio, primary_loc, cache)
-        if lat:
-            print(f"     -> {lat:.5f}, {lng:.5f}  ({geosrc})")
-        else:
-            print("     -> SIN GEOCODE")
-
+        cascades.append(geocode_candidates(escenario, direccion_sede, barrio, primary_loc))
         schools.append({
             "name": name,
             "external_ref": f"IDRD-AVAL-{aval}" if aval else f"IDRD-ROW-{row_idx}",
@@ -394,12 +304,25 @@ def main() -> None:
             "escenario": escenario,
             "horarios": horarios,
             "total_alumnos": int(total_alumnos) if isinstance(total_alumnos, int) else None,
-            "lat": lat,
-            "lng": lng,
-            "geo_source": geosrc,
+            "lat": None,
+            "lng": None,
+            "geo_source": "not_found",
             "slug": slugify(name),
         })
 
+    # Todas las cascadas en paralelo, cada proveedor a su ritmo (GEOCODE_PROVIDERS)
+    print(f"Geocodificando {len(schools)} escuelas…", flush=True)
+    results = geocode_all([[q for q, _ in c] for c in cascades], cache,
+                          bounds=BOGOTA_BOUNDS, user_agent=USER_AGENT)
+    for idx, (school, candidates, (coords, hit)) in enumerate(zip(schools, cascades, results), 1):
+        print(f"[{idx:02d}] {school['name'][:50]}")
+        if coords:
+            school["lat"], school["lng"] = coords
+            school["geo_source"] = candidates[hit][1]
+            print(f"     -> {coords[0]:.5f}, {coords[1]:.5f}  ({school['geo_source']})")
+        else:
+            print("     -> SIN GEOCODE")
+
     geocoded = sum(1 for s in schools if s["lat"])
     print(f"\nTotal: {len(schools)} escuelas, {geocoded} geocodificadas")
 
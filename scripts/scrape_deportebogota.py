@@ -13,7 +13,7 @@ Outputs:
   supabase/seed/deportebogota_directorio_2026.sql   (idempotent UPSERT)
   Landing_page/.../mapData.deportebogota.ts          (TS for map)
 
-Re-runnable. Cache: scripts/.geocode_cache.json (shared with IDRD importer).
+Re-runnable. Cache: scripts/.geocode_cache.sqlite (shared with the other importers, see geocoding.py).
 """
 
 from __future__ import annotations
@@ -36,13 +36,14 @@ except Exception:
 try:
     import requests  # type: ignore
     from bs4 import BeautifulSoup  # type: ignore
+    from geocoding import GeocodeCache
+    from geocoding_engine import geocode_all
 except ImportError as e:
-    print(f"Missing dep: {e.name}. Run: pip install requests beautifulsoup4 lxml")
+    print(f"Missing dep: {e.name}. Run: pip install requests beautifulsoup4 lxml httpx")
     sys.exit(1)
 
 
 ROOT = Path(__file__).resolve().parents[1]
-CACHE_FILE = ROOT / "scripts" / ".geocode_cache.json"
 SQL_OUT = ROOT / "supabase" / "seed" / "deportebogota_directorio_2026.sql"
 TS_OUT = Path(
     "C:/Users/Usuario/Documents/Landing_page/sportmap-maps-landing-page/frontend/src/data/mapData.deportebogota.ts"
@@ -52,74 +53,14 @@ API_BASE = "https://deportebogota.com/wp-json/wp/v2/at_biz_dir"
 PROFILE_BASE = "https://deportebogota.com/perfil/"
 USER_AGENT = "SportMaps-Importer/1.0 (brayan.lopez@osigu.com)"
 
-NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
-RATE_LIMIT = 1.1
 BOGOTA_BOUNDS = (4.40, 4.85, -74.30, -73.90)
 
 
 # ── Geocode cache (shared) ────────────────────────────────────────────────────
 
-def load_cache() -> dict[str, dict]:
-    if CACHE_FILE.exists():
-        try:
-            return json.loads(CACHE_FILE.read_text(encoding="utf-8"))
-        except Exception:
-            return {}
-    return {}
-
-
-def save_cache(cache: dict[str, dict]) -> None:
-    CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
-    CACHE_FILE.write_text(json.dumps(cache, ensure_ascii=False, indent=2), encoding="utf-8")
-
-
-def in_bogota(lat: float, lng: float) -> bool:
-    lo_lat, hi_lat, lo_lng, hi_lng = BOGOTA_BOUNDS
-    return lo_lat <= lat <= hi_lat and lo_lng <= lng <= hi_lng
-
-
-def geocode(query: str, cache: dict[str, dict]) -> Optional[tuple[float, float]]:
-    key = query.strip().lower()
-    if not key:
-        return None
-    if key in cache:
-        v = cache[key]
-        return (float(v["lat"]), float(v["lng"])) if v.get("lat") is not None else None
-
-    for attempt in range(3):
-        try:
-            time.sleep(RATE_LIMIT if attempt == 0 else 3.0 * attempt)
-            resp = requests.get(
-                NOMINATIM_URL,
-                params={
-                    "q": query, "format": "json", "limit": 1, "countrycodes": "co",
-                    "viewbox": f"{BOGOTA_BOUNDS[2]},{BOGOTA_BOUNDS[1]},{BOGOTA_BOUNDS[3]},{BOGOTA_BOUNDS[0]}",
-                    "bounded": 1,
-                },
-                headers={"User-Agent": USER_AGENT},
-                timeout=30,
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            if not data:
-                cache[key] = {"lat": None, "lng": None}
-                save_cache(cache)
-                return None
-            lat, lng = float(data[0]["lat"]), float(data[0]["lon"])
-            if not in_bogota(lat, lng):
-                cache[key] = {"lat": None, "lng": None}
-                save_cache(cache)
-                return None
-            cache[key] = {"lat": lat, "lng": lng}
-            save_cache(cache)
-            return lat, lng
-        except Exception as e:
-            if attempt < 2:
-                print(f"  [warn] geocode retry {attempt+1}: {str(e)[:80]}", flush=True)
-                continue
-    cache[key] = {"lat": None, "lng": None}
-    save_cache(cache)
-    return None
+def geocode_cascades(cascades: list[list[str]], cache: GeocodeCache) -> list:
+    """[(coords, indice) | (None, None)] por cascada. Cache y proveedores compartidos: ver geocoding_engine.py."""
+    return geocode_all(cascades, cache, bounds=BOGOTA_BOUNDS, user_agent=USER_AGENT)
 
 
 # ── Listings via WP REST ──────────────────────────────────────────────────────
@@ -463,13 +404,14 @@ def write_ts(records: list[dict]) -> None:
 # ── Main ──────────────────────────────────────────────────────────────────────
 
 def main() -> None:
-    cache = load_cache()
+    cache = GeocodeCache.open()
     print(f"Cache: {len(cache)} entradas")
     print("Fetching listings via WP REST...", flush=True)
     listings = fetch_all_listings()
     print(f"Total listings: {len(listings)}", flush=True)
 
     records: list[dict] = []
+    cascades: list[list[str]] = []
     for idx, item in enumerate(listings, 1):
         slug = item.get("slug")
         title = (item.get("title") or {}).get("rendered", slug)
@@ -496,8 +438,7 @@ def main() -> None:
         elif not prof.get("name") or len(prof["name"]) < 3:
             prof["name"] = html_unescape(title)
 
-        # Geocode con cascada de candidatos
-        lat = lng = None
+        # Geocode con cascada de candidatos (se resuelven todas juntas al final)
         candidates = []
         if parsed_place:
             # El "place" del titulo es lo MAS especifico (parque, coliseo, barrio)
@@ -507,21 +448,19 @@ def main() -> None:
         if prof.get("locality"):
             candidates.append(f"{prof['locality']}, Bogotá, Colombia")
 
-        for q in candidates:
-            coords = geocode(q, cache)
-            if coords:
-                lat, lng = coords
-                break
-        prof["lat"] = lat
-        prof["lng"] = lng
-        if lat:
-            print(f"  -> {lat:.5f}, {lng:.5f}", flush=True)
-        else:
-            print("  -> NO GEOCODE", flush=True)
+        cascades.append(candidates)
 
         records.append(prof)
         time.sleep(0.3)  # gentle delay between profile fetches
 
+    print(f"\nGeocoding {len(records)} records...", flush=True)
+    for prof, (coords, _) in zip(records, geocode_cascades(cascades, cache)):
+        prof["lat"], prof["lng"] = coords if coords else (None, None)
+        if coords:
+            print(f"  {prof['name'][:50]:50} -> {coords[0]:.5f}, {coords[1]:.5f}", flush=True)
+        else:
+            print(f"  {prof['name'][:50]:50} -> NO GEOCODE", flush=True)
+
     print(f"\nTotal records: {len(records)}, geocoded: {sum(1 for r in records if r.get('lat'))}")
 
     write_sql(records)
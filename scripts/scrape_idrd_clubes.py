@@ -32,9 +32,9 @@ Uso:
     python scripts/scrape_idrd_clubes.py
     # Variables opcionales:
     #   IDRD_CLUBES_HTML="C:/tmp/idrd_clubes.html"  (usa archivo local en vez de bajar)
-    #   GEOCODE_CACHE="scripts/.geocode_cache.json"
+    #   GEOCODE_CACHE="scripts/.geocode_cache.sqlite"  (ver geocoding.py)
 
-Requiere: pip install requests beautifulsoup4 lxml
+Requiere: pip install requests beautifulsoup4 lxml httpx
 """
 
 from __future__ import annotations
@@ -43,7 +43,6 @@ import json
 import os
 import re
 import sys
-import time
 import unicodedata
 from pathlib import Path
 from typing import Optional
@@ -57,8 +56,10 @@ except Exception:
 try:
     import requests  # type: ignore
     from bs4 import BeautifulSoup  # type: ignore
+    from geocoding import GeocodeCache
+    from geocoding_engine import geocode_all
 except ImportError as e:
-    print(f"Falta dependencia: {e.name}. Instala con: pip install requests beautifulsoup4 lxml")
+    print(f"Falta dependencia: {e.name}. Instala con: pip install requests beautifulsoup4 lxml httpx")
     sys.exit(1)
 
 
@@ -66,12 +67,9 @@ except ImportError as e:
 ROOT = Path(__file__).resolve().parents[1]
 SOURCE_URL = "https://sim1.idrd.gov.co/SIM/CS_RendimientoDeportivo/Presentacion/Consulta_General_Clubes_Web.php"
 LOCAL_HTML = os.environ.get("IDRD_CLUBES_HTML", "")  # si esta seteado, lee de disco
-CACHE_FILE = Path(os.environ.get("GEOCODE_CACHE", ROOT / "scripts" / ".geocode_cache.json"))
 SQL_OUT = ROOT / "supabase" / "seed" / "idrd_clubes_2026.sql"
 
 USER_AGENT = "SportMaps-IDRD-Clubes-Import/1.0 (brayan.lopez@osigu.com)"
-NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
-RATE_LIMIT_SECS = 1.1
 
 # Bogota bounding box (lat_min, lat_max, lng_min, lng_max)
 BOGOTA_BOUNDS = (4.45, 4.85, -74.25, -73.95)
@@ -137,73 +135,9 @@ SPORT_FIX = {
 
 # ── Geocoding (Nominatim) — solo por localidad ─────────────────────────────────
 
-def load_cache() -> dict[str, dict]:
-    if CACHE_FILE.exists():
-        try:
-            return json.loads(CACHE_FILE.read_text(encoding="utf-8"))
-        except Exception:
-            return {}
-    return {}
-
-
-def save_cache(cache: dict[str, dict]) -> None:
-    CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
-    CACHE_FILE.write_text(json.dumps(cache, ensure_ascii=False, indent=2), encoding="utf-8")
-
-
-def in_bogota(lat: float, lng: float) -> bool:
-    lo_lat, hi_lat, lo_lng, hi_lng = BOGOTA_BOUNDS
-    return lo_lat <= lat <= hi_lat and lo_lng <= lng <= hi_lng
-
-
-def geocode(query: str, cache: dict[str, dict]) -> Optional[tuple[float, float]]:
-    key = query.strip().lower()
-    if not key:
-        return None
-    if key in cache:
-        v = cache[key]
-        if v.get("lat") is not None and v.get("lng") is not None:
-            return float(v["lat"]), float(v["lng"])
-        return None
-
-    last_err: Optional[str] = None
-    for attempt in range(3):
-        try:
-            time.sleep(RATE_LIMIT_SECS if attempt == 0 else 3.0 * attempt)
-            resp = requests.get(
-                NOMINATIM_URL,
-                params={
-                    "q": query, "format": "json", "limit": 1, "countrycodes": "co",
-                    "viewbox": f"{BOGOTA_BOUNDS[2]},{BOGOTA_BOUNDS[1]},{BOGOTA_BOUNDS[3]},{BOGOTA_BOUNDS[0]}",
-                    "bounded": 1,
-                },
-                headers={"User-Agent": USER_AGENT},
-                timeout=30,
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            if not data:
-                cache[key] = {"lat": None, "lng": None}
-                save_cache(cache)
-                return None
-            lat, lng = float(data[0]["lat"]), float(data[0]["lon"])
-            if not in_bogota(lat, lng):
-                print(f"  [warn] geocode fuera de Bogota descartado: {query} -> {lat},{lng}", flush=True)
-                cache[key] = {"lat": None, "lng": None}
-                save_cache(cache)
-                return None
-            cache[key] = {"lat": lat, "lng": lng, "display_name": data[0].get("display_name")}
-            save_cache(cache)
-            return lat, lng
-        except Exception as e:
-            last_err = str(e)[:200]
-            if attempt < 2:
-                print(f"  [warn] geocode retry {attempt+1}/3 '{query[:50]}': {last_err[:70]}", flush=True)
-                continue
-    print(f"  [fail] geocode definitivo '{query[:50]}': {last_err}", flush=True)
-    cache[key] = {"lat": None, "lng": None}
-    save_cache(cache)
-    return None
+def geocode_cascades(cascades: list[list[str]], cache: GeocodeCache) -> list:
+    """[(coords, indice) | (None, None)] por cascada. Cache y proveedores compartidos: ver geocoding_engine.py."""
+    return geocode_all(cascades, cache, bounds=BOGOTA_BOUNDS, user_agent=USER_AGENT)
 
 
 # ── Parsing helpers ────────────────────────────────────────────────────────────
@@ -473,14 +407,14 @@ def main() -> None:
     records = parse_rows(html)
     print(f"Parseados {len(records)} clubes.", flush=True)
 
-    cache = load_cache()
+    cache = GeocodeCache.open()
     print(f"Cache geocode: {len(cache)} entradas previas", flush=True)
 
     # Geocodificar SOLO localidades unicas (cacheado -> ~20 queries reales)
     localidades = sorted({r["localidad"] for r in records if r["localidad"]})
     loc_coords: dict[str, tuple[float, float]] = {}
-    for loc in localidades:
-        coords = geocode(f"{loc}, Bogotá, Colombia", cache)
+    results = geocode_cascades([[f"{loc}, Bogotá, Colombia"] for loc in localidades], cache)
+    for loc, (coords, _) in zip(localidades, results):
         if coords:
             loc_coords[loc] = coords
             print(f"  {loc:20} -> {coords[0]:.5f}, {coords[1]:.5f}", flush=True)
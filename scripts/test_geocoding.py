@@ -0,0 +1,193 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from geocoding import GeocodeCache  # noqa: E402
+from geocoding_engine import GeocodeEngine, Provider, TokenBucket, parse_providers  # noqa: E402
+
+BOGOTA_BOUNDS = (4.45, 4.85, -74.25, -73.95)
+PUBLIC = "https://nominatim.openstreetmap.org/search"
+SELF_HOSTED = "http://nominatim.test/search"
+
+# Lo que "sabe" el servidor falso: solo localidades y un par de parques
+PLACES = {
+    "usme, bogota, colombia": ("4.47", "-74.12"),
+    "suba, bogota, colombia": ("4.74", "-74.08"),
+    "parque timiza, bogota, colombia": ("4.61", "-74.15"),
+    "medellin, colombia": ("6.24", "-75.58"),
+}
+
+
+class FakeNominatim:
+    """Servidor /search falso para ambos hosts: registra cada request y puede fallar a pedido."""
+
+    def __init__(self):
+        self.requests = []
+        self.failures = {}  # query -> [status, ...] a devolver antes de contestar bien
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        query = request.url.params["q"]
+        self.requests.append((request.url.host, query, time.monotonic()))
+        assert request.headers["user-agent"] == "SportMaps-Test/1.0"
+        await asyncio.sleep(0.01)
+        pending = self.failures.get(query)
+        if pending:
+            return httpx.Response(pending.pop(0), headers={"Retry-After": "0"})
+        hit = PLACES.get(query.lower())
+        body = [{"lat": hit[0], "lon": hit[1], "display_name": query}] if hit else []
+        return httpx.Response(200, json=body)
+
+    def hosts(self, host):
+        return [r for r in self.requests if r[0] == host]
+
+
+class TestGeocodeCache(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.seed = self.tmp / ".geocode_cache.json"
+        self.seed.write_text(json.dumps({
+            "usme, bogota, colombia": {"lat": 4.47, "lng": -74.12, "display_name": "Usme"},
+            "calle falsa 123, bogota, colombia": {"lat": None, "lng": None},
+        }), encoding="utf-8")
+
+    def test_json_seed_is_migrated_once_and_never_overwrites(self):
+        with GeocodeCache(self.tmp / "c.sqlite", self.seed) as cache:
+            self.assertEqual((cache.migrated, len(cache), cache.resolved()), (2, 2, 1))
+            self.assertEqual(cache.get("  Usme, Bogota, Colombia ")["lat"], 4.47)
+            cache.put("calle falsa 123, bogota, colombia", 4.6, -74.1)
+        # Otro proceso abre la misma base: la semilla ya entro y no pisa lo nuevo
+        with GeocodeCache(self.tmp / "c.sqlite", self.seed) as other:
+            self.assertEqual(other.migrated, 0)
+            self.assertEqual(other.get("calle falsa 123, bogota, colombia")["lat"], 4.6)
+            self.assertIsNone(other.get("suba, bogota, colombia"))
+
+    def test_rate_slots_are_shared_between_connections(self):
+        first, second = GeocodeCache(self.tmp / "c.sqlite"), GeocodeCache(self.tmp / "c.sqlite")
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        self.assertAlmostEqual(first.reserve_slot("nominatim", 1.0), 0.0, places=1)
+        self.assertAlmostEqual(second.reserve_slot("nominatim", 1.0), 1.0, places=1)
+        self.assertAlmostEqual(first.reserve_slot("nominatim", 1.0), 2.0, places=1)
+        self.assertAlmostEqual(second.reserve_slot("propio", 1.0), 0.0, places=1)
+
+
+class TestProviders(unittest.TestCase):
+
+    def test_public_nominatim_policy_cannot_be_raised(self):
+        providers = parse_providers(f"public,propio={SELF_HOSTED}@20/4,otro={PUBLIC}@10/8")
+        self.assertEqual([(p.name, p.rate, p.concurrency) for p in providers],
+                         [("public", 1.0, 1), ("propio", 20.0, 4), ("otro", 1.0, 1)])
+        with self.assertRaises(ValueError):
+            parse_providers("propio")
+
+
+class TestTokenBucket(unittest.IsolatedAsyncioTestCase):
+
+    async def test_rate_and_pause(self):
+        bucket = TokenBucket(rate=50, burst=2)
+        started = time.monotonic()
+        for _ in range(7):
+            await bucket.acquire()
+        # 2 de rafaga + 5 a 50/s
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+        bucket.pause(0.2)
+        started = time.monotonic()
+        await bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.19)
+
+
+class TestGeocodeEngine(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache = GeocodeCache(Path(self.tmp.name) / "c.sqlite")
+        self.addCleanup(self.cache.close)
+        self.server = FakeNominatim()
+        self.transport = httpx.MockTransport(self.server.handler)
+
+    def engine(self, providers, **kwargs):
+        return GeocodeEngine(self.cache, providers, bounds=BOGOTA_BOUNDS, user_agent="SportMaps-Test/1.0",
+                             transport=self.transport, error_backoff=0.01, **kwargs)
+
+    async def test_cascades_fan_out_across_providers(self):
+        # 60 escuelas: escenario desconocido -> cae a la localidad, que comparten
+        cascades = [[f"Escenario {i}, Bogota, Colombia", f"{'Usme' if i % 2 else 'Suba'}, Bogota, Colombia"]
+                    for i in range(60)]
+        cascades.append(["Parque Timiza, Bogota, Colombia", "Usme, Bogota, Colombia"])
+        providers = [Provider("public", PUBLIC, 1.0), Provider("propio", SELF_HOSTED, 200, 4, burst=10)]
+        started = time.monotonic()
+        async with self.engine(providers) as engine:
+            results = await engine.resolve_all(cascades)
+            stats = engine.stats()
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(results[0], ((4.74, -74.08), 1))
+        self.assertEqual(results[1], ((4.47, -74.12), 1))
+        self.assertEqual(results[-1], ((4.61, -74.15), 0))
+        # Cada query viaja una sola vez, aunque 30 escuelas pidan la misma localidad
+        queries = [q for _, q, _ in self.server.requests]
+        self.assertEqual(len(queries), len(set(queries)))
+        self.assertEqual(len(queries), 63)
+        # El publico nunca pasa de 1 req/s; el propio hace el resto
+        public = self.server.hosts("nominatim.openstreetmap.org")
+        self.assertLessEqual(len(public), int(elapsed) + 1)
+        gaps = [b[2] - a[2] for a, b in zip(public, public[1:])]
+        self.assertTrue(all(gap >= 0.95 for gap in gaps))
+        self.assertLess(elapsed, 5)
+        self.assertEqual(stats["providers"]["propio"]["requests"] + stats["providers"]["public"]["requests"], 63)
+
+        # Segunda corrida: todo sale del cache
+        self.server.requests.clear()
+        async with self.engine(providers) as engine:
+            again = await engine.resolve_all(cascades)
+        self.assertEqual((again, self.server.requests), (results, []))
+
+    async def test_errors_are_retried_and_failures_not_persisted(self):
+        self.server.failures = {"Usme, Bogota, Colombia": [503, 429], "Suba, Bogota, Colombia": [500] * 3}
+        async with self.engine([Provider("propio", SELF_HOSTED, 100, 2)]) as engine:
+            usme, suba, lejos = await asyncio.gather(
+                engine.geocode("Usme, Bogota, Colombia"),
+                engine.geocode("Suba, Bogota, Colombia"),
+                engine.geocode("Medellin, Colombia"),
+            )
+            self.assertEqual(engine.stats()["failed"], 1)
+        self.assertEqual((usme, suba, lejos), ((4.47, -74.12), None, None))
+        # Fuera de Bogota se cachea como no encontrado; el fallo de red solo vale en esta corrida
+        self.assertEqual(self.cache.get("medellin, colombia"), {"lat": None, "lng": None})
+        with GeocodeCache(self.cache.path) as fresh:
+            self.assertIsNone(fresh.get("Suba, Bogota, Colombia"))
+
+    async def test_malformed_answers_fail_the_query_without_killing_workers(self):
+        # Un stand-in que contesta 200 con {"error": ...} o filas sin lat/lon
+        bodies = {"Usme, Bogota, Colombia": {"error": "Unable to geocode"},
+                  "Suba, Bogota, Colombia": [{"display_name": "sin coordenadas"}]}
+        transport = httpx.MockTransport(
+            lambda r: httpx.Response(200, json=bodies.get(r.url.params["q"], [{"lat": "4.61", "lon": "-74.15"}])))
+        engine = GeocodeEngine(self.cache, [Provider("local", SELF_HOSTED, 100)], bounds=BOGOTA_BOUNDS,
+                               user_agent="SportMaps-Test/1.0", transport=transport, error_backoff=0.01)
+        async with engine:
+            results = await asyncio.wait_for(engine.resolve_all([
+                ["Usme, Bogota, Colombia"], ["Suba, Bogota, Colombia"], ["Parque Timiza, Bogota, Colombia"],
+            ]), timeout=5)
+            self.assertEqual(engine.stats()["failed"], 2)
+        self.assertEqual(results, [(None, None), (None, None), ((4.61, -74.15), 0)])
+        # Como cualquier fallo transitorio, no queda cacheado como "no encontrado"
+        with GeocodeCache(self.cache.path) as fresh:
+            self.assertIsNone(fresh.get("Usme, Bogota, Colombia"))
+
+
+if __name__ == '__main__':
+    unittest.main()
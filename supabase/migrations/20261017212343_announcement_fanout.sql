@@ -0,0 +1,178 @@
+-- =============================================================================
+-- 20261017212343_announcement_fanout.sql
+-- Autor: agent   Fecha: 2026-10-17   Versión anterior: 20260819173354
+-- Objetivo: envío de anuncios por lotes en Postgres para
+--           POST /api/schools/{id}/announcements/{id}/publish (backend/).
+--           Sin esta migración `fan_out_announcement_chunk` no existe y el
+--           endpoint responde 503 siempre.
+-- =============================================================================
+-- Recordatorios (CLAUDE.md):
+--   · Inmutable: una vez commiteada no se edita ni se borra. Un fix va en una
+--     migración NUEVA con timestamp posterior.
+--   · Toda CREATE FUNCTION lleva SET search_path = pg_catalog, public, pg_temp.
+--   · GRANT EXECUTE explícito por RPC (SECURITY DEFINER no exime al caller).
+--   · Estados/enums en tablas nuevas: text + CHECK, no CREATE TYPE.
+--   · Policies de RLS: nunca SELECT sobre la misma tabla en el USING.
+-- =============================================================================
+--
+-- Escrita contra el modelo real (20260217000001 y siguientes), no contra
+-- database_schema.sql:
+--   · announcements: subject / message / audience IN ('parents','players','both')
+--     / team_id opcional / sent_at. No hay borradores: un anuncio cuenta como
+--     publicado cuando sent_at ya pasó.
+--   · Destinatarios = matrículas con status = 'active' de la escuela (del
+--     equipo, si el anuncio tiene team_id):
+--       parents → children.parent_id de las matrículas de menores (child_id)
+--       players → la cuenta del deportista: enrollments.user_id, o el
+--                 linked_profile_id de su ficha en unregistered_athletes
+--     Solo cuentas con fila en profiles (FK de notifications.user_id).
+--   · notifications: title / message / type / data. category queda NULL
+--     (la lista de 20260722000001 no tiene anuncios).
+--
+-- Locks: ADD COLUMN sin default es solo catálogo; el índice único parcial
+-- recorre notifications una vez bajo SHARE (bloquea escrituras mientras se
+-- construye, lecturas no). lock_timeout corta si hay alguien adelante.
+
+BEGIN;
+
+SET LOCAL lock_timeout = '5s';
+
+-- ─── 1. Una notificación por destinatario y anuncio ─────────────────────────
+-- El índice único hace que repetir un lote (reintento, doble clic en publicar)
+-- no notifique dos veces a nadie.
+ALTER TABLE public.notifications
+    ADD COLUMN IF NOT EXISTS announcement_id uuid REFERENCES public.announcements(id) ON DELETE CASCADE;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_announcement_user
+    ON public.notifications (announcement_id, user_id)
+    WHERE announcement_id IS NOT NULL;
+
+-- ─── 2. Progreso del envío ──────────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS public.announcement_fanouts (
+    announcement_id uuid        PRIMARY KEY REFERENCES public.announcements(id) ON DELETE CASCADE,
+    status          text        NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'done')),
+    recipients      integer     NOT NULL DEFAULT 0,  -- destinatarios recorridos
+    delivered       integer     NOT NULL DEFAULT 0,  -- notificaciones creadas (sin repetidas)
+    chunks          integer     NOT NULL DEFAULT 0,
+    last_recipient  uuid,                            -- cursor: el siguiente lote sigue después de este user_id
+    started_at      timestamptz NOT NULL DEFAULT now(),
+    updated_at      timestamptz NOT NULL DEFAULT now(),
+    finished_at     timestamptz
+);
+
+CREATE INDEX IF NOT EXISTS idx_announcement_fanouts_running
+    ON public.announcement_fanouts (updated_at) WHERE status = 'running';
+
+-- Solo el backend (service_role) la lee y la escribe: RLS sin policies
+ALTER TABLE public.announcement_fanouts ENABLE ROW LEVEL SECURITY;
+
+-- ─── 3. Destinatarios de un anuncio, sin repetidos ─────────────────────────
+CREATE OR REPLACE FUNCTION public.announcement_recipients(p_announcement_id uuid)
+RETURNS TABLE (user_id uuid)
+LANGUAGE sql
+STABLE
+SET search_path = pg_catalog, public, pg_temp
+AS $$
+    WITH members AS (
+        SELECT a.audience, e.child_id, e.user_id, e.unregistered_athlete_id
+        FROM public.announcements a
+        JOIN public.enrollments e
+          ON e.school_id = a.school_id
+         AND e.status = 'active'
+         AND (a.team_id IS NULL OR e.team_id = a.team_id)
+        WHERE a.id = p_announcement_id
+    ), accounts AS (
+        SELECT c.parent_id AS user_id
+        FROM members m
+        JOIN public.children c ON c.id = m.child_id
+        WHERE m.audience IN ('parents', 'both')
+        UNION
+        SELECT m.user_id
+        FROM members m
+        WHERE m.audience IN ('players', 'both') AND m.child_id IS NULL
+        UNION
+        SELECT u.linked_profile_id
+        FROM members m
+        JOIN public.unregistered_athletes u ON u.id = m.unregistered_athlete_id
+        WHERE m.audience IN ('players', 'both')
+    )
+    SELECT p.id
+    FROM accounts x
+    JOIN public.profiles p ON p.id = x.user_id;
+$$;
+
+-- ─── 4. Siguiente lote de un anuncio ────────────────────────────────────────
+-- Un INSERT ... SELECT de hasta p_limit notificaciones a partir del cursor. El
+-- FOR UPDATE sobre el progreso serializa lotes concurrentes del mismo anuncio.
+-- No devuelve filas si el anuncio no existe, no es de la escuela o todavía no
+-- se envía (sent_at en el futuro).
+CREATE OR REPLACE FUNCTION public.fan_out_announcement_chunk(p_school_id uuid, p_announcement_id uuid,
+                                                             p_limit integer DEFAULT 500)
+RETURNS SETOF public.announcement_fanouts
+LANGUAGE plpgsql
+SET search_path = pg_catalog, public, pg_temp
+AS $$
+DECLARE
+    v_progress public.announcement_fanouts;
+    v_scanned  integer;
+    v_created  integer;
+    v_last     uuid;
+BEGIN
+    PERFORM 1 FROM public.announcements
+    WHERE id = p_announcement_id AND school_id = p_school_id AND sent_at <= now();
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO public.announcement_fanouts (announcement_id) VALUES (p_announcement_id)
+    ON CONFLICT (announcement_id) DO NOTHING;
+    SELECT * INTO v_progress FROM public.announcement_fanouts
+    WHERE announcement_id = p_announcement_id FOR UPDATE;
+    IF v_progress.status = 'done' THEN
+        RETURN NEXT v_progress;
+        RETURN;
+    END IF;
+
+    WITH batch AS (
+        SELECT r.user_id
+        FROM public.announcement_recipients(p_announcement_id) r
+        WHERE v_progress.last_recipient IS NULL OR r.user_id > v_progress.last_recipient
+        ORDER BY r.user_id
+        LIMIT p_limit
+    ), created AS (
+        INSERT INTO public.notifications (user_id, school_id, announcement_id, type, title, message, data)
+        SELECT b.user_id, a.school_id, a.id, 'announcement', a.subject, a.message,
+               jsonb_build_object('announcement_id', a.id, 'school_id', a.school_id, 'team_id', a.team_id)
+        FROM batch b
+        JOIN public.announcements a ON a.id = p_announcement_id
+        ON CONFLICT (announcement_id, user_id) WHERE announcement_id IS NOT NULL DO NOTHING
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM batch), (SELECT count(*) FROM created),
+           (SELECT b.user_id FROM batch b ORDER BY b.user_id DESC LIMIT 1)
+    INTO v_scanned, v_created, v_last;
+
+    UPDATE public.announcement_fanouts
+    SET recipients     = recipients + v_scanned,
+        delivered      = delivered + v_created,
+        chunks         = chunks + 1,
+        last_recipient = COALESCE(v_last, last_recipient),
+        status         = CASE WHEN v_scanned < p_limit THEN 'done' ELSE 'running' END,
+        finished_at    = CASE WHEN v_scanned < p_limit THEN now() END,
+        updated_at     = now()
+    WHERE announcement_id = p_announcement_id
+    RETURNING * INTO v_progress;
+    RETURN NEXT v_progress;
+END;
+$$;
+
+-- Escriben notificaciones para toda una escuela y exponen sus cuentas: solo
+-- el backend con service_role, nunca anon/authenticated vía /rpc
+REVOKE ALL ON FUNCTION public.announcement_recipients(uuid) FROM PUBLIC, anon, authenticated;
+REVOKE ALL ON FUNCTION public.fan_out_announcement_chunk(uuid, uuid, integer) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.announcement_recipients(uuid) TO service_role;
+GRANT EXECUTE ON FUNCTION public.fan_out_announcement_chunk(uuid, uuid, integer) TO service_role;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,66 @@
+-- =============================================================================
+-- 20261017213359_backend_audit_log.sql
+-- Autor: agent   Fecha: 2026-10-17   Versión anterior: 20261017212343
+-- Objetivo: tabla audit_log donde el backend Python (backend/audit_log.py)
+--           registra eventos de seguridad de pagos: firmas Wompi bloqueadas y
+--           webhooks con checksum inválido. Solo existía en
+--           database_schema.sql, que no se aplica: cada lote fallaba y el
+--           writer lo descartaba tras sus reintentos.
+-- =============================================================================
+-- Recordatorios (CLAUDE.md):
+--   · Inmutable: una vez commiteada no se edita ni se borra. Un fix va en una
+--     migración NUEVA con timestamp posterior.
+--   · Toda CREATE FUNCTION lleva SET search_path = pg_catalog, public, pg_temp.
+--   · GRANT EXECUTE explícito por RPC (SECURITY DEFINER no exime al caller).
+--   · Estados/enums en tablas nuevas: text + CHECK, no CREATE TYPE.
+--   · Policies de RLS: nunca SELECT sobre la misma tabla en el USING.
+-- =============================================================================
+
+--
+-- Por qué no security_audit_log: su CHECK de action (20260415000001) ya no
+-- coincide con lo que escribe el BFF (order_create, refund_request, ...);
+-- reemplazarlo a ciegas puede romper esas escrituras. Tabla propia, con las
+-- columnas de database_schema.sql que ya usan data_access.py y sus tests.
+--
+-- school_id sin FK a propósito: una firma bloqueada puede nombrar un colegio
+-- que no existe, y una violación de FK tumbaría el lote entero (un INSERT
+-- multi-fila). Tabla nueva y vacía: sin riesgo de locks.
+
+BEGIN;
+
+SET LOCAL lock_timeout = '5s';
+
+CREATE TABLE IF NOT EXISTS public.audit_log (
+    id          uuid        PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id     uuid        REFERENCES public.profiles(id) ON DELETE SET NULL,
+    school_id   uuid,
+    action      text        NOT NULL CHECK (action IN ('wompi_signature_blocked', 'wompi_checksum_mismatch')),
+    entity_type text        NOT NULL,
+    entity_id   uuid,
+    old_values  jsonb,
+    new_values  jsonb,
+    metadata    jsonb,
+    ip_address  inet,
+    user_agent  text,
+    created_at  timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_audit_log_school_created
+    ON public.audit_log (school_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_audit_log_action_created
+    ON public.audit_log (action, created_at DESC);
+
+-- La escribe solo el backend (service_role); la lectura es de super_admin
+ALTER TABLE public.audit_log ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS audit_log_select_super_admin ON public.audit_log;
+CREATE POLICY audit_log_select_super_admin
+ON public.audit_log FOR SELECT TO authenticated
+USING (public.is_super_admin());
+
+REVOKE ALL ON public.audit_log FROM anon;
+REVOKE INSERT, UPDATE, DELETE ON public.audit_log FROM authenticated;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';